@@ -14,6 +14,8 @@ if not os.path.exists(_env_path) and os.path.exists(_env_example_path):
 class Settings(BaseSettings):
     # 数据库
     database_url: str = "sqlite+aiosqlite:///./data/gemini_proxy.db"
+    migrate_usage_logs: bool = False  # SQLite -> PostgreSQL 自动迁移时是否一并迁移使用日志
+    query_plan_check_strict: bool = False  # 热点查询未命中预期索引时拒绝启动（默认只在 /api/health 标记 degraded）
     
     # JWT
     secret_key: str = "your-super-secret-key-change-this"
@@ -97,6 +99,86 @@ class Settings(BaseSettings):
     # 日志保留
     log_retention_days: int = 7  # 日志保留天数（0=永久保留）
     
+    # 凭证批量上传
+    upload_concurrency: int = 20       # 上传时并发验证/获取 project_id 的凭证数
+    
+    # 后台任务（一键启动/一键检测等）
+    job_chunk_size: int = 200          # 每块处理的凭证数（每块结束写一次断点）
+    job_max_concurrency: int = 1       # 同类型任务最多同时运行数（超出的排队等待）
+    job_retention_hours: int = 24      # 已结束任务及其结果的保留时间
+    
+    # 生成图片的本地存储（static/images）
+    image_storage_max_mb: int = 1024          # 总大小上限，超出按最近使用顺序淘汰（0=不限）
+    image_storage_max_age_hours: int = 168    # 超过该时间未再生成的图片被清理（0=永久保留）
+    
+    # 假流式：等待上游完整响应期间的心跳间隔（秒）
+    fake_stream_heartbeat_interval: float = 2.0
+    
+    # SSE 写合并：窗口内到达的小 chunk 合并为一次发送（毫秒，0=关闭；首个 chunk 和 [DONE] 立即发送）
+    sse_coalesce_openai_ms: int = 15              # /v1/chat/completions（GeminiCLI）
+    sse_coalesce_gemini_ms: int = 15              # Gemini 原生 streamGenerateContent
+    sse_coalesce_antigravity_ms: int = 15         # Antigravity /v1/chat/completions
+    sse_coalesce_anthropic_ms: int = 15           # Anthropic 反代
+    sse_coalesce_openai_passthrough_ms: int = 0   # OpenAI API 原样转发
+    sse_coalesce_max_bytes: int = 16384           # 缓冲超过该字节数立即发送
+    
+    # 换凭证重试（重试次数见 error_retry_count）
+    failover_prewarm: bool = True                # 每次尝试进行时在后台预取下一个凭证和 token
+    failover_prewarm_delay_ms: int = 1000        # 首次尝试超过该时间仍未结束才开始预取（失败后的重试立即预取）
+    failover_backoff_base_ms: int = 200          # 换凭证重试前的退避基数（指数增长 + 随机抖动，0=立即重试）
+    failover_backoff_max_ms: int = 2000          # 单次退避上限
+    failover_retry_after_max_ms: int = 5000      # 上游给出的 Retry-After 不超过此值时，该模型所有重试都等到那之后
+    # 全局重试预算（所有代理路由共享）：重试次数不超过成功请求数的该比例，另有每秒保底
+    failover_retry_budget_percent: int = 20
+    failover_retry_budget_min_per_second: float = 1.0
+    failover_retry_budget_burst: int = 20        # 令牌上限（也是启动时的初始值）
+    
+    # 模型级配额耗尽熔断：窗口内多个凭证在同一模型上耗尽时，新请求直接返回 429
+    model_breaker_enabled: bool = True
+    model_breaker_window_seconds: int = 60            # 滑动窗口长度
+    model_breaker_min_credentials: int = 3            # 窗口内至少这么多个不同凭证耗尽
+    model_breaker_ratio_percent: int = 80             # 且耗尽占窗口内结果的比例不低于该值
+    model_breaker_min_open_seconds: int = 5           # 熔断时长取最早到期的凭证 CD，限制在该范围内
+    model_breaker_max_open_seconds: int = 300
+    model_breaker_probe_timeout_seconds: int = 60     # 探测请求多久没有结果就允许下一个探测
+    
+    # 凭证就绪排队：所有凭证都在 CD 时，请求排队等最早的凭证结束 CD，而不是照样用 CD 中的凭证
+    admission_wait_enabled: bool = True
+    admission_max_wait_ms: int = 10000           # 最长排队时间，等不到时按原逻辑选凭证
+    admission_order: str = "fair"               # fifo: 按到达顺序; fair: 优先最久没被叫到的用户
+    
+    # 共享池公平调度：full_shared / tier3_shared 模式下按用户加权公平分配公共池的并发名额
+    fair_share_enabled: bool = True
+    fair_share_capacity: int = 0                 # 同时进行中的公共池请求上限，0 = 活跃公共凭证数 × 下一项
+    fair_share_slots_per_credential: int = 2
+    fair_share_user_max_inflight: int = 4        # 每用户进行中上限（乘以权重，管理员豁免）
+    fair_share_contributor_weight: float = 2.0   # 贡献者权重（管理员可为单个用户设置 share_weight 覆盖）
+    fair_share_max_wait_ms: int = 30000          # 排队超过此时间返回 429
+    
+    # 凭证健康评分：按成功率 / 首字节耗时 / 输出速度的 EWMA 在不在 CD 中的凭证里二选一
+    credential_health_enabled: bool = True
+    credential_health_decay_seconds: int = 600   # 统计随时间回归全池平均的时间常数
+    credential_health_persist_seconds: int = 60  # 写回数据库的间隔
+    
+    # 凭证并发上限：同一凭证（或同一 project_id）同时进行中的上游调用数，按 account_type 区分，0 = 不限
+    credential_max_concurrency_pro: int = 8
+    credential_max_concurrency_free: int = 4
+    
+    # 对冲请求：非流式/假流式调用超过对冲延迟仍未返回时，换一个凭证再发一份，先成功的胜出
+    hedge_enabled: bool = False
+    hedge_percentile: float = 95                 # 对冲延迟取该模型最近成功耗时的分位数
+    hedge_min_delay_ms: int = 2000               # 对冲延迟下限
+    hedge_default_delay_ms: int = 30000          # 样本不足时的对冲延迟
+    hedge_budget_percent: int = 10               # 每个用户的对冲请求不超过其请求数的该比例
+    hedge_budget_burst: int = 2                  # 每个用户最多可攒的对冲次数
+    
+    # 模型列表缓存（/v1/models、/v1beta/models）
+    model_catalog_ttl_seconds: int = 600              # 上游动态模型列表过期后在后台刷新
+    model_catalog_membership_ttl_seconds: int = 30    # 用户凭证池可见性快照的有效期
+    
+    # 用户权益快照（凭证数 / 配额上限 / RPM 档位）缓存，凭证或配置变化时主动失效，这里只是兜底有效期，0 = 不缓存
+    entitlement_cache_ttl_seconds: int = 300
+    
     # 公告
     announcement_enabled: bool = False
     announcement_title: str = ""
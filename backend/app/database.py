@@ -41,6 +41,39 @@ async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit
 
 Base = declarative_base()
 
+# 热点查询的复合部分索引（只索引 is_active 的凭证）
+# - idx_credentials_owner_active: check_user_has_public_creds（user_id, api_type, is_public 定位）、
+#   check_user_has_tier3_creds、权益快照的按用户凭证分组统计（user_id 前缀，索引内含 model_tier）
+# - idx_credentials_owner_select: 凭证选择中“自己的凭证”那条查询（user_id, api_type 定位，按 last_used_at 顺序读出）
+# - idx_credentials_public_select: 凭证选择中“公开凭证”那条查询（api_type, is_public 定位，按 last_used_at 顺序读出）
+# 凭证选择拆成两条查询见 CredentialPool.build_selection_queries；index_advisor 启动时检查各查询命中的是哪个索引。
+# 部分索引的 WHERE 必须与查询编译出的布尔字面量一致（SQLite 为 1，PostgreSQL 为 true）
+HOT_QUERY_INDEXES = {
+    "idx_credentials_owner_active": ("credentials", ["user_id", "api_type", "is_public", "model_tier"]),
+    "idx_credentials_owner_select": ("credentials", ["user_id", "api_type", "last_used_at"]),
+    "idx_credentials_public_select": ("credentials", ["api_type", "is_public", "last_used_at"]),
+}
+
+# 列定义变了的旧索引（同名 CREATE INDEX IF NOT EXISTS 不会更新，先删掉）
+OBSOLETE_HOT_QUERY_INDEXES = ["idx_credentials_pool_select"]
+
+
+def hot_query_index_statements() -> list:
+    """生成当前数据库方言的热点查询索引 DDL"""
+    true_literal = "1" if is_sqlite else "true"
+    statements = [f"DROP INDEX IF EXISTS {name}" for name in OBSOLETE_HOT_QUERY_INDEXES]
+    for name, (table, columns) in HOT_QUERY_INDEXES.items():
+        # PostgreSQL 的排序列与 ORDER BY ... NULLS FIRST 保持一致
+        cols = [
+            f"{col} NULLS FIRST" if col == "last_used_at" and not is_sqlite else col
+            for col in columns
+        ]
+        statements.append(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table}({', '.join(cols)}) WHERE is_active = {true_literal}"
+        )
+    return statements
+
+
 async def get_db():
     async with async_session() as session:
         yield session
@@ -110,13 +143,18 @@ async def init_db(skip_migration_check: bool = False):
                 "ALTER TABLE credentials ADD COLUMN credential_type VARCHAR(20) DEFAULT 'oauth'",
                 "ALTER TABLE credentials ADD COLUMN model_tier VARCHAR(20)",
                 "ALTER TABLE credentials ADD COLUMN model_cooldowns TEXT",
+                "ALTER TABLE credentials ADD COLUMN health_stats TEXT",
                 # Antigravity 用户配额
                 "ALTER TABLE users ADD COLUMN quota_antigravity INTEGER DEFAULT 100",
                 "ALTER TABLE users ADD COLUMN used_antigravity INTEGER DEFAULT 0",
+                # 共享池公平调度权重
+                "ALTER TABLE users ADD COLUMN share_weight FLOAT DEFAULT 0",
                 # 凭证备注
                 "ALTER TABLE credentials ADD COLUMN note VARCHAR(500)",
                 # 重试次数统计
                 "ALTER TABLE usage_logs ADD COLUMN retry_count INTEGER DEFAULT 0",
+                # refresh_token 指纹（上传去重）
+                "ALTER TABLE credentials ADD COLUMN token_fingerprint VARCHAR(64)",
             ]
         else:
             # PostgreSQL 迁移（使用 IF NOT EXISTS 语法）
@@ -146,13 +184,18 @@ async def init_db(skip_migration_check: bool = False):
                 "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS credential_type VARCHAR(20) DEFAULT 'oauth'",
                 "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS model_tier VARCHAR(20)",
                 "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS model_cooldowns TEXT",
+                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS health_stats TEXT",
                 # Antigravity 用户配额
                 "ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_antigravity INTEGER DEFAULT 100",
                 "ALTER TABLE users ADD COLUMN IF NOT EXISTS used_antigravity INTEGER DEFAULT 0",
+                # 共享池公平调度权重
+                "ALTER TABLE users ADD COLUMN IF NOT EXISTS share_weight FLOAT DEFAULT 0",
                 # 凭证备注
                 "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS note VARCHAR(500)",
                 # 重试次数统计
                 "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS retry_count INTEGER DEFAULT 0",
+                # refresh_token 指纹（上传去重）
+                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS token_fingerprint VARCHAR(64)",
             ]
         
         for sql in migrations:
@@ -178,7 +221,10 @@ async def init_db(skip_migration_check: bool = False):
             "CREATE INDEX IF NOT EXISTS idx_usage_logs_date_error ON usage_logs(created_at, error_type)",
             # Antigravity 索引（新增）
             "CREATE INDEX IF NOT EXISTS idx_credentials_api_type ON credentials(api_type)",
+            "CREATE INDEX IF NOT EXISTS idx_credentials_token_fingerprint ON credentials(token_fingerprint)",
         ]
+        # 凭证选择/配额检查的复合部分索引
+        indexes.extend(hot_query_index_statements())
         
         for sql in indexes:
             try:
@@ -14,6 +14,7 @@ from app.routers.test import router as test_router
 from app.routers import antigravity_proxy, antigravity_manage, antigravity_oauth
 from app.routers import anthropic_manage, anthropic_proxy as anthropic_proxy_router
 from app.middleware.url_normalize import URLNormalizeMiddleware
+from app.middleware.fair_share import FairShareMiddleware
 from sqlalchemy import select
 
 
@@ -45,6 +46,15 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"⚠️ 数据库迁移检查失败: {e}")
     
+    # 热点查询执行计划自检（默认只在 /api/health 标记 degraded，query_plan_check_strict 时阻止启动）
+    from app.services.index_advisor import check_hot_query_plans, QueryPlanCheckFailed
+    try:
+        await check_hot_query_plans()
+    except QueryPlanCheckFailed:
+        raise
+    except Exception as e:
+        print(f"⚠️ 热点查询执行计划检查失败: {e}")
+    
     # 从数据库加载持久化配置
     try:
         await load_config_from_db()
@@ -52,6 +62,43 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"⚠️ 加载配置失败: {e}")
     
+    # 加载凭证按模型的 429 冷却（重启后继续生效）
+    try:
+        from app.services.model_cooldowns import model_cooldowns
+        async with async_session() as db:
+            loaded = await model_cooldowns.load(db)
+        if loaded:
+            print(f"✅ 已加载 {loaded} 个凭证的模型冷却")
+    except Exception as e:
+        print(f"⚠️ 加载模型冷却失败: {e}")
+    
+    # 加载凭证健康评分
+    from app.services.credential_health import credential_health
+    try:
+        async with async_session() as db:
+            loaded = await credential_health.load(db)
+        if loaded:
+            print(f"✅ 已加载 {loaded} 个凭证的健康统计")
+    except Exception as e:
+        print(f"⚠️ 加载凭证健康统计失败: {e}")
+    
+    # 为旧凭证补齐 refresh_token 指纹（上传去重用）
+    try:
+        from app.services.credential_upload import backfill_fingerprints
+        filled = await backfill_fingerprints()
+        if filled:
+            print(f"✅ 已为 {filled} 个旧凭证补齐指纹")
+    except Exception as e:
+        print(f"⚠️ 补齐凭证指纹失败: {e}")
+    
+    # 用户权益快照：凭证 / 用户配额字段变化后自动失效
+    from app.services.entitlements import entitlements
+    entitlements.install()
+    
+    # 按模型的 429 冷却：删除凭证时清掉对应条目
+    from app.services.model_cooldowns import model_cooldowns
+    model_cooldowns.install()
+    
     # 创建或更新管理员账号，确保只有配置的用户名是管理员
     async with async_session() as db:
         # 先把其他管理员降级为普通用户
@@ -97,6 +144,9 @@ async def lifespan(app: FastAPI):
                         await db.commit()
                         if deleted_count > 0:
                             print(f"🗑️ 自动清理了 {deleted_count} 条过期日志（{retention_days}天前）")
+                # 清理已结束的过期后台任务
+                from app.services.jobs import job_manager
+                await job_manager.prune()
             except Exception as e:
                 print(f"⚠️ 日志清理失败: {e}")
             
@@ -107,14 +157,52 @@ async def lifespan(app: FastAPI):
     cleanup_task = asyncio.create_task(cleanup_old_logs())
     print("✅ 已启动日志自动清理任务")
     
+    # 定期把凭证健康统计写回数据库
+    async def persist_credential_health():
+        while True:
+            await asyncio.sleep(max(5, settings.credential_health_persist_seconds))
+            try:
+                async with async_session() as db:
+                    await credential_health.persist(db)
+            except Exception as e:
+                print(f"⚠️ 保存凭证健康统计失败: {e}")
+    
+    health_task = asyncio.create_task(persist_credential_health())
+    
+    # 后台任务：清理过期任务，接管上次未完成的任务（从断点继续）
+    from app.services.jobs import job_manager
+    try:
+        pruned = await job_manager.prune()
+        if pruned:
+            print(f"🗑️ 清理了 {pruned} 个过期后台任务")
+        await job_manager.resume_orphaned()
+    except Exception as e:
+        print(f"⚠️ 恢复后台任务失败: {e}")
+    
+    # 预热上游模型列表，第一次 /v1/models 就能拿到动态列表
+    from app.services.model_catalog import model_catalog
+    model_catalog.schedule_refresh("antigravity")
+    
     yield
     
+    # 关闭时把运行中的后台任务放回队列，重启后继续
+    await job_manager.shutdown()
+    
     # 关闭时取消后台任务
     cleanup_task.cancel()
+    health_task.cancel()
+    for task in (cleanup_task, health_task):
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    
+    # 关闭前保存最后一次凭证健康统计
     try:
-        await cleanup_task
-    except asyncio.CancelledError:
-        pass
+        async with async_session() as db:
+            await credential_health.persist(db)
+    except Exception as e:
+        print(f"⚠️ 保存凭证健康统计失败: {e}")
 
 
 app = FastAPI(
@@ -133,6 +221,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 共享池名额释放（流式响应结束后才释放，见 services/fair_share.py）
+app.add_middleware(FairShareMiddleware)
+
 # URL 规范化中间件（防呆设计：处理用户错误添加的 URL 前缀）
 # 注意：ASGI 中间件的执行顺序是后添加先执行，所以这个中间件会在 CORS 之后执行
 app.add_middleware(URLNormalizeMiddleware)
@@ -155,7 +246,10 @@ app.include_router(anthropic_manage.router)  # Anthropic 凭证管理
 
 @app.get("/api/health")
 async def health():
-    return {"status": "ok", "service": "Catiecli"}
+    from app.services.index_advisor import last_check
+    query_plans = last_check()
+    status = "ok" if query_plans is None or query_plans["ok"] else "degraded"
+    return {"status": status, "service": "Catiecli", "checks": {"query_plans": query_plans}}
 
 
 @app.get("/api/public/stats")
@@ -216,10 +310,9 @@ frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static
 if os.path.exists(frontend_path):
     app.mount("/assets", StaticFiles(directory=os.path.join(frontend_path, "assets")), name="assets")
     
-    # 图片存储目录
-    images_path = os.path.join(frontend_path, "images")
-    os.makedirs(images_path, exist_ok=True)
-    app.mount("/images", StaticFiles(directory=images_path), name="images")
+    # 图片存储目录（文件名为内容哈希，附带长期缓存头）
+    from app.services.image_storage import ImageStorage
+    app.mount("/images", ImageStorage.static_files(), name="images")
     
     @app.get("/{full_path:path}")
     async def serve_frontend(full_path: str):
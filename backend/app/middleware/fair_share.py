@@ -0,0 +1,34 @@
+"""
+共享池名额释放中间件
+
+路由通过 fair_share.admit() 领取的名额挂在 request.state.fair_share_slot 上；
+流式响应要等生成器跑完才算结束，所以在这里（整个响应发送完或客户端断开之后）统一释放。
+"""
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+class FairShareMiddleware:
+    """
+    ASGI 中间件：请求结束时释放共享池名额
+
+    使用方式：
+        from app.middleware.fair_share import FairShareMiddleware
+        app.add_middleware(FairShareMiddleware)
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # 先建好 state 字典，路由里的 request.state 和这里看到的是同一个
+        state = scope.setdefault("state", {})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            slot = state.get("fair_share_slot")
+            if slot is not None:
+                slot.release()
@@ -3,6 +3,9 @@
 当检测到 PostgreSQL 配置且存在 SQLite 数据库文件时自动执行
 """
 import os
+import json
+import asyncio
+import hashlib
 from datetime import datetime
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine
@@ -11,16 +14,36 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# 校验和取 64 位（各行摘要求和后截断）
+CHECKSUM_MASK = (1 << 64) - 1
+
+# 需要过滤孤儿外键的表 -> 它引用的（已先迁移的）表
+FK_DEPENDENCIES = {
+    "usage_logs": ("users", "api_keys", "credentials"),
+    "background_jobs": ("users",),
+    "background_job_results": ("background_jobs",),
+}
+
 
 class DatabaseMigrator:
-    def __init__(self, sqlite_path: str, postgres_engine):
+    def __init__(self, sqlite_path: str, postgres_engine, include_logs: bool = False):
         """
         初始化迁移器
         :param sqlite_path: SQLite 数据库文件路径（例如: ./data/gemini_proxy.db）
         :param postgres_engine: PostgreSQL 引擎（复用主应用的连接池）
+        :param include_logs: 是否迁移 usage_logs（数据量大，默认跳过）
         """
         self.sqlite_path = sqlite_path
         self.postgres_engine = postgres_engine
+        self.include_logs = include_logs
+
+        # 断点文件：记录每个表的迁移状态、行数、校验和、待重建的索引
+        self.checkpoint_path = f"{sqlite_path}.migrate.json"
+        self.checkpoint = self._load_checkpoint()
+        self._checkpoint_lock = asyncio.Lock()
+
+        # 外键过滤用的 ID 集合（表名 -> ID 集合）
+        self._fk_ids = {}
 
         # 构建 SQLite 异步连接 URL
         sqlite_url = f"sqlite+aiosqlite:///{sqlite_path}"
@@ -86,6 +109,8 @@ class DatabaseMigrator:
             "users": ["is_active", "is_admin"],
             "api_keys": ["is_active"],
             "credentials": ["is_public", "is_active"],
+            "error_message_configs": ["is_active"],
+            "background_jobs": ["cancel_requested"],
         }
 
         # 转换布尔字段：SQLite 的 0/1 -> PostgreSQL 的 False/True
@@ -102,6 +127,9 @@ class DatabaseMigrator:
             "credentials": ["created_at", "last_used_at", "last_used_flash", "last_used_pro", "last_used_30"],
             "usage_logs": ["created_at"],
             "system_config": ["updated_at"],
+            "error_message_configs": ["created_at", "updated_at"],
+            "background_jobs": ["heartbeat_at", "created_at", "updated_at", "finished_at"],
+            "background_job_results": ["created_at"],
         }
 
         # 转换日期时间字段：SQLite 的字符串 -> PostgreSQL 的 datetime
@@ -193,72 +221,272 @@ class DatabaseMigrator:
 
         return data
 
+    # ===== 断点续传 =====
+
+    def _load_checkpoint(self) -> dict:
+        """读取迁移断点文件（不存在或损坏时返回空断点）"""
+        if not os.path.exists(self.checkpoint_path):
+            return {"tables": {}}
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            checkpoint.setdefault("tables", {})
+            return checkpoint
+        except Exception as e:
+            logger.warning(f"读取迁移断点失败，将从头迁移: {e}")
+            return {"tables": {}}
+
+    async def _save_checkpoint(self):
+        """原子写入迁移断点（并行迁移的多个表共用一个文件，需要加锁）"""
+        async with self._checkpoint_lock:
+            tmp_path = f"{self.checkpoint_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.checkpoint, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.checkpoint_path)
+
+    def _table_state(self, table_name: str) -> dict:
+        """获取单个表的断点状态"""
+        return self.checkpoint["tables"].setdefault(table_name, {})
+
+    def is_resuming(self) -> bool:
+        """是否存在上次未完成的迁移"""
+        return bool(self.checkpoint["tables"])
+
+    # ===== 校验和 =====
+
+    @staticmethod
+    def _canonical_value(value) -> str:
+        """把字段值规范化为字符串，保证 SQLite 转换后的值与 PostgreSQL 读回的值一致"""
+        if value is None:
+            return "\x00"
+        if isinstance(value, bool):
+            return "1" if value else "0"
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, float):
+            # REAL 列里的整数值（如 latency_ms=0）两边可能分别读成 0 / 0.0
+            return str(int(value)) if value.is_integer() else repr(value)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value).hex()
+        return str(value)
+
+    @classmethod
+    def _row_digest(cls, values) -> int:
+        """单行摘要（取 md5 前 8 字节）"""
+        raw = "\x1f".join(cls._canonical_value(v) for v in values)
+        return int.from_bytes(hashlib.md5(raw.encode("utf-8", errors="surrogatepass")).digest()[:8], "big")
+
+    async def table_checksum(self, table_name: str) -> tuple[int, str]:
+        """
+        计算 PostgreSQL 表的行数和校验和
+        校验和是各行摘要之和（与行顺序无关），无需 ORDER BY 即可与导入时的结果比对
+        """
+        total_rows = 0
+        checksum = 0
+        async with self.postgres_engine.connect() as pg_conn:
+            result = await pg_conn.stream(text(f"SELECT * FROM {table_name}"))
+            async for partition in result.partitions(10000):
+                for row in partition:
+                    checksum = (checksum + self._row_digest(tuple(row))) & CHECKSUM_MASK
+                    total_rows += 1
+        return total_rows, f"{checksum:016x}"
+
+    # ===== 索引延迟创建 =====
+
+    async def _drop_secondary_indexes(self, table_name: str) -> list:
+        """
+        导入前删除二级索引（主键/唯一约束保留），返回索引定义用于导入后重建
+        """
+        async with self.postgres_engine.begin() as pg_conn:
+            result = await pg_conn.execute(text(
+                "SELECT i.indexname, i.indexdef FROM pg_indexes i "
+                "WHERE i.schemaname = current_schema() AND i.tablename = :table "
+                "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname)"
+            ), {"table": table_name})
+            indexes = [{"name": row[0], "sql": row[1]} for row in result.fetchall()]
+            for index in indexes:
+                await pg_conn.exec_driver_sql(f'DROP INDEX IF EXISTS "{index["name"]}"')
+
+        if indexes:
+            logger.info(f"  {table_name}: 已暂时删除 {len(indexes)} 个索引，导入完成后重建")
+        return indexes
+
+    async def _restore_indexes(self, table_name: str, indexes: list):
+        """导入完成后重建索引"""
+        if not indexes:
+            return
+        async with self.postgres_engine.begin() as pg_conn:
+            for index in indexes:
+                sql = index["sql"]
+                sql = sql.replace("CREATE UNIQUE INDEX ", "CREATE UNIQUE INDEX IF NOT EXISTS ", 1)
+                sql = sql.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", 1)
+                await pg_conn.exec_driver_sql(sql)
+        logger.info(f"  ✓ {table_name}: 已重建 {len(indexes)} 个索引")
+
+    # ===== 数据导入 =====
+
+    async def _clear_partial_tables(self, tables):
+        """
+        清空上次中断或校验失败、需要重新导入的表（断点里 started 但未 done）
+        在导入任何表之前一次性 TRUNCATE：父表被子表的外键引用时，单独 TRUNCATE 会被拒绝，
+        逐表 DELETE 又会违反仍有数据的子表的外键。引用它们的已迁移表在校验失败时已一并重置
+        （见 verify_migration），CASCADE 只会额外清到未迁移的空表
+        """
+        partial = [
+            table for table in tables
+            if self._table_state(table).get("started") and not self._table_state(table).get("done")
+        ]
+        if not partial:
+            return
+        async with self.postgres_engine.begin() as pg_conn:
+            await pg_conn.execute(text(f"TRUNCATE TABLE {', '.join(partial)} CASCADE"))
+        for table in partial:
+            self._table_state(table)["started"] = False
+        await self._save_checkpoint()
+        logger.info(f"  已清空上次未完成的表: {', '.join(partial)}，将重新导入")
+
+    @staticmethod
+    def _with_dependents(tables, candidates) -> list:
+        """tables 加上 candidates 中（直接或间接）通过外键引用它们的表"""
+        from app.database import Base
+
+        result = set(tables)
+        changed = True
+        while changed:
+            changed = False
+            for name in candidates:
+                table = Base.metadata.tables.get(name)
+                if name in result or table is None:
+                    continue
+                if any(fk.target_fullname.split(".")[0] in result for fk in table.foreign_keys):
+                    result.add(name)
+                    changed = True
+        return [name for name in candidates if name in result]
+
+    async def _sqlite_table_exists(self, table_name: str) -> bool:
+        """检查 SQLite 中是否存在该表（旧版本数据库可能没有新加的表）"""
+        async with self.sqlite_engine.connect() as sqlite_conn:
+            result = await sqlite_conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name=:table"
+            ), {"table": table_name})
+            return result.scalar() is not None
+
+    async def _load_fk_ids(self, tables):
+        """
+        加载已迁移表的 ID 集合，用于过滤孤儿外键（见 FK_DEPENDENCIES）
+        SQLite 默认不强制外键，直接 COPY 会因外键约束失败
+        """
+        for table in tables:
+            if table in self._fk_ids:
+                continue
+            async with self.postgres_engine.connect() as pg_conn:
+                result = await pg_conn.execute(text(f"SELECT id FROM {table}"))
+                self._fk_ids[table] = {row[0] for row in result.fetchall()}
+
+    def _fix_foreign_keys(self, table_name: str, data: dict) -> bool:
+        """修正孤儿外键，返回 False 表示该行无法导入需要跳过"""
+        if table_name == "background_jobs":
+            if data.get("created_by") is not None and data["created_by"] not in self._fk_ids["users"]:
+                data["created_by"] = None
+            return True
+        if table_name == "background_job_results":
+            return data.get("job_id") in self._fk_ids["background_jobs"]
+        if table_name != "usage_logs":
+            return True
+        if data.get("user_id") not in self._fk_ids["users"]:
+            return False
+        if data.get("api_key_id") is not None and data["api_key_id"] not in self._fk_ids["api_keys"]:
+            data["api_key_id"] = None
+        if data.get("credential_id") is not None and data["credential_id"] not in self._fk_ids["credentials"]:
+            data["credential_id"] = None
+        return True
+
     async def migrate_table(self, table_name: str, batch_size: int = 10000):
         """
-        迁移单个表的数据
+        使用 asyncpg 二进制 COPY 协议迁移单个表
         :param table_name: 表名
-        :param batch_size: 批量处理大小
+        :param batch_size: 每次从 SQLite 读取的行数
+
+        流程：删除二级索引 -> COPY 导入（同时计算源数据校验和）-> 重置序列 -> 重建索引
+        断点以表为单位：中断时未完成的表会被清空后整表重新导入
         """
+        state = self._table_state(table_name)
+        if state.get("done"):
+            logger.info(f"  ↷ {table_name}: 断点记录显示已完成，跳过")
+            return
+
         logger.info(f"开始迁移表: {table_name}")
 
         try:
+            if not await self._sqlite_table_exists(table_name):
+                logger.info(f"  ✓ {table_name}: SQLite 中不存在该表，跳过")
+                state.update({"done": True, "rows": 0, "skipped": 0, "checksum": f"{0:016x}"})
+                await self._save_checkpoint()
+                return
+
             # 获取 SQLite 表的列名
-            async with self.sqlite_engine.begin() as sqlite_conn:
+            async with self.sqlite_engine.connect() as sqlite_conn:
                 result = await sqlite_conn.execute(text(f"SELECT * FROM {table_name} LIMIT 0"))
                 sqlite_columns = list(result.keys())
 
             # 获取 PostgreSQL 表的列名和顺序
-            async with self.postgres_engine.begin() as pg_conn:
+            async with self.postgres_engine.connect() as pg_conn:
                 result = await pg_conn.execute(text(f"SELECT * FROM {table_name} LIMIT 0"))
                 pg_columns = list(result.keys())
 
-            # 构建插入语句（在循环外构建一次）
-            columns_str = ", ".join(pg_columns)
-            placeholders = ", ".join([f":{col}" for col in pg_columns])
-            insert_sql = f"INSERT INTO {table_name} ({columns_str}) VALUES ({placeholders})"
-
-            # 对于可能有唯一约束冲突的表，使用 ON CONFLICT DO NOTHING
-            if table_name in ["users", "api_keys", "credentials"]:
-                insert_sql += " ON CONFLICT (id) DO NOTHING"
-
-            # 使用批量插入
-            async with self.sqlite_engine.connect() as sqlite_conn:
-                # 使用流式游标
-                result = await sqlite_conn.stream(text(f"SELECT * FROM {table_name}"))
-
-                total_rows = 0
-                truncation_stats = {}  # 统计截断次数
-
-                # 使用单个事务处理多个批次，减少事务开销
-                async with self.postgres_engine.begin() as pg_conn:
-                    # 流式处理数据
+            # 延迟创建索引（init_db 可能在重启时重新建了索引，所以每次都要检查并合并）
+            dropped = await self._drop_secondary_indexes(table_name)
+            known = {index["name"] for index in state.get("indexes", [])}
+            state["indexes"] = state.get("indexes", []) + [i for i in dropped if i["name"] not in known]
+            state["started"] = True
+            await self._save_checkpoint()
+
+            if table_name in FK_DEPENDENCIES:
+                await self._load_fk_ids(FK_DEPENDENCIES[table_name])
+
+            total_rows = 0
+            skipped_rows = 0
+            checksum = 0
+            truncation_stats = {}  # 统计截断次数
+
+            async def records():
+                """流式读取 SQLite 并转换为 PostgreSQL 列顺序的元组"""
+                nonlocal total_rows, skipped_rows, checksum
+                async with self.sqlite_engine.connect() as sqlite_conn:
+                    result = await sqlite_conn.stream(text(f"SELECT * FROM {table_name}"))
                     async for partition in result.partitions(batch_size):
-                        batch_data = []
                         for row in partition:
                             # 转换数据类型（使用 SQLite 的列顺序读取）
                             row_dict = dict(zip(sqlite_columns, row))
                             converted = self.convert_sqlite_to_postgres_types(table_name, row_dict, truncation_stats)
+                            if not self._fix_foreign_keys(table_name, converted):
+                                skipped_rows += 1
+                                continue
 
                             # 重新排序数据以匹配 PostgreSQL 的列顺序
-                            reordered = {col: converted.get(col) for col in pg_columns}
-                            batch_data.append(reordered)
+                            values = tuple(converted.get(col) for col in pg_columns)
+                            checksum = (checksum + self._row_digest(values)) & CHECKSUM_MASK
                             total_rows += 1
-
-                        # 批量插入到 PostgreSQL（复用已有的事务）
-                        if batch_data:
-                            await pg_conn.execute(text(insert_sql), batch_data)
-                            logger.info(f"  已处理 {total_rows} 条记录")
-
-                if total_rows == 0:
-                    logger.info(f"  ✓ {table_name}: 无数据，跳过")
-                    return
-
-                logger.info(f"  ✓ 共迁移 {total_rows} 条记录")
-                if truncation_stats:
-                    logger.info(f"  ⚠ 字段截断统计: {', '.join([f'{k}({v}条)' for k, v in truncation_stats.items()])}")
-
-            # 重置自增序列（PostgreSQL 特有）
-            if "id" in pg_columns:
+                            yield values
+                        logger.info(f"  {table_name}: 已处理 {total_rows} 条记录")
+
+            # 整表一次 COPY，单个事务内完成
+            async with self.postgres_engine.connect() as pg_conn:
+                raw_conn = await pg_conn.get_raw_connection()
+                asyncpg_conn = raw_conn.driver_connection
+                async with asyncpg_conn.transaction():
+                    await asyncpg_conn.copy_records_to_table(
+                        table_name, records=records(), columns=pg_columns
+                    )
+
+            logger.info(f"  ✓ {table_name}: 共迁移 {total_rows} 条记录")
+            if skipped_rows:
+                logger.info(f"  ⚠ {table_name}: 跳过 {skipped_rows} 条外键失效的记录")
+            if truncation_stats:
+                logger.info(f"  ⚠ 字段截断统计: {', '.join([f'{k}({v}条)' for k, v in truncation_stats.items()])}")
+
+            # 重置自增序列（PostgreSQL 特有；background_jobs 的 id 是字符串，没有序列）
+            if "id" in pg_columns and total_rows > 0 and table_name != "background_jobs":
                 async with self.postgres_engine.begin() as pg_conn:
                     try:
                         # 获取当前最大 ID
@@ -273,6 +501,16 @@ class DatabaseMigrator:
                     except Exception as e:
                         logger.warning(f"  ! 序列重置失败（可能不影响使用）: {e}")
 
+            await self._restore_indexes(table_name, state["indexes"])
+
+            state.update({
+                "done": True,
+                "rows": total_rows,
+                "skipped": skipped_rows,
+                "checksum": f"{checksum:016x}",
+                "indexes": [],
+            })
+            await self._save_checkpoint()
             logger.info(f"  ✓ {table_name}: 迁移完成")
 
         except Exception as e:
@@ -282,22 +520,28 @@ class DatabaseMigrator:
     async def get_table_order(self) -> dict:
         """
         获取表的正确迁移顺序（按外键依赖）
-        返回分组的表名列表，同组的表可以并行迁移
+        返回分组的表名列表，同组的表之间没有外键依赖，会并行迁移
 
-        注意：只迁移核心数据（用户、凭证、配置），跳过日志
+        注意：默认只迁移核心数据（用户、凭证、配置、后台任务），日志需开启 migrate_usage_logs
         """
-        # 按依赖关系分组 - 只迁移必要的表
-        return {
-            "group_1": ["users", "system_config"],  # 核心：用户数据和系统配置
-            "group_2": ["api_keys", "credentials"],  # 核心：用户的 API 密钥和凭证
-            # 跳过：usage_logs（日志数据量大，不影响功能，新系统会重新记录）
+        # 按依赖关系分组
+        groups = {
+            "group_1": ["users", "system_config", "error_message_configs"],  # 核心：用户数据和系统配置
+            "group_2": ["api_keys", "credentials", "background_jobs"],  # 核心：用户的 API 密钥和凭证，后台任务
+            "group_3": ["background_job_results"],  # 任务结果依赖 background_jobs
         }
+        if self.include_logs:
+            groups["group_3"].append("usage_logs")  # 日志依赖 users/api_keys/credentials
+        return groups
 
     async def migrate_all(self):
         """执行迁移流程"""
         logger.info("=" * 60)
         logger.info("开始数据库迁移：SQLite -> PostgreSQL")
-        logger.info("迁移范围：用户、API密钥、凭证、配置（跳过日志）")
+        if self.include_logs:
+            logger.info("迁移范围：用户、API密钥、凭证、配置、日志")
+        else:
+            logger.info("迁移范围：用户、API密钥、凭证、配置（跳过日志）")
         logger.info("=" * 60)
 
         try:
@@ -309,13 +553,17 @@ class DatabaseMigrator:
                 return False
             logger.info("  ✓ SQLite 数据库包含数据")
 
-            # 2. 检查 PostgreSQL 是否为空
+            # 2. 检查 PostgreSQL 是否为空（有断点时继续上次的迁移）
             logger.info("\n[2/5] 检查 PostgreSQL 数据库...")
-            is_empty = await self.check_postgres_empty()
-            if not is_empty:
-                logger.warning("PostgreSQL 数据库已包含数据，跳过迁移")
-                return False
-            logger.info("  ✓ PostgreSQL 数据库为空，可以迁移")
+            if self.is_resuming():
+                done_tables = [t for t, s in self.checkpoint["tables"].items() if s.get("done")]
+                logger.info(f"  ✓ 检测到迁移断点，继续上次未完成的迁移（已完成: {', '.join(done_tables) or '无'}）")
+            else:
+                is_empty = await self.check_postgres_empty()
+                if not is_empty:
+                    logger.warning("PostgreSQL 数据库已包含数据，跳过迁移")
+                    return False
+                logger.info("  ✓ PostgreSQL 数据库为空，可以迁移")
 
             # 3. 创建表结构（通过 init_db）
             logger.info("\n[3/5] 创建 PostgreSQL 表结构...")
@@ -323,34 +571,69 @@ class DatabaseMigrator:
             await init_db(skip_migration_check=True)  # 跳过迁移检查避免递归
             logger.info("  ✓ 表结构创建完成")
 
-            # 4. 串行迁移数据（避免连接数超限）
+            # 4. 按依赖分组迁移，同组内并行（每个表占用 1 个连接，组内最多 3 个表）
             logger.info("\n[4/5] 迁移数据...")
             table_groups = await self.get_table_order()
+            await self._clear_partial_tables([table for tables in table_groups.values() for table in tables])
 
             for group_name, tables in table_groups.items():
                 logger.info(f"\n  处理 {group_name}: {', '.join(tables)}")
-                # 串行迁移避免连接数超限
-                for table in tables:
-                    await self.migrate_table(table)
+                # 一个表失败时等同组其他表跑完再抛出，避免 finally 释放 SQLite 引擎时它们还在读
+                results = await asyncio.gather(
+                    *(self.migrate_table(table) for table in tables), return_exceptions=True
+                )
+                errors = [result for result in results if isinstance(result, BaseException)]
+                if errors:
+                    raise errors[0]
 
             # 5. 验证数据完整性
             logger.info("\n[5/5] 验证迁移结果...")
             await self.verify_migration()
 
+            # 迁移完成，删除断点文件
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+
             logger.info("\n" + "=" * 60)
             logger.info("✓ 数据迁移完成！")
             logger.info("=" * 60)
             return True
 
         except Exception as e:
-            logger.error(f"\n✗ 迁移失败: {e}", exc_info=True)
+            logger.error(f"\n✗ 迁移失败: {e}（断点已保存到 {self.checkpoint_path}，重启后将继续迁移）", exc_info=True)
             return False
         finally:
             await self.sqlite_engine.dispose()
             # PostgreSQL 引擎由主应用管理，不在这里释放
 
+    async def _verify_table(self, table_name: str):
+        """校验单个表：行数 + 校验和"""
+        state = self._table_state(table_name)
+        expected_rows = state.get("rows", 0)
+        expected_checksum = state.get("checksum", f"{0:016x}")
+
+        pg_count, pg_checksum = await self.table_checksum(table_name)
+
+        if pg_count != expected_rows:
+            logger.error(f"  ✗ {table_name}: 数量不匹配 (导入: {expected_rows}, PostgreSQL: {pg_count})")
+            raise Exception(f"表 {table_name} 数据验证失败")
+        if pg_checksum != expected_checksum:
+            logger.error(f"  ✗ {table_name}: 校验和不匹配 (导入: {expected_checksum}, PostgreSQL: {pg_checksum})")
+            raise Exception(f"表 {table_name} 数据验证失败")
+
+        # 与 SQLite 源表行数核对（跳过的孤儿记录计入）
+        if await self._sqlite_table_exists(table_name):
+            async with self.sqlite_engine.connect() as sqlite_conn:
+                result = await sqlite_conn.execute(text(f"SELECT COUNT(*) FROM {table_name}"))
+                sqlite_count = result.scalar()
+            if sqlite_count != pg_count + state.get("skipped", 0):
+                logger.error(f"  ✗ {table_name}: 数量不匹配 (SQLite: {sqlite_count}, PostgreSQL: {pg_count})")
+                raise Exception(f"表 {table_name} 数据验证失败")
+
+        logger.info(f"  ✓ {table_name}: {pg_count} 条记录, 校验和 {pg_checksum}")
+
     async def verify_migration(self):
-        """验证迁移的数据完整性"""
+        """验证迁移的数据完整性（按表并行计算校验和）"""
         table_groups = await self.get_table_order()
 
         # 展平所有表名
@@ -358,27 +641,18 @@ class DatabaseMigrator:
         for tables in table_groups.values():
             all_tables.extend(tables)
 
-        for table_name in all_tables:
-            try:
-                # 统计 SQLite 记录数
-                async with self.sqlite_engine.begin() as sqlite_conn:
-                    result = await sqlite_conn.execute(text(f"SELECT COUNT(*) FROM {table_name}"))
-                    sqlite_count = result.scalar()
-
-                # 统计 PostgreSQL 记录数
-                async with self.postgres_engine.begin() as pg_conn:
-                    result = await pg_conn.execute(text(f"SELECT COUNT(*) FROM {table_name}"))
-                    pg_count = result.scalar()
-
-                if sqlite_count == pg_count:
-                    logger.info(f"  ✓ {table_name}: {pg_count} 条记录")
-                else:
-                    logger.error(f"  ✗ {table_name}: 数量不匹配 (SQLite: {sqlite_count}, PostgreSQL: {pg_count})")
-                    raise Exception(f"表 {table_name} 数据验证失败")
-
-            except Exception as e:
-                logger.error(f"  ✗ {table_name}: 验证失败 - {e}")
-                raise
+        results = await asyncio.gather(
+            *(self._verify_table(table) for table in all_tables), return_exceptions=True
+        )
+        failed = [table for table, result in zip(all_tables, results) if isinstance(result, BaseException)]
+        if failed:
+            # 校验失败的表和引用它们的表数据不可信，重置断点让下次重新导入（started 保留，导入前统一清空）
+            reset = self._with_dependents(failed, all_tables)
+            logger.error(f"  ✗ 验证失败: {', '.join(failed)}，下次启动重新导入: {', '.join(reset)}")
+            for table in reset:
+                self._table_state(table)["done"] = False
+            await self._save_checkpoint()
+            raise next(result for result in results if isinstance(result, BaseException))
 
 
 async def auto_migrate_if_needed(sqlite_path: str, postgres_engine) -> bool:
@@ -391,7 +665,8 @@ async def auto_migrate_if_needed(sqlite_path: str, postgres_engine) -> bool:
     logger.info(f"检测到 SQLite 数据库: {sqlite_path}")
 
     # 创建迁移器并执行迁移（复用主应用的 PostgreSQL 引擎）
-    migrator = DatabaseMigrator(sqlite_path, postgres_engine)
+    from app.config import settings
+    migrator = DatabaseMigrator(sqlite_path, postgres_engine, include_logs=settings.migrate_usage_logs)
     success = await migrator.migrate_all()
 
     if success:
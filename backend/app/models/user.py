@@ -26,6 +26,8 @@ class User(Base):
     # Antigravity 配额
     quota_antigravity = Column(Integer, default=100)  # Antigravity 每日配额
     used_antigravity = Column(Integer, default=0)     # 当天已使用次数
+    # 共享池公平调度权重（0=按是否贡献凭证自动）
+    share_weight = Column(Float, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # 关系
@@ -104,6 +106,7 @@ class Credential(Base):
     name = Column(String(100), nullable=False)
     api_key = Column(Text, nullable=False)  # Gemini API Key 或 OAuth access_token
     refresh_token = Column(Text, nullable=True)  # OAuth refresh_token
+    token_fingerprint = Column(String(64), nullable=True, index=True)  # refresh_token 指纹（去重用）
     client_id = Column(Text, nullable=True)  # OAuth client_id（加密存储）
     client_secret = Column(Text, nullable=True)  # OAuth client_secret（加密存储）
     project_id = Column(String(200), nullable=True)  # Project ID（两种类型都需要）
@@ -127,6 +130,8 @@ class Credential(Base):
     last_used_30 = Column(DateTime, nullable=True)     # 3.0 模型组 CD
     # 模型级 CD 机制（JSON 格式 {"model_name": "timestamp"}）
     model_cooldowns = Column(Text, nullable=True)
+    # 健康评分 EWMA 统计 JSON（见 services/credential_health.py）
+    health_stats = Column(Text, nullable=True)
     
     # 关系
     owner = relationship("User", back_populates="credentials")
@@ -165,3 +170,39 @@ class ErrorMessageConfig(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+
+
+class BackgroundJob(Base):
+    """后台任务表（一键启动/一键检测等长时间管理操作）
+    
+    任务状态持久化到数据库：重启后可从 checkpoint 继续，多 worker 间可见。
+    状态: pending / queued（已被 worker 领取，等待并发名额）/ running / done / failed / cancelled
+    """
+    __tablename__ = "background_jobs"
+    
+    id = Column(String(64), primary_key=True)                   # 任务 ID
+    job_type = Column(String(50), nullable=False, index=True)   # 任务类型（如 credentials.verify_all）
+    status = Column(String(20), default="pending", index=True)
+    params = Column(Text, nullable=True)                        # 任务参数（JSON）
+    progress = Column(Text, nullable=True)                      # 进度计数（JSON，如 {"valid": 1, "invalid": 2}）
+    checkpoint = Column(Text, nullable=True)                    # 断点（JSON，如 {"last_id": 123}）
+    total = Column(Integer, default=0)
+    processed = Column(Integer, default=0)
+    error = Column(Text, nullable=True)
+    cancel_requested = Column(Boolean, default=False)
+    worker_id = Column(String(100), nullable=True)              # 当前执行的 worker（hostname:pid）
+    heartbeat_at = Column(DateTime, nullable=True)              # 心跳时间，超时视为 worker 已退出
+    created_by = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class BackgroundJobResult(Base):
+    """后台任务的逐条结果（按块写入，流式读取，不在内存中累积）"""
+    __tablename__ = "background_job_results"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String(64), ForeignKey("background_jobs.id", ondelete="CASCADE"), nullable=False, index=True)
+    data = Column(Text, nullable=False)                         # 单条结果（JSON）
+    created_at = Column(DateTime, default=datetime.utcnow)
@@ -9,6 +9,10 @@ from app.database import get_db
 from app.models.user import User, APIKey, UsageLog, Credential
 from app.services.auth import get_current_admin, get_password_hash
 from app.services.credential_pool import CredentialPool
+from app.services.model_cooldowns import model_cooldowns
+from app.services.credential_health import credential_health
+from app.services.inflight import inflight
+from app.services.entitlements import entitlements
 from app.services.websocket import notify_user_update, notify_credential_update
 from app.services.error_classifier import ErrorType, ERROR_TYPE_NAMES, get_error_type_name
 
@@ -23,6 +27,7 @@ class UserUpdate(BaseModel):
     quota_flash: Optional[int] = None
     quota_25pro: Optional[int] = None
     quota_30pro: Optional[int] = None
+    share_weight: Optional[float] = None
 
 
 class UserPasswordUpdate(BaseModel):
@@ -128,6 +133,7 @@ async def list_users(
             "quota_flash": quota_flash,
             "quota_25pro": quota_25pro,
             "quota_30pro": quota_30pro,
+            "share_weight": u.share_weight or 0,  # 共享池调度权重（0=自动）
             "today_usage": today_usage,
             "credential_count": credential_count,
             "discord_id": u.discord_id,
@@ -163,6 +169,10 @@ async def update_user(
         user.quota_25pro = data.quota_25pro
     if data.quota_30pro is not None:
         user.quota_30pro = data.quota_30pro
+    if data.share_weight is not None:
+        if data.share_weight < 0:
+            raise HTTPException(status_code=400, detail="调度权重不能为负数")
+        user.share_weight = data.share_weight
     
     await db.commit()
     await notify_user_update()
@@ -199,6 +209,8 @@ async def delete_user(
     
     await db.delete(user)
     await db.commit()
+    for cred_id in user_cred_ids:
+        model_cooldowns.clear(cred_id)
     await notify_user_update()
     await notify_credential_update()
     return {"message": "删除成功（已同时删除关联凭证）"}
@@ -276,6 +288,11 @@ async def list_credentials(
                 "cd_flash": get_cd_remaining(c.last_used_flash, settings.cd_flash),
                 "cd_pro": get_cd_remaining(c.last_used_pro, settings.cd_pro),
                 "cd_30": get_cd_remaining(c.last_used_30, settings.cd_30),
+                "model_cooldowns": model_cooldowns.for_credential(c.id),  # 按模型的 429 冷却剩余秒数
+                "health": credential_health.snapshot(c.id),  # 健康评分 EWMA（没有样本时为 None）
+                "project_id": c.project_id,
+                "in_flight": inflight.for_credential(c.id, c.project_id),  # 进行中的上游调用数（凭证 / 所在项目）
+                "max_concurrency": inflight.limit_for(c.account_type),
             }
             for c in credentials
         ],
@@ -388,6 +405,14 @@ async def get_credential_detail(
     }
 
 
+@router.get("/credentials/inflight")
+async def get_credentials_inflight(
+    admin: User = Depends(get_current_admin)
+):
+    """进行中的上游调用数（凭证 / 项目），凭证列表页轮询用"""
+    return inflight.stats()
+
+
 @router.get("/credentials/export")
 async def export_all_credentials(
     admin: User = Depends(get_current_admin),
@@ -615,7 +640,10 @@ async def delete_duplicate_credentials(
     await db.execute(
         delete(Credential).where(Credential.id.in_(ids_to_delete))
     )
+    entitlements.invalidate_on_commit(db)
     await db.commit()
+    for cred_id in ids_to_delete:
+        model_cooldowns.clear(cred_id)
     
     return {
         "deleted_count": len(ids_to_delete),
@@ -667,6 +695,57 @@ async def get_stats(
     }
 
 
+@router.get("/db/query-plans")
+async def get_query_plans(
+    admin: User = Depends(get_current_admin)
+):
+    """热点查询执行计划（检查凭证选择/配额查询是否命中索引）"""
+    from app.services.index_advisor import explain_hot_queries, summarize
+    report = await explain_hot_queries()
+    return {
+        "ok": summarize(report)["ok"],
+        "queries": report
+    }
+
+
+@router.get("/conversion-cache/stats")
+async def get_conversion_cache_stats(
+    admin: User = Depends(get_current_admin)
+):
+    """请求转换缓存命中率"""
+    from app.services.openai2gemini_full import get_tool_cache_stats
+    from app.services.conversion_cache import get_conversion_cache_stats as get_prefix_cache_stats
+    from app.services.model_catalog import model_catalog
+    return {
+        "tool_schema": get_tool_cache_stats(),
+        "conversation_prefix": get_prefix_cache_stats(),
+        "model_catalog": model_catalog.stats()
+    }
+
+
+@router.get("/upstream/stats")
+async def get_upstream_stats(
+    admin: User = Depends(get_current_admin)
+):
+    """上游调用策略统计（对冲请求、全局重试预算、模型熔断、按模型 429 冷却、凭证就绪排队、共享池公平调度、凭证健康评分、凭证并发、用户权益快照缓存）"""
+    from app.services.admission import admission
+    from app.services.fair_share import fair_share
+    from app.services.hedging import hedging
+    from app.services.model_breaker import model_breaker
+    from app.services.retry_budget import retry_budget
+    return {
+        "hedging": hedging.stats(),
+        "retry_budget": retry_budget.stats(),
+        "model_breaker": model_breaker.stats(),
+        "model_cooldowns": model_cooldowns.stats(),
+        "admission": admission.stats(),
+        "fair_share": fair_share.stats(),
+        "credential_health": credential_health.stats(),
+        "inflight": inflight.stats(),
+        "entitlements": entitlements.stats()
+    }
+
+
 @router.get("/logs")
 async def get_logs(
     limit: int = 100,
@@ -7,7 +7,6 @@ from fastapi.responses import StreamingResponse, JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func
 import httpx
-import json
 import time
 import uuid
 from datetime import datetime, timedelta
@@ -16,6 +15,10 @@ from typing import Optional, AsyncGenerator
 from app.database import get_db
 from app.models.user import User, Credential, UsageLog
 from app.config import settings
+from app.services import json_codec
+from app.services.json_codec import ChunkTemplate
+from app.services.sse_writer import coalesce_sse
+from app.services.request_body import get_json_body
 
 
 router = APIRouter(prefix="/anthropic", tags=["Anthropic API代理"])
@@ -143,10 +146,7 @@ async def chat_completions(
     接收 OpenAI 格式请求，转换为 Anthropic Messages API 格式
     """
     # 解析请求体
-    try:
-        body = await request.json()
-    except:
-        raise HTTPException(status_code=400, detail="无效的请求体")
+    body = await get_json_body(request, detail="无效的请求体")
     
     model = body.get("model", "claude-sonnet-4-5-20250929")
     messages = body.get("messages", [])
@@ -204,6 +204,7 @@ async def chat_completions(
     if stream:
         # 流式响应
         async def stream_generator() -> AsyncGenerator[str, None]:
+            template = ChunkTemplate(f"chatcmpl-{request_id[:8]}", model, created=None)
             try:
                 async with httpx.AsyncClient(timeout=300) as client:
                     async with client.stream(
@@ -214,7 +215,7 @@ async def chat_completions(
                     ) as response:
                         if response.status_code != 200:
                             error_text = await response.aread()
-                            yield f"data: {json.dumps({'error': error_text.decode()})}\n\n"
+                            yield json_codec.sse({"error": error_text.decode()})
                             return
                         
                         async for line in response.aiter_lines():
@@ -227,15 +228,15 @@ async def chat_completions(
                                     break
                                 
                                 try:
-                                    event = json.loads(data)
+                                    event = json_codec.loads(data)
                                     # 转换 Anthropic 事件为 OpenAI 格式
-                                    openai_chunk = convert_anthropic_stream_to_openai(event, model, request_id)
+                                    openai_chunk = convert_anthropic_stream_to_openai(event, template)
                                     if openai_chunk:
-                                        yield f"data: {json.dumps(openai_chunk)}\n\n"
-                                except json.JSONDecodeError:
+                                        yield openai_chunk
+                                except json_codec.JSONDecodeError:
                                     pass
             except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                yield json_codec.sse({"error": str(e)})
             finally:
                 # 更新凭证使用信息
                 credential.use_count = (credential.use_count or 0) + 1
@@ -243,7 +244,7 @@ async def chat_completions(
                 await db.commit()
         
         return StreamingResponse(
-            stream_generator(),
+            coalesce_sse(stream_generator(), "anthropic"),
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
@@ -316,42 +317,16 @@ def convert_anthropic_to_openai(anthropic_response: dict, model: str, request_id
     }
 
 
-def convert_anthropic_stream_to_openai(event: dict, model: str, request_id: str) -> Optional[dict]:
-    """将 Anthropic 流式事件转换为 OpenAI 格式"""
+def convert_anthropic_stream_to_openai(event: dict, template: ChunkTemplate) -> Optional[str]:
+    """将 Anthropic 流式事件转换为 OpenAI 格式的 SSE 数据（使用该流的 chunk 信封）"""
     event_type = event.get("type", "")
     
     if event_type == "content_block_delta":
         delta = event.get("delta", {})
         if delta.get("type") == "text_delta":
-            return {
-                "id": f"chatcmpl-{request_id[:8]}",
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "content": delta.get("text", "")
-                        },
-                        "finish_reason": None
-                    }
-                ]
-            }
+            return template.delta({"content": delta.get("text", "")})
     
     elif event_type == "message_stop":
-        return {
-            "id": f"chatcmpl-{request_id[:8]}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": "stop"
-                }
-            ]
-        }
+        return template.delta({}, "stop")
     
     return None
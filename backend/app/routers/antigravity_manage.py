@@ -2,7 +2,7 @@
 Antigravity 凭证管理路由
 独立的凭证管理系统，与 GeminiCLI 凭证完全分离
 """
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
 from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func, update
@@ -21,6 +21,8 @@ from app.services.credential_pool import (
     fetch_project_id,
     ANTIGRAVITY_USER_AGENT
 )
+from app.services.jobs import job_manager, JobContext
+from app.services.entitlements import entitlements
 from app.config import settings
 
 
@@ -36,14 +38,17 @@ MODE = "antigravity"
 async def upload_antigravity_credentials(
     files: List[UploadFile] = File(...),
     is_public: bool = Form(default=False),
-    user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    stream: bool = Form(default=False),
+    user: User = Depends(get_current_user)
 ):
     """
     上传 Antigravity JSON 凭证文件（支持多文件和ZIP压缩包）
     
     凭证会使用 Antigravity User-Agent 获取 project_id
+    stream=true 时以 NDJSON 逐条返回每个文件的结果，最后一行为汇总 {"done": true, ...}
     """
+    from app.services.credential_upload import run_upload
+    
     if not files:
         raise HTTPException(status_code=400, detail="请选择要上传的文件")
     
@@ -51,201 +56,22 @@ async def upload_antigravity_credentials(
     if settings.force_donate:
         is_public = True
     
-    results = []
-    success_count = 0
+    events = run_upload(files, user.id, is_public, mode=MODE)
     
-    # 预处理：解压ZIP文件，收集所有JSON文件
-    json_files = []  # [(filename, content_bytes), ...]
+    if stream:
+        async def generate():
+            async for event in events:
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
     
-    for file in files:
-        if file.filename.endswith('.zip'):
-            try:
-                zip_content = await file.read()
-                with zipfile.ZipFile(io.BytesIO(zip_content), 'r') as zf:
-                    for name in zf.namelist():
-                        if name.endswith('.json') and not name.startswith('__MACOSX'):
-                            json_files.append((name, zf.read(name)))
-                results.append({
-                    "filename": file.filename, 
-                    "status": "info", 
-                    "message": f"已解压 {len([n for n in zf.namelist() if n.endswith('.json')])} 个JSON文件"
-                })
-            except zipfile.BadZipFile:
-                results.append({"filename": file.filename, "status": "error", "message": "无效的ZIP文件"})
-            except Exception as e:
-                results.append({"filename": file.filename, "status": "error", "message": f"解压失败: {str(e)[:50]}"})
-        elif file.filename.endswith('.json'):
-            content = await file.read()
-            json_files.append((file.filename, content))
+    results = []
+    summary = {}
+    async for event in events:
+        if event.get("done"):
+            summary = event
         else:
-            results.append({"filename": file.filename, "status": "error", "message": "只支持 JSON 或 ZIP 文件"})
-    
-    # 处理所有JSON文件
-    for filename, content in json_files:
-        try:
-            parsed_data = json.loads(content.decode('utf-8') if isinstance(content, bytes) else content)
-            
-            # 支持两种格式：
-            # 1. 单个凭证对象: {"email": "...", "refresh_token": "..."}
-            # 2. 凭证数组: [{"email": "...", "refresh_token": "..."}, ...]
-            if isinstance(parsed_data, list):
-                # 数组格式：多个凭证
-                cred_list = parsed_data
-                results.append({"filename": filename, "status": "info", "message": f"检测到数组格式，包含 {len(cred_list)} 个凭证"})
-            else:
-                # 单个凭证对象
-                cred_list = [parsed_data]
-            
-            for idx, cred_data in enumerate(cred_list):
-                item_name = f"{filename}[{idx}]" if len(cred_list) > 1 else filename
-                
-                # 验证必要字段
-                required_fields = ["refresh_token"]
-                missing = [f for f in required_fields if f not in cred_data]
-                if missing:
-                    results.append({"filename": item_name, "status": "error", "message": f"缺少字段: {', '.join(missing)}"})
-                    continue
-                
-                # 创建凭证（加密存储）
-                email = cred_data.get("email") or item_name
-                refresh_token = cred_data.get("refresh_token")
-                
-                # 去重检查：根据 email 判断是否已存在（仅在 antigravity 凭证中）
-                existing = await db.execute(
-                    select(Credential)
-                    .where(Credential.email == email)
-                    .where(Credential.api_type == MODE)
-                )
-                if existing.scalar_one_or_none():
-                    results.append({"filename": item_name, "status": "skip", "message": f"凭证已存在: {email}"})
-                    continue
-                
-                # 也检查 refresh_token 是否重复
-                encrypted_token = encrypt_credential(refresh_token)
-                existing_token = await db.execute(
-                    select(Credential)
-                    .where(Credential.refresh_token == encrypted_token)
-                    .where(Credential.api_type == MODE)
-                )
-                if existing_token.scalar_one_or_none():
-                    results.append({"filename": item_name, "status": "skip", "message": f"凭证token已存在: {email}"})
-                    continue
-            
-                # 获取 access_token 并验证
-                is_valid = False
-                project_id = cred_data.get("project_id", "")
-                verify_msg = ""
-            
-                try:
-                    import httpx
-                
-                    # 创建临时凭证对象用于获取 token
-                    temp_cred = Credential(
-                        api_key=encrypt_credential(cred_data.get("token") or cred_data.get("access_token", "")),
-                        refresh_token=encrypt_credential(refresh_token),
-                        client_id=encrypt_credential(cred_data.get("client_id")) if cred_data.get("client_id") else None,
-                        client_secret=encrypt_credential(cred_data.get("client_secret")) if cred_data.get("client_secret") else None,
-                        credential_type="oauth"
-                    )
-                
-                    access_token = await CredentialPool.get_access_token(temp_cred, db)
-                    if access_token:
-                        # 如果没有 project_id，使用 Antigravity 方式获取
-                        if not project_id:
-                            print(f"[Antigravity上传] 正在获取 project_id: {email}", flush=True)
-                            project_id = await fetch_project_id(
-                                access_token=access_token,
-                                user_agent=ANTIGRAVITY_USER_AGENT,
-                                api_base_url=settings.antigravity_api_base
-                            )
-                            if project_id:
-                                print(f"[Antigravity上传] 获取到 project_id: {project_id}", flush=True)
-                    
-                        # 测试 API 是否可用
-                        if project_id:
-                            async with httpx.AsyncClient(timeout=15) as client:
-                                test_url = f"{settings.antigravity_api_base}/v1internal:generateContent"
-                                headers = {
-                                    "Authorization": f"Bearer {access_token}", 
-                                    "Content-Type": "application/json",
-                                    "User-Agent": ANTIGRAVITY_USER_AGENT
-                                }
-                                test_payload = {
-                                    "model": "gemini-2.5-flash",
-                                    "project": project_id,
-                                    "request": {"contents": [{"role": "user", "parts": [{"text": "hi"}]}]}
-                                }
-                                resp = await client.post(test_url, headers=headers, json=test_payload)
-                            
-                                if resp.status_code in [200, 429]:
-                                    is_valid = True
-                                    verify_msg = f"✅ 有效 (project: {project_id[:20]}...)"
-                                    # Antigravity 全部是 3.0 模型，无需检测
-                                else:
-                                    verify_msg = f"❌ API测试失败 ({resp.status_code})"
-                        else:
-                            verify_msg = "❌ 无法获取 project_id"
-                    else:
-                        verify_msg = "❌ 无法获取 access_token"
-                except Exception as e:
-                    verify_msg = f"⚠️ 验证失败: {str(e)[:30]}"
-            
-                # 如果要捐赠但凭证无效，不允许
-                actual_public = is_public and is_valid
-            
-                credential = Credential(
-                    user_id=user.id,
-                    name=f"Antigravity - {email}",
-                    api_key=encrypt_credential(cred_data.get("token") or cred_data.get("access_token", "")),
-                    refresh_token=encrypt_credential(refresh_token),
-                    client_id=encrypt_credential(cred_data.get("client_id")) if cred_data.get("client_id") else None,
-                    client_secret=encrypt_credential(cred_data.get("client_secret")) if cred_data.get("client_secret") else None,
-                    project_id=project_id,
-                    credential_type="oauth",
-                    email=email,
-                    is_public=actual_public,
-                    is_active=is_valid,
-                    api_type=MODE,  # 标记为 Antigravity 凭证
-                    model_tier="3"  # Antigravity 全是 3.0 模型
-                )
-                db.add(credential)
-            
-                status_msg = f"上传成功 {verify_msg}"
-                if is_public and not is_valid:
-                    status_msg += " (无效凭证不会上传到公共池)"
-                results.append({
-                    "filename": item_name, 
-                    "status": "success" if is_valid else "warning", 
-                    "message": status_msg
-                })
-                success_count += 1
-            
-                # 每50个凭证提交一次
-                if success_count % 50 == 0:
-                    try:
-                        await db.commit()
-                        print(f"[Antigravity批量上传] 已提交 {success_count} 个凭证", flush=True)
-                    except Exception as commit_err:
-                        print(f"[Antigravity批量上传] 提交失败: {commit_err}", flush=True)
-            
-        except json.JSONDecodeError:
-            results.append({"filename": filename, "status": "error", "message": "JSON 格式错误"})
-        except Exception as e:
-            results.append({"filename": filename, "status": "error", "message": str(e)})
-    
-    # 最终提交
-    try:
-        await db.commit()
-        print(f"[Antigravity批量上传] 最终提交完成，共 {success_count} 个凭证", flush=True)
-    except Exception as final_err:
-        print(f"[Antigravity批量上传] 最终提交失败: {final_err}", flush=True)
-        try:
-            await db.rollback()
-            await db.commit()
-        except:
-            pass
-    
-    return {"uploaded_count": success_count, "total_count": len(json_files), "results": results}
+            results.append(event)
+    return {"uploaded_count": summary.get("uploaded_count", 0), "total_count": summary.get("total_count", 0), "results": results}
 
 
 @router.get("/credentials")
@@ -778,6 +604,8 @@ async def batch_antigravity_credential_action(
     else:
         raise HTTPException(status_code=400, detail="无效的操作")
     
+    # 批量 UPDATE 不触发 ORM 事件，提交后权益快照全部失效
+    entitlements.invalidate_on_commit(db)
     await db.commit()
     return {"message": f"已对 {len(ids)} 个凭证执行 {action} 操作"}
 
@@ -946,96 +774,91 @@ async def admin_verify_antigravity_credential(
     }
 
 
-@router.post("/manage/credentials/verify-all")
-async def verify_all_antigravity_credentials(
-    background_tasks: BackgroundTasks,
-    user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
-):
-    """一键检测所有 Antigravity 凭证（后台任务，立即返回）"""
+# ===== 后台任务：一键检测 / 一键启动 =====
+
+JOB_VERIFY_ALL = "antigravity.verify_all"
+JOB_START_ALL = "antigravity.start_all"
+
+
+async def _verify_all_job(ctx: JobContext):
+    """一键检测：按 id 分块检测 Antigravity 凭证，每块写一次断点"""
     import asyncio
     import httpx
     from app.database import async_session
     
-    result = await db.execute(
-        select(Credential).where(Credential.api_type == MODE)
-    )
-    creds = result.scalars().all()
-    total = len(creds)
-    
-    # 提取凭证数据
-    cred_data = [{
-        "id": c.id,
-        "email": c.email,
-        "refresh_token": c.refresh_token,
-        "client_id": c.client_id,
-        "client_secret": c.client_secret,
-        "project_id": c.project_id,
-        "api_key": c.api_key,
-    } for c in creds]
-    
-    task_id = f"antigravity_verify_{datetime.utcnow().timestamp()}"
-    
-    async def run_in_background():
-        """后台执行检测"""
-        semaphore = asyncio.Semaphore(30)  # 限制并发
-        valid = 0
-        invalid = 0
-        
-        async def verify_single(data):
-            nonlocal valid, invalid
-            async with semaphore:
-                try:
-                    # 获取 access_token
-                    temp_cred = Credential(
-                        id=data["id"],
-                        refresh_token=data["refresh_token"],
-                        client_id=data["client_id"],
-                        client_secret=data["client_secret"],
-                        project_id=data["project_id"],
-                        api_key=data["api_key"],
-                        credential_type="oauth"
+    semaphore = asyncio.Semaphore(30)  # 限制并发
+    last_id = ctx.cursor.get("last_id", 0)
+    
+    async def verify_single(data):
+        async with semaphore:
+            try:
+                # 获取 access_token
+                temp_cred = Credential(
+                    id=data.id,
+                    refresh_token=data.refresh_token,
+                    client_id=data.client_id,
+                    client_secret=data.client_secret,
+                    project_id=data.project_id,
+                    api_key=data.api_key,
+                    credential_type="oauth"
+                )
+                access_token = await CredentialPool.refresh_access_token(temp_cred) if temp_cred.refresh_token else None
+                if not access_token:
+                    return {"id": data.id, "email": data.email, "is_valid": False}
+                
+                # 获取 project_id
+                project_id = data.project_id
+                if not project_id:
+                    project_id = await fetch_project_id(
+                        access_token=access_token,
+                        user_agent=ANTIGRAVITY_USER_AGENT,
+                        api_base_url=settings.antigravity_api_base
                     )
-                    access_token = await CredentialPool.refresh_access_token(temp_cred) if temp_cred.refresh_token else None
-                    if not access_token:
-                        return {"id": data["id"], "is_valid": False}
-                    
-                    # 获取 project_id
-                    project_id = data["project_id"]
-                    if not project_id:
-                        project_id = await fetch_project_id(
-                            access_token=access_token,
-                            user_agent=ANTIGRAVITY_USER_AGENT,
-                            api_base_url=settings.antigravity_api_base
-                        )
-                    
-                    is_valid = False
-                    if project_id:
-                        async with httpx.AsyncClient(timeout=10) as client:
-                            test_url = f"{settings.antigravity_api_base}/v1internal:generateContent"
-                            headers = {
-                                "Authorization": f"Bearer {access_token}",
-                                "Content-Type": "application/json",
-                                "User-Agent": ANTIGRAVITY_USER_AGENT
-                            }
-                            test_payload = {
-                                "model": "gemini-2.5-flash",
-                                "project": project_id,
-                                "request": {"contents": [{"role": "user", "parts": [{"text": "hi"}]}]}
-                            }
-                            resp = await client.post(test_url, headers=headers, json=test_payload)
-                            is_valid = resp.status_code in [200, 429]
-                    
-                    return {"id": data["id"], "is_valid": is_valid, "project_id": project_id, "token": access_token}
-                except Exception as e:
-                    print(f"[Antigravity检测] ❌ {data['email']} 异常: {e}", flush=True)
-                    return {"id": data["id"], "is_valid": False}
+                
+                is_valid = False
+                if project_id:
+                    async with httpx.AsyncClient(timeout=10) as client:
+                        test_url = f"{settings.antigravity_api_base}/v1internal:generateContent"
+                        headers = {
+                            "Authorization": f"Bearer {access_token}",
+                            "Content-Type": "application/json",
+                            "User-Agent": ANTIGRAVITY_USER_AGENT
+                        }
+                        test_payload = {
+                            "model": "gemini-2.5-flash",
+                            "project": project_id,
+                            "request": {"contents": [{"role": "user", "parts": [{"text": "hi"}]}]}
+                        }
+                        resp = await client.post(test_url, headers=headers, json=test_payload)
+                        is_valid = resp.status_code in [200, 429]
+                
+                return {"id": data.id, "email": data.email, "is_valid": is_valid, "project_id": project_id, "token": access_token}
+            except Exception as e:
+                print(f"[Antigravity检测] ❌ {data.email} 异常: {e}", flush=True)
+                return {"id": data.id, "email": data.email, "is_valid": False}
+    
+    print(f"[Antigravity检测] 后台开始检测 {ctx.total} 个凭证...", flush=True)
+    while True:
+        async with async_session() as session:
+            rows = (await session.execute(
+                select(
+                    Credential.id, Credential.email, Credential.refresh_token,
+                    Credential.client_id, Credential.client_secret, Credential.project_id,
+                    Credential.api_key
+                )
+                .where(Credential.api_type == MODE)
+                .where(Credential.id > last_id)
+                .order_by(Credential.id)
+                .limit(settings.job_chunk_size)
+            )).all()
+        if not rows:
+            break
         
-        print(f"[Antigravity检测] 后台开始检测 {total} 个凭证...", flush=True)
-        results = await asyncio.gather(*[verify_single(d) for d in cred_data])
+        results = await asyncio.gather(*[verify_single(r) for r in rows])
         
-        # 批量更新数据库
+        # 本块的数据库更新与断点在同一事务提交
         async with async_session() as session:
+            items = []
             for res in results:
                 update_vals = {"is_active": res["is_valid"]}
                 if res.get("project_id"):
@@ -1047,75 +870,61 @@ async def verify_all_antigravity_credentials(
                     update(Credential).where(Credential.id == res["id"]).values(**update_vals)
                 )
                 
-                if res["is_valid"]:
-                    valid += 1
-                else:
-                    invalid += 1
-            
-            await session.commit()
-        
-        print(f"[Antigravity检测] 完成: 有效 {valid}, 无效 {invalid}", flush=True)
-    
-    asyncio.create_task(run_in_background())
-    
-    return {"message": "后台任务已启动", "task_id": task_id, "total": total}
+                key = "valid" if res["is_valid"] else "invalid"
+                ctx.progress[key] = ctx.progress.get(key, 0) + 1
+                items.append({"id": res["id"], "email": res["email"], "is_valid": res["is_valid"]})
+            last_id = rows[-1].id
+            entitlements.invalidate_on_commit(session)
+            await ctx.commit({"last_id": last_id}, processed=len(rows), results=items, session=session)
+    
+    print(f"[Antigravity检测] 完成: 有效 {ctx.progress.get('valid', 0)}, 无效 {ctx.progress.get('invalid', 0)}", flush=True)
 
 
-@router.post("/manage/credentials/start-all")
-async def start_all_antigravity_credentials(
-    background_tasks: BackgroundTasks,
-    user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
-):
-    """一键启动所有 Antigravity 凭证（刷新 token 并启用）"""
+async def _start_all_job(ctx: JobContext):
+    """一键启动：按 id 分块刷新 Antigravity 凭证的 access_token，每块写一次断点"""
     import asyncio
     from app.database import async_session
     
-    result = await db.execute(
-        select(Credential).where(
-            Credential.api_type == MODE,
-            Credential.refresh_token.isnot(None)
-        )
-    )
-    creds = result.scalars().all()
-    total = len(creds)
-    
-    cred_data = [{
-        "id": c.id,
-        "email": c.email,
-        "refresh_token": c.refresh_token,
-        "client_id": c.client_id,
-        "client_secret": c.client_secret,
-    } for c in creds]
-    
-    task_id = f"antigravity_start_{datetime.utcnow().timestamp()}"
-    
-    async def run_in_background():
-        semaphore = asyncio.Semaphore(50)
-        success = 0
-        failed = 0
-        
-        async def refresh_single(data):
-            nonlocal success, failed
-            async with semaphore:
-                try:
-                    temp_cred = Credential(
-                        id=data["id"],
-                        refresh_token=data["refresh_token"],
-                        client_id=data["client_id"],
-                        client_secret=data["client_secret"]
-                    )
-                    access_token = await CredentialPool.refresh_access_token(temp_cred)
-                    return {"id": data["id"], "email": data["email"], "token": access_token}
-                except Exception as e:
-                    print(f"[Antigravity启动] ❌ {data['email']} 异常: {e}", flush=True)
-                    return {"id": data["id"], "email": data["email"], "token": None}
+    semaphore = asyncio.Semaphore(50)
+    last_id = ctx.cursor.get("last_id", 0)
+    
+    async def refresh_single(data):
+        async with semaphore:
+            try:
+                temp_cred = Credential(
+                    id=data.id,
+                    refresh_token=data.refresh_token,
+                    client_id=data.client_id,
+                    client_secret=data.client_secret
+                )
+                access_token = await CredentialPool.refresh_access_token(temp_cred)
+                return {"id": data.id, "email": data.email, "token": access_token}
+            except Exception as e:
+                print(f"[Antigravity启动] ❌ {data.email} 异常: {e}", flush=True)
+                return {"id": data.id, "email": data.email, "token": None}
+    
+    print(f"[Antigravity启动] 后台开始刷新 {ctx.total} 个凭证...", flush=True)
+    while True:
+        async with async_session() as session:
+            rows = (await session.execute(
+                select(
+                    Credential.id, Credential.email, Credential.refresh_token,
+                    Credential.client_id, Credential.client_secret
+                )
+                .where(Credential.api_type == MODE, Credential.refresh_token.isnot(None))
+                .where(Credential.id > last_id)
+                .order_by(Credential.id)
+                .limit(settings.job_chunk_size)
+            )).all()
+        if not rows:
+            break
         
-        print(f"[Antigravity启动] 后台开始刷新 {total} 个凭证...", flush=True)
-        results = await asyncio.gather(*[refresh_single(d) for d in cred_data])
+        results = await asyncio.gather(*[refresh_single(r) for r in rows])
         
         async with async_session() as session:
+            items = []
             for res in results:
+                ok = False
                 if res["token"]:
                     result = await session.execute(
                         update(Credential)
@@ -1126,16 +935,49 @@ async def start_all_antigravity_credentials(
                             last_error=None
                         )
                     )
-                    if result.rowcount > 0:
-                        success += 1
-                else:
-                    failed += 1
-            await session.commit()
-        
-        print(f"[Antigravity启动] 完成: 成功 {success}, 失败 {failed}", flush=True)
+                    ok = result.rowcount > 0
+                key = "success" if ok else "failed"
+                ctx.progress[key] = ctx.progress.get(key, 0) + 1
+                items.append({"id": res["id"], "email": res["email"], "success": ok})
+            last_id = rows[-1].id
+            entitlements.invalidate_on_commit(session)
+            await ctx.commit({"last_id": last_id}, processed=len(rows), results=items, session=session)
+    
+    print(f"[Antigravity启动] 完成: 成功 {ctx.progress.get('success', 0)}, 失败 {ctx.progress.get('failed', 0)}", flush=True)
+
+
+job_manager.register(JOB_VERIFY_ALL, _verify_all_job)
+job_manager.register(JOB_START_ALL, _start_all_job)
+
+
+@router.post("/manage/credentials/verify-all")
+async def verify_all_antigravity_credentials(
+    user: User = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_db)
+):
+    """一键检测所有 Antigravity 凭证（后台任务，立即返回，进度见 /api/manage/jobs/{task_id}）"""
+    total = (await db.execute(
+        select(func.count(Credential.id)).where(Credential.api_type == MODE)
+    )).scalar() or 0
     
-    asyncio.create_task(run_in_background())
+    task_id = await job_manager.submit(JOB_VERIFY_ALL, total=total, created_by=user.id)
+    return {"message": "后台任务已启动", "task_id": task_id, "total": total}
+
+
+@router.post("/manage/credentials/start-all")
+async def start_all_antigravity_credentials(
+    user: User = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_db)
+):
+    """一键启动所有 Antigravity 凭证（刷新 token 并启用，后台任务）"""
+    total = (await db.execute(
+        select(func.count(Credential.id)).where(
+            Credential.api_type == MODE,
+            Credential.refresh_token.isnot(None)
+        )
+    )).scalar() or 0
     
+    task_id = await job_manager.submit(JOB_START_ALL, total=total, created_by=user.id)
     return {"message": "后台任务已启动", "task_id": task_id, "total": total}
 
 
@@ -11,7 +11,7 @@ from app.database import get_db
 from app.models.user import User, Credential
 from app.services.auth import get_current_user
 from app.config import settings
-from app.services.crypto import encrypt_credential
+from app.services.crypto import encrypt_credential, token_fingerprint
 
 router = APIRouter(prefix="/api/agy-oauth", tags=["Antigravity OAuth"])
 
@@ -301,6 +301,7 @@ async def antigravity_credential_from_callback_url(
             # 更新现有凭证
             existing.api_key = encrypt_credential(access_token)
             existing.refresh_token = encrypt_credential(refresh_token)
+            existing.token_fingerprint = token_fingerprint(refresh_token)
             existing.client_id = encrypt_credential(ANTIGRAVITY_CLIENT_ID)
             existing.client_secret = encrypt_credential(ANTIGRAVITY_CLIENT_SECRET)
             existing.project_id = project_id
@@ -314,6 +315,7 @@ async def antigravity_credential_from_callback_url(
                 name=f"Antigravity - {email}",
                 api_key=encrypt_credential(access_token),
                 refresh_token=encrypt_credential(refresh_token),
+                token_fingerprint=token_fingerprint(refresh_token),
                 client_id=encrypt_credential(ANTIGRAVITY_CLIENT_ID),
                 client_secret=encrypt_credential(ANTIGRAVITY_CLIENT_SECRET),
                 project_id=project_id,
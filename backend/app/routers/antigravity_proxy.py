@@ -1,10 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, BackgroundTasks
 from fastapi.responses import StreamingResponse, JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, or_, and_
+from sqlalchemy import select, func, or_, and_, case
 from datetime import datetime, timedelta
-import json
 import time
+from typing import Any, Dict, List, Optional
 
 from app.database import get_db, async_session
 from app.models.user import User, UsageLog
@@ -14,6 +14,13 @@ from app.services.antigravity_client import AntigravityClient
 from app.services.websocket import notify_log_update, notify_stats_update
 from app.services.error_classifier import classify_error_simple
 from app.services.error_message_service import get_custom_error_message
+from app.services import json_codec
+from app.services.sse_writer import coalesce_sse
+from app.services.request_snapshot import RequestSnapshot
+from app.services.request_body import get_json_body
+from app.services.model_catalog import model_catalog
+from app.services.failover import CredentialSource, FailoverExecutor, FailoverError
+from app.services.entitlements import entitlements
 from app.config import settings
 import re
 
@@ -85,46 +92,16 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
     else:
         start_of_day = reset_time_utc
 
-    body = await request.json()
+    body = await get_json_body(request)
     model = body.get("model", "gemini-2.5-flash")
     required_tier = CredentialPool.get_required_tier(model)
     
-    from app.models.user import Credential
-    from sqlalchemy import case
-    
-    # 只统计 Antigravity 类型的凭证
-    cred_stats_result = await db.execute(
-        select(
-            func.count(Credential.id).label("total"),
-            func.sum(case((Credential.model_tier == "3", 1), else_=0)).label("tier_30")
-        )
-        .where(Credential.user_id == user.id)
-        .where(Credential.api_type == "antigravity")  # 只统计 Antigravity 凭证
-        .where(Credential.is_active == True)
-    )
-    cred_stats = cred_stats_result.one()
-    total_cred_count = cred_stats.total or 0
-    cred_30_count = cred_stats.tier_30 or 0
-    cred_25_count = total_cred_count - cred_30_count
-    has_credential = total_cred_count > 0
-
-    if user.quota_flash and user.quota_flash > 0:
-        user_quota_flash = user.quota_flash
-    elif has_credential:
-        user_quota_flash = total_cred_count * settings.quota_flash
-    else:
-        user_quota_flash = settings.no_cred_quota_flash
-    
-    if user.quota_25pro and user.quota_25pro > 0:
-        user_quota_pro = user.quota_25pro
-    elif cred_30_count > 0:
-        user_quota_pro = cred_30_count * settings.quota_30pro
-    elif has_credential:
-        user_quota_pro = total_cred_count * settings.quota_25pro
-    else:
-        user_quota_pro = settings.no_cred_quota_25pro
-    
-    has_30_access = cred_30_count > 0 or (user.quota_30pro and user.quota_30pro > 0)
+    # 只按 Antigravity 凭证计算配额上限（按用户缓存的权益快照，凭证或配置变化时失效）
+    limits = (await entitlements.get(db, user)).quota("antigravity")
+    has_credential = limits.has_credential
+    user_quota_flash = limits.quota_flash
+    user_quota_pro = limits.quota_pro
+    has_30_access = limits.has_30_access
 
     if required_tier == "3":
         if not has_30_access:
@@ -185,104 +162,81 @@ async def options_handler():
     })
 
 
-@router.get("/v1/models")
-@router.get("/models")
-async def list_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
-    """列出可用模型 (OpenAI兼容) - Antigravity"""
-    from app.models.user import Credential
-    
-    # 检查是否有可用的 3.0 Antigravity 凭证
-    has_tier3 = await CredentialPool.has_tier3_credentials(user, db, mode="antigravity")
-    
-    # 尝试从 Antigravity API 获取动态模型列表
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id, mode="antigravity")
-    credential = await CredentialPool.get_available_credential(
-        db, user_id=user.id, user_has_public_creds=user_has_public, model="gemini-2.5-flash",
-        mode="antigravity"  # 使用 Antigravity 凭证
-    )
-    
-    if credential:
-        access_token = await CredentialPool.get_access_token(credential, db)
-        if access_token:
-            project_id = credential.project_id or ""
-            client = AntigravityClient(access_token, project_id)
-            try:
-                dynamic_models = await client.fetch_available_models()
-                if dynamic_models:
-                    print(f"[Antigravity] 🔍 动态模型数量: {len(dynamic_models)}", flush=True)
-                    
-                    # 过滤掉不需要的测试/内部模型
-                    # 只保留标准的 gemini, claude, gpt 模型
-                    def is_valid_model(model_id: str) -> bool:
-                        model_lower = model_id.lower()
-                        # 排除条件：包含这些关键字的跳过
-                        invalid_patterns = [
-                            "chat_", "rev", "tab_", "uic", "test", "exp", "lite_preview",
-                            "gcli-", "search"  # search模型反重力不支持
-                        ]
-                        for pattern in invalid_patterns:
-                            if pattern in model_lower:
-                                return False
-                        # 允许条件：必须是 gemini, claude, gpt 开头的模型
-                        # 反重力支持 gemini-2.5 和 gemini-3 系列
-                        valid_prefixes = [
-                            "gemini-2.5", "gemini-3", "claude", "gpt-oss",
-                            "agy-gemini-2.5", "agy-gemini-3", "agy-claude", "agy-gpt"
-                        ]
-                        for prefix in valid_prefixes:
-                            if model_lower.startswith(prefix):
-                                return True
-                        return False
-                    
-                    # 添加流式抗截断变体（假非流已自动处理，不需要单独列出）
-                    models = []
-                    for m in dynamic_models:
-                        model_id = m.get("id", "")
-                        # 过滤无效模型
-                        if not is_valid_model(model_id):
-                            continue
-                        models.append({"id": model_id, "object": "model", "owned_by": "google"})
-                        models.append({"id": f"流式抗截断/{model_id}", "object": "model", "owned_by": "google"})
-                        
-                        if "image" in model_id.lower() and "2k" not in model_id.lower() and "4k" not in model_id.lower():
-                            models.append({"id": f"{model_id}-2k", "object": "model", "owned_by": "google"})
-                            models.append({"id": f"{model_id}-4k", "object": "model", "owned_by": "google"})
-                            if not model_id.startswith("agy-"):
-                                models.append({"id": f"agy-{model_id}-2k", "object": "model", "owned_by": "google"})
-                                models.append({"id": f"agy-{model_id}-4k", "object": "model", "owned_by": "google"})
-                    
-                    # 强制添加 Claude 模型的不带 -thinking 后缀版本
-                    claude_base_models = [
-                        "claude-opus-4-5", "agy-claude-opus-4-5",
-                        "claude-sonnet-4-5", "agy-claude-sonnet-4-5",
-                    ]
-                    existing_ids = {m["id"] for m in models}
-                    for base_model in claude_base_models:
-                        if base_model not in existing_ids:
-                            models.append({"id": base_model, "object": "model", "owned_by": "google"})
-                            models.append({"id": f"流式抗截断/{base_model}", "object": "model", "owned_by": "google"})
-                            print(f"[Antigravity] ✅ 强制添加 Claude 基础模型: {base_model}", flush=True)
-                    
-                    image_variants = [
-                        "gemini-3-pro-image", "agy-gemini-3-pro-image",
-                        "gemini-3-pro-image-2k", "agy-gemini-3-pro-image-2k",
-                        "流式抗截断/gemini-3-pro-image-2k", "流式抗截断/agy-gemini-3-pro-image-2k",
-                        "gemini-3-pro-image-4k", "agy-gemini-3-pro-image-4k",
-                        "流式抗截断/gemini-3-pro-image-4k", "流式抗截断/agy-gemini-3-pro-image-4k",
-                    ]
-                    existing_ids = {m["id"] for m in models}
-                    for variant in image_variants:
-                        if variant not in existing_ids:
-                            models.append({"id": variant, "object": "model", "owned_by": "google"})
-                            print(f"[Antigravity] ✅ 强制添加图片模型变体: {variant}", flush=True)
-                    
-                    # 调试：打印所有图片相关模型
-                    image_models = [m["id"] for m in models if "image" in m["id"].lower()]
-                    print(f"[Antigravity] 📷 图片模型列表: {image_models}", flush=True)
-                    
-                    return {"object": "list", "data": models}
-            except Exception as e:
-                print(f"[Antigravity] 获取动态模型列表失败: {e}", flush=True)
+def _build_model_list(dynamic_models: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """根据（缓存的）上游动态模型列表生成模型列表，没有时使用静态列表"""
+    if dynamic_models:
+        print(f"[Antigravity] 🔍 动态模型数量: {len(dynamic_models)}", flush=True)
+        
+        # 过滤掉不需要的测试/内部模型
+        # 只保留标准的 gemini, claude, gpt 模型
+        def is_valid_model(model_id: str) -> bool:
+            model_lower = model_id.lower()
+            # 排除条件：包含这些关键字的跳过
+            invalid_patterns = [
+                "chat_", "rev", "tab_", "uic", "test", "exp", "lite_preview",
+                "gcli-", "search"  # search模型反重力不支持
+            ]
+            for pattern in invalid_patterns:
+                if pattern in model_lower:
+                    return False
+            # 允许条件：必须是 gemini, claude, gpt 开头的模型
+            # 反重力支持 gemini-2.5 和 gemini-3 系列
+            valid_prefixes = [
+                "gemini-2.5", "gemini-3", "claude", "gpt-oss",
+                "agy-gemini-2.5", "agy-gemini-3", "agy-claude", "agy-gpt"
+            ]
+            for prefix in valid_prefixes:
+                if model_lower.startswith(prefix):
+                    return True
+            return False
+        
+        # 添加流式抗截断变体（假非流已自动处理，不需要单独列出）
+        models = []
+        for m in dynamic_models:
+            model_id = m.get("id", "")
+            # 过滤无效模型
+            if not is_valid_model(model_id):
+                continue
+            models.append({"id": model_id, "object": "model", "owned_by": "google"})
+            models.append({"id": f"流式抗截断/{model_id}", "object": "model", "owned_by": "google"})
+            
+            if "image" in model_id.lower() and "2k" not in model_id.lower() and "4k" not in model_id.lower():
+                models.append({"id": f"{model_id}-2k", "object": "model", "owned_by": "google"})
+                models.append({"id": f"{model_id}-4k", "object": "model", "owned_by": "google"})
+                if not model_id.startswith("agy-"):
+                    models.append({"id": f"agy-{model_id}-2k", "object": "model", "owned_by": "google"})
+                    models.append({"id": f"agy-{model_id}-4k", "object": "model", "owned_by": "google"})
+        
+        # 强制添加 Claude 模型的不带 -thinking 后缀版本
+        claude_base_models = [
+            "claude-opus-4-5", "agy-claude-opus-4-5",
+            "claude-sonnet-4-5", "agy-claude-sonnet-4-5",
+        ]
+        existing_ids = {m["id"] for m in models}
+        for base_model in claude_base_models:
+            if base_model not in existing_ids:
+                models.append({"id": base_model, "object": "model", "owned_by": "google"})
+                models.append({"id": f"流式抗截断/{base_model}", "object": "model", "owned_by": "google"})
+                print(f"[Antigravity] ✅ 强制添加 Claude 基础模型: {base_model}", flush=True)
+        
+        image_variants = [
+            "gemini-3-pro-image", "agy-gemini-3-pro-image",
+            "gemini-3-pro-image-2k", "agy-gemini-3-pro-image-2k",
+            "流式抗截断/gemini-3-pro-image-2k", "流式抗截断/agy-gemini-3-pro-image-2k",
+            "gemini-3-pro-image-4k", "agy-gemini-3-pro-image-4k",
+            "流式抗截断/gemini-3-pro-image-4k", "流式抗截断/agy-gemini-3-pro-image-4k",
+        ]
+        existing_ids = {m["id"] for m in models}
+        for variant in image_variants:
+            if variant not in existing_ids:
+                models.append({"id": variant, "object": "model", "owned_by": "google"})
+                print(f"[Antigravity] ✅ 强制添加图片模型变体: {variant}", flush=True)
+        
+        # 调试：打印所有图片相关模型
+        image_models = [m["id"] for m in models if "image" in m["id"].lower()]
+        print(f"[Antigravity] 📷 图片模型列表: {image_models}", flush=True)
+        
+        return {"object": "list", "data": models}
     
     # 回退到静态模型列表
     base_models = [
@@ -327,6 +281,17 @@ async def list_models(request: Request, user: User = Depends(get_user_from_api_k
     return {"object": "list", "data": models}
 
 
+@router.get("/v1/models")
+@router.get("/models")
+async def list_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
+    """列出可用模型 (OpenAI兼容) - Antigravity
+
+    上游动态模型列表来自 model_catalog 的缓存（后台刷新），不同步请求上游；支持 ETag
+    """
+    dynamic_models, version = model_catalog.upstream_models("antigravity")
+    return model_catalog.respond(request, ("antigravity", version), lambda: _build_model_list(dynamic_models))
+
+
 @router.post("/v1/chat/completions")
 @router.post("/chat/completions")
 async def chat_completions(
@@ -341,12 +306,10 @@ async def chat_completions(
     client_ip = request.headers.get("X-Forwarded-For", request.client.host if request.client else "unknown").split(",")[0].strip()
     user_agent = request.headers.get("User-Agent", "")[:500]
     
-    try:
-        body = await request.json()
-    except:
-        raise HTTPException(status_code=400, detail="无效的JSON请求体")
+    body = await get_json_body(request)
     
-    request_body_str = json.dumps(body, ensure_ascii=False)[:2000] if body else None
+    # 请求内容摘要（截断到2000字符，省略图片数据），只在写入失败日志时才生成
+    request_snapshot = RequestSnapshot(body)
     
     model = body.get("model", "gemini-2.5-flash")
     # 去除 agy- 前缀（用于标识 Antigravity 模型，但 API 不需要它）
@@ -359,7 +322,11 @@ async def chat_completions(
         raise HTTPException(status_code=400, detail="messages不能为空")
     
     # 检查用户是否有公开的 Antigravity 凭证
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id, mode="antigravity")
+    entitlement = await entitlements.get(db, user)
+    user_has_public = entitlement.has_public("antigravity")
+    
+    # 模型大面积配额耗尽时直接快速失败（不计入 RPM，也不扣配额；只看该请求可用的凭证池）
+    await CredentialPool.enforce_model_breaker(db, user.id, user_has_public, model, mode="antigravity")
     
     # 速率限制检查
     if not user.is_admin:
@@ -370,7 +337,7 @@ async def chat_completions(
             .where(UsageLog.created_at >= one_minute_ago)
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.antigravity_contributor_rpm if user_has_public else settings.antigravity_base_rpm
+        max_rpm = entitlement.rpm_limit("antigravity")
         
         if current_rpm >= max_rpm:
             raise HTTPException(
@@ -409,16 +376,14 @@ async def chat_completions(
     await db.refresh(placeholder_log)
     placeholder_log_id = placeholder_log.id
     
-    # 获取 Antigravity 凭证
-    max_retries = settings.error_retry_count
-    tried_credential_ids = set()
+    # 获取 Antigravity 凭证（报错时由 FailoverExecutor 切换凭证重试）
+    credential_source = CredentialSource(user.id, user_has_public, model, mode="antigravity")
     
     credential = await CredentialPool.get_available_credential(
         db,
         user_id=user.id,
         user_has_public_creds=user_has_public,
         model=model,
-        exclude_ids=tried_credential_ids,
         mode="antigravity"  # 使用 Antigravity 凭证
     )
     if not credential:
@@ -445,8 +410,6 @@ async def chat_completions(
         await db.commit()
         raise HTTPException(status_code=503, detail="暂无可用凭证，请稍后重试")
     
-    tried_credential_ids.add(credential.id)
-    
     # 使用 Antigravity 模式获取 token 和 project_id
     access_token, project_id = await CredentialPool.get_access_token_and_project(credential, db, mode="antigravity")
     if not access_token:
@@ -472,8 +435,6 @@ async def chat_completions(
         placeholder_log.credential_email = credential.email
         await db.commit()
         raise HTTPException(status_code=503, detail="凭证未激活 Antigravity，无法获取 project_id")
-    first_credential_id = credential.id
-    first_credential_email = credential.email
     print(f"[Antigravity Proxy] ★★★ 凭证信息 ★★★", flush=True)
     print(f"[Antigravity Proxy] ★ 凭证邮箱: {credential.email}", flush=True)
     print(f"[Antigravity Proxy] ★ Project ID: {project_id}", flush=True)
@@ -484,303 +445,16 @@ async def chat_completions(
     client = AntigravityClient(access_token, project_id)
     print(f"[Antigravity Proxy] AntigravityClient 已创建, api_base: {client.api_base}", flush=True)
     use_fake_streaming = client.is_fake_streaming(model)
-    last_error = None
     
-    # 非流式处理
-    async def handle_non_stream():
-        nonlocal credential, access_token, project_id, client, tried_credential_ids, last_error
-        
-        for retry_attempt in range(max_retries + 1):
-            try:
-                result = await client.chat_completions(
-                    model=model,
-                    messages=messages,
-                    server_base_url=str(request.base_url).rstrip("/"),
-                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-                )
-                
-                latency = (time.time() - start_time) * 1000
-                
-                placeholder_log.credential_id = credential.id
-                placeholder_log.status_code = 200
-                placeholder_log.latency_ms = latency
-                placeholder_log.credential_email = credential.email
-                placeholder_log.retry_count = retry_attempt
-                await db.commit()
-                
-                credential.total_requests = (credential.total_requests or 0) + 1
-                credential.last_used_at = datetime.utcnow()
-                await db.commit()
-                
-                await notify_log_update({
-                    "username": user.username,
-                    "model": f"antigravity/{model}",
-                    "status_code": 200,
-                    "latency_ms": round(latency, 0),
-                    "created_at": datetime.utcnow().isoformat()
-                })
-                await notify_stats_update()
-                
-                return JSONResponse(content=result)
-                
-            except Exception as e:
-                error_str = str(e)
-                last_error = error_str
-                
-                # 检查是否是 Token 过期导致的 401 错误
-                is_auth_error = any(code in error_str for code in ["401", "UNAUTHENTICATED", "invalid_grant", "Token has been expired", "token expired"])
-                
-                if is_auth_error:
-                    # 先尝试刷新当前凭证的 Token
-                    print(f"[Antigravity Proxy] ⚠️ 认证失败，尝试刷新 Token: {credential.email}", flush=True)
-                    new_token = await CredentialPool.refresh_access_token(credential)
-                    
-                    if new_token:
-                        # 刷新成功，更新凭证并重试
-                        from app.services.crypto import encrypt_credential
-                        credential.api_key = encrypt_credential(new_token)
-                        await db.commit()
-                        client = AntigravityClient(new_token, project_id)
-                        print(f"[Antigravity Proxy] ✅ Token 刷新成功，使用相同凭证重试: {credential.email}", flush=True)
-                        continue
-                    else:
-                        # 刷新失败，禁用凭证
-                        print(f"[Antigravity Proxy] ❌ Token 刷新失败，禁用凭证: {credential.email}", flush=True)
-                        await CredentialPool.handle_credential_failure(db, credential.id, error_str)
-                else:
-                    # 非认证错误，照常处理
-                    await CredentialPool.handle_credential_failure(db, credential.id, error_str)
-                
-                # 决定是否切换凭证重试（增加401到重试列表）
-                should_retry = any(code in error_str for code in ["401", "404", "500", "502", "503", "504", "429", "UNAUTHENTICATED", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
-                
-                if should_retry and retry_attempt < max_retries:
-                    print(f"[Antigravity Proxy] ⚠️ 请求失败: {error_str}，切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
-                    
-                    credential = await CredentialPool.get_available_credential(
-                        db, user_id=user.id, user_has_public_creds=user_has_public,
-                        model=model, exclude_ids=tried_credential_ids,
-                        mode="antigravity"  # 使用 Antigravity 凭证
-                    )
-                    if not credential:
-                        break
-                    
-                    tried_credential_ids.add(credential.id)
-                    access_token, project_id = await CredentialPool.get_access_token_and_project(credential, db, mode="antigravity")
-                    if not access_token or not project_id:
-                        continue
-                    client = AntigravityClient(access_token, project_id)
-                    print(f"[Antigravity Proxy] 🔄 切换到凭证: {credential.email}", flush=True)
-                    continue
-                
-                status_code = extract_status_code(error_str)
-                latency = (time.time() - start_time) * 1000
-                error_type, error_code = classify_error_simple(status_code, error_str)
-                
-                placeholder_log.credential_id = credential.id
-                placeholder_log.status_code = status_code
-                placeholder_log.latency_ms = latency
-                placeholder_log.error_message = error_str[:2000]
-                placeholder_log.error_type = error_type
-                placeholder_log.error_code = error_code
-                placeholder_log.credential_email = credential.email
-                placeholder_log.request_body = request_body_str
-                placeholder_log.retry_count = retry_attempt
-                await db.commit()
-                
-                raise HTTPException(status_code=status_code, detail=f"Antigravity API调用失败 (已重试 {retry_attempt + 1} 次): {error_str}")
-        
-        raise HTTPException(status_code=503, detail=f"所有凭证都失败了: {last_error}")
-    
-    # 假非流模式：以流式调用 API，发送心跳保持连接，最后返回普通 JSON
-    # 适用于：前端强制非流式（stream=false），但需要防止 Cloudflare 504 超时
-    async def fake_non_stream_generator():
-        nonlocal credential, access_token, project_id, client, tried_credential_ids, last_error
-        
-        heartbeat_interval = 15  # 每15秒发送一次心跳（空格）
-        
-        for retry_attempt in range(max_retries + 1):
-            try:
-                full_content = ""
-                reasoning_content = ""
-                last_heartbeat = time.time()
-                
-                async for chunk in client.chat_completions_stream(
-                    model=model,
-                    messages=messages,
-                    server_base_url=str(request.base_url).rstrip("/"),
-                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-                ):
-                    # 定期发送心跳保持连接
-                    if time.time() - last_heartbeat > heartbeat_interval:
-                        yield " "  # 发送空格作为心跳
-                        last_heartbeat = time.time()
-                    
-                    # 解析流式响应块，提取内容
-                    if chunk.startswith("data: "):
-                        chunk_data = chunk[6:]
-                        if chunk_data.strip() == "[DONE]":
-                            continue
-                        try:
-                            chunk_json = json.loads(chunk_data)
-                            if "choices" in chunk_json and chunk_json["choices"]:
-                                delta = chunk_json["choices"][0].get("delta", {})
-                                if "content" in delta:
-                                    full_content += delta["content"]
-                                if "reasoning_content" in delta:
-                                    reasoning_content += delta["reasoning_content"]
-                        except json.JSONDecodeError:
-                            pass
-                
-                # 收集完成，更新日志
-                latency = (time.time() - start_time) * 1000
-                
-                try:
-                    async with async_session() as bg_db:
-                        log_result = await bg_db.execute(
-                            select(UsageLog).where(UsageLog.id == placeholder_log_id)
-                        )
-                        log = log_result.scalar_one_or_none()
-                        if log:
-                            log.credential_id = credential.id
-                            log.status_code = 200
-                            log.latency_ms = latency
-                            log.credential_email = credential.email
-                            log.retry_count = retry_attempt
-                        
-                        # 更新凭证使用次数
-                        from app.models.user import Credential as CredentialModel
-                        cred_result = await bg_db.execute(
-                            select(CredentialModel).where(CredentialModel.id == credential.id)
-                        )
-                        cred = cred_result.scalar_one_or_none()
-                        if cred:
-                            cred.total_requests = (cred.total_requests or 0) + 1
-                            cred.last_used_at = datetime.utcnow()
-                        
-                        await bg_db.commit()
-                except Exception as log_err:
-                    print(f"[Antigravity Proxy] ⚠️ 假非流日志记录失败: {log_err}", flush=True)
-                
-                await notify_log_update({
-                    "username": user.username,
-                    "model": f"antigravity/{model}",
-                    "status_code": 200,
-                    "latency_ms": round(latency, 0),
-                    "created_at": datetime.utcnow().isoformat()
-                })
-                await notify_stats_update()
-                
-                # 构建并返回 JSON 响应
-                message = {"role": "assistant", "content": full_content}
-                if reasoning_content:
-                    message["reasoning_content"] = reasoning_content
-                
-                result = {
-                    "id": "chatcmpl-antigravity",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": model,
-                    "choices": [{
-                        "index": 0,
-                        "message": message,
-                        "finish_reason": "stop"
-                    }],
-                    "usage": {
-                        "prompt_tokens": 0,
-                        "completion_tokens": 0,
-                        "total_tokens": 0
-                    }
-                }
-                yield json.dumps(result)
-                return
-                
-            except Exception as e:
-                error_str = str(e)
-                last_error = error_str
-                
-                # 检查是否是 Token 过期导致的 401 错误
-                is_auth_error = any(code in error_str for code in ["401", "UNAUTHENTICATED", "invalid_grant", "Token has been expired", "token expired"])
-                
-                if is_auth_error:
-                    # 先尝试刷新当前凭证的 Token
-                    print(f"[Antigravity Proxy] ⚠️ 假非流认证失败，尝试刷新 Token: {credential.email}", flush=True)
-                    try:
-                        async with async_session() as bg_db:
-                            # 重新获取凭证
-                            from sqlalchemy import select
-                            from app.models.user import Credential as CredentialModel
-                            result = await bg_db.execute(select(CredentialModel).where(CredentialModel.id == credential.id))
-                            cred_obj = result.scalar_one_or_none()
-                            if cred_obj:
-                                new_token = await CredentialPool.refresh_access_token(cred_obj)
-                                if new_token:
-                                    # 刷新成功，更新凭证并重试
-                                    from app.services.crypto import encrypt_credential
-                                    cred_obj.api_key = encrypt_credential(new_token)
-                                    await bg_db.commit()
-                                    access_token = new_token
-                                    client = AntigravityClient(new_token, project_id)
-                                    print(f"[Antigravity Proxy] ✅ 假非流 Token 刷新成功: {credential.email}", flush=True)
-                                    continue
-                                else:
-                                    # 刷新失败，禁用凭证
-                                    print(f"[Antigravity Proxy] ❌ 假非流 Token 刷新失败: {credential.email}", flush=True)
-                                    await CredentialPool.handle_credential_failure(bg_db, credential.id, error_str)
-                    except Exception as refresh_err:
-                        print(f"[Antigravity Proxy] ⚠️ 假非流 Token 刷新异常: {refresh_err}", flush=True)
-                else:
-                    # 非认证错误，照常处理
-                    try:
-                        async with async_session() as bg_db:
-                            await CredentialPool.handle_credential_failure(bg_db, credential.id, error_str)
-                    except:
-                        pass
-                
-                should_retry = any(code in error_str for code in ["401", "404", "500", "502", "503", "504", "429", "UNAUTHENTICATED", "RESOURCE_EXHAUSTED", "NOT_FOUND"])
-                
-                if should_retry and retry_attempt < max_retries:
-                    print(f"[Antigravity Proxy] ⚠️ 假非流请求失败: {error_str}，切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
-                    
-                    try:
-                        async with async_session() as bg_db:
-                            new_cred = await CredentialPool.get_available_credential(
-                                bg_db, user_id=user.id, user_has_public_creds=user_has_public,
-                                model=model, exclude_ids=tried_credential_ids,
-                                mode="antigravity"
-                            )
-                            if new_cred:
-                                tried_credential_ids.add(new_cred.id)
-                                new_token, new_project = await CredentialPool.get_access_token_and_project(new_cred, bg_db, mode="antigravity")
-                                if new_token and new_project:
-                                    credential = new_cred
-                                    access_token = new_token
-                                    project_id = new_project
-                                    client = AntigravityClient(access_token, project_id)
-                                    print(f"[Antigravity Proxy] 🔄 切换到凭证: {credential.email}", flush=True)
-                                    continue
-                    except Exception as retry_err:
-                        print(f"[Antigravity Proxy] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
-                
-                # 失败，返回错误 JSON
-                yield json.dumps({"error": f"Antigravity 假非流调用失败: {error_str}"})
-                return
-        
-        yield json.dumps({"error": f"所有凭证都失败了: {last_error}"})
-    
-    # 路由逻辑：
-    # 1. 假非流模式（假非流/前缀 或 stream=false）：使用 StreamingResponse + 心跳，返回 JSON
-    # 2. 普通流式：调用流式 API
-    # 注意：反重力 API 非流式可能超时，所以非流式请求也自动使用假非流模式
-    if use_fake_streaming or not stream:
-        print(f"[Antigravity Proxy] 🔄 使用假非流模式 (use_fake_streaming={use_fake_streaming}, stream={stream})", flush=True)
-        return StreamingResponse(
-            fake_non_stream_generator(),
-            media_type="application/json",
-            headers={"Cache-Control": "no-cache"}
-        )
+    # Token 过期导致的认证失败先刷新当前凭证的 Token 重试，其余可重试错误换凭证
+    failover = FailoverExecutor(
+        credential_source, credential_source.lease_for(credential, access_token, project_id),
+        max_retries=settings.error_retry_count, tag="Antigravity Proxy", refresh_on_auth=True
+    )
+    server_base_url = str(request.base_url).rstrip("/")
+    extra_params = {k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
     
-    # 流式处理
+    # 日志记录（独立会话，不持有主db连接）
     async def save_log_background(log_data: dict):
         try:
             async with async_session() as bg_db:
@@ -805,7 +479,7 @@ async def chat_completions(
                     log.error_type = error_type
                     log.error_code = error_code
                     log.credential_email = log_data.get("cred_email")
-                    log.request_body = request_body_str if status_code != 200 else None
+                    log.request_body = request_snapshot.text if status_code != 200 else None
                     log.retry_count = log_data.get("retry_count", 0)
                 
                 cred_id = log_data.get("cred_id")
@@ -834,119 +508,143 @@ async def chat_completions(
         except Exception as log_err:
             print(f"[Antigravity Proxy] ❌ 后台日志记录失败: {log_err}", flush=True)
     
-    async def stream_generator_with_retry():
-        nonlocal access_token, project_id, client, tried_credential_ids, last_error
-        current_cred_id = first_credential_id
-        current_cred_email = first_credential_email
+    async def log_failure(e: FailoverError):
+        await save_log_background({
+            "status_code": 503 if e.exhausted else extract_status_code(e.error_str),
+            "cred_id": e.lease.credential_id,
+            "cred_email": e.lease.email,
+            "error_message": e.error_str,
+            "latency_ms": (time.time() - start_time) * 1000,
+            "retry_count": e.retry_count
+        })
+    
+    async def log_success():
+        await save_log_background({
+            "status_code": 200,
+            "cred_id": failover.lease.credential_id,
+            "cred_email": failover.lease.email,
+            "latency_ms": (time.time() - start_time) * 1000,
+            "retry_count": failover.retry_count
+        })
+    
+    # 假非流模式：以流式调用 API，发送心跳保持连接，最后返回普通 JSON
+    # 适用于：前端强制非流式（stream=false），但需要防止 Cloudflare 504 超时
+    async def fake_non_stream_generator():
+        heartbeat_interval = 15  # 每15秒发送一次心跳（空格）
+        collected = {}
         
-        for stream_retry in range(max_retries + 1):
-            try:
-                if use_fake_streaming:
-                    async for chunk in client.chat_completions_fake_stream(
-                        model=model,
-                        messages=messages,
-                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-                    ):
-                        yield chunk
-                else:
-                    async for chunk in client.chat_completions_stream(
-                        model=model,
-                        messages=messages,
-                        server_base_url=str(request.base_url).rstrip("/"),
-                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-                    ):
-                        yield chunk
-                
-                latency = (time.time() - start_time) * 1000
-                await save_log_background({
-                    "status_code": 200,
-                    "cred_id": current_cred_id,
-                    "cred_email": current_cred_email,
-                    "latency_ms": latency,
-                    "retry_count": stream_retry
-                })
-                yield "data: [DONE]\n\n"
-                return
-                
-            except Exception as e:
-                error_str = str(e)
-                last_error = error_str
-                
-                # 检查是否是 Token 过期导致的 401 错误
-                is_auth_error = any(code in error_str for code in ["401", "UNAUTHENTICATED", "invalid_grant", "Token has been expired", "token expired"])
-                
-                if is_auth_error:
-                    # 先尝试刷新当前凭证的 Token
-                    print(f"[Antigravity Proxy] ⚠️ 流式认证失败，尝试刷新 Token: {current_cred_email}", flush=True)
-                    try:
-                        async with async_session() as stream_db:
-                            from sqlalchemy import select
-                            from app.models.user import Credential as CredentialModel
-                            result = await stream_db.execute(select(CredentialModel).where(CredentialModel.id == current_cred_id))
-                            cred_obj = result.scalar_one_or_none()
-                            if cred_obj:
-                                new_token = await CredentialPool.refresh_access_token(cred_obj)
-                                if new_token:
-                                    from app.services.crypto import encrypt_credential
-                                    cred_obj.api_key = encrypt_credential(new_token)
-                                    await stream_db.commit()
-                                    access_token = new_token
-                                    client = AntigravityClient(new_token, project_id)
-                                    print(f"[Antigravity Proxy] ✅ 流式 Token 刷新成功: {current_cred_email}", flush=True)
-                                    continue
-                                else:
-                                    print(f"[Antigravity Proxy] ❌ 流式 Token 刷新失败: {current_cred_email}", flush=True)
-                                    await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
-                    except Exception as refresh_err:
-                        print(f"[Antigravity Proxy] ⚠️ 流式 Token 刷新异常: {refresh_err}", flush=True)
-                else:
-                    try:
-                        async with async_session() as stream_db:
-                            await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
-                    except Exception as db_err:
-                        print(f"[Antigravity Proxy] ⚠️ 标记凭证失败时出错: {db_err}", flush=True)
-                
-                should_retry = any(code in error_str for code in ["401", "404", "500", "502", "503", "504", "429", "UNAUTHENTICATED", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
-                
-                if should_retry and stream_retry < max_retries:
-                    print(f"[Antigravity Proxy] ⚠️ 流式请求失败: {error_str}，切换凭证重试 ({stream_retry + 2}/{max_retries + 1})", flush=True)
-                    
+        async def call(lease):
+            full_content = ""
+            reasoning_content = ""
+            last_heartbeat = time.time()
+            
+            client = AntigravityClient(lease.access_token, lease.project_id)
+            async for chunk in client.chat_completions_stream(
+                model=model,
+                messages=messages,
+                server_base_url=server_base_url,
+                **extra_params
+            ):
+                # 定期发送心跳保持连接
+                if time.time() - last_heartbeat > heartbeat_interval:
+                    yield " "  # 发送空格作为心跳
+                    last_heartbeat = time.time()
+                
+                # 解析流式响应块，提取内容
+                if chunk.startswith("data: "):
+                    chunk_data = chunk[6:]
+                    if chunk_data.strip() == "[DONE]":
+                        continue
                     try:
-                        async with async_session() as stream_db:
-                            new_credential = await CredentialPool.get_available_credential(
-                                stream_db, user_id=user.id, user_has_public_creds=user_has_public,
-                                model=model, exclude_ids=tried_credential_ids,
-                                mode="antigravity"  # 使用 Antigravity 凭证
-                            )
-                            if new_credential:
-                                tried_credential_ids.add(new_credential.id)
-                                new_token, new_project_id = await CredentialPool.get_access_token_and_project(new_credential, stream_db, mode="antigravity")
-                                if new_token and new_project_id:
-                                    current_cred_id = new_credential.id
-                                    current_cred_email = new_credential.email
-                                    access_token = new_token
-                                    project_id = new_project_id
-                                    client = AntigravityClient(access_token, project_id)
-                                    print(f"[Antigravity Proxy] 🔄 切换到凭证: {current_cred_email}", flush=True)
-                                    continue
-                    except Exception as retry_err:
-                        print(f"[Antigravity Proxy] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
-                
-                status_code = extract_status_code(error_str)
-                latency = (time.time() - start_time) * 1000
-                await save_log_background({
-                    "status_code": status_code,
-                    "cred_id": current_cred_id,
-                    "cred_email": current_cred_email,
-                    "error_message": error_str,
-                    "latency_ms": latency,
-                    "retry_count": stream_retry
-                })
-                yield f"data: {json.dumps({'error': f'Antigravity API Error (已重试 {stream_retry + 1} 次): {error_str}'})}\n\n"
-                return
+                        chunk_json = json_codec.loads(chunk_data)
+                        if "choices" in chunk_json and chunk_json["choices"]:
+                            delta = chunk_json["choices"][0].get("delta", {})
+                            if "content" in delta:
+                                full_content += delta["content"]
+                                failover.observe(len(delta["content"] or ""))
+                            if "reasoning_content" in delta:
+                                reasoning_content += delta["reasoning_content"]
+                                failover.observe(len(delta["reasoning_content"] or ""))
+                    except json_codec.JSONDecodeError:
+                        pass
+            
+            collected["content"] = full_content
+            collected["reasoning_content"] = reasoning_content
+        
+        try:
+            async for heartbeat in failover.stream(call):
+                yield heartbeat
+        except FailoverError as e:
+            await log_failure(e)
+            # 失败，返回错误 JSON
+            if e.exhausted:
+                yield json_codec.dumps({"error": f"所有凭证都失败了: {e.error_str}"})
+            else:
+                yield json_codec.dumps({"error": f"Antigravity 假非流调用失败: {e.error_str}"})
+            return
+        
+        # 收集完成，更新日志
+        await log_success()
+        
+        # 构建并返回 JSON 响应
+        message = {"role": "assistant", "content": collected["content"]}
+        if collected["reasoning_content"]:
+            message["reasoning_content"] = collected["reasoning_content"]
+        
+        result = {
+            "id": "chatcmpl-antigravity",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": message,
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0
+            }
+        }
+        yield json_codec.dumps(result)
+    
+    # 路由逻辑：
+    # 1. 假非流模式（假非流/前缀 或 stream=false）：使用 StreamingResponse + 心跳，返回 JSON
+    # 2. 普通流式：调用流式 API
+    # 注意：反重力 API 非流式可能超时，所以非流式请求也自动使用假非流模式
+    if use_fake_streaming or not stream:
+        print(f"[Antigravity Proxy] 🔄 使用假非流模式 (use_fake_streaming={use_fake_streaming}, stream={stream})", flush=True)
+        return StreamingResponse(
+            fake_non_stream_generator(),
+            media_type="application/json",
+            headers={"Cache-Control": "no-cache"}
+        )
+    
+    # 流式处理
+    async def stream_generator_with_retry():
+        def call(lease):
+            client = AntigravityClient(lease.access_token, lease.project_id)
+            return client.chat_completions_stream(
+                model=model,
+                messages=messages,
+                server_base_url=server_base_url,
+                **extra_params
+            )
+        
+        try:
+            async for chunk in failover.stream(call):
+                yield chunk
+        except FailoverError as e:
+            await log_failure(e)
+            yield json_codec.sse({'error': f'Antigravity API Error (已重试 {e.retry_count + 1} 次): {e.error_str}'})
+            return
+        
+        await log_success()
+        yield "data: [DONE]\n\n"
     
     return StreamingResponse(
-        stream_generator_with_retry(),
+        coalesce_sse(stream_generator_with_retry(), "antigravity"),
         media_type="text/event-stream",
         headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
     )
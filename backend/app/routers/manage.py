@@ -1,7 +1,7 @@
 """
 管理功能路由 - 凭证管理、配置、统计等
 """
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
 from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func, update
@@ -17,6 +17,8 @@ from app.models.user import User, Credential, UsageLog
 from app.services.auth import get_current_user, get_current_admin
 from app.services.crypto import encrypt_credential, decrypt_credential
 from app.services.websocket import notify_stats_update
+from app.services.jobs import job_manager, JobContext
+from app.services.entitlements import entitlements
 from app.config import settings
 
 
@@ -115,6 +117,8 @@ async def batch_credential_action(
     else:
         raise HTTPException(status_code=400, detail="无效的操作")
     
+    # 批量 UPDATE 不触发 ORM 事件，提交后权益快照全部失效
+    entitlements.invalidate_on_commit(db)
     await db.commit()
     return {"message": f"已对 {len(ids)} 个凭证执行 {action} 操作"}
 
@@ -345,72 +349,60 @@ async def verify_credential(
     }
 
 
-# 后台任务状态存储
-_background_tasks = {}
+# ===== 后台任务：一键启动 / 一键检测 =====
 
-@router.post("/credentials/start-all")
-async def start_all_credentials(
-    background_tasks: BackgroundTasks,
-    user: User = Depends(get_current_admin),
-    db: AsyncSession = Depends(get_db)
-):
-    """一键启动所有凭证（后台任务，立即返回）"""
+JOB_START_ALL = "credentials.start_all"
+JOB_VERIFY_ALL = "credentials.verify_all"
+
+
+async def _start_all_job(ctx: JobContext):
+    """一键启动：按 id 分块刷新 OAuth 凭证的 access_token，每块写一次断点"""
     import asyncio
     from app.services.credential_pool import CredentialPool
-    from app.services.crypto import encrypt_credential
     from app.database import async_session
     
-    result = await db.execute(
-        select(Credential).where(
-            Credential.credential_type == "oauth",
-            Credential.refresh_token.isnot(None)
-        )
-    )
-    creds = result.scalars().all()
-    total = len(creds)
-    
-    # 提取凭证数据（避免 session 关闭后无法访问）
-    cred_data = [{
-        "id": c.id,
-        "email": c.email,
-        "refresh_token": c.refresh_token,
-        "client_id": c.client_id,
-        "client_secret": c.client_secret,
-    } for c in creds]
-    
-    task_id = f"start_{datetime.utcnow().timestamp()}"
-    _background_tasks[task_id] = {"status": "running", "total": total, "success": 0, "failed": 0, "progress": 0}
-    
-    async def run_in_background():
-        """后台执行刷新"""
-        semaphore = asyncio.Semaphore(50)  # 更高并发
-        success = 0
-        failed = 0
-        
-        async def refresh_single(data):
-            nonlocal success, failed
-            async with semaphore:
-                try:
-                    # 创建临时凭证对象用于刷新
-                    temp_cred = Credential(
-                        id=data["id"],
-                        refresh_token=data["refresh_token"],
-                        client_id=data["client_id"],
-                        client_secret=data["client_secret"]
-                    )
-                    access_token = await CredentialPool.refresh_access_token(temp_cred)
-                    return {"id": data["id"], "email": data["email"], "token": access_token}
-                except Exception as e:
-                    print(f"[启动凭证] ❌ {data['email']} 异常: {e}", flush=True)
-                    return {"id": data["id"], "email": data["email"], "token": None}
+    semaphore = asyncio.Semaphore(50)  # 更高并发
+    last_id = ctx.cursor.get("last_id", 0)
+    
+    async def refresh_single(data):
+        async with semaphore:
+            try:
+                # 创建临时凭证对象用于刷新
+                temp_cred = Credential(
+                    id=data.id,
+                    refresh_token=data.refresh_token,
+                    client_id=data.client_id,
+                    client_secret=data.client_secret
+                )
+                access_token = await CredentialPool.refresh_access_token(temp_cred)
+                return {"id": data.id, "email": data.email, "token": access_token}
+            except Exception as e:
+                print(f"[启动凭证] ❌ {data.email} 异常: {e}", flush=True)
+                return {"id": data.id, "email": data.email, "token": None}
+    
+    print(f"[启动凭证] 后台开始刷新 {ctx.total} 个凭证...", flush=True)
+    while True:
+        async with async_session() as session:
+            rows = (await session.execute(
+                select(
+                    Credential.id, Credential.email, Credential.refresh_token,
+                    Credential.client_id, Credential.client_secret
+                )
+                .where(Credential.credential_type == "oauth", Credential.refresh_token.isnot(None))
+                .where(Credential.id > last_id)
+                .order_by(Credential.id)
+                .limit(settings.job_chunk_size)
+            )).all()
+        if not rows:
+            break
         
-        # 并发刷新
-        print(f"[启动凭证] 后台开始刷新 {total} 个凭证...", flush=True)
-        results = await asyncio.gather(*[refresh_single(d) for d in cred_data])
+        results = await asyncio.gather(*[refresh_single(r) for r in rows])
         
-        # 批量更新数据库
+        # 本块的数据库更新与断点在同一事务提交
         async with async_session() as session:
+            items = []
             for res in results:
+                ok = False
                 if res["token"]:
                     result = await session.execute(
                         update(Credential)
@@ -423,24 +415,244 @@ async def start_all_credentials(
                     )
                     # 检查是否实际更新了行
                     if result.rowcount > 0:
-                        success += 1
+                        ok = True
                         print(f"[启动凭证] ✅ {res['email']}", flush=True)
                     else:
-                        failed += 1
                         print(f"[启动凭证] ⚠️ {res['email']} Token获取成功但数据库更新失败(凭证可能已被删除)", flush=True)
-                else:
-                    failed += 1
-            await session.commit()
+                key = "success" if ok else "failed"
+                ctx.progress[key] = ctx.progress.get(key, 0) + 1
+                items.append({"id": res["id"], "email": res["email"], "success": ok})
+            last_id = rows[-1].id
+            entitlements.invalidate_on_commit(session)
+            await ctx.commit({"last_id": last_id}, processed=len(rows), results=items, session=session)
+    
+    print(f"[启动凭证] 完成: 成功 {ctx.progress.get('success', 0)}, 失败 {ctx.progress.get('failed', 0)}", flush=True)
+    
+    # 通知前端刷新统计数据
+    await notify_stats_update()
+
+
+# 一键检测流水线参数
+VERIFY_WORKERS = 50        # 并发检测的 worker 数（共享一个 HTTP 连接池）
+VERIFY_WRITE_BATCH = 100   # 每批写库的结果数（一次 executemany + 一个断点）
+
+
+async def _verify_all_job(ctx: JobContext):
+    """一键检测：生产者/消费者流水线
+    
+    reader(按 id 分页读取) -> 有界队列 -> N 个 worker(共享 HTTP 客户端，2.5/3.0 并行探测)
+    -> 有界队列 -> writer(按批 executemany 写库 + 写断点)
+    
+    内存占用与凭证总数无关；断点为“此 id 之前全部已写库”的水位线，
+    以及水位线之上已写库的 id（最多一个在途窗口），重启后跳过这些 id。
+    """
+    import asyncio
+    import httpx
+    from collections import deque
+    from sqlalchemy import bindparam
+    from app.services.credential_pool import CredentialPool
+    from app.database import async_session
+    
+    test_url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
+    watermark = ctx.cursor.get("last_id", 0)
+    done_above = set(ctx.cursor.get("done_above", []))
+    
+    in_queue: asyncio.Queue = asyncio.Queue(maxsize=VERIFY_WORKERS * 2)
+    out_queue: asyncio.Queue = asyncio.Queue(maxsize=VERIFY_WRITE_BATCH * 2)
+    issued = deque()  # 已发出的 id（按 id 升序），用于推进水位线
+    
+    cred_table = Credential.__table__
+    # 只写检测得到的结果：参数为 NULL（未检测出账号类型 / 未拿到新 token）的列保留写库时的当前值，
+    # 不用读取时的旧快照覆盖检测期间的其他修改
+    update_stmt = (
+        update(cred_table)
+        .where(cred_table.c.id == bindparam("b_id"))
+        .values(
+            is_active=bindparam("b_is_active"),
+            model_tier=bindparam("b_model_tier"),
+            account_type=func.coalesce(bindparam("b_account_type"), cred_table.c.account_type),
+            api_key=func.coalesce(bindparam("b_api_key"), cred_table.c.api_key),
+        )
+    )
+    
+    async def probe(client, headers, model, project_id):
+        payload = {
+            "model": model,
+            "project": project_id or "",
+            "request": {"contents": [{"role": "user", "parts": [{"text": "hi"}]}]}
+        }
+        resp = await client.post(test_url, headers=headers, json=payload, timeout=10)
+        return resp.status_code in [200, 429]
+    
+    async def verify_single(client, data):
+        result = {"row": data, "is_valid": False, "supports_3": False, "account_type": "unknown", "token": None}
+        try:
+            # 获取 access_token
+            temp_cred = Credential(
+                id=data.id,
+                refresh_token=data.refresh_token,
+                client_id=data.client_id,
+                client_secret=data.client_secret,
+                project_id=data.project_id,
+                credential_type=data.credential_type,
+                api_key=data.api_key,
+            )
+            access_token = await CredentialPool.refresh_access_token(temp_cred, client=client) if temp_cred.refresh_token else None
+            if not access_token:
+                return result
+            result["token"] = access_token
+            
+            # 2.5 和 3.0 并行探测
+            headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+            ok_25, ok_3 = await asyncio.gather(
+                probe(client, headers, "gemini-2.5-flash", data.project_id),
+                probe(client, headers, "gemini-3-pro-preview", data.project_id),
+                return_exceptions=True
+            )
+            result["is_valid"] = ok_25 is True
+            result["supports_3"] = result["is_valid"] and ok_3 is True
+            
+            # 检测账号类型
+            if result["is_valid"] and data.project_id:
+                try:
+                    type_result = await CredentialPool.detect_account_type(access_token, data.project_id, client=client)
+                    result["account_type"] = type_result.get("account_type", "unknown")
+                except:
+                    pass
+        except Exception as e:
+            print(f"[检测] ❌ {data.email} 异常: {e}", flush=True)
+        return result
+    
+    async def reader():
+        last_id = watermark
+        while True:
+            async with async_session() as session:
+                rows = (await session.execute(
+                    select(
+                        Credential.id, Credential.email, Credential.refresh_token,
+                        Credential.client_id, Credential.client_secret, Credential.project_id,
+                        Credential.credential_type, Credential.api_key
+                    )
+                    .where(Credential.id > last_id)
+                    .order_by(Credential.id)
+                    .limit(settings.job_chunk_size)
+                )).all()
+            if not rows:
+                break
+            for row in rows:
+                if row.id in done_above:
+                    continue
+                issued.append(row.id)
+                await in_queue.put(row)
+            last_id = rows[-1].id
+        for _ in range(VERIFY_WORKERS):
+            await in_queue.put(None)
+    
+    async def worker(client):
+        while True:
+            row = await in_queue.get()
+            if row is None:
+                await out_queue.put(None)
+                return
+            await out_queue.put(await verify_single(client, row))
+    
+    async def flush(batch):
+        nonlocal watermark
+        params = []
+        items = []
+        for res in batch:
+            row = res["row"]
+            model_tier = "3" if res["supports_3"] else "2.5"
+            params.append({
+                "b_id": row.id,
+                "b_is_active": res["is_valid"],
+                "b_model_tier": model_tier,
+                # 每行参数键一致以便 executemany；None 表示保留库里的当前值
+                "b_account_type": None if res["account_type"] == "unknown" else res["account_type"],
+                "b_api_key": encrypt_credential(res["token"]) if res["token"] else None,
+            })
+            if res["is_valid"]:
+                ctx.progress["valid"] = ctx.progress.get("valid", 0) + 1
+                if res["supports_3"]:
+                    ctx.progress["tier3"] = ctx.progress.get("tier3", 0) + 1
+                if res["account_type"] == "pro":
+                    ctx.progress["pro"] = ctx.progress.get("pro", 0) + 1
+            else:
+                ctx.progress["invalid"] = ctx.progress.get("invalid", 0) + 1
+            items.append({
+                "id": row.id, "email": row.email, "is_valid": res["is_valid"],
+                "model_tier": model_tier, "account_type": res["account_type"]
+            })
+            done_above.add(row.id)
         
-        _background_tasks[task_id] = {"status": "done", "total": total, "success": success, "failed": failed}
-        print(f"[启动凭证] 完成: 成功 {success}, 失败 {failed}", flush=True)
+        # 推进水位线：issued 队首连续已完成的 id 都可以移出
+        while issued and issued[0] in done_above:
+            watermark = issued.popleft()
+        done_above.difference_update([i for i in done_above if i <= watermark])
         
-        # 通知前端刷新统计数据
-        await notify_stats_update()
+        async with async_session() as session:
+            await session.execute(update_stmt, params)
+            entitlements.invalidate_on_commit(session)
+            await ctx.commit(
+                {"last_id": watermark, "done_above": sorted(done_above)},
+                processed=len(batch), results=items, session=session
+            )
+        print(f"[检测凭证] 进度 {ctx.processed}/{ctx.total}: 有效 {ctx.progress.get('valid', 0)}, 无效 {ctx.progress.get('invalid', 0)}", flush=True)
+    
+    async def writer():
+        finished = 0
+        batch = []
+        while finished < VERIFY_WORKERS:
+            res = await out_queue.get()
+            if res is None:
+                finished += 1
+                continue
+            batch.append(res)
+            if len(batch) >= VERIFY_WRITE_BATCH:
+                await flush(batch)
+                batch = []
+        if batch:
+            await flush(batch)
+    
+    print(f"[检测凭证] 后台开始检测 {ctx.total} 个凭证...", flush=True)
+    limits = httpx.Limits(max_connections=VERIFY_WORKERS * 2, max_keepalive_connections=VERIFY_WORKERS * 2)
+    async with httpx.AsyncClient(timeout=15, limits=limits) as client:
+        tasks = [asyncio.create_task(reader()), asyncio.create_task(writer())]
+        tasks += [asyncio.create_task(worker(client)) for _ in range(VERIFY_WORKERS)]
+        try:
+            # writer 结束即全部完成；任一环节异常（包括取消）则停止整条流水线
+            await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
     
-    # 启动后台任务
-    asyncio.create_task(run_in_background())
+    print(f"[检测凭证] 完成: 有效 {ctx.progress.get('valid', 0)}, 无效 {ctx.progress.get('invalid', 0)}, 3.0 {ctx.progress.get('tier3', 0)}", flush=True)
     
+    # 通知前端刷新统计数据
+    await notify_stats_update()
+
+
+job_manager.register(JOB_START_ALL, _start_all_job)
+job_manager.register(JOB_VERIFY_ALL, _verify_all_job)
+
+
+@router.post("/credentials/start-all")
+async def start_all_credentials(
+    user: User = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_db)
+):
+    """一键启动所有凭证（后台任务，立即返回）"""
+    total = (await db.execute(
+        select(func.count(Credential.id)).where(
+            Credential.credential_type == "oauth",
+            Credential.refresh_token.isnot(None)
+        )
+    )).scalar() or 0
+    
+    task_id = await job_manager.submit(
+        JOB_START_ALL, total=total, created_by=user.id
+    )
     return {"message": "后台任务已启动", "task_id": task_id, "total": total}
 
 
@@ -450,9 +662,10 @@ async def get_task_status(
     user: User = Depends(get_current_admin)
 ):
     """查询后台任务状态"""
-    if task_id not in _background_tasks:
+    job = await job_manager.get(task_id)
+    if not job:
         raise HTTPException(status_code=404, detail="任务不存在")
-    return _background_tasks[task_id]
+    return job
 
 
 @router.post("/credentials/verify-all")
@@ -461,135 +674,61 @@ async def verify_all_credentials(
     db: AsyncSession = Depends(get_db)
 ):
     """一键检测所有凭证（后台任务，立即返回）"""
-    import asyncio
-    import httpx
-    from app.services.credential_pool import CredentialPool
-    from app.database import async_session
+    total = (await db.execute(select(func.count(Credential.id)))).scalar() or 0
     
-    result = await db.execute(select(Credential))
-    creds = result.scalars().all()
-    total = len(creds)
-    
-    # 提取凭证数据
-    cred_data = [{
-        "id": c.id,
-        "email": c.email,
-        "refresh_token": c.refresh_token,
-        "client_id": c.client_id,
-        "client_secret": c.client_secret,
-        "project_id": c.project_id,
-        "credential_type": c.credential_type,
-        "api_key": c.api_key,
-    } for c in creds]
-    
-    task_id = f"verify_{datetime.utcnow().timestamp()}"
-    _background_tasks[task_id] = {"status": "running", "total": total, "valid": 0, "invalid": 0, "tier3": 0, "pro": 0}
-    
-    async def run_in_background():
-        """后台执行检测"""
-        semaphore = asyncio.Semaphore(50)
-        valid = 0
-        invalid = 0
-        tier3 = 0
-        pro = 0
-        updates = []
-        
-        async def verify_single(data):
-            async with semaphore:
-                try:
-                    # 获取 access_token
-                    temp_cred = Credential(
-                        id=data["id"],
-                        refresh_token=data["refresh_token"],
-                        client_id=data["client_id"],
-                        client_secret=data["client_secret"],
-                        project_id=data["project_id"],
-                        credential_type=data["credential_type"],
-                        api_key=data["api_key"],
-                    )
-                    access_token = await CredentialPool.refresh_access_token(temp_cred) if temp_cred.refresh_token else None
-                    if not access_token:
-                        return {"id": data["id"], "email": data["email"], "is_valid": False, "supports_3": False, "account_type": "unknown"}
-                    
-                    is_valid = False
-                    supports_3 = False
-                    account_type = "unknown"
-                    
-                    async with httpx.AsyncClient(timeout=10) as client:
-                        test_url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
-                        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-                        
-                        # 测试 2.5
-                        test_payload = {
-                            "model": "gemini-2.5-flash",
-                            "project": data["project_id"] or "",
-                            "request": {"contents": [{"role": "user", "parts": [{"text": "hi"}]}]}
-                        }
-                        resp = await client.post(test_url, headers=headers, json=test_payload)
-                        if resp.status_code in [200, 429]:
-                            is_valid = True
-                            # 测试 3.0
-                            test_payload["model"] = "gemini-3-pro-preview"
-                            resp_3 = await client.post(test_url, headers=headers, json=test_payload)
-                            supports_3 = resp_3.status_code in [200, 429]
-                    
-                    # 检测账号类型
-                    if is_valid and data["project_id"]:
-                        try:
-                            type_result = await CredentialPool.detect_account_type(access_token, data["project_id"])
-                            account_type = type_result.get("account_type", "unknown")
-                        except:
-                            pass
-                    
-                    return {"id": data["id"], "email": data["email"], "is_valid": is_valid, "supports_3": supports_3, "account_type": account_type, "token": access_token}
-                except Exception as e:
-                    print(f"[检测] ❌ {data['email']} 异常: {e}", flush=True)
-                    return {"id": data["id"], "email": data["email"], "is_valid": False, "supports_3": False, "account_type": "unknown"}
-        
-        print(f"[检测凭证] 后台开始检测 {total} 个凭证...", flush=True)
-        results = await asyncio.gather(*[verify_single(d) for d in cred_data])
-        
-        # 批量更新数据库
-        async with async_session() as session:
-            for res in results:
-                model_tier = "3" if res["supports_3"] else "2.5"
-                update_vals = {"is_active": res["is_valid"], "model_tier": model_tier}
-                if res.get("account_type") != "unknown":
-                    update_vals["account_type"] = res["account_type"]
-                if res.get("token"):
-                    from app.services.crypto import encrypt_credential
-                    update_vals["api_key"] = encrypt_credential(res["token"])
-                
-                result = await session.execute(
-                    update(Credential).where(Credential.id == res["id"]).values(**update_vals)
-                )
-                
-                # 检查是否实际更新了行
-                if result.rowcount > 0:
-                    if res["is_valid"]:
-                        valid += 1
-                        if res["supports_3"]:
-                            tier3 += 1
-                        if res["account_type"] == "pro":
-                            pro += 1
-                        print(f"[检测] ✅ {res['email']} tier={model_tier}", flush=True)
-                    else:
-                        invalid += 1
-                        print(f"[检测] ❌ {res['email']}", flush=True)
-                else:
-                    print(f"[检测] ⚠️ {res['email']} 数据库更新失败(凭证可能已被删除)", flush=True)
-            
-            await session.commit()
-        
-        _background_tasks[task_id] = {"status": "done", "total": total, "valid": valid, "invalid": invalid, "tier3": tier3, "pro": pro}
-        print(f"[检测凭证] 完成: 有效 {valid}, 无效 {invalid}, 3.0 {tier3}", flush=True)
-        
-        # 通知前端刷新统计数据
-        await notify_stats_update()
+    task_id = await job_manager.submit(
+        JOB_VERIFY_ALL, total=total, created_by=user.id
+    )
+    return {"message": "后台任务已启动", "task_id": task_id, "total": total}
+
+
+@router.get("/jobs")
+async def list_jobs(
+    job_type: Optional[str] = None,
+    limit: int = 50,
+    user: User = Depends(get_current_admin)
+):
+    """后台任务列表"""
+    return {"jobs": await job_manager.list_jobs(job_type=job_type, limit=min(limit, 200))}
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    user: User = Depends(get_current_admin)
+):
+    """后台任务状态"""
+    job = await job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_job(
+    job_id: str,
+    user: User = Depends(get_current_admin)
+):
+    """取消后台任务（运行中的任务在当前块结束后停止）"""
+    if not await job_manager.cancel(job_id):
+        raise HTTPException(status_code=400, detail="任务不存在或已结束")
+    return {"message": "已请求取消"}
+
+
+@router.get("/jobs/{job_id}/results")
+async def stream_job_results(
+    job_id: str,
+    user: User = Depends(get_current_admin)
+):
+    """逐条结果（NDJSON 流式输出）"""
+    if not await job_manager.get(job_id):
+        raise HTTPException(status_code=404, detail="任务不存在")
     
-    asyncio.create_task(run_in_background())
+    async def generate():
+        async for item in job_manager.iter_results(job_id):
+            yield json.dumps(item, ensure_ascii=False) + "\n"
     
-    return {"message": "后台任务已启动", "task_id": task_id, "total": total}
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 
 # Google Gemini CLI 配额参考（每日请求数限制）
@@ -1425,6 +1564,9 @@ async def update_config(
         await save_config_to_db("stats_timezone", stats_timezone)
         updated["stats_timezone"] = stats_timezone
     
+    # 配额公式 / RPM 档位可能变化，用户权益快照全部重算
+    entitlements.invalidate_all()
+    
     return {"message": "配置已保存", "updated": updated}
 
 
@@ -303,7 +303,7 @@ async def credential_from_callback_url(
         
         # 检查是否已存在相同邮箱的凭证（去重）
         from sqlalchemy import select
-        from app.services.crypto import encrypt_credential
+        from app.services.crypto import encrypt_credential, token_fingerprint
         existing_cred = await db.execute(
             select(Credential).where(
                 Credential.user_id == user.id,
@@ -316,6 +316,7 @@ async def credential_from_callback_url(
             # 更新现有凭证而不是新增
             existing.api_key = encrypt_credential(access_token)
             existing.refresh_token = encrypt_credential(refresh_token)
+            existing.token_fingerprint = token_fingerprint(refresh_token)
             existing.project_id = project_id
             credential = existing
             is_new_credential = False
@@ -327,6 +328,7 @@ async def credential_from_callback_url(
                 name=f"OAuth - {email}",
                 api_key=encrypt_credential(access_token),
                 refresh_token=encrypt_credential(refresh_token),
+                token_fingerprint=token_fingerprint(refresh_token),
                 project_id=project_id,
                 credential_type="oauth",
                 email=email,
@@ -551,7 +553,7 @@ async def credential_from_callback_url_discord(
         
         # 检查是否已存在相同邮箱的凭证（去重）
         from sqlalchemy import select
-        from app.services.crypto import encrypt_credential
+        from app.services.crypto import encrypt_credential, token_fingerprint
         existing_cred = await db.execute(
             select(Credential).where(
                 Credential.user_id == user.id,
@@ -564,6 +566,7 @@ async def credential_from_callback_url_discord(
             # 更新现有凭证
             existing.api_key = encrypt_credential(access_token)
             existing.refresh_token = encrypt_credential(refresh_token)
+            existing.token_fingerprint = token_fingerprint(refresh_token)
             existing.project_id = project_id
             credential = existing
             is_new_credential = False
@@ -575,6 +578,7 @@ async def credential_from_callback_url_discord(
                 name=f"Discord - {email}",
                 api_key=encrypt_credential(access_token),
                 refresh_token=encrypt_credential(refresh_token),
+                token_fingerprint=token_fingerprint(refresh_token),
                 project_id=project_id,
                 credential_type="oauth",
                 email=email,
@@ -1,10 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, BackgroundTasks
 from fastapi.responses import StreamingResponse, JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, or_, and_
+from sqlalchemy import select, func, or_, and_, case
 from datetime import datetime, timedelta
-import json
 import time
+from typing import Any, Dict, List, Optional
 
 from app.database import get_db, async_session
 from app.models.user import User, UsageLog
@@ -14,6 +14,15 @@ from app.services.gemini_client import GeminiClient
 from app.services.websocket import notify_log_update, notify_stats_update
 from app.services.error_classifier import classify_error_simple
 from app.services.error_message_service import get_custom_error_message
+from app.services import json_codec
+from app.services.sse_passthrough import GeminiStreamPassthrough
+from app.services.sse_writer import coalesce_sse
+from app.services.request_snapshot import RequestSnapshot
+from app.services.request_body import get_json_body, set_json_body
+from app.services.model_catalog import model_catalog, PoolMembership
+from app.services.failover import CredentialSource, FailoverExecutor, FailoverError, UpstreamStatusError
+from app.services.fair_share import fair_share
+from app.services.entitlements import entitlements
 from app.config import settings
 import re
 
@@ -83,55 +92,20 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
     else:
         start_of_day = reset_time_utc
 
-    # 获取请求的模型
-    body = await request.json()
+    # 获取请求的模型（解析结果缓存在 request.state 上，handler 直接复用）
+    body = await get_json_body(request)
     model = body.get("model", "gemini-2.5-flash")
     required_tier = CredentialPool.get_required_tier(model)
     
-    # 检查用户凭证情况
-    from app.models.user import Credential
-    from sqlalchemy import case
-    
-    # 合并凭证统计查询（2.5和3.0一次性查询）
-    cred_stats_result = await db.execute(
-        select(
-            func.count(Credential.id).label("total"),
-            func.sum(case((Credential.model_tier == "3", 1), else_=0)).label("tier_30")
-        )
-        .where(Credential.user_id == user.id)
-        .where(Credential.is_active == True)
-    )
-    cred_stats = cred_stats_result.one()
-    total_cred_count = cred_stats.total or 0
-    cred_30_count = cred_stats.tier_30 or 0
-    cred_25_count = total_cred_count - cred_30_count
-    has_credential = total_cred_count > 0
-
-    # 计算用户各类模型的配额上限
-    # 优先使用用户设置的按模型配额，0表示使用系统默认
-    if user.quota_flash and user.quota_flash > 0:
-        user_quota_flash = user.quota_flash
-    elif has_credential:
-        user_quota_flash = total_cred_count * settings.quota_flash
-    else:
-        user_quota_flash = settings.no_cred_quota_flash
-    
+    # 用户凭证情况和配额上限（按用户缓存的权益快照，凭证或配置变化时失效）
+    entitlement = await entitlements.get(db, user)
+    limits = entitlement.quota("geminicli")
+    has_credential = limits.has_credential
+    user_quota_flash = limits.quota_flash
     # Pro配额（2.5pro和3.0共享）
-    # 官方规则：无3.0资格200次2.5pro，有3.0资格100次共享，Pro号250次共享
-    if user.quota_25pro and user.quota_25pro > 0:
-        user_quota_pro = user.quota_25pro  # 用户手动设置的配额
-    elif cred_30_count > 0:
-        # 有3.0凭证：使用3.0配额（2.5pro和3.0共享）
-        user_quota_pro = cred_30_count * settings.quota_30pro
-    elif has_credential:
-        # 只有2.5凭证：使用2.5pro配额
-        user_quota_pro = total_cred_count * settings.quota_25pro
-    else:
-        # 无凭证
-        user_quota_pro = settings.no_cred_quota_25pro
-    
+    user_quota_pro = limits.quota_pro
     # 判断用户是否有3.0资格（用于决定是否允许使用3.0模型）
-    has_30_access = cred_30_count > 0 or (user.quota_30pro and user.quota_30pro > 0)
+    has_30_access = limits.has_30_access
 
     # 确定当前请求的模型类别和对应配额
     if required_tier == "3":
@@ -199,47 +173,17 @@ async def options_handler():
     })
 
 
-@router.get("/v1/models")
-async def list_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
-    """列出可用模型 (OpenAI兼容) - 根据用户凭证类型显示对应模型
-    
-    规则：
-    - 有 GeminiCLI 凭证：显示 gcli- 前缀模型
-    - 有 Antigravity 凭证：显示 agy- 前缀模型
-    - 没有任何凭证：不显示任何模型
-    """
-    from app.models.user import Credential
-    from sqlalchemy import or_
-    
+def _build_openai_model_list(
+    membership: PoolMembership,
+    show_agy: bool,
+    agy_api_models: Optional[List[Dict[str, Any]]],
+) -> List[Dict[str, Any]]:
+    """根据凭证池可见性和（缓存的）Antigravity 上游模型列表生成 /v1/models 的模型"""
     models = []
     
-    # ===== 检查用户是否有 GeminiCLI 凭证 =====
-    cli_creds_result = await db.execute(
-        select(func.count(Credential.id))
-        .where(Credential.api_type != "antigravity")  # 非 Antigravity 就是 CLI
-        .where(Credential.is_active == True)
-        .where(or_(
-            Credential.user_id == user.id,
-            Credential.is_public == True
-        ))
-    )
-    has_cli_creds = (cli_creds_result.scalar() or 0) > 0
-    
-    # ===== 检查用户是否有 Antigravity 凭证 =====
-    agy_creds_result = await db.execute(
-        select(func.count(Credential.id))
-        .where(Credential.api_type == "antigravity")
-        .where(Credential.is_active == True)
-        .where(or_(
-            Credential.user_id == user.id,
-            Credential.is_public == True
-        ))
-    )
-    has_agy_creds = (agy_creds_result.scalar() or 0) > 0
-    
     # ===== GeminiCLI 模型（仅当有 CLI 凭证时显示）=====
-    if has_cli_creds:
-        has_cli_tier3 = await CredentialPool.has_tier3_credentials(user, db, mode="geminicli")
+    if membership.has_cli:
+        has_cli_tier3 = membership.cli_tier3
         
         base_models = ["gemini-2.5-pro", "gemini-2.5-flash"]
         tier3_models = ["gemini-3-pro-preview", "gemini-3-flash-preview"]
@@ -267,101 +211,103 @@ async def list_models(request: Request, user: User = Depends(get_user_from_api_k
                 models.append({"id": f"gcli-{base}{combined}", "object": "model", "owned_by": "google"})
     
     # ===== Antigravity 模型（仅当有 Antigravity 凭证时显示）=====
-    if has_agy_creds and settings.antigravity_enabled:
-        # 定义有效模型的过滤函数
-        def is_valid_agy_model(model_id: str) -> bool:
-            model_lower = model_id.lower()
-            # 排除条件：包含这些关键字的跳过
-            invalid_patterns = [
-                "chat_", "rev", "tab_", "uic", "test", "exp", "lite_preview",
-                "2.5", "gemini-2", "gcli-"
-            ]
-            for pattern in invalid_patterns:
-                if pattern in model_lower:
-                    return False
-            # 允许条件：必须是 gemini-3, claude, gpt 开头
-            valid_prefixes = ["gemini-3", "claude", "gpt-oss"]
-            for prefix in valid_prefixes:
-                if model_lower.startswith(prefix):
-                    return True
-            return False
+    if not show_agy:
+        return models
+    
+    # 定义有效模型的过滤函数
+    def is_valid_agy_model(model_id: str) -> bool:
+        model_lower = model_id.lower()
+        # 排除条件：包含这些关键字的跳过
+        invalid_patterns = [
+            "chat_", "rev", "tab_", "uic", "test", "exp", "lite_preview",
+            "2.5", "gemini-2", "gcli-"
+        ]
+        for pattern in invalid_patterns:
+            if pattern in model_lower:
+                return False
+        # 允许条件：必须是 gemini-3, claude, gpt 开头
+        valid_prefixes = ["gemini-3", "claude", "gpt-oss"]
+        for prefix in valid_prefixes:
+            if model_lower.startswith(prefix):
+                return True
+        return False
+    
+    if agy_api_models is not None:
+        # 添加过滤后的模型
+        for model_info in agy_api_models:
+            model_id = model_info.get("id", "")
+            if model_id and is_valid_agy_model(model_id):
+                models.append({"id": f"agy-{model_id}", "object": "model", "owned_by": "google"})
+                # 为图片模型添加 2k/4k 变体
+                if "image" in model_id.lower() and "2k" not in model_id.lower() and "4k" not in model_id.lower():
+                    models.append({"id": f"agy-{model_id}-2k", "object": "model", "owned_by": "google"})
+                    models.append({"id": f"agy-{model_id}-4k", "object": "model", "owned_by": "google"})
         
-        try:
-            from app.services.antigravity_client import AntigravityClient
-            
-            # 获取一个有效的 Antigravity 凭证
-            agy_cred_result = await db.execute(
-                select(Credential)
-                .where(Credential.api_type == "antigravity")
-                .where(Credential.is_active == True)
-                .where(or_(
-                    Credential.user_id == user.id,
-                    Credential.is_public == True
-                ))
-                .limit(1)
-            )
-            agy_cred = agy_cred_result.scalar_one_or_none()
-            
-            if agy_cred:
-                access_token = await CredentialPool.get_access_token(agy_cred, db)
-                if access_token:
-                    client = AntigravityClient(access_token, agy_cred.project_id)
-                    api_models = await client.fetch_available_models()
-                    
-                    # 添加过滤后的模型
-                    for model_info in api_models:
-                        model_id = model_info.get("id", "")
-                        if model_id and is_valid_agy_model(model_id):
-                            models.append({"id": f"agy-{model_id}", "object": "model", "owned_by": "google"})
-                            # 为图片模型添加 2k/4k 变体
-                            if "image" in model_id.lower() and "2k" not in model_id.lower() and "4k" not in model_id.lower():
-                                models.append({"id": f"agy-{model_id}-2k", "object": "model", "owned_by": "google"})
-                                models.append({"id": f"agy-{model_id}-4k", "object": "model", "owned_by": "google"})
-                    
-                    existing_ids = {m["id"] for m in models}
-                    image_variants = [
-                        "agy-gemini-3-pro-image", "agy-gemini-3-pro-image-2k", "agy-gemini-3-pro-image-4k"
-                    ]
-                    for variant in image_variants:
-                        if variant not in existing_ids:
-                            models.append({"id": variant, "object": "model", "owned_by": "google"})
-                    
-                    # 强制添加不带 -thinking 后缀的 Claude 基础模型
-                    # search 变体已移除 - 反重力API不支持联网搜索
-                    claude_model_variants = [
-                        # 基础模型（不带后缀）
-                        "agy-claude-opus-4-5", "agy-claude-sonnet-4-5",
-                    ]
-                    existing_ids = {m["id"] for m in models}
-                    for variant in claude_model_variants:
-                        if variant not in existing_ids:
-                            models.append({"id": variant, "object": "model", "owned_by": "google"})
-                            print(f"[Models] ✅ 强制添加 Claude 模型变体: {variant}", flush=True)
-                    
-                    # 强制添加 Gemini 2.5 系列模型（反重力API动态列表可能不包含）
-                    gemini_25_variants = [
-                        "agy-gemini-2.5-flash", "agy-gemini-2.5-flash-lite", 
-                        "agy-gemini-2.5-pro", "agy-gemini-2.5-flash-thinking",
-                    ]
-                    existing_ids = {m["id"] for m in models}
-                    for variant in gemini_25_variants:
-                        if variant not in existing_ids:
-                            models.append({"id": variant, "object": "model", "owned_by": "google"})
-                            print(f"[Models] ✅ 强制添加 Gemini 2.5 模型: {variant}", flush=True)
-        except Exception as e:
-            print(f"[Models] 获取 Antigravity 模型列表失败: {e}", flush=True)
-            # 降级：使用静态模型列表
-            fallback_agy_models = [
-                "gemini-3-flash", "gemini-3-pro-low", "gemini-3-pro-high", "gemini-3-pro-image",
-                "gemini-3-pro-image-2k", "gemini-3-pro-image-4k",
-                "claude-opus-4-5", "claude-opus-4-5-thinking",
-                "claude-sonnet-4-5", "claude-sonnet-4-5-thinking",
-                "gpt-oss-120b-medium"
-            ]
-            for base in fallback_agy_models:
-                models.append({"id": f"agy-{base}", "object": "model", "owned_by": "google"})
-    
-    return {"object": "list", "data": models}
+        existing_ids = {m["id"] for m in models}
+        image_variants = [
+            "agy-gemini-3-pro-image", "agy-gemini-3-pro-image-2k", "agy-gemini-3-pro-image-4k"
+        ]
+        for variant in image_variants:
+            if variant not in existing_ids:
+                models.append({"id": variant, "object": "model", "owned_by": "google"})
+        
+        # 强制添加不带 -thinking 后缀的 Claude 基础模型
+        # search 变体已移除 - 反重力API不支持联网搜索
+        claude_model_variants = [
+            # 基础模型（不带后缀）
+            "agy-claude-opus-4-5", "agy-claude-sonnet-4-5",
+        ]
+        existing_ids = {m["id"] for m in models}
+        for variant in claude_model_variants:
+            if variant not in existing_ids:
+                models.append({"id": variant, "object": "model", "owned_by": "google"})
+                print(f"[Models] ✅ 强制添加 Claude 模型变体: {variant}", flush=True)
+        
+        # 强制添加 Gemini 2.5 系列模型（反重力API动态列表可能不包含）
+        gemini_25_variants = [
+            "agy-gemini-2.5-flash", "agy-gemini-2.5-flash-lite", 
+            "agy-gemini-2.5-pro", "agy-gemini-2.5-flash-thinking",
+        ]
+        existing_ids = {m["id"] for m in models}
+        for variant in gemini_25_variants:
+            if variant not in existing_ids:
+                models.append({"id": variant, "object": "model", "owned_by": "google"})
+                print(f"[Models] ✅ 强制添加 Gemini 2.5 模型: {variant}", flush=True)
+    else:
+        # 上游列表尚未缓存（后台刷新中）：使用静态模型列表
+        fallback_agy_models = [
+            "gemini-3-flash", "gemini-3-pro-low", "gemini-3-pro-high", "gemini-3-pro-image",
+            "gemini-3-pro-image-2k", "gemini-3-pro-image-4k",
+            "claude-opus-4-5", "claude-opus-4-5-thinking",
+            "claude-sonnet-4-5", "claude-sonnet-4-5-thinking",
+            "gpt-oss-120b-medium"
+        ]
+        for base in fallback_agy_models:
+            models.append({"id": f"agy-{base}", "object": "model", "owned_by": "google"})
+    
+    return models
+
+
+@router.get("/v1/models")
+async def list_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
+    """列出可用模型 (OpenAI兼容) - 根据用户凭证类型显示对应模型
+    
+    规则：
+    - 有 GeminiCLI 凭证：显示 gcli- 前缀模型
+    - 有 Antigravity 凭证：显示 agy- 前缀模型
+    - 没有任何凭证：不显示任何模型
+    
+    可见性与上游模型列表都来自 model_catalog 的缓存，不同步请求上游；支持 ETag
+    """
+    membership = await model_catalog.membership(db, user)
+    show_agy = membership.has_agy and settings.antigravity_enabled
+    agy_api_models, agy_version = model_catalog.upstream_models("antigravity") if show_agy else (None, 0)
+    
+    key = ("openai", membership.has_cli, membership.cli_tier3, show_agy, agy_version)
+    return model_catalog.respond(request, key, lambda: {
+        "object": "list",
+        "data": _build_openai_model_list(membership, show_agy, agy_api_models),
+    })
 
 
 @router.post("/v1/chat/completions")
@@ -378,10 +324,7 @@ async def chat_completions(
     - gcli-xxx 前缀或无前缀 → GeminiCLI 代理
     - 流式前缀（假非流/、流式抗截断/）保留，由对应代理处理
     """
-    try:
-        body = await request.json()
-    except:
-        raise HTTPException(status_code=400, detail="无效的JSON请求体")
+    body = await get_json_body(request)
     
     model = body.get("model", "gemini-2.5-flash")
     
@@ -406,25 +349,11 @@ async def chat_completions(
         clean_model = model_without_stream[4:]  # 移除 "agy-"
         body["model"] = stream_prefix + clean_model
         
-        # 调用 Antigravity 代理处理
+        # 调用 Antigravity 代理处理：修改后的 body 直接交给它，不再重新序列化
         from app.routers.antigravity_proxy import chat_completions as agy_chat_completions
         
-        # 创建一个新的 Request 对象，包含修改后的 body
-        # 由于 FastAPI 的 Request 对象不可变，我们需要通过 Starlette 的方式处理
-        from starlette.requests import Request as StarletteRequest
-        from starlette.datastructures import Headers
-        import io
-        
-        # 将修改后的 body 序列化
-        modified_body = json.dumps(body).encode()
-        
-        # 创建一个新的 scope，复制原有的但修改 body
-        async def receive():
-            return {"type": "http.request", "body": modified_body}
-        
-        new_request = StarletteRequest(scope=request.scope, receive=receive)
-        
-        return await agy_chat_completions(new_request, background_tasks, user, db)
+        set_json_body(request, body)
+        return await agy_chat_completions(request, background_tasks, user, db)
     
     # 移除 gcli- 前缀（如果有），保留流式前缀
     if model_without_stream.startswith("gcli-"):
@@ -438,16 +367,20 @@ async def chat_completions(
     client_ip = request.headers.get("X-Forwarded-For", request.client.host if request.client else "unknown").split(",")[0].strip()
     user_agent = request.headers.get("User-Agent", "")[:500]
     
-    # 保存请求内容摘要（截断到2000字符）
-    request_body_str = json.dumps(body, ensure_ascii=False)[:2000] if body else None
+    # 请求内容摘要（截断到2000字符，省略图片数据），只在写入失败日志时才生成
+    request_snapshot = RequestSnapshot(body)
     messages = body.get("messages", [])
     stream = body.get("stream", False)
     
     if not messages:
         raise HTTPException(status_code=400, detail="messages不能为空")
     
-    # 检查用户是否参与大锅饭
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
+    # 检查用户是否参与大锅饭（权益快照，鉴权时已加载）
+    entitlement = await entitlements.get(db, user)
+    user_has_public = entitlement.has_public("geminicli")
+    
+    # 模型大面积配额耗尽时直接快速失败（不计入 RPM；只看该请求可用的凭证池）
+    await CredentialPool.enforce_model_breaker(db, user.id, user_has_public, model)
     
     # 速率限制检查 (RPM) - 管理员豁免
     if not user.is_admin:
@@ -458,7 +391,7 @@ async def chat_completions(
             .where(UsageLog.created_at >= one_minute_ago)
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
+        max_rpm = entitlement.rpm_limit("geminicli")
         
         if current_rpm >= max_rpm:
             raise HTTPException(
@@ -466,6 +399,9 @@ async def chat_completions(
                 detail=f"速率限制: {max_rpm} 次/分钟。{'上传凭证可提升至 ' + str(settings.contributor_rpm) + ' 次/分钟' if not user_has_public else ''}"
             )
     
+    # 共享池公平调度：公共池繁忙时按用户加权排队（名额在请求结束时由中间件释放）
+    await fair_share.admit(request, db, user, user_has_public, model)
+    
     # 立即插入占位记录以计入 RPM（防止 BackgroundTasks 导致 RPM 失效）
     placeholder_log = UsageLog(
         user_id=user.id,
@@ -482,18 +418,16 @@ async def chat_completions(
     placeholder_log_id = placeholder_log.id  # 保存ID，后续通过独立会话访问
     
     # 获取首个凭证后立即释放主连接（流式响应将使用独立会话）
-    # 重试逻辑：报错时切换凭证重试
+    # 重试逻辑：报错时切换凭证重试（FailoverExecutor，后续凭证在独立会话中预取）
     max_retries = settings.error_retry_count
-    last_error = None
-    tried_credential_ids = set()
+    credential_source = CredentialSource(user.id, user_has_public, model)
     
     # 预先获取第一个凭证和token（使用主db）
     credential = await CredentialPool.get_available_credential(
         db, 
         user_id=user.id,
         user_has_public_creds=user_has_public,
-        model=model,
-        exclude_ids=tried_credential_ids
+        model=model
     )
     if not credential:
         required_tier = CredentialPool.get_required_tier(model)
@@ -520,8 +454,6 @@ async def chat_completions(
         await db.commit()
         raise HTTPException(status_code=503, detail="暂无可用凭证，请稍后重试")
     
-    tried_credential_ids.add(credential.id)
-    
     # 获取 access_token（自动刷新）
     access_token = await CredentialPool.get_access_token(credential, db)
     if not access_token:
@@ -539,112 +471,81 @@ async def chat_completions(
     
     # 获取 project_id
     project_id = credential.project_id or ""
-    first_credential_id = credential.id
-    first_credential_email = credential.email
     print(f"[Proxy] 使用凭证: {credential.email}, project_id: {project_id}, model: {model}", flush=True)
     
     if not project_id:
         print(f"[Proxy] ⚠️ 凭证 {credential.email} 没有 project_id!", flush=True)
     
-    client = GeminiClient(access_token, project_id)
-    use_fake_streaming = client.is_fake_streaming(model)
+    failover = FailoverExecutor(
+        credential_source, credential_source.lease_for(credential, access_token, project_id),
+        max_retries=max_retries, tag="Proxy"
+    )
+    use_fake_streaming = GeminiClient(access_token, project_id).is_fake_streaming(model)
+    extra_params = {k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
     
     # 主db连接到此处结束使用，流式生成器将使用独立会话
     
     # 非流式模式的处理函数（仍在主请求处理器内，可使用主db）
     async def handle_non_stream():
         """处理非流式请求（使用主db）"""
-        nonlocal credential, access_token, project_id, client, tried_credential_ids, last_error
+        async def call(lease):
+            client = GeminiClient(lease.access_token, lease.project_id)
+            return await client.chat_completions(model=model, messages=messages, **extra_params)
         
-        for retry_attempt in range(max_retries + 1):
-            try:
-                result = await client.chat_completions(
-                    model=model,
-                    messages=messages,
-                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-                )
-                
-                # 成功：更新占位日志
-                latency = (time.time() - start_time) * 1000
-                error_type = None
-                error_code = None
-                
-                placeholder_log.credential_id = credential.id
-                placeholder_log.status_code = 200
-                placeholder_log.latency_ms = latency
-                placeholder_log.error_type = error_type
-                placeholder_log.error_code = error_code
-                placeholder_log.credential_email = credential.email
-                placeholder_log.retry_count = retry_attempt  # 记录重试次数
-                await db.commit()
-                
-                # 更新凭证使用次数
-                credential.total_requests = (credential.total_requests or 0) + 1
-                credential.last_used_at = datetime.utcnow()
-                await db.commit()
-                
-                # WebSocket 实时通知
-                await notify_log_update({
-                    "username": user.username,
-                    "model": model,
-                    "status_code": 200,
-                    "error_type": error_type,
-                    "latency_ms": round(latency, 0),
-                    "created_at": datetime.utcnow().isoformat()
-                })
-                await notify_stats_update()
-                
-                return JSONResponse(content=result)
-                
-            except Exception as e:
-                error_str = str(e)
-                await CredentialPool.handle_credential_failure(db, credential.id, error_str)
-                last_error = error_str
-                
-                # 检查是否应该重试
-                should_retry = any(code in error_str for code in ["404", "500", "502", "503", "504", "429", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
-                
-                if should_retry and retry_attempt < max_retries:
-                    print(f"[Proxy] ⚠️ 请求失败: {error_str}，切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
-                    
-                    # 获取新凭证
-                    credential = await CredentialPool.get_available_credential(
-                        db, user_id=user.id, user_has_public_creds=user_has_public,
-                        model=model, exclude_ids=tried_credential_ids
-                    )
-                    if not credential:
-                        break
-                    
-                    tried_credential_ids.add(credential.id)
-                    access_token = await CredentialPool.get_access_token(credential, db)
-                    if not access_token:
-                        continue
-                    
-                    project_id = credential.project_id or ""
-                    client = GeminiClient(access_token, project_id)
-                    print(f"[Proxy] 🔄 切换到凭证: {credential.email}", flush=True)
-                    continue
-                
-                # 失败：更新占位日志
-                status_code = extract_status_code(error_str)
-                latency = (time.time() - start_time) * 1000
-                error_type, error_code = classify_error_simple(status_code, error_str)
-                
-                placeholder_log.credential_id = credential.id
-                placeholder_log.status_code = status_code
-                placeholder_log.latency_ms = latency
-                placeholder_log.error_message = error_str[:2000]
-                placeholder_log.error_type = error_type
-                placeholder_log.error_code = error_code
-                placeholder_log.credential_email = credential.email
-                placeholder_log.request_body = request_body_str
-                placeholder_log.retry_count = retry_attempt  # 记录重试次数
-                await db.commit()
-                
-                raise HTTPException(status_code=status_code, detail=f"API调用失败 (已重试 {retry_attempt + 1} 次): {error_str}")
+        try:
+            result = await failover.run(call)
+        except FailoverError as e:
+            error_str = e.error_str
+            # 没有更多凭证可换时返回 503
+            status_code = 503 if e.exhausted else extract_status_code(error_str)
+            latency = (time.time() - start_time) * 1000
+            error_type, error_code = classify_error_simple(status_code, error_str)
+            
+            placeholder_log.credential_id = e.lease.credential_id
+            placeholder_log.status_code = status_code
+            placeholder_log.latency_ms = latency
+            placeholder_log.error_message = error_str[:2000]
+            placeholder_log.error_type = error_type
+            placeholder_log.error_code = error_code
+            placeholder_log.credential_email = e.lease.email
+            placeholder_log.request_body = request_snapshot.text
+            placeholder_log.retry_count = e.retry_count  # 记录重试次数
+            await db.commit()
+            
+            if e.exhausted:
+                raise HTTPException(status_code=503, detail=f"所有凭证都失败了: {error_str}")
+            raise HTTPException(status_code=status_code, detail=f"API调用失败 (已重试 {e.retry_count + 1} 次): {error_str}")
         
-        # 所有重试都失败
-        raise HTTPException(status_code=503, detail=f"所有凭证都失败了: {last_error}")
+        # 成功：更新占位日志
+        lease = failover.lease
+        latency = (time.time() - start_time) * 1000
+        error_type = None
+        error_code = None
+        
+        placeholder_log.credential_id = lease.credential_id
+        placeholder_log.status_code = 200
+        placeholder_log.latency_ms = latency
+        placeholder_log.error_type = error_type
+        placeholder_log.error_code = error_code
+        placeholder_log.credential_email = lease.email
+        placeholder_log.retry_count = failover.retry_count  # 记录重试次数
+        await db.commit()
+        
+        # 更新凭证使用次数
+        await CredentialPool.record_usage(db, lease.credential_id)
+        
+        # WebSocket 实时通知
+        await notify_log_update({
+            "username": user.username,
+            "model": model,
+            "status_code": 200,
+            "error_type": error_type,
+            "latency_ms": round(latency, 0),
+            "created_at": datetime.utcnow().isoformat()
+        })
+        await notify_stats_update()
+        
+        return JSONResponse(content=result)
     
     # 流式模式的处理
     if not stream:
@@ -678,7 +579,7 @@ async def chat_completions(
                     log.error_type = error_type
                     log.error_code = error_code
                     log.credential_email = log_data.get("cred_email")
-                    log.request_body = request_body_str if status_code != 200 else None
+                    log.request_body = request_snapshot.text if status_code != 200 else None
                     log.retry_count = log_data.get("retry_count", 0)  # 记录重试次数
                 
                 # 更新凭证使用次数
@@ -709,95 +610,76 @@ async def chat_completions(
         except Exception as log_err:
             print(f"[Proxy] ❌ 后台日志记录失败: {log_err}", flush=True)
     
+    async def log_stream_failure(e: FailoverError):
+        error_str = e.error_str
+        status_code = 503 if e.exhausted else extract_status_code(error_str)
+        latency = (time.time() - start_time) * 1000
+        await save_log_background({
+            "status_code": status_code,
+            "cred_id": e.lease.credential_id,
+            "cred_email": e.lease.email,
+            "error_message": error_str,
+            "latency_ms": latency,
+            "retry_count": e.retry_count  # 记录重试次数
+        })
+    
+    async def log_stream_success():
+        latency = (time.time() - start_time) * 1000
+        await save_log_background({
+            "status_code": 200,
+            "cred_id": failover.lease.credential_id,
+            "cred_email": failover.lease.email,
+            "latency_ms": latency,
+            "retry_count": failover.retry_count  # 记录重试次数
+        })
+    
+    async def fake_stream_generator():
+        """假流式：内部那次非流式请求走 failover.run（可重试、可对冲），这里只负责心跳"""
+        fake_error: Optional[FailoverError] = None
+        
+        async def generate(*args):
+            nonlocal fake_error
+            try:
+                return await failover.run(
+                    lambda lease: GeminiClient(lease.access_token, lease.project_id).generate_content(*args)
+                )
+            except FailoverError as e:
+                fake_error = e
+                raise
+        
+        client = GeminiClient(failover.lease.access_token, failover.lease.project_id)
+        # chat_completions_fake_stream 自己输出错误块和 [DONE]
+        async for chunk in client.chat_completions_fake_stream(
+            model=model, messages=messages, request_runner=generate, **extra_params
+        ):
+            yield chunk
+        
+        if fake_error is not None:
+            await log_stream_failure(fake_error)
+        else:
+            await log_stream_success()
+    
     async def stream_generator_with_retry():
         """流式生成器（使用独立会话进行数据库操作）"""
-        nonlocal access_token, project_id, client, tried_credential_ids, last_error
-        current_cred_id = first_credential_id
-        current_cred_email = first_credential_email
+        def call(lease):
+            client = GeminiClient(lease.access_token, lease.project_id)
+            return client.chat_completions_stream(model=model, messages=messages, **extra_params)
         
-        for stream_retry in range(max_retries + 1):
-            try:
-                if use_fake_streaming:
-                    async for chunk in client.chat_completions_fake_stream(
-                        model=model,
-                        messages=messages,
-                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-                    ):
-                        yield chunk
-                else:
-                    async for chunk in client.chat_completions_stream(
-                        model=model,
-                        messages=messages,
-                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-                    ):
-                        yield chunk
-                
-                # 成功：记录日志数据
-                latency = (time.time() - start_time) * 1000
-                await save_log_background({
-                    "status_code": 200,
-                    "cred_id": current_cred_id,
-                    "cred_email": current_cred_email,
-                    "latency_ms": latency,
-                    "retry_count": stream_retry  # 记录重试次数
-                })
-                yield "data: [DONE]\n\n"
-                return  # 成功，退出
-                
-            except Exception as e:
-                error_str = str(e)
-                last_error = error_str
-                
-                # 使用独立会话处理凭证失败
-                try:
-                    async with async_session() as stream_db:
-                        await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
-                except Exception as db_err:
-                    print(f"[Proxy] ⚠️ 标记凭证失败时出错: {db_err}", flush=True)
-                
-                # 检查是否应该重试
-                should_retry = any(code in error_str for code in ["404", "500", "502", "503", "504", "429", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout"])
-                
-                if should_retry and stream_retry < max_retries:
-                    print(f"[Proxy] ⚠️ 流式请求失败: {error_str}，切换凭证重试 ({stream_retry + 2}/{max_retries + 1})", flush=True)
-                    
-                    # 🚀 使用独立会话获取新凭证
-                    try:
-                        async with async_session() as stream_db:
-                            new_credential = await CredentialPool.get_available_credential(
-                                stream_db, user_id=user.id, user_has_public_creds=user_has_public,
-                                model=model, exclude_ids=tried_credential_ids
-                            )
-                            if new_credential:
-                                tried_credential_ids.add(new_credential.id)
-                                new_token = await CredentialPool.get_access_token(new_credential, stream_db)
-                                if new_token:
-                                    current_cred_id = new_credential.id
-                                    current_cred_email = new_credential.email
-                                    access_token = new_token
-                                    project_id = new_credential.project_id or ""
-                                    client = GeminiClient(access_token, project_id)
-                                    print(f"[Proxy] 🔄 切换到凭证: {current_cred_email}", flush=True)
-                                    continue
-                    except Exception as retry_err:
-                        print(f"[Proxy] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
-                
-                # 无法重试，输出错误并记录日志
-                status_code = extract_status_code(error_str)
-                latency = (time.time() - start_time) * 1000
-                await save_log_background({
-                    "status_code": status_code,
-                    "cred_id": current_cred_id,
-                    "cred_email": current_cred_email,
-                    "error_message": error_str,
-                    "latency_ms": latency,
-                    "retry_count": stream_retry  # 记录重试次数
-                })
-                yield f"data: {json.dumps({'error': f'API Error (已重试 {stream_retry + 1} 次): {error_str}'})}\n\n"
-                return
+        try:
+            async for chunk in failover.stream(call):
+                yield chunk
+        except FailoverError as e:
+            # 无法重试，输出错误并记录日志
+            await log_stream_failure(e)
+            yield json_codec.sse({'error': f'API Error (已重试 {e.retry_count + 1} 次): {e.error_str}'})
+            return
+        
+        # 成功：记录日志数据
+        await log_stream_success()
+        yield "data: [DONE]\n\n"
     
     return StreamingResponse(
-        stream_generator_with_retry(),
+        coalesce_sse(fake_stream_generator() if use_fake_streaming else stream_generator_with_retry(), "openai"),
         media_type="text/event-stream",
         headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
     )
@@ -820,12 +702,8 @@ async def gemini_options_handler(model: str):
     })
 
 
-@router.get("/v1beta/models")
-async def list_gemini_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
-    """Gemini 格式模型列表"""
-    # 检查是否有可用的 3.0 凭证
-    has_tier3 = await CredentialPool.has_tier3_credentials(user, db)
-    
+def _build_gemini_model_list(has_tier3: bool) -> Dict[str, Any]:
+    """/v1beta/models 的响应"""
     base_models = ["gemini-2.5-pro", "gemini-2.5-flash"]
     if has_tier3:
         base_models.append("gemini-3-pro-preview")
@@ -846,6 +724,15 @@ async def list_gemini_models(request: Request, user: User = Depends(get_user_fro
     return {"models": models}
 
 
+@router.get("/v1beta/models")
+async def list_gemini_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
+    """Gemini 格式模型列表"""
+    # 检查是否有可用的 3.0 凭证（来自缓存的凭证池快照）
+    membership = await model_catalog.membership(db, user)
+    has_tier3 = membership.cli_tier3
+    return model_catalog.respond(request, ("gemini", has_tier3), lambda: _build_gemini_model_list(has_tier3))
+
+
 @router.post("/v1beta/models/{model:path}:generateContent")
 async def gemini_generate_content(
     model: str,
@@ -857,10 +744,10 @@ async def gemini_generate_content(
     import httpx
     start_time = time.time()
     
-    try:
-        body = await request.json()
-    except:
-        raise HTTPException(status_code=400, detail="无效的JSON请求体")
+    body = await get_json_body(request)
+    
+    # 请求内容摘要，只在写入失败日志时才生成
+    request_snapshot = RequestSnapshot(body)
     
     contents = body.get("contents", [])
     if not contents:
@@ -870,8 +757,12 @@ async def gemini_generate_content(
     if model.startswith("models/"):
         model = model[7:]
     
-    # 检查用户是否参与大锅饭
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
+    # 检查用户是否参与大锅饭（权益快照，鉴权时已加载）
+    entitlement = await entitlements.get(db, user)
+    user_has_public = entitlement.has_public("geminicli")
+    
+    # 模型大面积配额耗尽时直接快速失败（不计入 RPM；只看该请求可用的凭证池）
+    await CredentialPool.enforce_model_breaker(db, user.id, user_has_public, model)
     
     # 速率限制 - 管理员豁免
     if not user.is_admin:
@@ -882,11 +773,14 @@ async def gemini_generate_content(
             .where(UsageLog.created_at >= one_minute_ago)
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
+        max_rpm = entitlement.rpm_limit("geminicli")
         
         if current_rpm >= max_rpm:
             raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
     
+    # 共享池公平调度：公共池繁忙时按用户加权排队（名额在请求结束时由中间件释放）
+    await fair_share.admit(request, db, user, user_has_public, model)
+    
     # 构建请求体（只构建一次）
     url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
     request_body = {"contents": contents}
@@ -910,197 +804,110 @@ async def gemini_generate_content(
     if "tools" in body:
         request_body["tools"] = body["tools"]
     
-    # 重试逻辑
-    max_retries = settings.error_retry_count
-    tried_credential_ids = set()
-    last_error = None
-    credential = None
-    access_token = None
-    project_id = ""
-    
-    for retry_attempt in range(max_retries + 1):
-        # 获取凭证
-        credential = await CredentialPool.get_available_credential(
-            db, user_id=user.id, user_has_public_creds=user_has_public, model=model,
-            exclude_ids=tried_credential_ids
-        )
-        if not credential:
-            if retry_attempt == 0:
-                raise HTTPException(status_code=503, detail="暂无可用凭证")
-            break  # 无更多凭证可用，退出重试
-        
-        tried_credential_ids.add(credential.id)
-        
-        access_token = await CredentialPool.get_access_token(credential, db)
-        if not access_token:
-            print(f"[Gemini API] ⚠️ 凭证 {credential.email} Token 刷新失败，尝试下一个", flush=True)
-            continue
-        
-        project_id = credential.project_id or ""
-        print(f"[Gemini API] 使用凭证: {credential.email}, project_id: {project_id}, model: {model}" +
-              (f" (重试 {retry_attempt}/{max_retries})" if retry_attempt > 0 else ""), flush=True)
-        
-        payload = {"model": model, "project": project_id, "request": request_body}
+    # 重试逻辑：报错时切换凭证重试
+    credential_source = CredentialSource(user.id, user_has_public, model)
+    lease = await credential_source.acquire()
+    if lease is None:
+        raise HTTPException(status_code=503, detail="暂无可用凭证")
+    print(f"[Gemini API] 使用凭证: {lease.email}, project_id: {lease.project_id}, model: {model}", flush=True)
+    
+    async def log_attempt_failure(attempt, error):
+        """✅ 每次尝试都记录日志（包括中间的重试）"""
+        if isinstance(error, UpstreamStatusError):
+            status_code, error_text = error.status_code, error.text[:500]
+        else:
+            status_code, error_text = extract_status_code(attempt.error), attempt.error
+        attempt_latency = (time.time() - start_time) * 1000
+        error_type, error_code = classify_error_simple(status_code, error_text)
+        db.add(UsageLog(
+            user_id=user.id,
+            credential_id=attempt.credential_id,
+            model=model,
+            endpoint="/v1beta/generateContent",
+            status_code=status_code,
+            latency_ms=attempt_latency,
+            cd_seconds=attempt.cd_seconds,
+            error_message=error_text[:2000],
+            error_type=error_type,
+            error_code=error_code,
+            credential_email=attempt.credential_email,
+            request_body=request_snapshot.text
+        ))
+        await db.commit()
+        await CredentialPool.record_usage(db, attempt.credential_id)
         
-        try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    url,
-                    headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
-                    json=payload
-                )
-                
-                if response.status_code == 200:
-                    # 成功：记录日志
-                    latency = (time.time() - start_time) * 1000
-                    log = UsageLog(
-                        user_id=user.id,
-                        credential_id=credential.id,
-                        model=model,
-                        endpoint="/v1beta/generateContent",
-                        status_code=200,
-                        latency_ms=latency,
-                        credential_email=credential.email
-                    )
-                    db.add(log)
-                    credential.total_requests = (credential.total_requests or 0) + 1
-                    credential.last_used_at = datetime.utcnow()
-                    await db.commit()
-                    
-                    # WebSocket 实时通知
-                    await notify_log_update({
-                        "username": user.username,
-                        "model": model,
-                        "status_code": 200,
-                        "latency_ms": round(latency, 0),
-                        "created_at": datetime.utcnow().isoformat()
-                    })
-                    await notify_stats_update()
-                    
-                    # 转换响应格式
-                    result = response.json()
-                    if "response" in result:
-                        standard_result = result.get("response", {})
-                        if "modelVersion" in result:
-                            standard_result["modelVersion"] = result["modelVersion"]
-                        return JSONResponse(content=standard_result)
-                    return JSONResponse(content=result)
-                
-                # 请求失败
-                error_text = response.text[:500]
-                last_error = f"API Error {response.status_code}: {error_text}"
-                print(f"[Gemini API] ❌ 错误 {response.status_code}: {error_text}", flush=True)
-                
-                # 处理凭证失败
-                cd_sec = None
-                if response.status_code in [401, 403]:
-                    await CredentialPool.handle_credential_failure(db, credential.id, last_error)
-                elif response.status_code == 429:
-                    cd_sec = await CredentialPool.handle_429_rate_limit(
-                        db, credential.id, model, error_text, dict(response.headers)
-                    )
-                
-                # ✅ 每次尝试都记录日志（包括中间的重试）
-                attempt_latency = (time.time() - start_time) * 1000
-                error_type, error_code = classify_error_simple(response.status_code, error_text)
-                log = UsageLog(
-                    user_id=user.id,
-                    credential_id=credential.id,
-                    model=model,
-                    endpoint="/v1beta/generateContent",
-                    status_code=response.status_code,
-                    latency_ms=attempt_latency,
-                    cd_seconds=cd_sec,
-                    error_message=error_text[:2000],
-                    error_type=error_type,
-                    error_code=error_code,
-                    credential_email=credential.email
-                )
-                db.add(log)
-                credential.total_requests = (credential.total_requests or 0) + 1
-                credential.last_used_at = datetime.utcnow()
-                await db.commit()
-                
-                # WebSocket 实时通知
-                await notify_log_update({
-                    "username": user.username,
-                    "model": model,
-                    "status_code": response.status_code,
-                    "error_type": error_type,
-                    "latency_ms": round(attempt_latency, 0),
-                    "created_at": datetime.utcnow().isoformat()
-                })
-                await notify_stats_update()
-                
-                # 检查是否应该重试
-                should_retry = response.status_code in [429, 500, 503, 404]
-                if should_retry and retry_attempt < max_retries:
-                    print(f"[Gemini API] 🔄 切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
-                    continue
-                
-                # 不重试，返回错误
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"API调用失败 (已重试 {retry_attempt + 1} 次): {response.text}"
-                )
-                
-        except HTTPException:
-            raise
-        except Exception as e:
-            error_str = str(e)
-            last_error = error_str
-            print(f"[Gemini API] ❌ 异常: {error_str}", flush=True)
-            
-            if credential:
-                await CredentialPool.handle_credential_failure(db, credential.id, error_str)
-            
-            # ✅ 每次尝试都记录日志（包括中间的重试）
-            status_code = extract_status_code(error_str)
-            attempt_latency = (time.time() - start_time) * 1000
-            error_type, error_code = classify_error_simple(status_code, error_str)
-            log = UsageLog(
-                user_id=user.id,
-                credential_id=credential.id if credential else None,
-                model=model,
-                endpoint="/v1beta/generateContent",
-                status_code=status_code,
-                latency_ms=attempt_latency,
-                error_message=error_str[:2000],
-                error_type=error_type,
-                error_code=error_code,
-                credential_email=credential.email if credential else None
-            )
-            db.add(log)
-            if credential:
-                credential.total_requests = (credential.total_requests or 0) + 1
-                credential.last_used_at = datetime.utcnow()
-            await db.commit()
-            
-            # WebSocket 实时通知
-            await notify_log_update({
-                "username": user.username,
-                "model": model,
-                "status_code": status_code,
-                "error_type": error_type,
-                "latency_ms": round(attempt_latency, 0),
-                "created_at": datetime.utcnow().isoformat()
-            })
-            await notify_stats_update()
-            
-            # 检查是否应该重试
-            should_retry = any(code in error_str for code in ["429", "500", "503", "RESOURCE_EXHAUSTED", "ECONNRESET", "ETIMEDOUT"])
-            if should_retry and retry_attempt < max_retries:
-                print(f"[Gemini API] 🔄 切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
-                continue
-            
-            # 不重试，返回错误
-            raise HTTPException(
-                status_code=status_code,
-                detail=f"API调用失败 (已重试 {retry_attempt + 1} 次): {error_str}"
+        # WebSocket 实时通知
+        await notify_log_update({
+            "username": user.username,
+            "model": model,
+            "status_code": status_code,
+            "error_type": error_type,
+            "latency_ms": round(attempt_latency, 0),
+            "created_at": datetime.utcnow().isoformat()
+        })
+        await notify_stats_update()
+    
+    failover = FailoverExecutor(
+        credential_source, lease, max_retries=settings.error_retry_count,
+        tag="Gemini API", on_failure=log_attempt_failure
+    )
+    
+    async def call(lease):
+        payload = {"model": model, "project": lease.project_id, "request": request_body}
+        async with httpx.AsyncClient(timeout=120.0) as client:
+            response = await client.post(
+                url,
+                headers={"Authorization": f"Bearer {lease.access_token}", "Content-Type": "application/json"},
+                json=payload
             )
+        if response.status_code != 200:
+            print(f"[Gemini API] ❌ 错误 {response.status_code}: {response.text[:500]}", flush=True)
+            raise UpstreamStatusError(response.status_code, response.text, dict(response.headers))
+        return response.json()
+    
+    try:
+        result = await failover.run(call)
+    except FailoverError as e:
+        if e.exhausted:
+            raise HTTPException(status_code=503, detail=f"所有凭证都失败了: {e.error_str}")
+        detail = e.error.text if isinstance(e.error, UpstreamStatusError) else e.error_str
+        raise HTTPException(
+            status_code=e.status_code or extract_status_code(e.error_str),
+            detail=f"API调用失败 (已重试 {e.retry_count + 1} 次): {detail}"
+        )
     
-    # 所有重试都失败
-    raise HTTPException(status_code=503, detail=f"所有凭证都失败了: {last_error}")
+    # 成功：记录日志
+    lease = failover.lease
+    latency = (time.time() - start_time) * 1000
+    db.add(UsageLog(
+        user_id=user.id,
+        credential_id=lease.credential_id,
+        model=model,
+        endpoint="/v1beta/generateContent",
+        status_code=200,
+        latency_ms=latency,
+        credential_email=lease.email
+    ))
+    await db.commit()
+    await CredentialPool.record_usage(db, lease.credential_id)
+    
+    # WebSocket 实时通知
+    await notify_log_update({
+        "username": user.username,
+        "model": model,
+        "status_code": 200,
+        "latency_ms": round(latency, 0),
+        "created_at": datetime.utcnow().isoformat()
+    })
+    await notify_stats_update()
+    
+    # 转换响应格式
+    if "response" in result:
+        standard_result = result.get("response", {})
+        if "modelVersion" in result:
+            standard_result["modelVersion"] = result["modelVersion"]
+        return JSONResponse(content=standard_result)
+    return JSONResponse(content=result)
 
 
 @router.post("/v1beta/models/{model:path}:streamGenerateContent")
@@ -1111,14 +918,19 @@ async def gemini_stream_generate_content(
     user: User = Depends(get_user_from_api_key),
     db: AsyncSession = Depends(get_db)
 ):
-    """Gemini 原生 streamGenerateContent 接口（带重试功能）"""
+    """Gemini 原生 streamGenerateContent 接口（带重试功能）
+
+    默认把上游内部格式 {"response": {...}, "traceId": ...} 剥成标准 Gemini 格式；
+    客户端带 ?envelope=internal 时直接转发上游事件，不做任何改写。
+    """
     import httpx
     start_time = time.time()
+    forward_internal_envelope = request.query_params.get("envelope") == "internal"
     
-    try:
-        body = await request.json()
-    except:
-        raise HTTPException(status_code=400, detail="无效的JSON请求体")
+    body = await get_json_body(request)
+    
+    # 请求内容摘要，只在写入失败日志时才生成
+    request_snapshot = RequestSnapshot(body)
     
     contents = body.get("contents", [])
     if not contents:
@@ -1128,8 +940,12 @@ async def gemini_stream_generate_content(
     if model.startswith("models/"):
         model = model[7:]
     
-    # 检查用户是否参与大锅饭
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
+    # 检查用户是否参与大锅饭（权益快照，鉴权时已加载）
+    entitlement = await entitlements.get(db, user)
+    user_has_public = entitlement.has_public("geminicli")
+    
+    # 模型大面积配额耗尽时直接快速失败（不计入 RPM；只看该请求可用的凭证池）
+    await CredentialPool.enforce_model_breaker(db, user.id, user_has_public, model)
     
     # 速率限制 - 管理员豁免
     if not user.is_admin:
@@ -1140,11 +956,14 @@ async def gemini_stream_generate_content(
             .where(UsageLog.created_at >= one_minute_ago)
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
+        max_rpm = entitlement.rpm_limit("geminicli")
         
         if current_rpm >= max_rpm:
             raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
     
+    # 共享池公平调度：公共池繁忙时按用户加权排队（名额在请求结束时由中间件释放）
+    await fair_share.admit(request, db, user, user_has_public, model)
+    
     # 构建请求体（只构建一次）
     url = "https://cloudcode-pa.googleapis.com/v1internal:streamGenerateContent?alt=sse"
     request_body = {"contents": contents}
@@ -1168,29 +987,15 @@ async def gemini_stream_generate_content(
     if "tools" in body:
         request_body["tools"] = body["tools"]
     
-    # 预先获取第一个凭证（使用主db）
-    max_retries = settings.error_retry_count
-    tried_credential_ids = set()
-    
-    credential = await CredentialPool.get_available_credential(
-        db, user_id=user.id, user_has_public_creds=user_has_public, model=model,
-        exclude_ids=tried_credential_ids
-    )
-    if not credential:
+    # 预先获取第一个凭证（独立会话，换凭证重试见 FailoverExecutor）
+    credential_source = CredentialSource(user.id, user_has_public, model)
+    lease = await credential_source.acquire()
+    if lease is None:
         raise HTTPException(status_code=503, detail="暂无可用凭证")
     
-    tried_credential_ids.add(credential.id)
-    
-    access_token = await CredentialPool.get_access_token(credential, db)
-    if not access_token:
-        raise HTTPException(status_code=503, detail="凭证已失效")
-    
-    project_id = credential.project_id or ""
-    first_credential_id = credential.id
-    first_credential_email = credential.email
     user_id = user.id
     username = user.username
-    print(f"[Gemini Stream] 使用凭证: {credential.email}, project_id: {project_id}, model: {model}", flush=True)
+    print(f"[Gemini Stream] 使用凭证: {lease.email}, project_id: {lease.project_id}, model: {model}", flush=True)
     
     # ✅ 主db连接到此处结束使用，流式生成器将使用独立会话
     
@@ -1215,13 +1020,16 @@ async def gemini_stream_generate_content(
                     credential_id=cred_id,
                     model=model,
                     endpoint="/v1beta/streamGenerateContent",
+                    tokens_input=log_data.get("tokens_input", 0),
+                    tokens_output=log_data.get("tokens_output", 0),
                     status_code=status_code,
                     latency_ms=latency,
                     cd_seconds=log_data.get("cd_seconds"),
                     error_message=error_msg[:2000] if error_msg else None,
                     error_type=error_type,
                     error_code=error_code,
-                    credential_email=cred_email
+                    credential_email=cred_email,
+                    request_body=request_snapshot.text if status_code != 200 else None
                 )
                 bg_db.add(log)
                 
@@ -1252,166 +1060,77 @@ async def gemini_stream_generate_content(
         except Exception as log_err:
             print(f"[Gemini Stream] ❌ 后台日志记录失败: {log_err}", flush=True)
     
+    async def log_attempt_failure(attempt, error):
+        """✅ 每次尝试都记录日志（包括中间的重试）"""
+        if isinstance(error, UpstreamStatusError):
+            status_code, error_text = error.status_code, error.text[:500]
+        else:
+            status_code, error_text = extract_status_code(attempt.error), attempt.error
+        background_tasks.add_task(save_log_background, {
+            "status_code": status_code,
+            "error_message": error_text,
+            "latency_ms": (time.time() - start_time) * 1000,
+            "cd_seconds": attempt.cd_seconds,
+            "cred_id": attempt.credential_id,
+            "cred_email": attempt.credential_email
+        })
+    
+    failover = FailoverExecutor(
+        credential_source, lease, max_retries=settings.error_retry_count,
+        tag="Gemini Stream", on_failure=log_attempt_failure
+    )
+    
     async def stream_generator_with_retry():
         """🚀 流式生成器（带重试功能，使用独立会话进行数据库操作）"""
-        nonlocal access_token, project_id, tried_credential_ids
-        current_cred_id = first_credential_id
-        current_cred_email = first_credential_email
-        last_error = None
+        passthrough = None
         
-        for stream_retry in range(max_retries + 1):
-            cd_seconds = None
-            payload = {"model": model, "project": project_id, "request": request_body}
-            
-            try:
-                async with httpx.AsyncClient(timeout=120.0) as client:
-                    async with client.stream(
-                        "POST", url,
-                        headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
-                        json=payload
-                    ) as response:
-                        if response.status_code != 200:
-                            # 一开始就报错，可以重试
-                            error = await response.aread()
-                            error_text = error.decode()[:500]
-                            last_error = f"API Error {response.status_code}: {error_text}"
-                            print(f"[Gemini Stream] ❌ 错误 {response.status_code}: {error_text}", flush=True)
-                            
-                            # 使用独立会话处理凭证失败
-                            try:
-                                async with async_session() as stream_db:
-                                    if response.status_code in [401, 403]:
-                                        await CredentialPool.handle_credential_failure(stream_db, current_cred_id, last_error)
-                                    elif response.status_code == 429:
-                                        cd_seconds = await CredentialPool.handle_429_rate_limit(
-                                            stream_db, current_cred_id, model, error_text, dict(response.headers)
-                                        )
-                            except Exception as db_err:
-                                print(f"[Gemini Stream] ⚠️ 处理凭证失败时出错: {db_err}", flush=True)
-                            
-                            # ✅ 每次尝试都记录日志（包括中间的重试）
-                            attempt_latency = (time.time() - start_time) * 1000
-                            background_tasks.add_task(save_log_background, {
-                                "status_code": response.status_code,
-                                "error_message": error_text,
-                                "latency_ms": attempt_latency,
-                                "cd_seconds": cd_seconds,
-                                "cred_id": current_cred_id,
-                                "cred_email": current_cred_email
-                            })
-                            
-                            # 检查是否应该重试
-                            should_retry = response.status_code in [429, 500, 503, 404]
-                            if should_retry and stream_retry < max_retries:
-                                print(f"[Gemini Stream] 🔄 切换凭证重试 ({stream_retry + 2}/{max_retries + 1})", flush=True)
-                                
-                                # 使用独立会话获取新凭证
-                                try:
-                                    async with async_session() as stream_db:
-                                        new_credential = await CredentialPool.get_available_credential(
-                                            stream_db, user_id=user_id, user_has_public_creds=user_has_public,
-                                            model=model, exclude_ids=tried_credential_ids
-                                        )
-                                        if new_credential:
-                                            tried_credential_ids.add(new_credential.id)
-                                            new_token = await CredentialPool.get_access_token(new_credential, stream_db)
-                                            if new_token:
-                                                current_cred_id = new_credential.id
-                                                current_cred_email = new_credential.email
-                                                access_token = new_token
-                                                project_id = new_credential.project_id or ""
-                                                print(f"[Gemini Stream] 🔄 切换到凭证: {current_cred_email}", flush=True)
-                                                continue
-                                except Exception as retry_err:
-                                    print(f"[Gemini Stream] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
-                            
-                            # 无法重试，输出错误（日志已记录）
-                            yield f"data: {json.dumps({'error': f'API Error (已重试 {stream_retry + 1} 次): {error.decode()}'})}\n\n"
-                            return
-                        
-                        # 响应成功，开始输出数据（此后无法重试）
-                        async for line in response.aiter_lines():
-                            if line:
-                                # 转换 SSE 数据格式
-                                if line.startswith("data: "):
-                                    try:
-                                        data = json.loads(line[6:])
-                                        if "response" in data:
-                                            standard_data = data.get("response", {})
-                                            if "modelVersion" in data:
-                                                standard_data["modelVersion"] = data["modelVersion"]
-                                            yield f"data: {json.dumps(standard_data)}\n\n"
-                                        else:
-                                            yield f"{line}\n"
-                                    except:
-                                        yield f"{line}\n"
-                                else:
-                                    yield f"{line}\n"
-                
-                # 成功：后台记录日志
-                latency = (time.time() - start_time) * 1000
-                background_tasks.add_task(save_log_background, {
-                    "status_code": 200,
-                    "latency_ms": latency,
-                    "cred_id": current_cred_id,
-                    "cred_email": current_cred_email
-                })
-                return  # 成功，退出
-                
-            except Exception as e:
-                error_str = str(e)
-                last_error = error_str
-                
-                # 使用独立会话处理凭证失败
-                try:
-                    async with async_session() as stream_db:
-                        await CredentialPool.handle_credential_failure(stream_db, current_cred_id, error_str)
-                except Exception as db_err:
-                    print(f"[Gemini Stream] ⚠️ 标记凭证失败时出错: {db_err}", flush=True)
-                
-                # ✅ 每次尝试都记录日志（包括中间的重试）
-                status_code = extract_status_code(error_str)
-                attempt_latency = (time.time() - start_time) * 1000
-                background_tasks.add_task(save_log_background, {
-                    "status_code": status_code,
-                    "error_message": error_str,
-                    "latency_ms": attempt_latency,
-                    "cred_id": current_cred_id,
-                    "cred_email": current_cred_email
-                })
-                
-                # 检查是否应该重试
-                should_retry = any(code in error_str for code in ["429", "500", "503", "RESOURCE_EXHAUSTED", "ECONNRESET", "ETIMEDOUT"])
-                
-                if should_retry and stream_retry < max_retries:
-                    print(f"[Gemini Stream] ⚠️ 流式请求失败: {error_str}，切换凭证重试 ({stream_retry + 2}/{max_retries + 1})", flush=True)
+        async def call(lease):
+            nonlocal passthrough
+            payload = {"model": model, "project": lease.project_id, "request": request_body}
+            async with httpx.AsyncClient(timeout=120.0) as client:
+                async with client.stream(
+                    "POST", url,
+                    headers={"Authorization": f"Bearer {lease.access_token}", "Content-Type": "application/json"},
+                    json=payload
+                ) as response:
+                    if response.status_code != 200:
+                        # 一开始就报错，可以重试
+                        error = await response.aread()
+                        error_text = error.decode()
+                        print(f"[Gemini Stream] ❌ 错误 {response.status_code}: {error_text[:500]}", flush=True)
+                        raise UpstreamStatusError(response.status_code, error_text, dict(response.headers))
                     
-                    # 使用独立会话获取新凭证
-                    try:
-                        async with async_session() as stream_db:
-                            new_credential = await CredentialPool.get_available_credential(
-                                stream_db, user_id=user_id, user_has_public_creds=user_has_public,
-                                model=model, exclude_ids=tried_credential_ids
-                            )
-                            if new_credential:
-                                tried_credential_ids.add(new_credential.id)
-                                new_token = await CredentialPool.get_access_token(new_credential, stream_db)
-                                if new_token:
-                                    current_cred_id = new_credential.id
-                                    current_cred_email = new_credential.email
-                                    access_token = new_token
-                                    project_id = new_credential.project_id or ""
-                                    print(f"[Gemini Stream] 🔄 切换到凭证: {current_cred_email}", flush=True)
-                                    continue
-                    except Exception as retry_err:
-                        print(f"[Gemini Stream] ⚠️ 获取新凭证失败: {retry_err}", flush=True)
-                
-                # 无法重试，输出错误（日志已记录）
-                yield f"data: {json.dumps({'error': f'API Error (已重试 {stream_retry + 1} 次): {error_str}'})}\n\n"
-                return
+                    # 按字节切分 SSE 事件，在字节层面剥掉 response 包装（或原样转发内部格式），
+                    # 不再逐行解析 + 重新序列化；usageMetadata 只做轻量扫描用于记录 token
+                    passthrough = GeminiStreamPassthrough(unwrap=not forward_internal_envelope)
+                    async for chunk in response.aiter_bytes():
+                        for frame in passthrough.feed(chunk):
+                            yield frame
+                    for frame in passthrough.flush():
+                        yield frame
+        
+        try:
+            async for frame in failover.stream(call):
+                yield frame
+        except FailoverError as e:
+            # 无法重试，输出错误（日志已记录）
+            detail = e.error.text if isinstance(e.error, UpstreamStatusError) else e.error_str
+            yield json_codec.sse({'error': f'API Error (已重试 {e.retry_count + 1} 次): {detail}'})
+            return
+        
+        # 成功：后台记录日志
+        latency = (time.time() - start_time) * 1000
+        background_tasks.add_task(save_log_background, {
+            "status_code": 200,
+            "latency_ms": latency,
+            "cred_id": failover.lease.credential_id,
+            "cred_email": failover.lease.email,
+            "tokens_input": passthrough.tokens_input,
+            "tokens_output": passthrough.tokens_output
+        })
     
     return StreamingResponse(
-        stream_generator_with_retry(),
+        coalesce_sse(stream_generator_with_retry(), "gemini"),
         media_type="text/event-stream",
         headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
     )
@@ -1435,7 +1154,7 @@ async def openai_proxy(
     start_time = time.time()
     
     # 检查速率限制 - 管理员豁免
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
+    entitlement = await entitlements.get(db, user)
     if not user.is_admin:
         one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
         rpm_result = await db.execute(
@@ -1444,7 +1163,7 @@ async def openai_proxy(
             .where(UsageLog.created_at >= one_minute_ago)
         )
         current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
+        max_rpm = entitlement.rpm_limit("geminicli")
         
         if current_rpm >= max_rpm:
             raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
@@ -1485,7 +1204,8 @@ async def openai_proxy(
             latency_ms=latency,
             error_message=error_msg[:2000] if error_msg else None,
             error_type=error_type,
-            error_code=error_code
+            error_code=error_code,
+            request_body=request_snapshot.text if status_code != 200 else None
         )
         db.add(log)
         await db.commit()
@@ -1501,12 +1221,14 @@ async def openai_proxy(
     
     # 判断是否是流式请求
     is_stream = False
+    body_json = None
     if body:
         try:
-            body_json = json.loads(body)
+            body_json = await get_json_body(request)  # 鉴权依赖已解析过，直接复用
             is_stream = body_json.get("stream", False)
         except:
             pass
+    request_snapshot = RequestSnapshot(body_json)
     
     print(f"[OpenAI Proxy] {request.method} {target_url}, stream={is_stream}", flush=True)
     
@@ -1524,7 +1246,7 @@ async def openai_proxy(
                             if response.status_code != 200:
                                 error = await response.aread()
                                 await log_usage(response.status_code, error_msg=error.decode()[:500])
-                                yield f"data: {json.dumps({'error': error.decode()})}\n\n"
+                                yield json_codec.sse({'error': error.decode()})
                                 return
                             
                             async for line in response.aiter_lines():
@@ -1536,10 +1258,10 @@ async def openai_proxy(
                     error_str = str(e)
                     status_code = extract_status_code(error_str)
                     await log_usage(status_code, error_msg=error_str)
-                    yield f"data: {json.dumps({'error': error_str})}\n\n"
+                    yield json_codec.sse({'error': error_str})
             
             return StreamingResponse(
-                stream_generator(),
+                coalesce_sse(stream_generator(), "openai_passthrough"),
                 media_type="text/event-stream",
                 headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
             )
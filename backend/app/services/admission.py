@@ -0,0 +1,208 @@
+"""
+凭证就绪排队（wait-for-ready admission）
+
+凭证池里所有凭证都在 CD（模型组轮询 CD 或按模型的 429 冷却）时，get_available_credential
+原先照样返回 credentials[0]，这个请求几乎一定 429，白白烧掉一次重试，还把 CD 又延长了。
+开启 admission_wait_enabled 后，请求改为在这里排队，直到最早的凭证 CD 结束（最多等
+admission_max_wait_ms，等不到再按原逻辑选）：
+
+- 按 (api_type, 基础模型) 排队；调度器用 loop.call_later 定时到最早的就绪时间，不轮询
+- 同一队列同一时间只叫一个号：被叫到的请求重新选凭证并占用后 release()，再叫下一个，
+  避免所有等待者同时醒来争抢同一个凭证；没选到的请求保留原来的排队序号重新挂起
+- 叫号顺序：fifo 按到达顺序；fair 优先叫最近最久没被叫到的用户，同一用户内按到达顺序
+- 不在 CD 的凭证都因并发饱和被跳过时（见 inflight.py），请求以 saturated 挂起，有上游调用结束时立即叫号
+- 统计队列深度和等待时间分布
+"""
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+
+# 等待时间分布的桶上界（秒）
+_WAIT_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60)
+# 被叫到的请求超过这么久还没 release，视为已丢失，继续叫下一个
+_TURN_TIMEOUT = 10.0
+
+
+def _policy() -> Tuple[bool, float, str]:
+    """(是否开启, 最长等待秒, 叫号顺序 fifo/fair)"""
+    try:
+        from app.config import settings
+        order = settings.admission_order if settings.admission_order in ("fifo", "fair") else "fair"
+        return settings.admission_wait_enabled, max(0, settings.admission_max_wait_ms) / 1000, order
+    except ImportError:
+        return True, 10.0, "fair"
+
+
+class Ticket:
+    """一个排队中的请求（重新挂起时保留序号）"""
+    __slots__ = ("key", "user_id", "seq", "enqueued_at", "ready_at", "future", "has_turn", "saturated")
+
+    def __init__(self, key: Hashable, user_id: Optional[int], seq: int):
+        self.key = key
+        self.user_id = user_id
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.ready_at = 0.0
+        self.future: Optional[asyncio.Future] = None
+        self.has_turn = False
+        # 在等凭证并发名额（而不只是等 CD 结束）
+        self.saturated = False
+
+
+class AdmissionQueue:
+    """按模型的就绪排队（进程内单例 admission）"""
+
+    def __init__(self, max_users: int = 10000):
+        self._seq = itertools.count()
+        self._waiters: Dict[Hashable, List[Ticket]] = {}
+        # 队列 -> (叫到的号, 叫号时间)
+        self._turns: Dict[Hashable, Tuple[Ticket, float]] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        # user_id -> 最近一次被叫到的时间（fair 顺序用）
+        self._served: "OrderedDict[Optional[int], float]" = OrderedDict()
+        self._max_users = max_users
+        self.admitted = 0
+        self.timeouts = 0
+        self._histogram = [0] * (len(_WAIT_BUCKETS) + 1)
+
+    def enabled(self) -> bool:
+        return _policy()[0]
+
+    def max_wait(self) -> float:
+        return _policy()[1]
+
+    def ticket(self, key: Hashable, user_id: Optional[int]) -> Ticket:
+        return Ticket(key, user_id, next(self._seq))
+
+    async def wait(self, ticket: Ticket, ready_in: float, deadline: float, saturated: bool = False) -> bool:
+        """挂起直到 ready_in 秒后被叫到号（返回 True，之后必须 release）；到 deadline（monotonic）返回 False
+
+        saturated: 在等凭证并发名额，wake_saturated() 时提前叫号
+        """
+        now = time.monotonic()
+        ticket.ready_at = now + max(0.0, ready_in)
+        ticket.saturated = saturated
+        ticket.future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(ticket.key, []).append(ticket)
+        self._schedule(ticket.key)
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout=max(0.0, deadline - now))
+        except asyncio.TimeoutError:
+            self._remove(ticket)
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 超时的同一时刻被叫到：把号让给下一个
+                ticket.has_turn = True
+                self.release(ticket)
+            self.timeouts += 1
+            self._observe(time.monotonic() - ticket.enqueued_at)
+            return False
+        except asyncio.CancelledError:
+            self._remove(ticket)
+            if ticket.future.done() and not ticket.future.cancelled():
+                ticket.has_turn = True
+                self.release(ticket)
+            raise
+        ticket.has_turn = True
+        return True
+
+    def release(self, ticket: Ticket, admitted: bool = False):
+        """被叫到的请求选完凭证：叫下一个号；admitted 表示已拿到就绪的凭证（计入等待时间分布）"""
+        if not ticket.has_turn:
+            return
+        ticket.has_turn = False
+        if admitted:
+            self.admitted += 1
+            self._observe(time.monotonic() - ticket.enqueued_at)
+        turn = self._turns.get(ticket.key)
+        if turn is not None and turn[0] is ticket:
+            del self._turns[ticket.key]
+        self._schedule(ticket.key)
+
+    def wake_saturated(self):
+        """有上游调用结束：等并发名额的请求立即变为可叫号"""
+        now = time.monotonic()
+        for key, waiters in list(self._waiters.items()):
+            woke = False
+            for ticket in waiters:
+                if ticket.saturated and ticket.ready_at > now:
+                    ticket.ready_at = now
+                    woke = True
+            if woke:
+                self._schedule(key)
+
+    # ===== 调度 =====
+
+    def _schedule(self, key: Hashable):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        waiters = self._waiters.get(key)
+        if not waiters:
+            self._waiters.pop(key, None)
+            return
+        now = time.monotonic()
+        turn = self._turns.get(key)
+        if turn is not None:
+            held = now - turn[1]
+            if held < _TURN_TIMEOUT:
+                self._timers[key] = asyncio.get_running_loop().call_later(_TURN_TIMEOUT - held, self._schedule, key)
+                return
+            del self._turns[key]
+
+        ready = [t for t in waiters if t.ready_at <= now]
+        if not ready:
+            delay = min(t.ready_at for t in waiters) - now
+            self._timers[key] = asyncio.get_running_loop().call_later(delay, self._schedule, key)
+            return
+
+        chosen = self._pick(ready)
+        waiters.remove(chosen)
+        self._turns[key] = (chosen, now)
+        self._served[chosen.user_id] = now
+        self._served.move_to_end(chosen.user_id)
+        while len(self._served) > self._max_users:
+            self._served.popitem(last=False)
+        chosen.future.set_result(True)
+
+    def _pick(self, ready: List[Ticket]) -> Ticket:
+        if _policy()[2] == "fifo":
+            return min(ready, key=lambda t: t.seq)
+        # fair：最久没被叫到的用户优先
+        return min(ready, key=lambda t: (self._served.get(t.user_id, 0.0), t.seq))
+
+    def _remove(self, ticket: Ticket):
+        waiters = self._waiters.get(ticket.key)
+        if waiters and ticket in waiters:
+            waiters.remove(ticket)
+            self._schedule(ticket.key)
+
+    def _observe(self, seconds: float):
+        for i, bound in enumerate(_WAIT_BUCKETS):
+            if seconds <= bound:
+                self._histogram[i] += 1
+                return
+        self._histogram[-1] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        enabled, max_wait, order = _policy()
+        labels = [f"<={bound}s" for bound in _WAIT_BUCKETS] + [f">{_WAIT_BUCKETS[-1]}s"]
+        return {
+            "enabled": enabled,
+            "order": order,
+            "max_wait_ms": round(max_wait * 1000),
+            "depth": sum(len(waiters) for waiters in self._waiters.values()),
+            "queues": {
+                "/".join(map(str, key)) if isinstance(key, tuple) else str(key): len(waiters)
+                for key, waiters in self._waiters.items() if waiters
+            },
+            "admitted": self.admitted,
+            "timeouts": self.timeouts,
+            "wait_histogram": dict(zip(labels, self._histogram)),
+        }
+
+
+# 全局单例
+admission = AdmissionQueue()
@@ -1,8 +1,12 @@
 import httpx
 import json
 import uuid
-from typing import AsyncGenerator, Optional, Dict, Any, List
+from typing import AsyncGenerator, Optional, Dict, Any, List, Union
 from app.config import settings
+from app.services import json_codec
+from app.services.json_codec import ChunkTemplate
+from app.services.heartbeat import heartbeats_until_done
+from app.services.conversion_cache import antigravity_client_cache
 
 
 class AntigravityClient:
@@ -490,6 +494,7 @@ class AntigravityClient:
         
         # 4. 调用 generate_content (会在内部调用 _normalize_antigravity_request)
         result = await self.generate_content(gemini_model, contents, generation_config, system_instruction)
+        await self._save_inline_images(result)
         return self._convert_to_openai_response(result, model, server_base_url)
     
     async def chat_completions_stream(
@@ -520,8 +525,18 @@ class AntigravityClient:
         generation_config = gemini_dict.get("generationConfig", {})
         system_instruction = gemini_dict.get("systemInstruction")
         
+        template = ChunkTemplate("chatcmpl-antigravity", model)
         async for chunk in self.generate_content_stream(gemini_model, contents, generation_config, system_instruction):
-            yield self._convert_to_openai_stream(chunk, model, server_base_url)
+            if '"inlineData"' in chunk:
+                # 图片 chunk：先在线程池里解码落盘，避免大图阻塞其他流
+                try:
+                    parsed = json_codec.loads(chunk)
+                except json_codec.JSONDecodeError:
+                    continue
+                await self._save_inline_images(parsed)
+                yield self._convert_to_openai_stream(parsed, model, server_base_url, template)
+            else:
+                yield self._convert_to_openai_stream(chunk, model, server_base_url, template)
     
     async def chat_completions_fake_stream(
         self,
@@ -550,34 +565,22 @@ class AntigravityClient:
         generation_config = gemini_dict.get("generationConfig", {})
         system_instruction = gemini_dict.get("systemInstruction")
         
+        # 同一个流的 chunk 共用预序列化的信封，只编码 delta
+        template = ChunkTemplate("chatcmpl-antigravity", model)
+        
         # 发送初始 chunk（空内容，保持连接）
-        initial_chunk = {
-            "id": "chatcmpl-antigravity",
-            "object": "chat.completion.chunk",
-            "created": 0,
-            "model": model,
-            "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]
-        }
-        yield f"data: {json.dumps(initial_chunk)}\n\n"
+        yield template.delta({"role": "assistant"})
         
         # 创建请求任务
         request_task = asyncio.create_task(
             self.generate_content(gemini_model, contents, generation_config, system_instruction)
         )
         
-        # 每2秒发送心跳，直到请求完成
-        heartbeat_chunk = {
-            "id": "chatcmpl-antigravity",
-            "object": "chat.completion.chunk",
-            "created": 0,
-            "model": model,
-            "choices": [{"index": 0, "delta": {}, "finish_reason": None}]
-        }
+        # 请求完成前按间隔发送心跳，完成后立即输出结果
+        heartbeat_chunk = template.delta({})
         
-        while not request_task.done():
-            await asyncio.sleep(2)
-            if not request_task.done():
-                yield f"data: {json.dumps(heartbeat_chunk)}\n\n"
+        async for _ in heartbeats_until_done(request_task, settings.fake_stream_heartbeat_interval):
+            yield heartbeat_chunk
         
         # 获取完整响应
         try:
@@ -596,35 +599,14 @@ class AntigravityClient:
             
             # 输出完整内容
             if content:
-                content_chunk = {
-                    "id": "chatcmpl-antigravity",
-                    "object": "chat.completion.chunk",
-                    "created": 0,
-                    "model": model,
-                    "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
-                }
-                yield f"data: {json.dumps(content_chunk)}\n\n"
+                yield template.delta({"content": content})
             
             # 发送结束标记
-            done_chunk = {
-                "id": "chatcmpl-antigravity",
-                "object": "chat.completion.chunk",
-                "created": 0,
-                "model": model,
-                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
-            }
-            yield f"data: {json.dumps(done_chunk)}\n\n"
+            yield template.delta({}, "stop")
             yield "data: [DONE]\n\n"
             
         except Exception as e:
-            error_chunk = {
-                "id": "chatcmpl-antigravity",
-                "object": "chat.completion.chunk",
-                "created": 0,
-                "model": model,
-                "choices": [{"index": 0, "delta": {"content": f"\n\n[Error: {str(e)}]"}, "finish_reason": "stop"}]
-            }
-            yield f"data: {json.dumps(error_chunk)}\n\n"
+            yield template.delta({"content": f"\n\n[Error: {str(e)}]"}, "stop")
             yield "data: [DONE]\n\n"
     
     def _build_generation_config(self, model: str, kwargs: dict) -> dict:
@@ -684,75 +666,90 @@ class AntigravityClient:
                         print(f"[AntigravityClient] 已在最后一个 assistant 消息开头插入思考块（含跳过验证签名）", flush=True)
                     break
     
-    def _convert_messages_to_contents(self, messages: list) -> tuple:
-        """将OpenAI消息格式转换为Gemini contents格式"""
-        contents = []
-        system_instructions = []
+    @staticmethod
+    def _convert_message(msg: dict) -> tuple:
+        """转换单条 OpenAI 消息
         
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            
-            if role == "system":
-                if isinstance(content, str):
-                    system_instructions.append(content)
-                elif isinstance(content, list):
-                    for item in content:
-                        if isinstance(item, dict) and item.get("type") == "text":
-                            system_instructions.append(item.get("text", ""))
-                        elif isinstance(item, str):
-                            system_instructions.append(item)
-                continue
-            
-            gemini_role = "user" if role == "user" else "model"
-            
-            # 处理多模态内容
-            parts = []
+        Returns:
+            (system_texts, content): system 消息返回其文本，其他消息返回 Gemini content
+        """
+        system_texts = []
+        
+        role = msg.get("role", "user")
+        content = msg.get("content", "")
+
+        if role == "system":
             if isinstance(content, str):
-                parts.append({"text": content})
+                system_texts.append(content)
             elif isinstance(content, list):
                 for item in content:
-                    if isinstance(item, dict):
-                        if item.get("type") == "text":
-                            parts.append({"text": item.get("text", "")})
-                        elif item.get("type") == "image_url":
-                            image_url = item.get("image_url", {})
-                            url = image_url.get("url", "") if isinstance(image_url, dict) else image_url
-                            if url.startswith("data:"):
-                                try:
-                                    header, base64_data = url.split(",", 1)
-                                    mime_type = header.split(":")[1].split(";")[0]
-                                    parts.append({
-                                        "inlineData": {
-                                            "mimeType": mime_type,
-                                            "data": base64_data
-                                        }
-                                    })
-                                except Exception as e:
-                                    print(f"[AntigravityClient] ⚠️ 解析图片数据失败: {e}", flush=True)
-                            else:
+                    if isinstance(item, dict) and item.get("type") == "text":
+                        system_texts.append(item.get("text", ""))
+                    elif isinstance(item, str):
+                        system_texts.append(item)
+            return tuple(system_texts), None
+
+        gemini_role = "user" if role == "user" else "model"
+
+        # 处理多模态内容
+        parts = []
+        if isinstance(content, str):
+            parts.append({"text": content})
+        elif isinstance(content, list):
+            for item in content:
+                if isinstance(item, dict):
+                    if item.get("type") == "text":
+                        parts.append({"text": item.get("text", "")})
+                    elif item.get("type") == "image_url":
+                        image_url = item.get("image_url", {})
+                        url = image_url.get("url", "") if isinstance(image_url, dict) else image_url
+                        if url.startswith("data:"):
+                            try:
+                                header, base64_data = url.split(",", 1)
+                                mime_type = header.split(":")[1].split(";")[0]
                                 parts.append({
-                                    "fileData": {
-                                        "mimeType": "image/jpeg",
-                                        "fileUri": url
+                                    "inlineData": {
+                                        "mimeType": mime_type,
+                                        "data": base64_data
                                     }
                                 })
-                        elif "text" in item and "type" not in item:
-                            parts.append({"text": item["text"]})
-                        elif "inlineData" in item:
-                            parts.append({"inlineData": item["inlineData"]})
-                        elif "fileData" in item:
-                            parts.append({"fileData": item["fileData"]})
-                    elif isinstance(item, str):
-                        parts.append({"text": item})
-            
-            if not parts:
-                parts.append({"text": ""})
-            
-            contents.append({
-                "role": gemini_role,
-                "parts": parts
-            })
+                            except Exception as e:
+                                print(f"[AntigravityClient] ⚠️ 解析图片数据失败: {e}", flush=True)
+                        else:
+                            parts.append({
+                                "fileData": {
+                                    "mimeType": "image/jpeg",
+                                    "fileUri": url
+                                }
+                            })
+                    elif "text" in item and "type" not in item:
+                        parts.append({"text": item["text"]})
+                    elif "inlineData" in item:
+                        parts.append({"inlineData": item["inlineData"]})
+                    elif "fileData" in item:
+                        parts.append({"fileData": item["fileData"]})
+                elif isinstance(item, str):
+                    parts.append({"text": item})
+
+        if not parts:
+            parts.append({"text": ""})
+
+        return (), {
+            "role": gemini_role,
+            "parts": parts
+        }
+    
+    def _convert_messages_to_contents(self, messages: list) -> tuple:
+        """将OpenAI消息格式转换为Gemini contents格式"""
+        contents = []
+        system_instructions = []
+        
+        # 未变化的历史前缀直接复用上一轮的转换结果，只转换新增的尾部消息
+        for system_texts, content in antigravity_client_cache.convert(messages, self._convert_message):
+            system_instructions.extend(system_texts)
+            if content is not None:
+                # 浅拷贝：调用方可能整体替换 content["parts"]，不能影响缓存中的对象
+                contents.append(dict(content))
         
         # 构建 systemInstruction
         system_instruction = None
@@ -780,6 +777,20 @@ class AntigravityClient:
         
         return model
     
+    @staticmethod
+    async def _save_inline_images(gemini_response: dict) -> None:
+        """在线程池中保存响应里的 inlineData 图片，URL 记在 part 的 _saved_url 上供转换时使用"""
+        from app.services.image_storage import ImageStorage
+        
+        response_data = gemini_response.get("response", gemini_response)
+        for candidate in response_data.get("candidates") or []:
+            for part in (candidate.get("content") or {}).get("parts") or []:
+                inline_data = part.get("inlineData")
+                if inline_data and inline_data.get("data") and "_saved_url" not in inline_data:
+                    inline_data["_saved_url"] = await ImageStorage.save_base64_image_async(
+                        inline_data["data"], inline_data.get("mimeType", "image/png")
+                    )
+    
     def _convert_to_openai_response(self, gemini_response: dict, model: str, server_base_url: str = None) -> dict:
         """将Gemini响应转换为OpenAI格式"""
         content = ""
@@ -806,9 +817,11 @@ class AntigravityClient:
                         mime_type = inline_data.get("mimeType", "image/png")
                         data = inline_data.get("data", "")
                         if data:
-                            # 保存图片到本地并获取 URL
-                            from app.services.image_storage import ImageStorage
-                            relative_url = ImageStorage.save_base64_image(data, mime_type)
+                            # 保存图片到本地并获取 URL（通常已由 _save_inline_images 在线程池中保存）
+                            relative_url = inline_data.get("_saved_url")
+                            if relative_url is None:
+                                from app.services.image_storage import ImageStorage
+                                relative_url = ImageStorage.save_base64_image(data, mime_type)
                             
                             if relative_url:
                                 # 如果有 server_base_url，拼接成完整 URL
@@ -847,10 +860,16 @@ class AntigravityClient:
             }
         }
     
-    def _convert_to_openai_stream(self, chunk_data: str, model: str, server_base_url: str = None) -> str:
-        """将Gemini流式响应转换为OpenAI SSE格式"""
+    def _convert_to_openai_stream(
+        self,
+        chunk_data: Union[str, dict],
+        model: str,
+        server_base_url: str = None,
+        template: Optional[ChunkTemplate] = None,
+    ) -> str:
+        """将Gemini流式响应转换为OpenAI SSE格式（chunk_data 可以是已解析的 dict）"""
         try:
-            data = json.loads(chunk_data)
+            data = chunk_data if isinstance(chunk_data, dict) else json_codec.loads(chunk_data)
             content = ""
             reasoning_content = ""
             
@@ -873,9 +892,11 @@ class AntigravityClient:
                             mime_type = inline_data.get("mimeType", "image/png")
                             data = inline_data.get("data", "")
                             if data:
-                                # 保存图片到本地并获取 URL
-                                from app.services.image_storage import ImageStorage
-                                relative_url = ImageStorage.save_base64_image(data, mime_type)
+                                # 保存图片到本地并获取 URL（通常已由 _save_inline_images 在线程池中保存）
+                                relative_url = inline_data.get("_saved_url")
+                                if relative_url is None:
+                                    from app.services.image_storage import ImageStorage
+                                    relative_url = ImageStorage.save_base64_image(data, mime_type)
                                 
                                 if relative_url:
                                     # 如果有 server_base_url，拼接成完整 URL
@@ -898,17 +919,8 @@ class AntigravityClient:
             if not delta:
                 return ""
             
-            openai_chunk = {
-                "id": "chatcmpl-antigravity",
-                "object": "chat.completion.chunk",
-                "created": 0,
-                "model": model,
-                "choices": [{
-                    "index": 0,
-                    "delta": delta,
-                    "finish_reason": None
-                }]
-            }
-            return f"data: {json.dumps(openai_chunk)}\n\n"
+            if template is None:
+                template = ChunkTemplate("chatcmpl-antigravity", model)
+            return template.delta(delta)
         except:
             return ""
\ No newline at end of file
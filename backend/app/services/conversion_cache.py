@@ -0,0 +1,162 @@
+"""
+对话消息转换的前缀缓存
+
+长对话每一轮都会重发全部历史消息，而历史部分的转换结果与上一轮完全相同。
+把每条消息编码后拼接做一次增量哈希，在已缓存的前缀长度处取摘要，
+缓存“前 i 条消息 -> 每条消息的转换结果”，新一轮只需从最长命中前缀之后开始转换。
+
+大小按条目数和字节数双重限制：消息里可能带 base64 图片（inlineData），
+条目的字节数按该前缀全部消息的编码长度估算（转换前后的体积基本一致）。
+
+命中时返回的是共享对象：调用方组装 contents 时应浅拷贝每个 content dict
+（下游会整体替换 content["parts"]），不得原地修改 parts 里的 dict。
+"""
+import hashlib
+import json
+import marshal
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+
+def _encode(obj: Any) -> bytes:
+    """把 JSON 结构编码为字节串（marshal 比 json.dumps 快数倍）
+
+    使用 version 2：version 3 起会按对象引用计数写入引用标记，
+    同样内容在不同请求里可能编码不同，导致无谓的缓存未命中。
+    """
+    try:
+        return marshal.dumps(obj, 2)
+    except ValueError:
+        # 含有 marshal 不支持的对象时退回 JSON（长度前缀保证拼接后仍可区分边界）
+        raw = json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+        return b"J" + len(raw).to_bytes(8, "little") + raw
+
+
+def content_digest(obj: Any) -> bytes:
+    """对工具定义等 JSON 结构做快速内容哈希"""
+    return hashlib.blake2b(_encode(obj), digest_size=16).digest()
+
+
+class PrefixConversionCache:
+    """按消息前缀缓存逐条转换结果（LRU，按前缀条目数和估算字节数限制大小）"""
+
+    def __init__(self, name: str, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # 前缀哈希 -> (前缀长度, 估算字节数, 每条消息的转换结果)
+        self._data: "OrderedDict[bytes, Tuple[int, int, Tuple[Any, ...]]]" = OrderedDict()
+        self._bytes = 0
+        # 缓存中出现过的前缀长度 -> 条目数，只在这些位置计算前缀哈希
+        self._lengths: Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.reused_messages = 0
+        self.converted_messages = 0
+
+    def _prefix_keys(self, blobs: List[bytes], context: bytes) -> Dict[int, bytes]:
+        """单次增量哈希，在已缓存的前缀长度和完整长度处各取一次摘要"""
+        total = len(blobs)
+        positions = sorted(n for n in self._lengths if n < total)
+        positions.append(total)
+
+        hasher = hashlib.blake2b(context, digest_size=16)
+        keys = {}
+        done = 0
+        for n in positions:
+            hasher.update(b"".join(blobs[done:n]))
+            keys[n] = hasher.copy().digest()
+            done = n
+        return keys
+
+    def convert(
+        self,
+        messages: Sequence[Dict[str, Any]],
+        convert_one: Callable[[Dict[str, Any]], Any],
+        context: bytes = b"",
+    ) -> List[Any]:
+        """返回每条消息的转换结果；context 为影响转换结果的其他输入（如工具 schema）的哈希"""
+        if not messages:
+            return []
+
+        blobs = [_encode(message) for message in messages]
+        keys = self._prefix_keys(blobs, context)
+
+        # 从最长前缀往回找：普通的新一轮只比上一轮多 1~2 条消息
+        cached: Tuple[Any, ...] = ()
+        for n in sorted(keys, reverse=True):
+            entry = self._data.get(keys[n])
+            if entry is not None:
+                self._data.move_to_end(keys[n])
+                cached = entry[2]
+                break
+
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.reused_messages += len(cached)
+        self.converted_messages += len(messages) - len(cached)
+
+        outputs = list(cached)
+        for message in messages[len(cached):]:
+            outputs.append(convert_one(message))
+
+        if len(cached) < len(messages):
+            self._store(keys[len(messages)], tuple(outputs), sum(len(blob) for blob in blobs))
+        return outputs
+
+    def _store(self, key: bytes, outputs: Tuple[Any, ...], size: int):
+        # 单个前缀就超过预算（如多张大图）时不缓存，免得把其他条目全部挤出
+        if size > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is None:
+            self._lengths[len(outputs)] = self._lengths.get(len(outputs), 0) + 1
+        else:
+            self._bytes -= old[1]
+        self._data[key] = (len(outputs), size, outputs)
+        self._bytes += size
+        while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+            _, (length, evicted_size, _) = self._data.popitem(last=False)
+            self._bytes -= evicted_size
+            self._lengths[length] -= 1
+            if not self._lengths[length]:
+                del self._lengths[length]
+
+    def clear(self):
+        self._data.clear()
+        self._lengths.clear()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_messages = 0
+        self.converted_messages = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        total_messages = self.reused_messages + self.converted_messages
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "message_reuse_rate": round(self.reused_messages / total_messages, 4) if total_messages else 0.0,
+        }
+
+
+# 各转换器的缓存实例
+openai_request_cache = PrefixConversionCache("openai2gemini_full")
+gemini_client_cache = PrefixConversionCache("gemini_client")
+antigravity_client_cache = PrefixConversionCache("antigravity_client")
+
+
+def get_conversion_cache_stats() -> Dict[str, Any]:
+    """对话转换前缀缓存的命中统计"""
+    return {
+        cache.name: cache.stats()
+        for cache in (openai_request_cache, gemini_client_cache, antigravity_client_cache)
+    }
@@ -0,0 +1,248 @@
+"""
+凭证健康评分（自适应选凭证）
+
+原先选凭证只按 last_used_at 轮询：一半请求超时、首字节耗时是中位数 5 倍的凭证，在被硬性禁用之前
+和健康的凭证被选中得一样多。这里为每个凭证维护 EWMA 统计（进程内，定期写回 Credential.health_stats）：
+
+- 成功率：FailoverExecutor 每次尝试的结果（429/配额耗尽交给冷却处理，客户端错误不算凭证的问题，都不计入）
+- 首字节耗时（TTFB）：流式为第一个带文本负载的数据块到达的时间（心跳不算），非流式为整个请求的耗时
+- 输出速度（tokens/s）：流式响应首字节之后输出的文本负载长度 / 耗时（不含 SSE/JSON 包装），按约 4 个字符一个 token 估算
+- 评分 = 成功率 / (TTFB + 预期输出 token 数 / 输出速度)，即单位时间的期望有效产出；
+  样本不足的凭证按全池平均值计分，统计随时间（credential_health_decay_seconds）回归全池平均，
+  被冷落的凭证过一段时间会重新得到机会
+
+选凭证（credential_health_enabled）：在不在 CD 中的候选里随机取两个，选评分高的（power of two choices），
+同分时选更久未使用的。CD / 冷却规则不变，流量逐渐偏向又快又稳的凭证。
+"""
+import json
+import math
+import random
+import time
+from typing import Any, Dict, Optional, Sequence, Set, Tuple
+
+
+# EWMA 平滑系数
+_ALPHA = 0.2
+# 样本数少于此值时评分向全池平均靠拢
+_MIN_SAMPLES = 5
+# 评分里假设的一次请求输出 token 数
+_EXPECTED_OUTPUT_TOKENS = 500
+_BYTES_PER_TOKEN = 4
+# 首字节之后至少持续这么久的流才计入输出速度
+_MIN_STREAM_SECONDS = 0.5
+# 全池还没有样本时的默认值
+_DEFAULT_TTFB = 2.0
+_DEFAULT_TPS = 50.0
+
+
+def _policy() -> Tuple[bool, float]:
+    """(是否按评分选凭证, 统计回归全池平均的时间常数秒)"""
+    try:
+        from app.config import settings
+        return settings.credential_health_enabled, max(1, settings.credential_health_decay_seconds)
+    except ImportError:
+        return True, 600.0
+
+
+class _Stats:
+    __slots__ = ("success", "ttfb", "tps", "samples", "tps_samples", "updated_at")
+
+    def __init__(self):
+        self.success = 1.0
+        self.ttfb = _DEFAULT_TTFB
+        self.tps = _DEFAULT_TPS
+        self.samples = 0
+        self.tps_samples = 0
+        self.updated_at = time.time()
+
+
+def _ewma(current: float, value: float, samples: int) -> float:
+    # 前几个样本按算术平均，避免初始值影响太久
+    alpha = max(_ALPHA, 1 / (samples + 1))
+    return current + alpha * (value - current)
+
+
+class CredentialHealth:
+    """凭证 EWMA 统计与评分（进程内单例 credential_health）"""
+
+    def __init__(self):
+        self._stats: Dict[int, _Stats] = {}
+        self._dirty: Set[int] = set()
+        # 全池 EWMA：没有样本的凭证按它计分
+        self._pool = _Stats()
+        self.picks = 0
+        self.reordered = 0
+
+    def enabled(self) -> bool:
+        return _policy()[0]
+
+    # ===== 输入 =====
+
+    def _get(self, credential_id: int) -> _Stats:
+        stats = self._stats.get(credential_id)
+        if stats is None:
+            stats = self._stats[credential_id] = _Stats()
+            stats.success, stats.ttfb, stats.tps = self._pool.success, self._pool.ttfb, self._pool.tps
+        return stats
+
+    def record_success(self, credential_id: int, ttfb_seconds: float):
+        for stats in (self._get(credential_id), self._pool):
+            stats.success = _ewma(stats.success, 1.0, stats.samples)
+            stats.ttfb = _ewma(stats.ttfb, max(0.0, ttfb_seconds), stats.samples)
+            stats.samples += 1
+            stats.updated_at = time.time()
+        self._dirty.add(credential_id)
+
+    def record_failure(self, credential_id: int):
+        for stats in (self._get(credential_id), self._pool):
+            stats.success = _ewma(stats.success, 0.0, stats.samples)
+            stats.samples += 1
+            stats.updated_at = time.time()
+        self._dirty.add(credential_id)
+
+    def record_stream(self, credential_id: int, output_bytes: int, seconds: float):
+        """流式输出速度（首字节之后的部分）"""
+        if seconds < _MIN_STREAM_SECONDS or output_bytes <= 0:
+            return
+        tps = output_bytes / _BYTES_PER_TOKEN / seconds
+        for stats in (self._get(credential_id), self._pool):
+            stats.tps = _ewma(stats.tps, tps, stats.tps_samples)
+            stats.tps_samples += 1
+        self._dirty.add(credential_id)
+
+    # ===== 评分 =====
+
+    def _effective(self, credential_id: int) -> Tuple[float, float, float]:
+        """(成功率, TTFB, tokens/s)：样本不足或很久没有更新时向全池平均回归"""
+        pool = self._pool
+        stats = self._stats.get(credential_id)
+        if stats is None:
+            return pool.success, pool.ttfb, pool.tps
+        _, decay = _policy()
+        trust = min(1.0, stats.samples / _MIN_SAMPLES) * math.exp(-(time.time() - stats.updated_at) / decay)
+        tps_trust = min(1.0, stats.tps_samples / _MIN_SAMPLES) * trust
+        return (
+            pool.success + (stats.success - pool.success) * trust,
+            pool.ttfb + (stats.ttfb - pool.ttfb) * trust,
+            pool.tps + (stats.tps - pool.tps) * tps_trust,
+        )
+
+    def score(self, credential_id: int) -> float:
+        success, ttfb, tps = self._effective(credential_id)
+        return success / (max(ttfb, 0.01) + _EXPECTED_OUTPUT_TOKENS / max(tps, 0.1))
+
+    def choose(self, candidates: Sequence[Any]) -> Any:
+        """从按 last_used_at 排好序的候选（都不在 CD 中）里选一个"""
+        if len(candidates) < 2 or not self.enabled():
+            return candidates[0]
+        self.picks += 1
+        first, second = sorted(random.sample(range(len(candidates)), 2))
+        # 同分时选更久未使用的（排在前面的）
+        if self.score(candidates[second].id) > self.score(candidates[first].id):
+            first = second
+        if first != 0:
+            self.reordered += 1
+        return candidates[first]
+
+    # ===== 持久化 =====
+
+    def snapshot(self, credential_id: int) -> Optional[Dict[str, Any]]:
+        """前端展示用（没有样本时返回 None）"""
+        stats = self._stats.get(credential_id)
+        if stats is None or stats.samples == 0:
+            return None
+        return {
+            "success_rate": round(stats.success, 3),
+            "ttfb_ms": round(stats.ttfb * 1000),
+            "tokens_per_second": round(stats.tps, 1) if stats.tps_samples else None,
+            "samples": stats.samples,
+            "score": round(self.score(credential_id), 4),
+        }
+
+    def serialize(self, credential_id: int) -> Optional[str]:
+        stats = self._stats.get(credential_id)
+        if stats is None:
+            return None
+        return json.dumps({
+            "success": round(stats.success, 4),
+            "ttfb": round(stats.ttfb, 4),
+            "tps": round(stats.tps, 2),
+            "samples": stats.samples,
+            "tps_samples": stats.tps_samples,
+            "updated_at": round(stats.updated_at),
+        })
+
+    def load_row(self, credential_id: int, raw: Optional[str]) -> None:
+        """从 Credential.health_stats 恢复（格式错误时忽略）"""
+        if not raw:
+            return
+        try:
+            data = json.loads(raw)
+            stats = _Stats()
+            stats.success = min(1.0, max(0.0, float(data["success"])))
+            stats.ttfb = max(0.0, float(data["ttfb"]))
+            stats.tps = max(0.1, float(data["tps"]))
+            stats.samples = int(data.get("samples", 0))
+            stats.tps_samples = int(data.get("tps_samples", 0))
+            stats.updated_at = float(data.get("updated_at", time.time()))
+        except (TypeError, ValueError, KeyError):
+            return
+        self._stats[credential_id] = stats
+
+    async def load(self, db) -> int:
+        """启动时从数据库加载，并用各凭证的均值初始化全池统计；返回加载的凭证数"""
+        from sqlalchemy import select
+        from app.models.user import Credential
+
+        result = await db.execute(
+            select(Credential.id, Credential.health_stats).where(Credential.health_stats.isnot(None))
+        )
+        for credential_id, raw in result.all():
+            self.load_row(credential_id, raw)
+        loaded = [s for s in self._stats.values() if s.samples]
+        if loaded:
+            self._pool.success = sum(s.success for s in loaded) / len(loaded)
+            self._pool.ttfb = sum(s.ttfb for s in loaded) / len(loaded)
+            self._pool.tps = sum(s.tps for s in loaded) / len(loaded)
+            self._pool.samples = min(sum(s.samples for s in loaded), _MIN_SAMPLES)
+        return len(self._stats)
+
+    async def persist(self, db) -> int:
+        """把有变化的凭证统计写回数据库，返回写入的凭证数"""
+        from sqlalchemy import update
+        from app.models.user import Credential
+
+        dirty, self._dirty = self._dirty, set()
+        for credential_id in dirty:
+            await db.execute(
+                update(Credential)
+                .where(Credential.id == credential_id)
+                .values(health_stats=self.serialize(credential_id))
+            )
+        if dirty:
+            await db.commit()
+        return len(dirty)
+
+    def stats(self) -> Dict[str, Any]:
+        enabled, _ = _policy()
+        scored = sorted(
+            ((cid, self.score(cid)) for cid, s in self._stats.items() if s.samples),
+            key=lambda item: item[1],
+        )
+        return {
+            "enabled": enabled,
+            "tracked": len(self._stats),
+            "pool": {
+                "success_rate": round(self._pool.success, 3),
+                "ttfb_ms": round(self._pool.ttfb * 1000),
+                "tokens_per_second": round(self._pool.tps, 1),
+            },
+            "picks": self.picks,
+            "reordered": self.reordered,
+            # 评分最低的几个凭证，便于排查
+            "worst": {str(cid): round(score, 4) for cid, score in scored[:10]},
+        }
+
+
+# 全局单例
+credential_health = CredentialHealth()
@@ -1,19 +1,30 @@
-from typing import Optional
+from typing import List, Optional
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, or_
+from sqlalchemy import select, update, or_, func
 from app.models.user import Credential
 from app.services.crypto import decrypt_credential, encrypt_credential
+from app.services.admission import admission
+from app.services.credential_health import credential_health
+from app.services.entitlements import entitlements
+from app.services.inflight import inflight
+from app.services.model_breaker import PUBLIC_POOL, model_breaker, model_key, pool_of
+from app.services.model_cooldowns import model_cooldowns
 from app.config import settings
 import httpx
 import asyncio
+import heapq
+import time
 import logging
 
 log = logging.getLogger(__name__)
 
 # 异步 POST 请求封装
-async def post_async(url: str, json: dict = None, headers: dict = None, timeout: float = 30.0):
-    """异步 POST 请求"""
+async def post_async(url: str, json: dict = None, headers: dict = None, timeout: float = 30.0, client: httpx.AsyncClient = None):
+    """异步 POST 请求（传入 client 时复用其连接池）"""
+    if client is not None:
+        return await client.post(url, json=json, headers=headers, timeout=timeout)
     async with httpx.AsyncClient(timeout=timeout) as client:
         return await client.post(url, json=json, headers=headers)
 
@@ -26,7 +37,8 @@ ANTIGRAVITY_USER_AGENT = "antigravity/1.11.3 windows/amd64"  # 与 gcli2api 完
 async def fetch_project_id(
     access_token: str,
     user_agent: str,
-    api_base_url: str
+    api_base_url: str,
+    client: httpx.AsyncClient = None
 ) -> Optional[str]:
     """
     从 API 获取 project_id，如果 loadCodeAssist 失败则回退到 onboardUser
@@ -35,6 +47,7 @@ async def fetch_project_id(
         access_token: Google OAuth access token
         user_agent: User-Agent header
         api_base_url: API base URL (e.g., antigravity or code assist endpoint)
+        client: 可选的共享 httpx 客户端（批量上传时复用连接）
 
     Returns:
         project_id 字符串，如果获取失败返回 None
@@ -48,7 +61,7 @@ async def fetch_project_id(
 
     # 步骤 1: 尝试 loadCodeAssist
     try:
-        project_id = await _try_load_code_assist(api_base_url, headers)
+        project_id = await _try_load_code_assist(api_base_url, headers, client)
         if project_id:
             return project_id
 
@@ -60,7 +73,7 @@ async def fetch_project_id(
 
     # 步骤 2: 回退到 onboardUser
     try:
-        project_id = await _try_onboard_user(api_base_url, headers)
+        project_id = await _try_onboard_user(api_base_url, headers, client)
         if project_id:
             return project_id
 
@@ -76,7 +89,8 @@ async def fetch_project_id(
 
 async def _try_load_code_assist(
     api_base_url: str,
-    headers: dict
+    headers: dict,
+    client: httpx.AsyncClient = None
 ) -> Optional[str]:
     """
     尝试通过 loadCodeAssist 获取 project_id
@@ -101,6 +115,7 @@ async def _try_load_code_assist(
         json=request_body,
         headers=headers,
         timeout=30.0,
+        client=client,
     )
 
     log.debug(f"[loadCodeAssist] Response status: {response.status_code}")
@@ -136,7 +151,8 @@ async def _try_load_code_assist(
 
 async def _try_onboard_user(
     api_base_url: str,
-    headers: dict
+    headers: dict,
+    client: httpx.AsyncClient = None
 ) -> Optional[str]:
     """
     尝试通过 onboardUser 获取 project_id（长时间运行操作，需要轮询）
@@ -147,7 +163,7 @@ async def _try_onboard_user(
     request_url = f"{api_base_url.rstrip('/')}/v1internal:onboardUser"
 
     # 首先需要获取用户的 tier 信息
-    tier_id = await _get_onboard_tier(api_base_url, headers)
+    tier_id = await _get_onboard_tier(api_base_url, headers, client)
     if not tier_id:
         log.error("[onboardUser] Failed to determine user tier")
         return None
@@ -182,6 +198,7 @@ async def _try_onboard_user(
             json=request_body,
             headers=headers,
             timeout=30.0,
+            client=client,
         )
 
         log.debug(f"[onboardUser] Response status: {response.status_code}")
@@ -225,7 +242,8 @@ async def _try_onboard_user(
 
 async def _get_onboard_tier(
     api_base_url: str,
-    headers: dict
+    headers: dict,
+    client: httpx.AsyncClient = None
 ) -> Optional[str]:
     """
     从 loadCodeAssist 响应中获取用户应该注册的 tier
@@ -249,6 +267,7 @@ async def _get_onboard_tier(
         json=request_body,
         headers=headers,
         timeout=30.0,
+        client=client,
     )
 
     if response.status_code == 200:
@@ -423,17 +442,41 @@ class CredentialPool:
         return datetime.utcnow() < cd_end_time
     
     @staticmethod
-    async def check_user_has_tier3_creds(db: AsyncSession, user_id: int, mode: str = "geminicli") -> bool:
-        """检查用户是否有 3.0 等级的凭证"""
-        mode = CredentialPool.validate_mode(mode)
-        result = await db.execute(
-            select(Credential)
+    def seconds_until_ready(credential: Credential, model: str, model_group: str) -> float:
+        """凭证还要多久才能用于该模型（模型组 CD 与 429 冷却取较晚者）"""
+        remaining = model_cooldowns.remaining(credential.id, model)
+        cd_seconds = CredentialPool.get_cd_seconds(model_group)
+        if model_group == "30":
+            last_used = credential.last_used_30
+        elif model_group == "pro":
+            last_used = credential.last_used_pro
+        else:
+            last_used = credential.last_used_flash
+        if cd_seconds > 0 and last_used:
+            cd_end_time = last_used + timedelta(seconds=cd_seconds)
+            remaining = max(remaining, (cd_end_time - datetime.utcnow()).total_seconds())
+        return max(0.0, remaining)
+    
+    @staticmethod
+    def user_tier3_creds_query(user_id: int, mode: str = "geminicli"):
+        """用户是否有 3.0 凭证的探测查询（走 idx_credentials_owner_active 索引）"""
+        return (
+            select(Credential.id)
             .where(Credential.user_id == user_id)
             .where(Credential.api_type == mode)
             .where(Credential.model_tier == "3")
             .where(Credential.is_active == True)
             .limit(1)
         )
+    
+    @staticmethod
+    async def check_user_has_tier3_creds(db: AsyncSession, user_id: int, mode: str = "geminicli") -> bool:
+        """检查用户是否有 3.0 等级的凭证（有缓存的权益快照时直接读快照）"""
+        mode = CredentialPool.validate_mode(mode)
+        snapshot = entitlements.peek(user_id)
+        if snapshot is not None:
+            return snapshot.has_tier3(mode)
+        result = await db.execute(CredentialPool.user_tier3_creds_query(user_id, mode))
         return result.scalar_one_or_none() is not None
     
     @staticmethod
@@ -473,6 +516,100 @@ class CredentialPool:
         result = await db.execute(query)
         return result.scalar_one_or_none() is not None
     
+    @staticmethod
+    def build_selection_queries(
+        mode: str,
+        user_id: int,
+        required_tier: str = "2.5",
+        use_public_pool: bool = False,
+        exclude_ids: set = None
+    ) -> list:
+        """
+        构建凭证选择查询（每条都按 last_used_at 排序，结果用 merge_by_last_used 合并）
+        
+        公共池不用 is_public OR user_id 一条查询：OR 两边走不同的索引，数据库只能退回单列索引再临时排序。
+        拆成两条，分别由 idx_credentials_public_select / idx_credentials_owner_select 直接按 last_used_at
+        顺序读出（见 database.py 的 HOT_QUERY_INDEXES）：
+        - 公共池：公开凭证 + 自己的非公开凭证（自己的公开凭证已在第一条里）
+        - 私有池：自己的全部凭证
+        """
+        query = select(Credential).where(
+            Credential.is_active == True,
+            Credential.api_type == mode  # 按凭证类型过滤
+        )
+        
+        # 排除没有 project_id 的凭证（没有 project_id 无法调用 API）
+        query = query.where(Credential.project_id != None, Credential.project_id != "")
+        
+        # 排除已尝试过的凭证
+        if exclude_ids:
+            query = query.where(~Credential.id.in_(exclude_ids))
+        
+        # Antigravity 模式不检查 model_tier（权限由 Google API 控制）
+        # GeminiCLI 模式才需要检查：gemini-3 模型只能用 3 等级凭证
+        if mode == "geminicli" and required_tier == "3":
+            query = query.where(Credential.model_tier == "3")
+        
+        query = query.order_by(Credential.last_used_at.asc().nullsfirst())
+        if use_public_pool:
+            return [
+                query.where(Credential.is_public == True),
+                query.where(Credential.user_id == user_id).where(Credential.is_public.isnot(True)),
+            ]
+        return [query.where(Credential.user_id == user_id)]
+    
+    @staticmethod
+    def merge_by_last_used(*results: List[Credential]) -> List[Credential]:
+        """合并各条已按 last_used_at 排序的选择结果（NULL 在前，与 ORDER BY ... NULLS FIRST 一致）"""
+        if len(results) == 1:
+            return list(results[0])
+        return list(heapq.merge(
+            *results,
+            key=lambda c: (c.last_used_at is not None, c.last_used_at or datetime.min)
+        ))
+    
+    @staticmethod
+    async def uses_public_pool(
+        db: AsyncSession,
+        user_id: int,
+        user_has_public_creds: bool,
+        model: str = None,
+        mode: str = "geminicli"
+    ) -> bool:
+        """该用户请求该模型时是否可以使用公共池（池模式规则见 get_available_credential）"""
+        pool_mode = settings.credential_pool_mode
+        required_tier = CredentialPool.get_required_tier(model) if model else "2.5"
+        
+        # Antigravity 模式强制只用自己的凭证（自用模式，不使用公共池）
+        if mode == "antigravity":
+            return False
+        if pool_mode == "private":
+            # 私有模式：只能用自己的凭证
+            return False
+        if pool_mode == "tier3_shared":
+            # 3.0共享模式：
+            # - 请求3.0模型：需要有3.0凭证才能用公共3.0池
+            # - 请求2.5模型：所有用户都可以用公共2.5凭证
+            if required_tier == "3":
+                return await CredentialPool.check_user_has_tier3_creds(db, user_id, mode)
+            return True
+        # full_shared (大锅饭模式)：用户有贡献，可以用所有公共凭证 + 自己的私有凭证；否则只能用自己的凭证
+        return user_has_public_creds
+    
+    @staticmethod
+    async def enforce_model_breaker(
+        db: AsyncSession,
+        user_id: int,
+        user_has_public_creds: bool,
+        model: str,
+        mode: str = "geminicli"
+    ):
+        """该请求可用的凭证池（自己的私有凭证 + 可用时的公共池）在该模型上都已熔断时抛出 429"""
+        pools = [user_id]
+        if await CredentialPool.uses_public_pool(db, user_id, user_has_public_creds, model, mode):
+            pools.append(PUBLIC_POOL)
+        model_breaker.enforce(pools, mode, model)
+    
     @staticmethod
     async def get_available_credential(
         db: AsyncSession,
@@ -480,7 +617,8 @@ class CredentialPool:
         user_has_public_creds: bool = False,
         model: str = None,
         exclude_ids: set = None,
-        mode: str = "geminicli"
+        mode: str = "geminicli",
+        claim: bool = True
     ) -> Optional[Credential]:
         """
         获取一个可用的凭证 (根据模式 + 轮询策略 + 模型等级匹配)
@@ -492,6 +630,7 @@ class CredentialPool:
             model: 模型名称
             exclude_ids: 排除的凭证ID集合（用于重试时跳过已失败的凭证）
             mode: 凭证类型 ("geminicli" 或 "antigravity")
+            claim: 是否立即占用（更新使用时间/CD/计数）；预取备用凭证时传 False，真正使用时再 claim_credential
         
         池模式:
         - private: 只能用自己的凭证
@@ -503,145 +642,185 @@ class CredentialPool:
         - 2.5 模型可以用任何等级的凭证
         """
         mode = CredentialPool.validate_mode(mode)
-        pool_mode = settings.credential_pool_mode
-        query = select(Credential).where(
-            Credential.is_active == True,
-            Credential.api_type == mode  # 按凭证类型过滤
-        )
-        
-        # 排除没有 project_id 的凭证（没有 project_id 无法调用 API）
-        query = query.where(Credential.project_id != None, Credential.project_id != "")
-        
-        # 排除已尝试过的凭证
-        if exclude_ids:
-            query = query.where(~Credential.id.in_(exclude_ids))
         
         # 根据模型确定需要的凭证等级
         required_tier = CredentialPool.get_required_tier(model) if model else "2.5"
         
-        # Antigravity 模式不检查 model_tier（权限由 Google API 控制）
-        # GeminiCLI 模式才需要检查
-        if mode == "geminicli" and required_tier == "3":
-            # gemini-3 模型只能用 3 等级凭证
-            query = query.where(Credential.model_tier == "3")
-        # Antigravity 模式或者 2.5 模型可以用任何等级凭证（不添加额外筛选）
-        
-        # 根据模式决定凭证访问规则
-        # Antigravity 模式强制只用自己的凭证（自用模式，不使用公共池）
-        if mode == "antigravity":
-            query = query.where(Credential.user_id == user_id)
-        elif pool_mode == "private":
-            # 私有模式：只能用自己的凭证
-            query = query.where(Credential.user_id == user_id)
-        
-        elif pool_mode == "tier3_shared":
-            # 3.0共享模式：
-            # - 请求3.0模型：需要有3.0凭证才能用公共3.0池
-            # - 请求2.5模型：所有用户都可以用公共2.5凭证
-            user_has_tier3 = await CredentialPool.check_user_has_tier3_creds(db, user_id, mode)
-            
-            if required_tier == "3":
-                # 请求3.0模型
-                if user_has_tier3:
-                    # 用户有3.0凭证 → 可用公共3.0池
-                    query = query.where(
-                        or_(
-                            Credential.is_public == True,
-                            Credential.user_id == user_id
-                        )
-                    )
-                else:
-                    # 用户没有3.0凭证 → 只能用自己的凭证
-                    query = query.where(Credential.user_id == user_id)
-            else:
-                # 请求2.5模型 → 所有用户都可以用公共凭证
-                query = query.where(
-                    or_(
-                        Credential.is_public == True,
-                        Credential.user_id == user_id
-                    )
-                )
+        # 根据模式决定凭证访问规则（是否可以使用公共池）
+        use_public_pool = await CredentialPool.uses_public_pool(db, user_id, user_has_public_creds, model, mode)
         
-        else:  # full_shared (大锅饭模式)
-            if user_has_public_creds:
-                # 用户有贡献，可以用所有公共凭证 + 自己的私有凭证
-                query = query.where(
-                    or_(
-                        Credential.is_public == True,
-                        Credential.user_id == user_id
-                    )
-                )
-            else:
-                # 用户没有贡献，只能用自己的凭证
-                query = query.where(Credential.user_id == user_id)
+        queries = CredentialPool.build_selection_queries(
+            mode, user_id, required_tier, use_public_pool, exclude_ids
+        )
         
         # 确定模型组（用于 CD 筛选）
         model_group = CredentialPool.get_model_group(model) if model else "flash"
         cd_seconds = CredentialPool.get_cd_seconds(model_group)
         
-        result = await db.execute(
-            query.order_by(Credential.last_used_at.asc().nullsfirst())
-        )
-        credentials = result.scalars().all()
-        
-        if not credentials:
-            return None
-        
-        # 筛选不在 CD 中的凭证
-        available_credentials = [
-            c for c in credentials 
-            if not CredentialPool.is_credential_in_cd(c, model_group)
-        ]
-        
-        total_count = len(credentials)
-        available_count = len(available_credentials)
-        in_cd_count = total_count - available_count
-        
-        if not available_credentials:
-            # 所有凭证都在 CD 中，选择第一个（按 last_used_at 排序的）
-            credential = credentials[0]
-            print(f"[{mode}][CD] 模型组={model_group}, CD={cd_seconds}秒 | 全部{total_count}个凭证都在CD中，选择: {credential.email}", flush=True)
-        else:
-            # 选择最久未使用的凭证
-            credential = available_credentials[0]
-            print(f"[{mode}][CD] 模型组={model_group}, CD={cd_seconds}秒 | 可用{available_count}/{total_count}个, 选择: {credential.email}", flush=True)
-        
-        # 更新使用时间和计数
+        # 全部凭证都在 CD 中时排队等待最早就绪的凭证（见 admission.py）
+        ticket = None
+        deadline = None
+        waited_out = False
+        available_credentials = []
+        try:
+            while True:
+                if ticket is not None:
+                    # 重新查询时刷新已加载凭证的 CD 字段
+                    queries = [query.execution_options(populate_existing=True) for query in queries]
+                credentials = CredentialPool.merge_by_last_used(
+                    *[(await db.execute(query)).scalars().all() for query in queries]
+                )
+                
+                if not credentials:
+                    return None
+                
+                # 排除在该模型上 429 冷却中的凭证，再筛选不在模型组 CD 中的
+                not_cooling = [
+                    c for c in credentials
+                    if not model_cooldowns.in_cooldown(c.id, model)
+                ]
+                ready_credentials = [
+                    c for c in not_cooling
+                    if not CredentialPool.is_credential_in_cd(c, model_group)
+                ]
+                # 跳过进行中调用数已达上限的凭证（凭证或所在项目）
+                available_credentials = [c for c in ready_credentials if not inflight.saturated(c)]
+                if available_credentials or not claim or waited_out or not admission.enabled():
+                    break
+                
+                # 有不在 CD 的凭证但都饱和：等有调用结束（最多等到其他凭证 CD 结束）
+                saturated = bool(ready_credentials)
+                now = time.monotonic()
+                ready_in = min(
+                    (CredentialPool.seconds_until_ready(c, model, model_group)
+                     for c in credentials if c not in ready_credentials),
+                    default=(deadline - now) if deadline is not None else admission.max_wait()
+                )
+                if ticket is None:
+                    ticket = admission.ticket(model_key(mode, model), user_id)
+                    deadline = now + admission.max_wait()
+                else:
+                    # 叫到号但凭证又被别人占用了：交出号，保留排队序号重新挂起
+                    admission.release(ticket)
+                if now + ready_in > deadline:
+                    break
+                
+                if saturated:
+                    print(f"[{mode}][CD] 模型组={model_group} | {len(ready_credentials)}个可用凭证并发已满，排队等待", flush=True)
+                else:
+                    print(f"[{mode}][CD] 模型组={model_group} | 全部{len(credentials)}个凭证都在CD中，排队等待 {ready_in:.1f}s", flush=True)
+                # 等待期间不占用数据库连接
+                await db.commit()
+                waited_out = not await admission.wait(ticket, ready_in, deadline, saturated=saturated)
+            
+            total_count = len(credentials)
+            available_count = len(available_credentials)
+            
+            if not available_credentials:
+                # 都在 CD 中（或并发已满）：优先选不在 CD 的，其次没有 429 冷却的，否则选第一个（按 last_used_at 排序的）
+                credential = (ready_credentials or not_cooling or credentials)[0]
+                print(f"[{mode}][CD] 模型组={model_group}, CD={cd_seconds}秒 | 全部{total_count}个凭证都在CD中"
+                      f"（429 冷却 {total_count - len(not_cooling)} 个），选择: {credential.email}", flush=True)
+            else:
+                # 按健康评分在最久未使用的凭证里二选一（关闭时选最久未使用的）
+                credential = credential_health.choose(available_credentials)
+                print(f"[{mode}][CD] 模型组={model_group}, CD={cd_seconds}秒 | 可用{available_count}/{total_count}个, 选择: {credential.email}", flush=True)
+            
+            if not claim:
+                return credential
+            
+            # 更新使用时间和计数
+            now = datetime.utcnow()
+            credential.last_used_at = now
+            credential.total_requests = (credential.total_requests or 0) + 1
+            
+            # 更新对应模型组的 CD 时间
+            if model_group == "30":
+                credential.last_used_30 = now
+            elif model_group == "pro":
+                credential.last_used_pro = now
+            else:
+                credential.last_used_flash = now
+            
+            await db.commit()
+            
+            return credential
+        finally:
+            if ticket is not None:
+                # 占用完成后才叫下一个号
+                admission.release(ticket, admitted=bool(available_credentials))
+    
+    @staticmethod
+    async def claim_credential(db: AsyncSession, credential_id: int, model: str = None):
+        """占用 get_available_credential(claim=False) 选出的凭证：更新使用时间、计数和模型组 CD"""
+        model_group = CredentialPool.get_model_group(model) if model else "flash"
+        cd_column = {"30": "last_used_30", "pro": "last_used_pro"}.get(model_group, "last_used_flash")
         now = datetime.utcnow()
-        credential.last_used_at = now
-        credential.total_requests += 1
-        
-        # 更新对应模型组的 CD 时间
-        if model_group == "30":
-            credential.last_used_30 = now
-        elif model_group == "pro":
-            credential.last_used_pro = now
-        else:
-            credential.last_used_flash = now
-        
+        await db.execute(
+            update(Credential)
+            .where(Credential.id == credential_id)
+            .values(
+                last_used_at=now,
+                total_requests=func.coalesce(Credential.total_requests, 0) + 1,
+                **{cd_column: now}
+            )
+        )
         await db.commit()
-        
-        return credential
     
     @staticmethod
-    async def check_user_has_public_creds(db: AsyncSession, user_id: int, mode: str = "geminicli") -> bool:
-        """检查用户是否有公开的凭证（是否参与大锅饭）"""
-        mode = CredentialPool.validate_mode(mode)
-        result = await db.execute(
-            select(Credential)
+    async def record_usage(db: AsyncSession, credential_id: int):
+        """请求完成后更新凭证使用次数和最后使用时间"""
+        await db.execute(
+            update(Credential)
+            .where(Credential.id == credential_id)
+            .values(
+                total_requests=func.coalesce(Credential.total_requests, 0) + 1,
+                last_used_at=datetime.utcnow()
+            )
+        )
+        await db.commit()
+    
+    @staticmethod
+    def user_public_creds_query(user_id: int, mode: str = "geminicli"):
+        """用户是否有公开凭证的探测查询（走 idx_credentials_owner_active 索引）"""
+        return (
+            select(Credential.id)
             .where(Credential.user_id == user_id)
             .where(Credential.api_type == mode)
             .where(Credential.is_public == True)
             .where(Credential.is_active == True)
             .limit(1)
         )
+    
+    @staticmethod
+    async def check_user_has_public_creds(db: AsyncSession, user_id: int, mode: str = "geminicli") -> bool:
+        """检查用户是否有公开的凭证（是否参与大锅饭；有缓存的权益快照时直接读快照）"""
+        mode = CredentialPool.validate_mode(mode)
+        snapshot = entitlements.peek(user_id)
+        if snapshot is not None:
+            return snapshot.has_public(mode)
+        result = await db.execute(CredentialPool.user_public_creds_query(user_id, mode))
         return result.scalar_one_or_none() is not None
     
     @staticmethod
-    async def refresh_access_token(credential: Credential) -> Optional[str]:
+    async def count_public_credentials(db: AsyncSession, mode: str = "geminicli") -> int:
+        """公共池中可用凭证数（共享池公平调度按它估算容量）"""
+        result = await db.execute(
+            select(func.count(Credential.id))
+            .where(Credential.is_active == True)
+            .where(Credential.api_type == mode)
+            .where(Credential.is_public == True)
+            .where(Credential.project_id != None, Credential.project_id != "")
+        )
+        return result.scalar() or 0
+    
+    @staticmethod
+    async def refresh_access_token(credential: Credential, client: httpx.AsyncClient = None) -> Optional[str]:
         """
         使用 refresh_token 刷新 access_token
         返回新的 access_token，失败返回 None
+        
+        批量任务可传入共享的 client 复用连接，否则每次新建
         """
         refresh_token = decrypt_credential(credential.refresh_token)
         if not refresh_token:
@@ -668,7 +847,7 @@ class CredentialPool:
         print(f"[Token刷新] 开始刷新 token, refresh_token 前20字符: {refresh_token[:20]}...", flush=True)
         
         try:
-            async with httpx.AsyncClient(timeout=15) as client:
+            async with (nullcontext(client) if client else httpx.AsyncClient(timeout=15)) as client:
                 response = await client.post(
                     "https://oauth2.googleapis.com/token",
                     data={
@@ -779,6 +958,7 @@ class CredentialPool:
             .where(Credential.id == credential_id)
             .values(is_active=False)
         )
+        entitlements.invalidate_on_commit(db)
         await db.commit()
     
     @staticmethod
@@ -884,7 +1064,7 @@ class CredentialPool:
         """
         处理 429 速率限制错误：
         1. 解析 Google 返回的 CD 时间
-        2. 设置凭证对应模型组的 CD 时间
+        2. 设置凭证在该模型上的冷却（model_cooldowns，不影响同组的其他模型）
         
         Returns:
             CD 秒数
@@ -897,46 +1077,22 @@ class CredentialPool:
             cd_seconds = 60
             print(f"[429 CD] 使用默认 CD: {cd_seconds}s", flush=True)
         
-        # 确定模型组
-        model_group = CredentialPool.get_model_group(model)
-        
         # 获取凭证
         result = await db.execute(select(Credential).where(Credential.id == credential_id))
         cred = result.scalar_one_or_none()
         
         if cred:
-            # 设置 CD 结束时间 = 当前时间 - 配置的 CD 时间 + Google 返回的 CD 时间
-            # 这样 is_credential_in_cd 函数会正确计算剩余 CD
-            now = datetime.utcnow()
-            
-            # 直接设置 last_used 为一个特殊值，使得 CD 到期时间 = now + cd_seconds
-            # CD 到期时间 = last_used + config_cd_seconds
-            # 我们想要 CD 到期时间 = now + google_cd_seconds
-            # 所以 last_used = now + google_cd_seconds - config_cd_seconds
-            config_cd = CredentialPool.get_cd_seconds(model_group)
-            if config_cd > 0:
-                # 计算需要设置的 last_used 时间
-                # 使 CD 到期时间 = now + google_cd_seconds
-                cd_end = now + timedelta(seconds=cd_seconds)
-                last_used = cd_end - timedelta(seconds=config_cd)
-            else:
-                # 如果配置的 CD 为 0，则直接使用当前时间
-                # 此时 CD 机制不会生效，但我们仍然记录
-                last_used = now
-            
-            if model_group == "30":
-                cred.last_used_30 = last_used
-            elif model_group == "pro":
-                cred.last_used_pro = last_used
-            else:
-                cred.last_used_flash = last_used
+            cred.model_cooldowns = model_cooldowns.set(credential_id, model, cd_seconds)
             
             # 记录错误信息到 last_error（截取前 500 字符以保持简洁）
-            cred.last_error = f"429限速 CD {cd_seconds}秒 ({model_group}) - {error_text[:300] if error_text else ''}"
+            cred.last_error = f"429限速 CD {cd_seconds}秒 ({model}) - {error_text[:300] if error_text else ''}"
             cred.failed_requests = (cred.failed_requests or 0) + 1
             
             await db.commit()
-            print(f"[429 CD] 凭证 {credential_id} 模型组 {model_group} 设置 CD {cd_seconds}s", flush=True)
+            print(f"[429 CD] 凭证 {credential_id} 模型 {model} 设置 CD {cd_seconds}s", flush=True)
+            
+            # 喂给模型级熔断器（大面积耗尽时新请求直接快速失败）
+            model_breaker.record_exhausted(pool_of(cred), cred.api_type or "geminicli", model, credential_id, cd_seconds)
         
         return cd_seconds
     
@@ -961,7 +1117,7 @@ class CredentialPool:
         return credential
     
     @staticmethod
-    async def detect_account_type(access_token: str, project_id: str) -> dict:
+    async def detect_account_type(access_token: str, project_id: str, client: httpx.AsyncClient = None) -> dict:
         """
         检测账号类型（Pro/Free）
         
@@ -977,7 +1133,7 @@ class CredentialPool:
         
         print(f"[检测账号] 尝试使用 Drive API 检测存储空间...", flush=True)
         
-        async with httpx.AsyncClient(timeout=15.0) as client:
+        async with (nullcontext(client) if client else httpx.AsyncClient(timeout=15.0)) as client:
             # 方式1: 尝试 Drive API
             try:
                 resp = await client.get(
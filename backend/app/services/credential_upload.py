@@ -0,0 +1,399 @@
+"""
+凭证批量上传流水线（GeminiCLI / Antigravity 共用）
+
+reader(逐个读取 JSON / 流式读取 ZIP 成员) -> 指纹去重(按批查库) -> 有界并发验证(共享 HTTP 客户端)
+-> 批量 INSERT
+
+- ZIP 直接从上传的临时文件按成员读取，不把整个压缩包和全部解压内容读进内存
+- 去重用 refresh_token 指纹（token_fingerprint）和 email，每批一次查询，而不是每个凭证两次
+- 验证/获取 project_id 在 settings.upload_concurrency 个并发内进行，复用同一个连接池
+- 新凭证攒批 executemany 插入，配额奖励最后一次性累加
+- 每个文件/凭证的结果在完成时立即产出，路由可直接流式返回
+"""
+import asyncio
+import json
+import zipfile
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import httpx
+from fastapi import UploadFile
+from sqlalchemy import select, update, insert, or_
+
+from app.config import settings
+from app.database import async_session
+from app.models.user import User, Credential
+from app.services.crypto import encrypt_credential, decrypt_credential, token_fingerprint
+from app.services.credential_pool import CredentialPool, fetch_project_id, ANTIGRAVITY_USER_AGENT
+from app.services.entitlements import entitlements
+
+
+DEDUPE_BATCH = 200   # 每批去重查询的凭证数
+INSERT_BATCH = 500   # 每批插入的凭证数
+
+GEMINICLI_TEST_URL = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
+
+
+def _api_type_filter(mode: str):
+    """凭证类型过滤（GeminiCLI 兼容 api_type 为空的旧数据）"""
+    if mode == "antigravity":
+        return Credential.api_type == "antigravity"
+    return or_(
+        Credential.api_type == "geminicli",
+        Credential.api_type == None,
+        Credential.api_type == ""
+    )
+
+
+# 没有 refresh_token 或解密后为空、算不出指纹的旧凭证写入这个占位值，补齐查询不会再次选中它们
+NO_FINGERPRINT = "-"
+
+
+async def backfill_fingerprints() -> int:
+    """为旧凭证补齐 token_fingerprint（启动时执行一次，只在升级后首次启动时有实际工作量）
+
+    新凭证在上传 / OAuth 写入时已带指纹，之后的上传不再需要扫描
+    """
+    async with async_session() as session:
+        rows = (await session.execute(
+            select(Credential.id, Credential.refresh_token)
+            .where(Credential.token_fingerprint.is_(None))
+        )).all()
+        if not rows:
+            return 0
+        cred_table = Credential.__table__
+        from sqlalchemy import bindparam
+        params = [
+            {
+                "b_id": row.id,
+                "token_fingerprint": token_fingerprint(decrypt_credential(row.refresh_token)) or NO_FINGERPRINT,
+            }
+            for row in rows
+        ]
+        await session.execute(
+            update(cred_table).where(cred_table.c.id == bindparam("b_id")),
+            params
+        )
+        await session.commit()
+        return len(rows)
+
+
+async def iter_upload_items(files: List[UploadFile]) -> AsyncIterator[Tuple[str, object]]:
+    """逐个产出上传内容
+
+    产出 ("result", dict) 表示文件级提示/错误，("file", name) 表示一个 JSON 文件，
+    ("item", (item_name, cred_data)) 表示一个待处理的凭证。
+    """
+    async def parse(name: str, content: bytes):
+        try:
+            parsed_data = json.loads(content.decode('utf-8') if isinstance(content, bytes) else content)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            yield "result", {"filename": name, "status": "error", "message": "JSON 格式错误"}
+            return
+
+        # 支持两种格式：
+        # 1. 单个凭证对象: {"email": "...", "refresh_token": "..."}
+        # 2. 凭证数组: [{"email": "...", "refresh_token": "..."}, ...]
+        if isinstance(parsed_data, list):
+            cred_list = parsed_data
+            yield "result", {"filename": name, "status": "info", "message": f"检测到数组格式，包含 {len(cred_list)} 个凭证"}
+        else:
+            cred_list = [parsed_data]
+
+        for idx, cred_data in enumerate(cred_list):
+            item_name = f"{name}[{idx}]" if len(cred_list) > 1 else name
+            if not isinstance(cred_data, dict):
+                yield "result", {"filename": item_name, "status": "error", "message": "凭证格式错误"}
+                continue
+            yield "item", (item_name, cred_data)
+
+    for file in files:
+        if file.filename.endswith('.zip'):
+            try:
+                # UploadFile 底层是临时文件，ZipFile 按成员随机读取，不整体读入内存；
+                # 读目录和解压成员都是同步的磁盘 IO + CPU，放到线程里，不阻塞事件循环
+                zf = await asyncio.to_thread(zipfile.ZipFile, file.file, 'r')
+                with zf:
+                    members = [
+                        info for info in zf.infolist()
+                        if info.filename.endswith('.json') and not info.filename.startswith('__MACOSX')
+                    ]
+                    yield "result", {"filename": file.filename, "status": "info", "message": f"已解压 {len(members)} 个JSON文件"}
+                    for info in members:
+                        yield "file", info.filename
+                        content = await asyncio.to_thread(zf.read, info)
+                        async for event in parse(info.filename, content):
+                            yield event
+            except zipfile.BadZipFile:
+                yield "result", {"filename": file.filename, "status": "error", "message": "无效的ZIP文件"}
+            except Exception as e:
+                yield "result", {"filename": file.filename, "status": "error", "message": f"解压失败: {str(e)[:50]}"}
+        elif file.filename.endswith('.json'):
+            yield "file", file.filename
+            content = await file.read()
+            async for event in parse(file.filename, content):
+                yield event
+        else:
+            yield "result", {"filename": file.filename, "status": "error", "message": "只支持 JSON 或 ZIP 文件"}
+
+
+async def _get_token(client: httpx.AsyncClient, cred_data: dict, mode: str) -> Optional[str]:
+    """刷新 access_token，失败时回退到文件里自带的 token"""
+    temp_cred = Credential(
+        refresh_token=encrypt_credential(cred_data.get("refresh_token")),
+        client_id=encrypt_credential(cred_data.get("client_id")) if cred_data.get("client_id") else None,
+        client_secret=encrypt_credential(cred_data.get("client_secret")) if cred_data.get("client_secret") else None,
+        credential_type="oauth",
+        api_type=mode,
+    )
+    token = await CredentialPool.refresh_access_token(temp_cred, client=client)
+    return token or cred_data.get("token") or cred_data.get("access_token") or None
+
+
+async def _validate_geminicli(client: httpx.AsyncClient, cred_data: dict) -> dict:
+    """GeminiCLI：2.5 判断有效性，3.0 判断等级（并行探测）"""
+    project_id = cred_data.get("project_id", "")
+    result = {"is_valid": False, "model_tier": "2.5", "project_id": project_id, "verify_msg": ""}
+    access_token = await _get_token(client, cred_data, "geminicli")
+    if not access_token:
+        result["verify_msg"] = "❌ 无法获取 token"
+        return result
+
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+
+    async def probe(model):
+        payload = {
+            "model": model,
+            "project": project_id,
+            "request": {"contents": [{"role": "user", "parts": [{"text": "hi"}]}]}
+        }
+        return await client.post(GEMINICLI_TEST_URL, headers=headers, json=payload)
+
+    resp, resp3 = await asyncio.gather(probe("gemini-2.5-flash"), probe("gemini-3-pro-preview"), return_exceptions=True)
+    if isinstance(resp, Exception):
+        raise resp
+    if resp.status_code in [200, 429]:
+        result["is_valid"] = True
+        if not isinstance(resp3, Exception) and resp3.status_code in [200, 429]:
+            result["model_tier"] = "3"
+        result["verify_msg"] = f"✅ 有效 (等级: {result['model_tier']})"
+    else:
+        result["verify_msg"] = f"❌ 无效 ({resp.status_code})"
+    return result
+
+
+async def _validate_antigravity(client: httpx.AsyncClient, cred_data: dict) -> dict:
+    """Antigravity：缺少 project_id 时先获取（可能触发 onboardUser），再测试 API"""
+    project_id = cred_data.get("project_id", "")
+    # Antigravity 全部是 3.0 模型，无需检测等级
+    result = {"is_valid": False, "model_tier": "3", "project_id": project_id, "verify_msg": ""}
+    access_token = await _get_token(client, cred_data, "antigravity")
+    if not access_token:
+        result["verify_msg"] = "❌ 无法获取 access_token"
+        return result
+
+    if not project_id:
+        project_id = await fetch_project_id(
+            access_token=access_token,
+            user_agent=ANTIGRAVITY_USER_AGENT,
+            api_base_url=settings.antigravity_api_base,
+            client=client,
+        )
+        result["project_id"] = project_id or ""
+    if not project_id:
+        result["verify_msg"] = "❌ 无法获取 project_id"
+        return result
+
+    resp = await client.post(
+        f"{settings.antigravity_api_base}/v1internal:generateContent",
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "User-Agent": ANTIGRAVITY_USER_AGENT
+        },
+        json={
+            "model": "gemini-2.5-flash",
+            "project": project_id,
+            "request": {"contents": [{"role": "user", "parts": [{"text": "hi"}]}]}
+        }
+    )
+    if resp.status_code in [200, 429]:
+        result["is_valid"] = True
+        result["verify_msg"] = f"✅ 有效 (project: {project_id[:20]}...)"
+    else:
+        result["verify_msg"] = f"❌ API测试失败 ({resp.status_code})"
+    return result
+
+
+async def _find_existing(mode: str, emails: Set[str], fingerprints: Set[str]) -> Tuple[Set[str], Set[str]]:
+    """一次查询找出已存在的 email / 指纹"""
+    async with async_session() as session:
+        rows = (await session.execute(
+            select(Credential.email, Credential.token_fingerprint)
+            .where(_api_type_filter(mode))
+            .where(or_(
+                Credential.email.in_(emails),
+                Credential.token_fingerprint.in_(fingerprints)
+            ))
+        )).all()
+    return {r.email for r in rows if r.email}, {r.token_fingerprint for r in rows if r.token_fingerprint}
+
+
+async def run_upload(
+    files: List[UploadFile],
+    user_id: int,
+    is_public: bool,
+    mode: str = "geminicli",
+) -> AsyncIterator[Dict]:
+    """执行上传流水线，逐条产出结果，最后产出 {"done": True, ...} 汇总"""
+    log_tag = "[Antigravity批量上传]" if mode == "antigravity" else "[批量上传]"
+    validate = _validate_antigravity if mode == "antigravity" else _validate_geminicli
+    name_prefix = "Antigravity" if mode == "antigravity" else "Upload"
+
+    concurrency = max(1, settings.upload_concurrency)
+    out_queue: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+    seen_emails: Set[str] = set()
+    seen_fps: Set[str] = set()
+    pending_rows: List[Dict] = []
+    counters = {"files": 0, "success": 0, "reward": 0}
+
+    async def flush_rows():
+        if not pending_rows:
+            return
+        rows = pending_rows[:]
+        pending_rows.clear()
+        async with async_session() as session:
+            await session.execute(insert(Credential), rows)
+            # 批量 INSERT 不触发 ORM 事件：提交后失效上传者的权益快照
+            entitlements.invalidate_on_commit(session, user_id)
+            await session.commit()
+        print(f"{log_tag} 已提交 {counters['success']} 个凭证", flush=True)
+
+    async def process(client, item_name, cred_data, fingerprint):
+        email = cred_data.get("email") or item_name
+        try:
+            try:
+                checked = await validate(client, cred_data)
+            except Exception as e:
+                checked = {"is_valid": False, "model_tier": "3" if mode == "antigravity" else "2.5",
+                           "project_id": cred_data.get("project_id", ""), "verify_msg": f"⚠️ 验证失败: {str(e)[:30]}"}
+
+            is_valid = checked["is_valid"]
+            # 如果要捐赠但凭证无效，不允许
+            actual_public = is_public and is_valid
+            pending_rows.append({
+                "user_id": user_id,
+                "name": f"{name_prefix} - {email}",
+                "api_key": encrypt_credential(cred_data.get("token") or cred_data.get("access_token", "")),
+                "refresh_token": encrypt_credential(cred_data.get("refresh_token")),
+                "token_fingerprint": fingerprint,
+                "client_id": encrypt_credential(cred_data.get("client_id")) if cred_data.get("client_id") else None,
+                "client_secret": encrypt_credential(cred_data.get("client_secret")) if cred_data.get("client_secret") else None,
+                "project_id": checked["project_id"],
+                "credential_type": "oauth",
+                "email": email,
+                "is_public": actual_public,
+                "is_active": is_valid,
+                "model_tier": checked["model_tier"],
+                "api_type": mode,
+            })
+            counters["success"] += 1
+
+            # GeminiCLI 公开且有效的凭证按等级奖励额度
+            # 2.5凭证 = quota_flash + quota_25pro
+            # 3.0凭证 = quota_flash + quota_25pro + quota_30pro
+            if mode == "geminicli" and actual_public:
+                reward = settings.quota_flash + settings.quota_25pro
+                if checked["model_tier"] == "3":
+                    reward += settings.quota_30pro
+                counters["reward"] += reward
+
+            status_msg = f"上传成功 {checked['verify_msg']}"
+            if is_public and not is_valid:
+                status_msg += " (无效凭证不会上传到公共池)"
+            await out_queue.put({"filename": item_name, "status": "success" if is_valid else "warning", "message": status_msg})
+
+            if len(pending_rows) >= INSERT_BATCH:
+                await flush_rows()
+        finally:
+            semaphore.release()
+
+    async def dispatch(client, batch, tasks):
+        """批量去重，然后把新凭证交给验证 worker"""
+        existing_emails, existing_fps = await _find_existing(
+            mode, {e for _, _, e, _ in batch}, {f for _, _, _, f in batch if f is not None}
+        )
+        for item_name, cred_data, email, fp in batch:
+            if email in existing_emails:
+                await out_queue.put({"filename": item_name, "status": "skip", "message": f"凭证已存在: {email}"})
+                continue
+            if fp is not None and fp in existing_fps:
+                await out_queue.put({"filename": item_name, "status": "skip", "message": f"凭证token已存在: {email}"})
+                continue
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(process(client, item_name, cred_data, fp)))
+
+    async def producer():
+        limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+        tasks: List[asyncio.Task] = []
+        try:
+            async with httpx.AsyncClient(timeout=15, limits=limits) as client:
+                batch = []
+                async for kind, payload in iter_upload_items(files):
+                    if kind == "result":
+                        await out_queue.put(payload)
+                        continue
+                    if kind == "file":
+                        counters["files"] += 1
+                        continue
+                    item_name, cred_data = payload
+                    # 验证必要字段
+                    if "refresh_token" not in cred_data:
+                        await out_queue.put({"filename": item_name, "status": "error", "message": "缺少字段: refresh_token"})
+                        continue
+                    email = cred_data.get("email") or item_name
+                    fp = token_fingerprint(cred_data.get("refresh_token"))
+                    # 同一次上传内的重复（refresh_token 为空时没有指纹，只按 email 判断）
+                    if email in seen_emails or (fp is not None and fp in seen_fps):
+                        await out_queue.put({"filename": item_name, "status": "skip", "message": f"凭证已存在: {email}"})
+                        continue
+                    seen_emails.add(email)
+                    if fp is not None:
+                        seen_fps.add(fp)
+                    batch.append((item_name, cred_data, email, fp))
+                    if len(batch) >= DEDUPE_BATCH:
+                        await dispatch(client, batch, tasks)
+                        batch = []
+                if batch:
+                    await dispatch(client, batch, tasks)
+                await asyncio.gather(*tasks)
+            await flush_rows()
+            if counters["reward"]:
+                async with async_session() as session:
+                    await session.execute(
+                        update(User).where(User.id == user_id)
+                        .values(daily_quota=User.daily_quota + counters["reward"])
+                    )
+                    entitlements.invalidate_on_commit(session, user_id)
+                    await session.commit()
+                print(f"{log_tag} 用户 {user_id} 获得 {counters['reward']} 额度奖励", flush=True)
+        finally:
+            for t in tasks:
+                t.cancel()
+            await out_queue.put(None)
+
+    producer_task = asyncio.create_task(producer())
+    try:
+        while True:
+            result = await out_queue.get()
+            if result is None:
+                break
+            yield result
+        # 传播 producer 的异常
+        await producer_task
+    finally:
+        if not producer_task.done():
+            producer_task.cancel()
+
+    print(f"{log_tag} 最终提交完成，共 {counters['success']} 个凭证", flush=True)
+    yield {"done": True, "uploaded_count": counters["success"], "total_count": counters["files"]}
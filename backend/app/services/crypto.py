@@ -2,6 +2,7 @@
 from cryptography.fernet import Fernet
 from base64 import urlsafe_b64encode
 from hashlib import sha256
+from typing import Optional
 from app.config import settings
 
 
@@ -31,3 +32,15 @@ def decrypt_credential(ciphertext: str) -> str:
     except Exception:
         # 如果解密失败，可能是未加密的旧数据
         return ciphertext
+
+
+def token_fingerprint(refresh_token: Optional[str]) -> Optional[str]:
+    """refresh_token 指纹（HMAC-SHA256，用于去重）
+
+    Fernet 加密带随机 IV，同一 token 每次加密结果不同，无法用密文比较去重。
+    refresh_token 为空时没有指纹，返回 None（调用方只按 email 去重）。
+    """
+    import hmac
+    if not refresh_token:
+        return None
+    return hmac.new(settings.secret_key.encode(), refresh_token.encode(), sha256).hexdigest()
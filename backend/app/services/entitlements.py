@@ -0,0 +1,285 @@
+"""
+用户权益快照（配额上限 / RPM 档位 / 贡献者标记缓存）
+
+原先每个 POST 请求都要在 get_user_from_api_key 里统计一次用户的凭证数和 3.0 凭证数、套用配额公式，
+handler 里再查一次是否有公开凭证，tier3_shared 模式选凭证时还要再查一次是否有 3.0 凭证。这些结果只取决于
+用户的凭证集合、用户的配额字段和系统配置，这里按用户缓存成一个快照：
+
+- 一次分组查询得到用户按 类型 / 等级 / 是否公开 的活跃凭证数，连同算好的各类模型配额上限、RPM 档位一起缓存
+- 凭证的新增 / 删除 / 启用禁用 / 捐赠 / 等级变化，以及用户配额字段的修改，由 ORM 事件在事务提交后失效对应用户；
+  批量 INSERT / UPDATE / DELETE 语句不经过 ORM 事件，调用方用 invalidate_on_commit(session[, user_id]) 标记，
+  提交后失效该用户（不指定用户时全部失效）
+- 管理员保存配置后全部失效
+- entitlement_cache_ttl_seconds 兜底（多进程部署时其他进程的修改最多延迟这么久生效，0 = 不缓存）
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+
+# 影响快照的凭证 / 用户字段
+_CREDENTIAL_FIELDS = ("user_id", "is_active", "is_public", "model_tier", "api_type")
+_USER_FIELDS = ("quota_flash", "quota_25pro", "quota_30pro", "daily_quota")
+# session.info 里待失效的 user_id / 是否全部失效（提交后生效）
+_PENDING_KEY = "entitlements_pending"
+_PENDING_ALL_KEY = "entitlements_pending_all"
+
+
+def _ttl() -> float:
+    try:
+        from app.config import settings
+        return max(0, settings.entitlement_cache_ttl_seconds)
+    except ImportError:
+        return 300.0
+
+
+class QuotaLimits(NamedTuple):
+    """按某类凭证算出的每日配额上限"""
+    total_creds: int
+    tier3_creds: int
+    quota_flash: int
+    quota_pro: int
+    has_30_access: bool
+
+    @property
+    def has_credential(self) -> bool:
+        return self.total_creds > 0
+
+
+def _quota_limits(user, total_creds: int, tier3_creds: int) -> QuotaLimits:
+    """配额公式（用户设置的按模型配额优先，0 表示使用系统默认）"""
+    from app.config import settings
+
+    if user.quota_flash and user.quota_flash > 0:
+        quota_flash = user.quota_flash
+    elif total_creds > 0:
+        quota_flash = total_creds * settings.quota_flash
+    else:
+        quota_flash = settings.no_cred_quota_flash
+
+    # Pro配额（2.5pro和3.0共享）
+    # 官方规则：无3.0资格200次2.5pro，有3.0资格100次共享，Pro号250次共享
+    if user.quota_25pro and user.quota_25pro > 0:
+        quota_pro = user.quota_25pro
+    elif tier3_creds > 0:
+        quota_pro = tier3_creds * settings.quota_30pro
+    elif total_creds > 0:
+        quota_pro = total_creds * settings.quota_25pro
+    else:
+        quota_pro = settings.no_cred_quota_25pro
+
+    has_30_access = tier3_creds > 0 or bool(user.quota_30pro and user.quota_30pro > 0)
+    return QuotaLimits(total_creds, tier3_creds, quota_flash, quota_pro, has_30_access)
+
+
+class Entitlement:
+    """一个用户的权益快照（只读）"""
+    __slots__ = ("public_modes", "tier3_modes", "daily_quota", "_quotas", "_rpm")
+
+    def __init__(self, user, rows: Iterable[Tuple[Optional[str], Optional[str], bool, int]]):
+        """rows: 用户活跃凭证按 (api_type, model_tier, is_public) 分组的计数"""
+        from app.config import settings
+
+        totals: Dict[Optional[str], int] = {}
+        tier3: Dict[Optional[str], int] = {}
+        public_modes: Set[Optional[str]] = set()
+        for api_type, model_tier, is_public, count in rows:
+            totals[api_type] = totals.get(api_type, 0) + count
+            if model_tier == "3":
+                tier3[api_type] = tier3.get(api_type, 0) + count
+            if is_public and count:
+                public_modes.add(api_type)
+
+        self.public_modes = frozenset(public_modes)
+        self.tier3_modes = frozenset(mode for mode, count in tier3.items() if count)
+        self.daily_quota = user.daily_quota
+        # CLI 配额按全部凭证计算，Antigravity 配额只按 Antigravity 凭证计算
+        self._quotas = {
+            "geminicli": _quota_limits(user, sum(totals.values()), sum(tier3.values())),
+            "antigravity": _quota_limits(user, totals.get("antigravity", 0), tier3.get("antigravity", 0)),
+        }
+        self._rpm = {
+            "geminicli": settings.contributor_rpm if self.has_public("geminicli") else settings.base_rpm,
+            "antigravity": (
+                settings.antigravity_contributor_rpm if self.has_public("antigravity")
+                else settings.antigravity_base_rpm
+            ),
+        }
+
+    def has_public(self, mode: str = "geminicli") -> bool:
+        """是否有公开的该类型凭证（是否参与大锅饭）"""
+        return mode in self.public_modes
+
+    def has_tier3(self, mode: str = "geminicli") -> bool:
+        """是否有该类型的 3.0 凭证"""
+        return mode in self.tier3_modes
+
+    def quota(self, mode: str = "geminicli") -> QuotaLimits:
+        return self._quotas["antigravity" if mode == "antigravity" else "geminicli"]
+
+    def rpm_limit(self, mode: str = "geminicli") -> int:
+        return self._rpm["antigravity" if mode == "antigravity" else "geminicli"]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "public_modes": sorted(mode for mode in self.public_modes if mode),
+            "tier3_modes": sorted(mode for mode in self.tier3_modes if mode),
+            "daily_quota": self.daily_quota,
+            "quotas": {mode: {**limits._asdict(), "has_credential": limits.has_credential}
+                       for mode, limits in self._quotas.items()},
+            "rpm": dict(self._rpm),
+        }
+
+
+class EntitlementCache:
+    """按用户的权益快照缓存（进程内单例 entitlements）"""
+
+    def __init__(self, max_users: int = 10000):
+        # user_id -> (过期时间, 快照)
+        self._entries: "OrderedDict[int, Tuple[float, Entitlement]]" = OrderedDict()
+        self._max_users = max_users
+        # 每次失效加一：查询期间发生过失效的结果不写入缓存
+        self._version = 0
+        self._installed = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def peek(self, user_id: int) -> Optional[Entitlement]:
+        """未过期的缓存快照（没有时返回 None，不查询数据库）"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._entries.pop(user_id, None)
+            return None
+        return entry[1]
+
+    @staticmethod
+    def snapshot_query(user_id: int):
+        """按 (api_type, model_tier, is_public) 统计用户的活跃凭证数（走 idx_credentials_owner_active）"""
+        from sqlalchemy import func, select
+        from app.models.user import Credential
+
+        return (
+            select(Credential.api_type, Credential.model_tier, Credential.is_public, func.count(Credential.id))
+            .where(Credential.user_id == user_id)
+            .where(Credential.is_active == True)
+            .group_by(Credential.api_type, Credential.model_tier, Credential.is_public)
+        )
+
+    async def get(self, db, user) -> Entitlement:
+        snapshot = self.peek(user.id)
+        if snapshot is not None:
+            self.hits += 1
+            return snapshot
+
+        self.misses += 1
+        version = self._version
+        result = await db.execute(self.snapshot_query(user.id))
+        snapshot = Entitlement(user, result.all())
+        ttl = _ttl()
+        if ttl and version == self._version:
+            self._entries[user.id] = (time.monotonic() + ttl, snapshot)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self._max_users:
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id: Optional[int]):
+        if user_id is None:
+            return
+        self._version += 1
+        self.invalidations += 1
+        self._entries.pop(user_id, None)
+
+    def invalidate_all(self):
+        self._version += 1
+        self.invalidations += 1
+        self._entries.clear()
+
+    @staticmethod
+    def invalidate_on_commit(session, user_id: Optional[int] = None):
+        """批量修改凭证 / 用户的语句（不触发 ORM 事件）所在的会话提交后失效 user_id，未指定时全部失效"""
+        if user_id is None:
+            session.info[_PENDING_ALL_KEY] = True
+        else:
+            session.info.setdefault(_PENDING_KEY, set()).add(user_id)
+
+    # ===== ORM 事件 =====
+
+    def install(self):
+        """注册 ORM 事件：凭证 / 用户配额字段变化的事务提交后失效对应用户（重复调用无效果）"""
+        if self._installed:
+            return
+        self._installed = True
+
+        from sqlalchemy import event, inspect
+        from sqlalchemy.orm import Session, object_session
+        from app.models.user import Credential, User
+
+        def mark(target, user_ids: Iterable[Optional[int]]):
+            session = object_session(target)
+            if session is None:
+                for user_id in user_ids:
+                    self.invalidate(user_id)
+                return
+            session.info.setdefault(_PENDING_KEY, set()).update(uid for uid in user_ids if uid is not None)
+
+        def changed_users(target, fields: Tuple[str, ...], owner_field: Optional[str]) -> Set[Optional[int]]:
+            state = inspect(target)
+            if not any(state.attrs[name].history.has_changes() for name in fields):
+                return set()
+            if owner_field is None:
+                return {target.id}
+            # 凭证转移了归属时新旧用户都要失效
+            history = state.attrs[owner_field].history
+            return {getattr(target, owner_field), *history.deleted}
+
+        @event.listens_for(Credential, "after_insert")
+        @event.listens_for(Credential, "after_delete")
+        def credential_added_or_removed(mapper, connection, target):
+            mark(target, [target.user_id])
+
+        @event.listens_for(Credential, "after_update")
+        def credential_updated(mapper, connection, target):
+            users = changed_users(target, _CREDENTIAL_FIELDS, "user_id")
+            if users:
+                mark(target, users)
+
+        @event.listens_for(User, "after_update")
+        def user_updated(mapper, connection, target):
+            users = changed_users(target, _USER_FIELDS, None)
+            if users:
+                mark(target, users)
+
+        @event.listens_for(User, "after_delete")
+        def user_deleted(mapper, connection, target):
+            mark(target, [target.id])
+
+        @event.listens_for(Session, "after_commit")
+        def flush_pending(session):
+            user_ids = session.info.pop(_PENDING_KEY, ())
+            if session.info.pop(_PENDING_ALL_KEY, False):
+                self.invalidate_all()
+                return
+            for user_id in user_ids:
+                self.invalidate(user_id)
+
+        @event.listens_for(Session, "after_rollback")
+        def drop_pending(session):
+            session.info.pop(_PENDING_KEY, None)
+            session.info.pop(_PENDING_ALL_KEY, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ttl_seconds": _ttl(),
+            "cached": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+# 全局单例
+entitlements = EntitlementCache()
@@ -0,0 +1,618 @@
+"""
+上游故障转移（换凭证重试）
+
+OpenAI 兼容接口、Gemini 原生接口和 Antigravity 代理原先各自复制了一份
+"失败 -> 开新会话选凭证 -> 刷新 token -> 重试" 的循环，而且只在失败之后才串行地去拿下一个凭证。
+这里统一为 FailoverExecutor：
+
+- CredentialSource 为一个请求挑选凭证（排除已尝试过的），选取和取 token 在独立的短会话中完成
+- 每次尝试进行时在后台预取下一个凭证和它的 token；预取只选取不占用（不更新轮询时间/CD/计数），
+  真正切换过去时才 claim，请求一次成功时预取的凭证不受影响
+- 统一的可重试判断（is_retryable_error）；重试前经过全局重试预算和退避调度（见 retry_budget.py）
+- 每次尝试记录凭证、等待凭证耗时、尝试耗时和结果；发生过重试时打印一行汇总
+- 开启 hedge_enabled 时 run() 会对慢请求发出对冲请求（见 hedging.py）
+- 每次成功/失败按凭证所在的凭证池喂给模型级熔断器，用过的凭证池都熔断时不再换凭证重试（见 model_breaker.py）
+- 每次尝试的结果、首字节耗时和流式输出速度喂给凭证健康评分（见 credential_health.py）
+- 每次上游调用（含流式的整个输出过程）计入凭证 / 项目的进行中调用数（见 inflight.py）
+"""
+import asyncio
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, List, Optional, Set, Tuple
+
+from app.services.credential_health import credential_health
+from app.services.error_classifier import ErrorType, classify_error
+from app.services.hedging import hedging
+from app.services.inflight import inflight
+from app.services.model_breaker import PUBLIC_POOL, model_breaker, pool_of
+from app.services.retry_budget import retry_budget
+
+
+# 异常文本中出现这些标记时换凭证重试
+RETRYABLE_MARKERS = (
+    "404", "500", "502", "503", "504", "429", "RESOURCE_EXHAUSTED", "NOT_FOUND",
+    "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset",
+    "ETIMEDOUT", "ECONNREFUSED", "Gateway Timeout", "timeout",
+)
+# 上游返回这些状态码时换凭证重试
+RETRYABLE_STATUS = frozenset({404, 429, 500, 502, 503, 504})
+# Token 过期/失效
+AUTH_MARKERS = ("401", "UNAUTHENTICATED", "invalid_grant", "Token has been expired", "token expired")
+
+# GeminiClient 等抛出的普通异常文本里的状态码
+_API_ERROR_STATUS_RE = re.compile(r"API Error (\d{3})")
+# 流式数据块里的文本负载（text / content / reasoning_content 字段的值），心跳和 SSE/JSON 包装不计入输出速度
+_PAYLOAD_TEXT_RE = re.compile(r'"(?:text|content|reasoning_content)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_PAYLOAD_BYTES_RE = re.compile(_PAYLOAD_TEXT_RE.pattern.encode())
+
+# 选到的凭证取 token 失败时，最多再换几个
+_ACQUIRE_ATTEMPTS = 3
+
+# 请求已结束但还没跑完的预取任务（保持引用直到完成）
+_detached_prewarms: Set[asyncio.Task] = set()
+
+
+def _prewarm_enabled() -> bool:
+    """是否预取下一个凭证"""
+    try:
+        from app.config import settings
+        return settings.failover_prewarm
+    except ImportError:
+        return True
+
+
+def _prewarm_delay() -> float:
+    """首次尝试开始后多久才预取（秒）：绝大多数请求一次成功，不必每个请求都多取一次凭证和 token"""
+    try:
+        from app.config import settings
+        return max(0, settings.failover_prewarm_delay_ms) / 1000
+    except ImportError:
+        return 1.0
+
+
+async def _delayed(delay: float, acquire: Callable[[], Awaitable[Optional["Lease"]]]) -> Optional["Lease"]:
+    if delay:
+        await asyncio.sleep(delay)
+    return await acquire()
+
+
+def _is_quota_error(error: BaseException) -> bool:
+    """错误分类器判定为限流 / 配额耗尽"""
+    error_str = str(error)
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        match = _API_ERROR_STATUS_RE.search(error_str)
+        status_code = int(match.group(1)) if match else 0
+    return classify_error(status_code, error_str).error_type in (ErrorType.RATE_LIMIT, ErrorType.QUOTA_EXHAUSTED)
+
+
+def _record_breaker_failure(pool: Hashable, mode: str, model: str, credential_id: int, error: BaseException):
+    """按错误分类把一次失败喂给模型级熔断器（上游 429 由 handle_429_rate_limit 记录）"""
+    if _is_quota_error(error):
+        model_breaker.record_exhausted(pool, mode, model, credential_id)
+    else:
+        model_breaker.record_failure(pool, mode, model, credential_id)
+
+
+def _record_health_failure(credential_id: int, error: BaseException, mode: str):
+    """凭证本身的问题（超时、5xx、认证失败等）计入健康评分；限流/配额和客户端错误不计入"""
+    error_str = str(error)
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429 or _is_quota_error(error):
+        return
+    if is_auth_error(error_str) or is_retryable_error(error_str, status_code, mode):
+        credential_health.record_failure(credential_id)
+
+
+def _payload_size(item: Any) -> int:
+    """流式数据块中文本负载的长度"""
+    if isinstance(item, str):
+        return sum(len(text) for text in _PAYLOAD_TEXT_RE.findall(item))
+    if isinstance(item, bytes):
+        return sum(len(text) for text in _PAYLOAD_BYTES_RE.findall(item))
+    return 0
+
+
+def is_auth_error(error_str: str) -> bool:
+    return any(marker in error_str for marker in AUTH_MARKERS)
+
+
+def is_retryable_error(error_str: str, status_code: Optional[int] = None, mode: str = "geminicli") -> bool:
+    """是否值得换一个凭证重试
+
+    Antigravity 的 401 多半是单个凭证的 token 问题，换凭证即可；GeminiCLI 的 401/403 会禁用凭证后直接返回。
+    """
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS or (mode == "antigravity" and status_code == 401)
+    if any(marker in error_str for marker in RETRYABLE_MARKERS):
+        return True
+    return mode == "antigravity" and ("401" in error_str or "UNAUTHENTICATED" in error_str)
+
+
+class UpstreamStatusError(Exception):
+    """上游返回了非 200 状态码（直接使用 httpx 的调用方用它把响应交给执行器）"""
+
+    def __init__(self, status_code: int, text: str, headers: Optional[dict] = None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        super().__init__(f"API Error {status_code}: {text[:500]}")
+
+
+@dataclass
+class Lease:
+    """一次尝试使用的凭证"""
+    credential_id: int
+    email: str
+    access_token: str
+    project_id: str = ""
+    refreshed: bool = False  # 本次请求中是否已因认证失败刷新过 token
+    pool: Hashable = PUBLIC_POOL  # 所在凭证池（见 model_breaker.pool_of）
+
+
+@dataclass
+class Attempt:
+    """一次尝试的记录"""
+    credential_id: int
+    credential_email: str
+    wait_ms: float                   # 切换到该凭证时等待的时间（首个凭证由调用方获取，记 0）
+    prewarmed: bool                  # 是否使用了预取的凭证
+    started_at: float = field(default_factory=time.perf_counter)
+    elapsed_ms: float = 0.0
+    outcome: str = "pending"         # ok / retry / refreshed / failed / hedge / cancelled
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+    cd_seconds: Optional[int] = None
+    first_byte_ms: Optional[float] = None  # 流式：第一个带文本负载的数据块到达的时间
+    output_bytes: int = 0                  # 流式：输出的文本负载长度
+    pool: Hashable = PUBLIC_POOL           # 凭证所在凭证池
+
+    def describe(self) -> str:
+        source = f"预取, 等待 {self.wait_ms:.0f}ms" if self.prewarmed else f"等待 {self.wait_ms:.0f}ms"
+        result = self.outcome if self.status_code is None else f"{self.outcome} {self.status_code}"
+        return f"{self.credential_email} ({source}) {result} {self.elapsed_ms:.0f}ms"
+
+
+class _HedgedAttemptFailed(Exception):
+    """对冲的两份请求都失败：带上最后失败的那次尝试"""
+
+    def __init__(self, error: BaseException, attempt: Attempt):
+        self.error = error
+        self.attempt = attempt
+        super().__init__(str(error))
+
+
+class FailoverError(Exception):
+    """所有尝试都失败（或遇到不可重试的错误）"""
+
+    def __init__(self, error: BaseException, executor: "FailoverExecutor"):
+        self.error = error
+        self.error_str = str(error)
+        self.status_code: Optional[int] = getattr(error, "status_code", None)
+        self.exhausted = executor.exhausted
+        self.retry_count = executor.retry_count
+        self.lease = executor.lease
+        self.attempts = executor.attempts
+        super().__init__(self.error_str)
+
+
+class CredentialSource:
+    """为一个请求挑选凭证：排除已尝试过的，每次选取在独立的短会话中完成"""
+
+    def __init__(self, user_id: int, user_has_public_creds: bool, model: str, mode: str = "geminicli"):
+        self.user_id = user_id
+        self.user_has_public_creds = user_has_public_creds
+        self.model = model
+        self.mode = mode
+        self.tried_ids: Set[int] = set()
+
+    def lease_for(self, credential, access_token: str, project_id: Optional[str]) -> Lease:
+        """登记调用方已经拿到的凭证（通常是用主会话获取的第一个）"""
+        self.tried_ids.add(credential.id)
+        return Lease(credential.id, credential.email, access_token, project_id or "", pool=pool_of(credential))
+
+    async def acquire(self, claim: bool = True) -> Optional[Lease]:
+        """选一个未尝试过的凭证并准备好 token；没有可用凭证时返回 None"""
+        # 数据库相关依赖按需导入，本模块的基准测试不需要数据库
+        from app.database import async_session
+        from app.services.credential_pool import CredentialPool
+
+        async with async_session() as db:
+            for _ in range(_ACQUIRE_ATTEMPTS):
+                credential = await CredentialPool.get_available_credential(
+                    db, user_id=self.user_id, user_has_public_creds=self.user_has_public_creds,
+                    model=self.model, exclude_ids=self.tried_ids, mode=self.mode, claim=claim
+                )
+                if credential is None:
+                    return None
+                self.tried_ids.add(credential.id)
+
+                if self.mode == "antigravity":
+                    access_token, project_id = await CredentialPool.get_access_token_and_project(credential, db, mode=self.mode)
+                else:
+                    access_token = await CredentialPool.get_access_token(credential, db)
+                    project_id = credential.project_id or ""
+                if access_token and (project_id or self.mode != "antigravity"):
+                    return Lease(credential.id, credential.email, access_token, project_id, pool=pool_of(credential))
+
+                error = "Token 刷新失败" if not access_token else "无法获取 Antigravity project_id"
+                await CredentialPool.mark_credential_error(db, credential.id, error)
+                print(f"[Failover] ⚠️ 凭证 {credential.email} {error}，换下一个", flush=True)
+        return None
+
+    async def claim(self, lease: Lease):
+        """正式占用预取的凭证"""
+        from app.database import async_session
+        from app.services.credential_pool import CredentialPool
+
+        async with async_session() as db:
+            await CredentialPool.claim_credential(db, lease.credential_id, self.model)
+
+    async def report_failure(self, lease: Lease, error: BaseException) -> Optional[int]:
+        """记录凭证失败；上游 429 时设置模型组 CD 并返回 CD 秒数"""
+        from app.database import async_session
+        from app.services.credential_pool import CredentialPool
+
+        if not (isinstance(error, UpstreamStatusError) and error.status_code == 429):
+            _record_breaker_failure(lease.pool, self.mode, self.model, lease.credential_id, error)
+        try:
+            async with async_session() as db:
+                if isinstance(error, UpstreamStatusError):
+                    if error.status_code in (401, 403):
+                        await CredentialPool.handle_credential_failure(db, lease.credential_id, str(error))
+                    elif error.status_code == 429:
+                        return await CredentialPool.handle_429_rate_limit(
+                            db, lease.credential_id, self.model, error.text[:500], error.headers
+                        )
+                else:
+                    await CredentialPool.handle_credential_failure(db, lease.credential_id, str(error))
+        except Exception as db_err:
+            print(f"[Failover] ⚠️ 标记凭证失败时出错: {db_err}", flush=True)
+        return None
+
+    async def refresh(self, lease: Lease) -> bool:
+        """强制刷新凭证的 access_token（上游报认证失败时），成功后原地更新 lease"""
+        from sqlalchemy import select
+        from app.database import async_session
+        from app.models.user import Credential
+        from app.services.credential_pool import CredentialPool
+        from app.services.crypto import encrypt_credential
+
+        lease.refreshed = True
+        try:
+            async with async_session() as db:
+                result = await db.execute(select(Credential).where(Credential.id == lease.credential_id))
+                credential = result.scalar_one_or_none()
+                if credential is None:
+                    return False
+                new_token = await CredentialPool.refresh_access_token(credential)
+                if not new_token:
+                    return False
+                credential.api_key = encrypt_credential(new_token)
+                await db.commit()
+        except Exception as e:
+            print(f"[Failover] ⚠️ Token 刷新异常: {e}", flush=True)
+            return False
+        lease.access_token = new_token
+        return True
+
+
+class FailoverExecutor:
+    """按 CredentialSource 给出的凭证执行请求，失败时换凭证重试
+
+    call 接收当前 Lease：run() 用于返回结果的协程（开启对冲时慢请求会用另一个凭证并发一份），
+    stream() 用于异步生成器（与原先一样，流式输出中途出错也会换凭证重试；不对冲）。
+    on_failure 在每次失败的尝试后调用（用于逐次记录日志），最终失败时抛出 FailoverError。
+    """
+
+    def __init__(
+        self,
+        source: CredentialSource,
+        lease: Lease,
+        max_retries: int,
+        tag: str = "Proxy",
+        refresh_on_auth: bool = False,
+        on_failure: Optional[Callable[[Attempt, BaseException], Awaitable[None]]] = None,
+        prewarm: Optional[bool] = None,
+        hedge: Optional[bool] = None,
+    ):
+        self.source = source
+        self.lease = lease
+        self.max_retries = max(0, max_retries)
+        self.tag = tag
+        self.refresh_on_auth = refresh_on_auth
+        self.on_failure = on_failure
+        self.prewarm = _prewarm_enabled() if prewarm is None else prewarm
+        self.hedge = hedging.enabled() if hedge is None else hedge
+        self.attempts: List[Attempt] = []
+        self.exhausted = False
+        self._prewarm_task: Optional[asyncio.Task] = None
+        self._prewarm_at = 0.0  # 预取任务真正开始取凭证的时刻（之前只是在等待）
+        self._next_wait_ms = 0.0
+        self._next_prewarmed = False
+
+    @property
+    def retry_count(self) -> int:
+        return max(0, len(self.attempts) - 1)
+
+    async def run(self, call: Callable[[Lease], Awaitable[Any]]) -> Any:
+        if self.hedge:
+            hedging.admit(self.source.user_id)
+        while True:
+            attempt = self._begin()
+            try:
+                if self.hedge:
+                    result, attempt = await self._call_hedged(call, attempt)
+                else:
+                    result = await self._tracked(call, self.lease)
+            except asyncio.CancelledError:
+                self._cancel(attempt)
+                raise
+            except Exception as e:
+                if isinstance(e, _HedgedAttemptFailed):
+                    attempt, e = e.attempt, e.error
+                if await self._handle_failure(attempt, e):
+                    continue
+                self._report()
+                raise FailoverError(e, self) from e
+            self._succeed(attempt)
+            if self.hedge:
+                hedging.record_latency((self.source.mode, self.source.model), attempt.elapsed_ms / 1000)
+            return result
+
+    async def stream(self, call: Callable[[Lease], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        while True:
+            attempt = self._begin()
+            try:
+                # 客户端断开时生成器被关闭，track 在 finally 里释放计数
+                with inflight.track(self.lease.credential_id, self.lease.project_id):
+                    async for item in call(self.lease):
+                        self.observe(_payload_size(item))
+                        yield item
+            except (GeneratorExit, asyncio.CancelledError):
+                # 客户端断开 / 请求被取消：不是 Exception，记下这次尝试并释放预取后照常退出
+                self._cancel(attempt)
+                raise
+            except Exception as e:
+                if await self._handle_failure(attempt, e):
+                    continue
+                self._report()
+                raise FailoverError(e, self) from e
+            self._succeed(attempt)
+            return
+
+    def observe(self, payload_size: int):
+        """记录当前尝试输出的文本负载：第一次有负载的时间记为首字节耗时
+
+        stream() 自动从产出的数据块里提取；不把上游内容原样产出的调用（如只产出心跳的假非流）自己调用
+        """
+        if payload_size <= 0 or not self.attempts:
+            return
+        attempt = self.attempts[-1]
+        if attempt.first_byte_ms is None:
+            attempt.first_byte_ms = (time.perf_counter() - attempt.started_at) * 1000
+        attempt.output_bytes += payload_size
+
+    def timings(self) -> List[dict]:
+        """每次尝试的耗时明细"""
+        return [
+            {
+                "credential_id": a.credential_id,
+                "wait_ms": round(a.wait_ms, 1),
+                "prewarmed": a.prewarmed,
+                "elapsed_ms": round(a.elapsed_ms, 1),
+                "outcome": a.outcome,
+                "status_code": a.status_code,
+            }
+            for a in self.attempts
+        ]
+
+    # ===== 内部 =====
+
+    @staticmethod
+    async def _tracked(call: Callable[[Lease], Awaitable[Any]], lease: Lease) -> Any:
+        """调用上游，期间计入该凭证 / 项目的进行中调用数"""
+        with inflight.track(lease.credential_id, lease.project_id):
+            return await call(lease)
+
+    async def _call_hedged(self, call: Callable[[Lease], Awaitable[Any]], attempt: Attempt) -> Tuple[Any, Attempt]:
+        """主请求超过对冲延迟仍未返回时，用下一个凭证再发一份，先成功的胜出，另一份取消
+
+        返回 (结果, 胜出的尝试)；两份都失败时抛出 _HedgedAttemptFailed（先失败的那份在这里记录）。
+        """
+        primary = asyncio.ensure_future(self._tracked(call, self.lease))
+        delay = hedging.delay((self.source.mode, self.source.model))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        # 主请求已返回、没有剩余尝试次数或该用户的对冲预算用完时，不对冲
+        if done or len(self.attempts) > self.max_retries or not hedging.try_spend(self.source.user_id):
+            return await primary, attempt
+
+        wait_start = time.perf_counter()
+        lease, prewarmed = await self._next_lease()
+        if lease is None:
+            return await primary, attempt
+        hedge_attempt = Attempt(lease.credential_id, lease.email, (time.perf_counter() - wait_start) * 1000, prewarmed,
+                                pool=lease.pool)
+        hedge_attempt.outcome = "hedge"
+        self.attempts.append(hedge_attempt)
+        print(f"[{self.tag}] ⏱️ {self.lease.email} {delay:.1f}s 未返回，使用凭证 {lease.email} 发出对冲请求", flush=True)
+
+        owners = {primary: (self.lease, attempt), asyncio.ensure_future(self._tracked(call, lease)): (lease, hedge_attempt)}
+        pending = set(owners)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        task_lease, task_attempt = owners[task]
+                        self.lease = task_lease
+                        for loser in pending:
+                            loser_attempt = owners[loser][1]
+                            loser_attempt.outcome = "cancelled"
+                            loser_attempt.elapsed_ms = (time.perf_counter() - loser_attempt.started_at) * 1000
+                        if task_attempt is hedge_attempt:
+                            hedging.hedge_wins += 1
+                        else:
+                            hedging.primary_wins += 1
+                        return task.result(), task_attempt
+
+                failed = list(done)
+                if not pending:
+                    # 两份都失败：最后一份交给调用方按常规失败处理
+                    last = failed.pop()
+                    self.lease = owners[last][0]
+                    for task in failed:
+                        await self._record_side_failure(*owners[task], task.exception())
+                    raise _HedgedAttemptFailed(last.exception(), owners[last][1])
+                # 另一份还在进行：记录这次失败，继续等待
+                for task in failed:
+                    await self._record_side_failure(*owners[task], task.exception())
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _record_side_failure(self, lease: Lease, attempt: Attempt, error: BaseException):
+        """对冲中先失败的一份：记录并标记凭证，不触发换凭证"""
+        attempt.elapsed_ms = (time.perf_counter() - attempt.started_at) * 1000
+        attempt.error = str(error)
+        attempt.status_code = getattr(error, "status_code", None)
+        attempt.outcome = "failed"
+        _record_health_failure(lease.credential_id, error, self.source.mode)
+        attempt.cd_seconds = await self.source.report_failure(lease, error)
+        if self.on_failure is not None:
+            await self.on_failure(attempt, error)
+
+    def _begin(self) -> Attempt:
+        attempt = Attempt(self.lease.credential_id, self.lease.email, self._next_wait_ms, self._next_prewarmed,
+                          pool=self.lease.pool)
+        self.attempts.append(attempt)
+        self._next_wait_ms, self._next_prewarmed = 0.0, False
+        # 还有重试机会时，趁当前尝试进行中预取下一个凭证：首次尝试等一段时间还没结束才预取，重试时立即预取
+        if self.prewarm and self._prewarm_task is None and len(self.attempts) <= self.max_retries:
+            delay = _prewarm_delay() if len(self.attempts) == 1 else 0.0
+            self._prewarm_at = time.monotonic() + delay
+            self._prewarm_task = asyncio.create_task(_delayed(delay, lambda: self.source.acquire(claim=False)))
+        return attempt
+
+    def _cancel(self, attempt: Attempt):
+        attempt.elapsed_ms = (time.perf_counter() - attempt.started_at) * 1000
+        attempt.outcome = "cancelled"
+        self._report()
+
+    def _succeed(self, attempt: Attempt):
+        attempt.elapsed_ms = (time.perf_counter() - attempt.started_at) * 1000
+        attempt.outcome = "ok"
+        if attempt.first_byte_ms is None:
+            credential_health.record_success(attempt.credential_id, attempt.elapsed_ms / 1000)
+        else:
+            credential_health.record_success(attempt.credential_id, attempt.first_byte_ms / 1000)
+            credential_health.record_stream(
+                attempt.credential_id, attempt.output_bytes, (attempt.elapsed_ms - attempt.first_byte_ms) / 1000
+            )
+        retry_budget.record_success((self.source.mode, self.source.model))
+        model_breaker.record_success(attempt.pool, self.source.mode, self.source.model)
+        self._report()
+
+    async def _handle_failure(self, attempt: Attempt, error: BaseException) -> bool:
+        """记录失败并切换到下一个凭证；返回 False 表示不再重试"""
+        attempt.elapsed_ms = (time.perf_counter() - attempt.started_at) * 1000
+        error_str = str(error)
+        attempt.error = error_str
+        attempt.status_code = getattr(error, "status_code", None)
+        has_budget = len(self.attempts) <= self.max_retries
+
+        # 认证失败：先刷新当前凭证的 token，用同一个凭证重试
+        if self.refresh_on_auth and has_budget and not self.lease.refreshed and is_auth_error(error_str):
+            print(f"[{self.tag}] ⚠️ 认证失败，尝试刷新 Token: {self.lease.email}", flush=True)
+            if await self.source.refresh(self.lease):
+                attempt.outcome = "refreshed"
+                print(f"[{self.tag}] ✅ Token 刷新成功，使用相同凭证重试: {self.lease.email}", flush=True)
+                return True
+            print(f"[{self.tag}] ❌ Token 刷新失败: {self.lease.email}", flush=True)
+
+        _record_health_failure(attempt.credential_id, error, self.source.mode)
+        attempt.cd_seconds = await self.source.report_failure(self.lease, error)
+        if self.on_failure is not None:
+            await self.on_failure(attempt, error)
+
+        if not has_budget or not is_retryable_error(error_str, attempt.status_code, self.source.mode):
+            attempt.outcome = "failed"
+            return False
+
+        if model_breaker.is_open({a.pool for a in self.attempts}, self.source.mode, self.source.model):
+            attempt.outcome = "failed"
+            print(f"[{self.tag}] ⛔ 模型 {self.source.model} 已熔断，不再换凭证重试", flush=True)
+            return False
+
+        delay = retry_budget.schedule((self.source.mode, self.source.model), len(self.attempts) - 1, error)
+        if delay is None:
+            attempt.outcome = "failed"
+            print(f"[{self.tag}] ⚠️ 请求失败: {error_str[:300]}，全局重试预算不足，不再重试", flush=True)
+            return False
+
+        print(f"[{self.tag}] ⚠️ 请求失败: {error_str[:300]}，{delay:.2f}s 后切换凭证重试 ({len(self.attempts) + 1}/{self.max_retries + 1})", flush=True)
+        if delay:
+            await asyncio.sleep(delay)
+
+        wait_start = time.perf_counter()
+        lease, prewarmed = await self._next_lease()
+        if lease is None:
+            attempt.outcome = "failed"
+            self.exhausted = True
+            print(f"[{self.tag}] ❌ 没有更多可用凭证", flush=True)
+            return False
+
+        attempt.outcome = "retry"
+        self.lease = lease
+        self._next_wait_ms = (time.perf_counter() - wait_start) * 1000
+        self._next_prewarmed = prewarmed
+        print(f"[{self.tag}] 🔄 切换到凭证: {lease.email}" + (" (预取)" if prewarmed else ""), flush=True)
+        return True
+
+    async def _next_lease(self) -> Tuple[Optional[Lease], bool]:
+        task = self._take_prewarm()
+        if task is not None:
+            try:
+                lease = await task
+            except Exception as e:
+                print(f"[{self.tag}] ⚠️ 预取凭证失败: {e}", flush=True)
+            else:
+                if lease is None:
+                    # 预取时已经没有可用凭证
+                    return None, True
+                try:
+                    await self.source.claim(lease)
+                except Exception as e:
+                    print(f"[{self.tag}] ⚠️ 占用预取凭证失败: {e}", flush=True)
+                return lease, True
+        try:
+            return await self.source.acquire(), False
+        except Exception as e:
+            print(f"[{self.tag}] ⚠️ 获取新凭证失败: {e}", flush=True)
+            return None, False
+
+    def _report(self):
+        self._release_prewarm()
+        if len(self.attempts) > 1:
+            detail = " | ".join(f"#{i + 1} {a.describe()}" for i, a in enumerate(self.attempts))
+            print(f"[{self.tag}] 📊 {self.source.model} 共 {len(self.attempts)} 次尝试: {detail}", flush=True)
+    
+    def _take_prewarm(self) -> Optional[asyncio.Task]:
+        """取出预取任务；还在等待、没有开始取凭证的直接取消（返回 None），不必等它"""
+        task, self._prewarm_task = self._prewarm_task, None
+        if task is not None and not task.done() and time.monotonic() < self._prewarm_at:
+            task.cancel()
+            return None
+        return task
+    
+    def _release_prewarm(self):
+        """请求结束时丢弃未用上的预取结果（预取没有占用凭证，不需要回滚）"""
+        task = self._take_prewarm()
+        if task is not None and not task.done():
+            _detached_prewarms.add(task)
+            task.add_done_callback(_detached_prewarms.discard)
@@ -0,0 +1,236 @@
+"""
+共享池公平调度（加权公平排队）
+
+full_shared / tier3_shared 模式下所有人共用公共凭证池，一个高 RPM 的用户可以占满全部就绪的公共凭证，
+其他人只能拿到 CD 中的凭证或 503。使用公共池的请求在选凭证之前先在这里领一个名额（admit）：
+
+- 容量：同时进行中的公共池请求数上限 fair_share_capacity（0 = 活跃公共凭证数 × fair_share_slots_per_credential，
+  每 30 秒刷新一次）
+- 每个用户同时进行中的请求数不超过 fair_share_user_max_inflight × 权重（管理员豁免）
+- 名额不足时排队，按起始时间公平排队（SFQ）叫号：请求的虚拟起始时间 = max(当前虚拟时间, 该用户上一个请求的
+  虚拟结束时间)，虚拟结束时间 = 起始 + 1/权重。竞争时各用户按权重比例分到名额，没有竞争时不排队
+- 权重：管理员给用户设置的 share_weight（> 0 时），否则贡献者 fair_share_contributor_weight，其他用户 1
+- 排队超过 fair_share_max_wait_ms 返回 429
+- 名额挂在 request.state 上，请求（含流式响应）结束时由 FairShareMiddleware 释放
+"""
+import asyncio
+import itertools
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# 等待时间分布的桶上界（秒）
+_WAIT_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60)
+# 自动容量的刷新间隔（秒）
+_CAPACITY_TTL = 30.0
+
+
+def _policy() -> Tuple[bool, int, int, int, float, float]:
+    """(是否开启, 固定容量（0=自动）, 每个公共凭证的名额, 每用户进行中上限, 贡献者权重, 最长排队秒)"""
+    try:
+        from app.config import settings
+        return (
+            settings.fair_share_enabled,
+            max(0, settings.fair_share_capacity),
+            max(1, settings.fair_share_slots_per_credential),
+            max(1, settings.fair_share_user_max_inflight),
+            max(0.1, settings.fair_share_contributor_weight),
+            max(0, settings.fair_share_max_wait_ms) / 1000,
+        )
+    except ImportError:
+        return True, 0, 2, 4, 2.0, 30.0
+
+
+class Slot:
+    """一个进行中的公共池请求名额（release 可重复调用）"""
+    __slots__ = ("user_id", "released", "_scheduler")
+
+    def __init__(self, scheduler: "FairShare", user_id: int):
+        self.user_id = user_id
+        self.released = False
+        self._scheduler = scheduler
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._scheduler._release(self)
+
+
+class _Waiter:
+    __slots__ = ("user_id", "cap", "start", "seq", "enqueued_at", "future")
+
+    def __init__(self, user_id: int, cap: Optional[int], start: float, seq: int, future: asyncio.Future):
+        self.user_id = user_id
+        self.cap = cap
+        self.start = start
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.future = future
+
+
+class FairShare:
+    """公共池名额调度（进程内单例 fair_share）"""
+
+    def __init__(self):
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        # user_id -> 该用户最后一个请求的虚拟结束时间
+        self._finish: Dict[int, float] = {}
+        # user_id -> 进行中的请求数
+        self._inflight: Dict[int, int] = {}
+        self._total = 0
+        self._waiters: List[_Waiter] = []
+        self._auto_capacity = 0
+        self._capacity_at = 0.0
+        self.granted = 0
+        self.queued = 0
+        self.timeouts = 0
+        self._histogram = [0] * (len(_WAIT_BUCKETS) + 1)
+
+    def capacity(self) -> int:
+        _, fixed, per_credential, *_ = _policy()
+        if fixed:
+            return fixed
+        return max(1, self._auto_capacity * per_credential)
+
+    @staticmethod
+    def weight_for(user, user_has_public_creds: bool) -> float:
+        weight = getattr(user, "share_weight", None)
+        if weight and weight > 0:
+            return float(weight)
+        return _policy()[4] if user_has_public_creds else 1.0
+
+    async def admit(self, request, db, user, user_has_public_creds: bool, model: str = None, mode: str = "geminicli"):
+        """公共池请求领取名额（不使用公共池的请求直接放行）；排队超时抛出 429"""
+        enabled, fixed, _, user_max, _, max_wait = _policy()
+        if not enabled:
+            return
+        from app.services.credential_pool import CredentialPool
+
+        if not await CredentialPool.uses_public_pool(db, user.id, user_has_public_creds, model, mode):
+            return
+        if not fixed and time.monotonic() - self._capacity_at > _CAPACITY_TTL:
+            self._auto_capacity = await CredentialPool.count_public_credentials(db, mode)
+            self._capacity_at = time.monotonic()
+
+        weight = self.weight_for(user, user_has_public_creds)
+        cap = None if user.is_admin else max(1, round(user_max * weight))
+        # 排队期间不占用数据库连接
+        slot = await self.acquire(user.id, weight, cap, max_wait, before_wait=db.commit)
+        if slot is None:
+            from fastapi import HTTPException
+
+            raise HTTPException(
+                status_code=429,
+                detail=f"公共凭证池繁忙，排队超过 {max_wait:.0f} 秒，请稍后重试",
+                headers={"Retry-After": str(max(1, round(max_wait)))},
+            )
+        request.state.fair_share_slot = slot
+
+    async def acquire(self, user_id: int, weight: float, cap: Optional[int], max_wait: float,
+                      before_wait=None) -> Optional[Slot]:
+        """领取名额；排队超过 max_wait 秒返回 None
+
+        cap: 该用户同时进行中的上限（None 表示不限）
+        before_wait: 需要排队时先调用的协程函数（如提交数据库会话）
+        """
+        start = max(self._vtime, self._finish.get(user_id, 0.0))
+        self._finish[user_id] = start + 1 / weight
+        waiter = _Waiter(user_id, cap, start, next(self._seq), asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._dispatch()
+        if waiter.future.done():
+            self._observe(0.0)
+            return waiter.future.result()
+
+        self.queued += 1
+        if before_wait is not None:
+            await before_wait()
+        try:
+            slot = await asyncio.wait_for(asyncio.shield(waiter.future), timeout=max_wait)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            self.timeouts += 1
+            self._observe(time.monotonic() - waiter.enqueued_at)
+            print(f"[FairShare] ⏳ 用户 {user_id} 排队超时（{max_wait:.0f}s）", flush=True)
+            return None
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        self._observe(time.monotonic() - waiter.enqueued_at)
+        return slot
+
+    # ===== 调度 =====
+
+    def _dispatch(self):
+        capacity = self.capacity()
+        while self._waiters and self._total < capacity:
+            eligible = [
+                w for w in self._waiters
+                if w.cap is None or self._inflight.get(w.user_id, 0) < w.cap
+            ]
+            if not eligible:
+                return
+            chosen = min(eligible, key=lambda w: (w.start, w.seq))
+            self._waiters.remove(chosen)
+            self._vtime = max(self._vtime, chosen.start)
+            self._total += 1
+            self._inflight[chosen.user_id] = self._inflight.get(chosen.user_id, 0) + 1
+            self.granted += 1
+            chosen.future.set_result(Slot(self, chosen.user_id))
+
+    def _abandon(self, waiter: _Waiter):
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            self._forget_if_idle(waiter.user_id)
+        elif waiter.future.done() and not waiter.future.cancelled():
+            # 放弃的同一时刻被叫到：把名额还回去
+            waiter.future.result().release()
+
+    def _release(self, slot: Slot):
+        self._total -= 1
+        count = self._inflight.get(slot.user_id, 0) - 1
+        if count > 0:
+            self._inflight[slot.user_id] = count
+        else:
+            self._inflight.pop(slot.user_id, None)
+            self._forget_if_idle(slot.user_id)
+        self._dispatch()
+
+    def _forget_if_idle(self, user_id: int):
+        """没有进行中和排队请求、虚拟结束时间已落后的用户等同于新用户，不再保留"""
+        if user_id in self._inflight or any(w.user_id == user_id for w in self._waiters):
+            return
+        if self._finish.get(user_id, 0.0) <= self._vtime:
+            self._finish.pop(user_id, None)
+
+    def _observe(self, seconds: float):
+        for i, bound in enumerate(_WAIT_BUCKETS):
+            if seconds <= bound:
+                self._histogram[i] += 1
+                return
+        self._histogram[-1] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        enabled, *_, max_wait = _policy()
+        labels = [f"<={bound}s" for bound in _WAIT_BUCKETS] + [f">{_WAIT_BUCKETS[-1]}s"]
+        waiting: Dict[int, int] = {}
+        for w in self._waiters:
+            waiting[w.user_id] = waiting.get(w.user_id, 0) + 1
+        return {
+            "enabled": enabled,
+            "capacity": self.capacity(),
+            "in_flight": self._total,
+            "depth": len(self._waiters),
+            "max_wait_ms": round(max_wait * 1000),
+            "users_in_flight": dict(sorted(self._inflight.items(), key=lambda item: -item[1])[:20]),
+            "users_waiting": dict(sorted(waiting.items(), key=lambda item: -item[1])[:20]),
+            "granted": self.granted,
+            "queued": self.queued,
+            "timeouts": self.timeouts,
+            "wait_histogram": dict(zip(labels, self._histogram)),
+        }
+
+
+# 全局单例
+fair_share = FairShare()
@@ -1,7 +1,11 @@
 import httpx
 import json
-from typing import AsyncGenerator, Optional, Dict, Any
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Optional
 from app.config import settings
+from app.services import json_codec
+from app.services.json_codec import ChunkTemplate
+from app.services.heartbeat import heartbeats_until_done
+from app.services.conversion_cache import gemini_client_cache
 
 
 class GeminiClient:
@@ -224,50 +228,44 @@ class GeminiClient:
         generation_config = self._build_generation_config(model, kwargs)
         gemini_model = self._map_model_name(model)
         
+        template = ChunkTemplate("chatcmpl-catiecli", model)
         async for chunk in self.generate_content_stream(gemini_model, contents, generation_config, system_instruction):
-            yield self._convert_to_openai_stream(chunk, model)
+            yield self._convert_to_openai_stream(chunk, model, template)
     
     async def chat_completions_fake_stream(
         self,
         model: str,
         messages: list,
+        request_runner: Optional[Callable[..., Awaitable[Dict[str, Any]]]] = None,
         **kwargs
     ) -> AsyncGenerator[str, None]:
-        """假流式: 先发心跳，拿到完整响应后一次性输出"""
+        """假流式: 先发心跳，拿到完整响应后一次性输出
+        
+        request_runner: 代替 self.generate_content 发出内部那次非流式请求
+        （参数相同），调用方借此接入故障转移/对冲
+        """
         import asyncio
         
         contents, system_instruction = self._convert_messages_to_contents(messages)
         generation_config = self._build_generation_config(model, kwargs)
         gemini_model = self._map_model_name(model)
         
+        # 同一个流的 chunk 共用预序列化的信封，只编码 delta
+        template = ChunkTemplate("chatcmpl-catiecli", model)
+        
         # 发送初始 chunk（空内容，保持连接）
-        initial_chunk = {
-            "id": "chatcmpl-catiecli",
-            "object": "chat.completion.chunk",
-            "created": 0,
-            "model": model,
-            "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]
-        }
-        yield f"data: {json.dumps(initial_chunk)}\n\n"
+        yield template.delta({"role": "assistant"})
         
         # 创建请求任务
         request_task = asyncio.create_task(
-            self.generate_content(gemini_model, contents, generation_config, system_instruction)
+            (request_runner or self.generate_content)(gemini_model, contents, generation_config, system_instruction)
         )
         
-        # 每2秒发送心跳，直到请求完成
-        heartbeat_chunk = {
-            "id": "chatcmpl-catiecli",
-            "object": "chat.completion.chunk",
-            "created": 0,
-            "model": model,
-            "choices": [{"index": 0, "delta": {}, "finish_reason": None}]
-        }
+        # 请求完成前按间隔发送心跳，完成后立即输出结果
+        heartbeat_chunk = template.delta({})
         
-        while not request_task.done():
-            await asyncio.sleep(2)
-            if not request_task.done():
-                yield f"data: {json.dumps(heartbeat_chunk)}\n\n"
+        async for _ in heartbeats_until_done(request_task, settings.fake_stream_heartbeat_interval):
+            yield heartbeat_chunk
         
         # 获取完整响应
         try:
@@ -286,35 +284,14 @@ class GeminiClient:
             
             # 输出完整内容
             if content:
-                content_chunk = {
-                    "id": "chatcmpl-catiecli",
-                    "object": "chat.completion.chunk",
-                    "created": 0,
-                    "model": model,
-                    "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
-                }
-                yield f"data: {json.dumps(content_chunk)}\n\n"
+                yield template.delta({"content": content})
             
             # 发送结束标记
-            done_chunk = {
-                "id": "chatcmpl-catiecli",
-                "object": "chat.completion.chunk",
-                "created": 0,
-                "model": model,
-                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
-            }
-            yield f"data: {json.dumps(done_chunk)}\n\n"
+            yield template.delta({}, "stop")
             yield "data: [DONE]\n\n"
             
         except Exception as e:
-            error_chunk = {
-                "id": "chatcmpl-catiecli",
-                "object": "chat.completion.chunk",
-                "created": 0,
-                "model": model,
-                "choices": [{"index": 0, "delta": {"content": f"\n\n[Error: {str(e)}]"}, "finish_reason": "stop"}]
-            }
-            yield f"data: {json.dumps(error_chunk)}\n\n"
+            yield template.delta({"content": f"\n\n[Error: {str(e)}]"}, "stop")
             yield "data: [DONE]\n\n"
     
     def _build_generation_config(self, model: str, kwargs: dict) -> dict:
@@ -349,91 +326,106 @@ class GeminiClient:
         
         return generation_config
     
-    def _convert_messages_to_contents(self, messages: list) -> tuple:
-        """将OpenAI消息格式转换为Gemini contents格式
+    @staticmethod
+    def _convert_message(msg: dict) -> tuple:
+        """转换单条 OpenAI 消息
         
         Returns:
-            (contents, system_instruction): contents 列表和系统指令字典
+            (system_texts, content): system 消息返回其文本，其他消息返回 Gemini content
         """
-        contents = []
-        system_instructions = []
+        system_texts = []
         
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            
-            if role == "system":
-                # system 可能是字符串或列表
-                if isinstance(content, str):
-                    system_instructions.append(content)
-                elif isinstance(content, list):
-                    for item in content:
-                        if isinstance(item, dict) and item.get("type") == "text":
-                            system_instructions.append(item.get("text", ""))
-                        elif isinstance(item, str):
-                            system_instructions.append(item)
-                continue
-            
-            gemini_role = "user" if role == "user" else "model"
-            
-            # 处理多模态内容（图片+文本）
-            parts = []
+        role = msg.get("role", "user")
+        content = msg.get("content", "")
+
+        if role == "system":
+            # system 可能是字符串或列表
             if isinstance(content, str):
-                # 简单文本
-                parts.append({"text": content})
+                system_texts.append(content)
             elif isinstance(content, list):
-                # 多模态内容列表
                 for item in content:
-                    if isinstance(item, dict):
-                        # OpenAI 格式: {"type": "text", "text": "..."}
-                        if item.get("type") == "text":
-                            parts.append({"text": item.get("text", "")})
-                        elif item.get("type") == "image_url":
-                            # 处理图片
-                            image_url = item.get("image_url", {})
-                            url = image_url.get("url", "") if isinstance(image_url, dict) else image_url
-                            if url.startswith("data:"):
-                                # Base64 编码的图片
-                                # 格式: data:image/jpeg;base64,/9j/4AAQ...
-                                try:
-                                    header, base64_data = url.split(",", 1)
-                                    mime_type = header.split(":")[1].split(";")[0]
-                                    parts.append({
-                                        "inlineData": {
-                                            "mimeType": mime_type,
-                                            "data": base64_data
-                                        }
-                                    })
-                                except Exception as e:
-                                    print(f"[GeminiClient] ⚠️ 解析图片数据失败: {e}", flush=True)
-                            else:
-                                # URL 图片
+                    if isinstance(item, dict) and item.get("type") == "text":
+                        system_texts.append(item.get("text", ""))
+                    elif isinstance(item, str):
+                        system_texts.append(item)
+            return tuple(system_texts), None
+
+        gemini_role = "user" if role == "user" else "model"
+
+        # 处理多模态内容（图片+文本）
+        parts = []
+        if isinstance(content, str):
+            # 简单文本
+            parts.append({"text": content})
+        elif isinstance(content, list):
+            # 多模态内容列表
+            for item in content:
+                if isinstance(item, dict):
+                    # OpenAI 格式: {"type": "text", "text": "..."}
+                    if item.get("type") == "text":
+                        parts.append({"text": item.get("text", "")})
+                    elif item.get("type") == "image_url":
+                        # 处理图片
+                        image_url = item.get("image_url", {})
+                        url = image_url.get("url", "") if isinstance(image_url, dict) else image_url
+                        if url.startswith("data:"):
+                            # Base64 编码的图片
+                            # 格式: data:image/jpeg;base64,/9j/4AAQ...
+                            try:
+                                header, base64_data = url.split(",", 1)
+                                mime_type = header.split(":")[1].split(";")[0]
                                 parts.append({
-                                    "fileData": {
-                                        "mimeType": "image/jpeg",
-                                        "fileUri": url
+                                    "inlineData": {
+                                        "mimeType": mime_type,
+                                        "data": base64_data
                                     }
                                 })
-                        # Gemini 原生格式: {"text": "..."} 或 {"inlineData": {...}} 或 {"fileData": {...}}
-                        elif "text" in item and "type" not in item:
-                            parts.append({"text": item["text"]})
-                        elif "inlineData" in item:
-                            parts.append({"inlineData": item["inlineData"]})
-                        elif "fileData" in item:
-                            parts.append({"fileData": item["fileData"]})
+                            except Exception as e:
+                                print(f"[GeminiClient] ⚠️ 解析图片数据失败: {e}", flush=True)
                         else:
-                            # 未知格式，尝试作为文本处理
-                            print(f"[GeminiClient] ⚠️ 未知内容格式: {list(item.keys())}", flush=True)
-                    elif isinstance(item, str):
-                        parts.append({"text": item})
-            
-            if not parts:
-                parts.append({"text": ""})
-            
-            contents.append({
-                "role": gemini_role,
-                "parts": parts
-            })
+                            # URL 图片
+                            parts.append({
+                                "fileData": {
+                                    "mimeType": "image/jpeg",
+                                    "fileUri": url
+                                }
+                            })
+                    # Gemini 原生格式: {"text": "..."} 或 {"inlineData": {...}} 或 {"fileData": {...}}
+                    elif "text" in item and "type" not in item:
+                        parts.append({"text": item["text"]})
+                    elif "inlineData" in item:
+                        parts.append({"inlineData": item["inlineData"]})
+                    elif "fileData" in item:
+                        parts.append({"fileData": item["fileData"]})
+                    else:
+                        # 未知格式，尝试作为文本处理
+                        print(f"[GeminiClient] ⚠️ 未知内容格式: {list(item.keys())}", flush=True)
+                elif isinstance(item, str):
+                    parts.append({"text": item})
+
+        if not parts:
+            parts.append({"text": ""})
+
+        return (), {
+            "role": gemini_role,
+            "parts": parts
+        }
+    
+    def _convert_messages_to_contents(self, messages: list) -> tuple:
+        """将OpenAI消息格式转换为Gemini contents格式
+        
+        Returns:
+            (contents, system_instruction): contents 列表和系统指令字典
+        """
+        contents = []
+        system_instructions = []
+        
+        # 未变化的历史前缀直接复用上一轮的转换结果，只转换新增的尾部消息
+        for system_texts, content in gemini_client_cache.convert(messages, self._convert_message):
+            system_instructions.extend(system_texts)
+            if content is not None:
+                # 浅拷贝：调用方可能整体替换 content["parts"]，不能影响缓存中的对象
+                contents.append(dict(content))
         
         # 构建 systemInstruction
         system_instruction = None
@@ -550,10 +542,10 @@ class GeminiClient:
             }
         }
     
-    def _convert_to_openai_stream(self, chunk_data: str, model: str) -> str:
+    def _convert_to_openai_stream(self, chunk_data: str, model: str, template: Optional[ChunkTemplate] = None) -> str:
         """将Gemini流式响应转换为OpenAI SSE格式"""
         try:
-            data = json.loads(chunk_data)
+            data = json_codec.loads(chunk_data)
             content = ""
             reasoning_content = ""
             
@@ -580,17 +572,8 @@ class GeminiClient:
             if not delta:
                 return ""
             
-            openai_chunk = {
-                "id": "chatcmpl-catiecli",
-                "object": "chat.completion.chunk",
-                "created": 0,
-                "model": model,
-                "choices": [{
-                    "index": 0,
-                    "delta": delta,
-                    "finish_reason": None
-                }]
-            }
-            return f"data: {json.dumps(openai_chunk)}\n\n"
+            if template is None:
+                template = ChunkTemplate("chatcmpl-catiecli", model)
+            return template.delta(delta)
         except:
             return ""
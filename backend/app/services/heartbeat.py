@@ -0,0 +1,25 @@
+"""
+假流式心跳
+
+假流式先发心跳保持连接，拿到完整响应后一次性输出。原先用 asyncio.sleep(2) 轮询
+task.done()，上游完成后最多还要多等 2 秒才输出结果。这里改为 asyncio.wait 等待
+task 完成或心跳超时，哪个先到就处理哪个：上游一完成立刻返回。
+"""
+import asyncio
+from typing import AsyncIterator
+
+
+async def heartbeats_until_done(task: "asyncio.Future", interval: float) -> AsyncIterator[None]:
+    """task 完成前每隔 interval 秒产出一次（调用方据此发送心跳），完成后立即结束
+
+    生成器提前关闭（如客户端断开）时取消 task，不留下无人等待的上游请求。
+    """
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=interval)
+            if done:
+                return
+            yield
+    finally:
+        if not task.done():
+            task.cancel()
@@ -0,0 +1,116 @@
+"""
+对冲请求（hedged requests）
+
+部分凭证/项目在 cloudcode-pa 上的尾延迟很差，客户端要一直等到读超时（generate_content 为 600 秒）。
+开启 hedge_enabled 后，非流式调用（含假流式内部的那次调用）在超过对冲延迟仍未返回时，
+用另一个凭证再发一份相同的请求，先成功的胜出，另一份被取消（见 FailoverExecutor.run）。
+
+- 对冲延迟取该模型最近成功请求耗时的 hedge_percentile 分位数（样本不足时用 hedge_default_delay_ms），
+  且不低于 hedge_min_delay_ms
+- 每个用户一个令牌桶：每个请求积攒 hedge_budget_percent% 个令牌，每次对冲花 1 个，
+  对冲额外消耗的上游配额被限制在该比例以内
+- 统计对冲率、对冲胜出率和预算拒绝次数
+"""
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, Tuple
+
+
+# 样本数少于此值时不使用分位数
+_MIN_SAMPLES = 20
+# 每个模型保留的最近样本数
+_WINDOW = 200
+
+
+def _policy() -> Tuple[bool, float, float, float, float, float]:
+    """(是否开启, 分位数, 最小延迟秒, 样本不足时的延迟秒, 每请求积攒的令牌, 令牌上限)"""
+    try:
+        from app.config import settings
+        return (
+            settings.hedge_enabled,
+            min(max(settings.hedge_percentile, 50), 99.9),
+            max(0, settings.hedge_min_delay_ms) / 1000,
+            max(0, settings.hedge_default_delay_ms) / 1000,
+            max(0, settings.hedge_budget_percent) / 100,
+            max(1, settings.hedge_budget_burst),
+        )
+    except ImportError:
+        return False, 95.0, 2.0, 30.0, 0.1, 2.0
+
+
+class Hedging:
+    """对冲延迟、按用户的对冲预算和统计（进程内单例 hedging）"""
+
+    def __init__(self, max_users: int = 10000):
+        self._samples: Dict[Hashable, Deque[float]] = {}
+        # user_id -> 剩余令牌
+        self._budgets: "OrderedDict[int, float]" = OrderedDict()
+        self._max_users = max_users
+        self.eligible = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.budget_denied = 0
+
+    def enabled(self) -> bool:
+        return _policy()[0]
+
+    # ===== 延迟 =====
+
+    def record_latency(self, key: Hashable, seconds: float):
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=_WINDOW)
+        samples.append(seconds)
+
+    def delay(self, key: Hashable) -> float:
+        """该模型的对冲延迟（秒）"""
+        _, percentile, min_delay, default_delay, _, _ = _policy()
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < _MIN_SAMPLES:
+            return max(min_delay, default_delay)
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return max(min_delay, ordered[index])
+
+    # ===== 预算 =====
+
+    def admit(self, user_id: int):
+        """一个可对冲的请求开始：为该用户积攒令牌"""
+        _, _, _, _, earn, burst = _policy()
+        self.eligible += 1
+        tokens = self._budgets.pop(user_id, burst)
+        self._budgets[user_id] = min(burst, tokens + earn)
+        while len(self._budgets) > self._max_users:
+            self._budgets.popitem(last=False)
+
+    def try_spend(self, user_id: int) -> bool:
+        """花 1 个令牌发出对冲请求；余额不足时返回 False"""
+        tokens = self._budgets.get(user_id, 0.0)
+        if tokens < 1:
+            self.budget_denied += 1
+            return False
+        self._budgets[user_id] = tokens - 1
+        self.hedged += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        enabled, percentile, *_ = _policy()
+        return {
+            "enabled": enabled,
+            "eligible": self.eligible,
+            "hedged": self.hedged,
+            "hedge_rate": round(self.hedged / self.eligible, 4) if self.eligible else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "primary_wins": self.primary_wins,
+            "win_rate": round(self.hedge_wins / self.hedged, 4) if self.hedged else 0.0,
+            "budget_denied": self.budget_denied,
+            "delays_ms": {
+                "/".join(map(str, key)) if isinstance(key, tuple) else str(key): round(self.delay(key) * 1000)
+                for key in self._samples
+            },
+            "percentile": percentile,
+        }
+
+
+# 全局单例
+hedging = Hedging()
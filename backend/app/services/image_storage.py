@@ -1,77 +1,260 @@
 """
 图片本地存储服务
 用于保存 Antigravity 生成的图片并返回可访问的 URL
+
+- 文件名取图片内容哈希，同一张图只存一份，URL 永久不变（可长期缓存）
+- 哈希、base64 解码和写盘在线程池中进行（save_base64_image_async），不阻塞事件循环上的其他流
+- 目录总大小超过 image_storage_max_mb 时按最近使用顺序淘汰，
+  超过 image_storage_max_age_hours 未使用的图片定期清理
 """
 
-import os
+import asyncio
 import base64
-import uuid
-from datetime import datetime
+import binascii
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
+# 根据 MIME 类型确定扩展名
+EXT_MAP = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+# 内容寻址的文件不会变化，浏览器/CDN 可以缓存一年
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# 定期清理过期图片的最小间隔（秒）
+_AGE_SWEEP_INTERVAL = 3600
+
+# 访问时刷新文件修改时间的最小间隔（秒）：过期清理和重启后重建的 LRU 顺序都按修改时间
+_TOUCH_INTERVAL = 600
+
+# base64 分片解码的片长（4 的倍数）
+_DECODE_SLICE = 64 * 1024
+
+
+def _limits() -> tuple:
+    """(总字节上限, 最长保留秒数)，0 表示不限制"""
+    try:
+        from app.config import settings
+        max_mb = settings.image_storage_max_mb
+        max_age_hours = settings.image_storage_max_age_hours
+    except ImportError:
+        max_mb, max_age_hours = 1024, 168
+    return max(0, max_mb) * 1024 * 1024, max(0, max_age_hours) * 3600
+
+
+def _decode(raw: bytes) -> bytes:
+    """分片解码 base64
+
+    b64decode 全程持有 GIL，一张 2MB 的图要十几毫秒；分片并在片间主动让出 GIL，
+    事件循环线程不必等满 switch interval。分片边界与字符组不对齐（含换行等）时整体重解。
+    """
+    if len(raw) <= _DECODE_SLICE:
+        return base64.b64decode(raw)
+    view = memoryview(raw)
+    out = bytearray()
+    try:
+        for i in range(0, len(raw), _DECODE_SLICE):
+            out += base64.b64decode(view[i:i + _DECODE_SLICE])
+            time.sleep(0)
+    except binascii.Error:
+        return base64.b64decode(raw)
+    return bytes(out)
+
+
 class ImageStorage:
     """本地图片存储服务"""
-    
+
     # 图片存储目录（相对于 app 目录）
     # backend/app/services/image_storage.py -> backend/static/images
     STORAGE_DIR = Path(__file__).parent.parent.parent / "static" / "images"
-    
+
+    _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-store")
+    _lock = threading.Lock()
+    # 文件名 -> 字节数，按最近使用排序（最旧在前）
+    _index: "OrderedDict[str, int]" = OrderedDict()
+    _total_bytes = 0
+    _last_age_sweep = 0.0
+    # 文件名 -> 上次刷新修改时间的时刻
+    _touched: dict = {}
+
     @classmethod
     def init_storage(cls):
-        """初始化存储目录"""
+        """初始化存储目录，按修改时间重建 LRU 索引"""
         cls.STORAGE_DIR.mkdir(parents=True, exist_ok=True)
-        print(f"[ImageStorage] 图片存储目录: {cls.STORAGE_DIR}", flush=True)
-    
+        entries = []
+        for entry in os.scandir(cls.STORAGE_DIR):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        with cls._lock:
+            cls._index = OrderedDict((name, size) for _, name, size in entries)
+            cls._total_bytes = sum(size for _, _, size in entries)
+        print(f"[ImageStorage] 图片存储目录: {cls.STORAGE_DIR} ({len(entries)} 个文件, {cls._total_bytes // 1024} KB)", flush=True)
+
+    @classmethod
+    async def save_base64_image_async(cls, base64_data: str, mime_type: str = "image/png") -> str:
+        """在线程池中保存图片，返回值同 save_base64_image"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(cls._executor, cls.save_base64_image, base64_data, mime_type)
+
     @classmethod
     def save_base64_image(cls, base64_data: str, mime_type: str = "image/png") -> str:
         """
-        保存 base64 图片到本地并返回相对 URL
-        
+        保存 base64 图片到本地并返回相对 URL（同步版本，事件循环上请用 save_base64_image_async）
+
         Args:
             base64_data: base64 编码的图片数据
             mime_type: 图片 MIME 类型
-            
+
         Returns:
-            图片的相对 URL 路径 (如 /images/xxx.png)
+            图片的相对 URL 路径 (如 /images/<内容哈希>.png)，失败返回空字符串
         """
-        # 确保存储目录存在
-        cls.STORAGE_DIR.mkdir(parents=True, exist_ok=True)
-        
-        # 根据 MIME 类型确定扩展名
-        ext_map = {
-            "image/png": ".png",
-            "image/jpeg": ".jpg",
-            "image/jpg": ".jpg",
-            "image/gif": ".gif",
-            "image/webp": ".webp",
-        }
-        ext = ext_map.get(mime_type, ".png")
-        
-        # 生成唯一文件名
-        timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-        unique_id = str(uuid.uuid4())[:8]
-        filename = f"{timestamp}_{unique_id}{ext}"
-        
-        # 保存文件
+        ext = EXT_MAP.get(mime_type, ".png")
+        try:
+            raw = base64_data.encode("ascii")
+            image_data = _decode(raw)
+        except (UnicodeEncodeError, binascii.Error, ValueError) as e:
+            print(f"[ImageStorage] ❌ 保存图片失败: {e}", flush=True)
+            return ""
+        filename = hashlib.blake2b(image_data, digest_size=16).hexdigest() + ext
         file_path = cls.STORAGE_DIR / filename
+
+        with cls._lock:
+            exists = filename in cls._index
+            if exists:
+                cls._index.move_to_end(filename)
+        if exists and file_path.exists():
+            # 同一张图已保存过：只刷新修改时间，重启后重建的 LRU 顺序不丢失
+            try:
+                os.utime(file_path)
+            except OSError:
+                pass
+            return f"/images/{filename}"
+
         try:
-            image_data = base64.b64decode(base64_data)
-            with open(file_path, "wb") as f:
+            cls.STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+            # 先写临时文件再原子替换，读取方不会看到写了一半的图片
+            tmp_path = cls.STORAGE_DIR / f".{filename}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
                 f.write(image_data)
-            print(f"[ImageStorage] ✅ 图片已保存: {filename} ({len(image_data)} bytes)", flush=True)
-            
-            # 返回相对 URL
-            return f"/images/{filename}"
-        except Exception as e:
+            os.replace(tmp_path, file_path)
+        except OSError as e:
             print(f"[ImageStorage] ❌ 保存图片失败: {e}", flush=True)
             return ""
-    
+
+        with cls._lock:
+            cls._total_bytes += len(image_data) - cls._index.pop(filename, 0)
+            cls._index[filename] = len(image_data)
+        print(f"[ImageStorage] ✅ 图片已保存: {filename} ({len(image_data)} bytes)", flush=True)
+        cls._evict(keep=filename)
+        return f"/images/{filename}"
+
+    @classmethod
+    def _evict(cls, keep: str = ""):
+        """超出总字节预算时从最久未使用的开始删除；每小时顺带清理一次过期图片"""
+        max_bytes, max_age = _limits()
+        if max_age and time.time() - cls._last_age_sweep > _AGE_SWEEP_INTERVAL:
+            cls.cleanup_old_images(max_age / 3600)
+        if not max_bytes:
+            return
+
+        removed = []
+        with cls._lock:
+            while cls._total_bytes > max_bytes and cls._index:
+                name = next(iter(cls._index))
+                if name == keep:
+                    break
+                cls._total_bytes -= cls._index.pop(name)
+                cls._touched.pop(name, None)
+                removed.append(name)
+        for name in removed:
+            try:
+                os.unlink(cls.STORAGE_DIR / name)
+            except OSError:
+                pass
+        if removed:
+            print(f"[ImageStorage] 🗑️ 超出存储预算，淘汰 {len(removed)} 张图片", flush=True)
+
+    @classmethod
+    def cleanup_old_images(cls, max_age_hours: float = 24):
+        """清理超过 max_age_hours 未使用（按修改时间）的图片"""
+        cls._last_age_sweep = time.time()
+        cutoff = time.time() - max_age_hours * 3600
+        removed = 0
+        for entry in os.scandir(cls.STORAGE_DIR):
+            if not entry.is_file():
+                continue
+            name = entry.name
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+            except OSError:
+                continue
+            with cls._lock:
+                cls._total_bytes -= cls._index.pop(name, 0)
+                cls._touched.pop(name, None)
+            try:
+                os.unlink(entry.path)
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"[ImageStorage] 🗑️ 清理了 {removed} 张过期图片（{max_age_hours:g} 小时前）", flush=True)
+        return removed
+
+    @classmethod
+    def mark_used(cls, filename: str):
+        """记录一次访问：更新内存中的 LRU 顺序，并（限频）刷新文件修改时间，经常被访问的图片不会按过期清理"""
+        now = time.time()
+        with cls._lock:
+            if filename not in cls._index:
+                return
+            cls._index.move_to_end(filename)
+            if now - cls._touched.get(filename, 0.0) < _TOUCH_INTERVAL:
+                return
+            cls._touched[filename] = now
+        try:
+            os.utime(cls.STORAGE_DIR / filename)
+        except OSError:
+            pass
+
+    @classmethod
+    def static_files(cls):
+        """/images 的静态文件应用：记录访问顺序并附加长期缓存头"""
+        from starlette.staticfiles import StaticFiles
+
+        class ImageStaticFiles(StaticFiles):
+            async def get_response(self, path, scope):
+                response = await super().get_response(path, scope)
+                if response.status_code in (200, 304):
+                    cls.mark_used(os.path.basename(path))
+                    response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+                return response
+
+        return ImageStaticFiles(directory=str(cls.STORAGE_DIR))
+
     @classmethod
-    def cleanup_old_images(cls, max_age_hours: int = 24):
-        """清理过期图片（可选功能）"""
-        # TODO: 实现定期清理
-        pass
+    def stats(cls) -> dict:
+        max_bytes, max_age = _limits()
+        with cls._lock:
+            return {
+                "files": len(cls._index),
+                "total_bytes": cls._total_bytes,
+                "max_bytes": max_bytes,
+                "max_age_hours": max_age // 3600,
+            }
 
 
 # 初始化存储目录
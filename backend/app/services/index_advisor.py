@@ -0,0 +1,190 @@
+"""
+热点查询执行计划检查
+
+对凭证选择、公共/Tier3 凭证检查、权益快照、RPM 配额统计等热点查询执行 EXPLAIN，
+确认每条查询命中的是为它建的索引：
+
+- 全表扫描（SQLite "SCAN credentials"，PostgreSQL "Seq Scan on xxx"）
+- 额外排序（SQLite "USE TEMP B-TREE FOR ORDER BY/GROUP BY"，PostgreSQL "Sort" 节点），
+  说明索引列顺序与 ORDER BY / GROUP BY 不一致
+- 命中了其他索引（通常是回退到 idx_credentials_user_id 之类的单列索引，
+  查询条件与部分索引的 WHERE 不匹配时会出现）
+
+PostgreSQL 上小表走顺序扫描本身是合理的，因此在事务内 SET LOCAL 关闭 seqscan / bitmapscan / sort，
+让规划器在有可用索引时一定选择它。
+
+启动时检查结果保存在模块内，/api/health 据此返回 degraded；
+settings.query_plan_check_strict 开启时直接抛出 QueryPlanCheckFailed 阻止启动。
+"""
+import re
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Tuple, Union
+
+from sqlalchemy import select, func, text
+
+from app.database import engine, is_sqlite
+from app.models.user import UsageLog
+from app.services.credential_pool import CredentialPool
+from app.services.entitlements import EntitlementCache
+
+
+# 样例参数：只用于生成执行计划，不会真正读取数据
+_SAMPLE_USER_ID = 1
+
+_SQLITE_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)(?:\s|$)")
+_SQLITE_INDEX_RE = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+_SQLITE_SORT_RE = re.compile(r"USE TEMP B-TREE FOR (.+)$")
+_PG_SEQ_SCAN_RE = re.compile(r"Seq Scan on (\w+)")
+_PG_INDEX_RE = re.compile(r"(?:Index (?:Only )?Scan (?:Backward )?using|Bitmap Index Scan on) (\w+)")
+_PG_SORT_RE = re.compile(r"(?:^|->\s+)((?:Incremental )?Sort)\s")
+
+# 最近一次启动自检的结果（None = 尚未检查）
+_last_check: Optional[Dict] = None
+
+
+class QueryPlanCheckFailed(Exception):
+    """热点查询未命中预期索引（query_plan_check_strict 开启时抛出）"""
+
+
+def _hot_queries() -> Dict[str, Tuple[object, Union[str, Tuple[str, ...]]]]:
+    """热点查询（名称 -> (SQLAlchemy 语句, 预期命中的索引或可接受的索引组)）"""
+    one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
+    queries = {
+        "user_public_creds": (
+            CredentialPool.user_public_creds_query(_SAMPLE_USER_ID, "geminicli"),
+            "idx_credentials_owner_active",
+        ),
+        # 两个索引都以 (user_id, api_type) 定位到该用户的凭证，没有统计信息时 SQLite 任选其一
+        "user_tier3_creds": (
+            CredentialPool.user_tier3_creds_query(_SAMPLE_USER_ID, "geminicli"),
+            ("idx_credentials_owner_active", "idx_credentials_owner_select"),
+        ),
+        "entitlement_snapshot": (
+            EntitlementCache.snapshot_query(_SAMPLE_USER_ID),
+            "idx_credentials_owner_active",
+        ),
+        "rpm_usage_count": (
+            select(func.count(UsageLog.id))
+            .where(UsageLog.user_id == _SAMPLE_USER_ID)
+            .where(UsageLog.created_at >= one_minute_ago),
+            "idx_usage_logs_user_created",
+        ),
+    }
+    # 凭证选择：公共池拆成“公开凭证”和“自己的非公开凭证”两条查询，分别检查
+    selections = {
+        "select_private_pool": dict(mode="geminicli", use_public_pool=False),
+        "select_public_pool": dict(mode="geminicli", use_public_pool=True),
+        "select_public_pool_tier3": dict(
+            mode="geminicli", required_tier="3", use_public_pool=True, exclude_ids={1, 2}
+        ),
+        "select_antigravity": dict(mode="antigravity", use_public_pool=True),
+    }
+    for name, kwargs in selections.items():
+        branches = CredentialPool.build_selection_queries(user_id=_SAMPLE_USER_ID, **kwargs)
+        if len(branches) == 1:
+            queries[name] = (branches[0], "idx_credentials_owner_select")
+        else:
+            public_query, own_query = branches
+            queries[f"{name}:public"] = (public_query, "idx_credentials_public_select")
+            queries[f"{name}:own"] = (own_query, "idx_credentials_owner_select")
+    return queries
+
+
+def _find_problems(plan_lines: List[str], expected_index: Union[str, Tuple[str, ...]]) -> List[str]:
+    """从执行计划中找出全表扫描、额外排序和未命中预期索引的问题"""
+    expected = (expected_index,) if isinstance(expected_index, str) else expected_index
+    problems = []
+    used_indexes = []
+    for line in plan_lines:
+        stripped = line.strip()
+        if is_sqlite:
+            # "SCAN credentials USING INDEX ..." 是索引扫描，不算全表扫描
+            match = _SQLITE_SCAN_RE.match(stripped)
+            if match and "USING" not in stripped:
+                problems.append(f"全表扫描 {match.group(1)}")
+            sort = _SQLITE_SORT_RE.search(stripped)
+            if sort:
+                problems.append(f"临时 B-TREE 排序（{sort.group(1)}）")
+            used_indexes.extend(_SQLITE_INDEX_RE.findall(stripped))
+        else:
+            problems.extend(f"全表扫描 {table}" for table in _PG_SEQ_SCAN_RE.findall(stripped))
+            sort = _PG_SORT_RE.search(stripped)
+            if sort:
+                problems.append(f"额外排序（{sort.group(1)}）")
+            used_indexes.extend(_PG_INDEX_RE.findall(stripped))
+    if not any(index in used_indexes for index in expected):
+        if used_indexes:
+            problems.append(f"使用了 {', '.join(used_indexes)}，而不是 {' / '.join(expected)}")
+        else:
+            problems.append(f"未使用 {' / '.join(expected)}")
+    return problems
+
+
+async def explain_hot_queries() -> List[Dict]:
+    """对所有热点查询执行 EXPLAIN，返回每个查询的执行计划、预期索引和发现的问题"""
+    report = []
+    async with engine.connect() as conn:
+        if not is_sqlite:
+            # SET LOCAL 只在当前事务生效，连接关闭时回滚
+            for setting in ("enable_seqscan", "enable_bitmapscan", "enable_sort"):
+                await conn.execute(text(f"SET LOCAL {setting} = off"))
+        for name, (stmt, expected_index) in _hot_queries().items():
+            sql = str(stmt.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+            entry = {
+                "name": name,
+                "sql": sql,
+                "expected_index": expected_index,
+                "plan": [],
+                "problems": [],
+                "error": None,
+            }
+            try:
+                if is_sqlite:
+                    result = await conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))
+                    # 列: id, parent, notused, detail
+                    entry["plan"] = [row[3] for row in result.fetchall()]
+                else:
+                    # 语句出错后 PostgreSQL 会中止整个事务，每条 EXPLAIN 放在保存点里，失败时只回滚到保存点
+                    # （SET LOCAL 在保存点之前，不受影响），后面的查询照常检查
+                    async with conn.begin_nested():
+                        result = await conn.execute(text(f"EXPLAIN {sql}"))
+                        entry["plan"] = [row[0] for row in result.fetchall()]
+                entry["problems"] = _find_problems(entry["plan"], expected_index)
+            except Exception as e:
+                entry["error"] = str(e)
+            report.append(entry)
+        await conn.rollback()
+    return report
+
+
+def summarize(report: List[Dict]) -> Dict:
+    """汇总检查结果：ok 以及出问题的查询"""
+    failed = {
+        entry["name"]: entry["error"] or "; ".join(entry["problems"])
+        for entry in report
+        if entry["error"] or entry["problems"]
+    }
+    return {"ok": not failed, "checked": len(report), "failed": failed}
+
+
+def last_check() -> Optional[Dict]:
+    """最近一次启动自检的汇总（尚未检查时为 None）"""
+    return _last_check
+
+
+async def check_hot_query_plans() -> bool:
+    """启动自检：记录结果供 /api/health 使用，返回是否全部命中预期索引"""
+    from app.config import settings
+    global _last_check
+
+    report = await explain_hot_queries()
+    _last_check = summarize(report)
+    for name, reason in _last_check["failed"].items():
+        print(f"[IndexAdvisor] ⚠️ {name}: {reason}", flush=True)
+    if _last_check["ok"]:
+        print(f"[IndexAdvisor] ✅ {len(report)} 个热点查询均命中预期索引", flush=True)
+    elif settings.query_plan_check_strict:
+        raise QueryPlanCheckFailed(
+            f"{len(_last_check['failed'])} 个热点查询未命中预期索引: {', '.join(_last_check['failed'])}"
+        )
+    return _last_check["ok"]
@@ -0,0 +1,95 @@
+"""
+凭证 / 项目并发限制（进行中请求计数）
+
+Google 按 OAuth 项目限流，但原先没有任何东西阻止 30 个流同时落到同一个项目上。这里按凭证 ID 和 project_id
+分别计数进行中的上游调用：
+
+- FailoverExecutor 每次调用上游（含对冲的那一份、流式的整个输出过程）都在 track() 里进行，
+  正常结束、出错、客户端断开（生成器被关闭）时都会在 finally 里减回去
+- 上限按 account_type 配置（credential_max_concurrency_pro / credential_max_concurrency_free，0 = 不限），
+  凭证自身或它所在的项目达到上限都算饱和；get_available_credential 跳过饱和的凭证
+- 全部可用凭证都饱和时，请求在凭证就绪队列里等待，有调用结束时立即叫号（见 admission.py）
+"""
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from app.services.admission import admission
+
+
+def _policy() -> Tuple[int, int]:
+    """(pro 凭证并发上限, 其他凭证并发上限)，0 = 不限"""
+    try:
+        from app.config import settings
+        return max(0, settings.credential_max_concurrency_pro), max(0, settings.credential_max_concurrency_free)
+    except ImportError:
+        return 8, 4
+
+
+class InFlightTracker:
+    """按凭证 / 项目的进行中调用计数（进程内单例 inflight）"""
+
+    def __init__(self):
+        self._credentials: Dict[int, int] = {}
+        self._projects: Dict[str, int] = {}
+        self.saturated_skips = 0
+
+    @staticmethod
+    def limit_for(account_type: Optional[str]) -> int:
+        pro_limit, free_limit = _policy()
+        return pro_limit if account_type == "pro" else free_limit
+
+    def count(self, credential_id: int) -> int:
+        return self._credentials.get(credential_id, 0)
+
+    def project_count(self, project_id: Optional[str]) -> int:
+        return self._projects.get(project_id, 0) if project_id else 0
+
+    def saturated(self, credential) -> bool:
+        """凭证自身或所在项目的进行中调用数已达上限"""
+        limit = self.limit_for(credential.account_type)
+        if not limit:
+            return False
+        if self.count(credential.id) >= limit or self.project_count(credential.project_id) >= limit:
+            self.saturated_skips += 1
+            return True
+        return False
+
+    @contextmanager
+    def track(self, credential_id: int, project_id: Optional[str] = None) -> Iterator[None]:
+        self._credentials[credential_id] = self._credentials.get(credential_id, 0) + 1
+        if project_id:
+            self._projects[project_id] = self._projects.get(project_id, 0) + 1
+        try:
+            yield
+        finally:
+            self._decrement(self._credentials, credential_id)
+            if project_id:
+                self._decrement(self._projects, project_id)
+            # 有名额空出来：叫醒因凭证饱和而排队的请求
+            admission.wake_saturated()
+
+    @staticmethod
+    def _decrement(counts: Dict[Any, int], key: Any):
+        left = counts.get(key, 0) - 1
+        if left > 0:
+            counts[key] = left
+        else:
+            counts.pop(key, None)
+
+    def for_credential(self, credential_id: int, project_id: Optional[str] = None) -> Dict[str, int]:
+        """前端展示用：{"credential": 凭证进行中数, "project": 项目进行中数}"""
+        return {"credential": self.count(credential_id), "project": self.project_count(project_id)}
+
+    def stats(self) -> Dict[str, Any]:
+        pro_limit, free_limit = _policy()
+        return {
+            "limits": {"pro": pro_limit, "free": free_limit},
+            "total": sum(self._credentials.values()),
+            "credentials": {str(cid): n for cid, n in sorted(self._credentials.items(), key=lambda item: -item[1])},
+            "projects": dict(sorted(self._projects.items(), key=lambda item: -item[1])),
+            "saturated_skips": self.saturated_skips,
+        }
+
+
+# 全局单例
+inflight = InFlightTracker()
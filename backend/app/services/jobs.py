@@ -0,0 +1,409 @@
+"""
+后台任务框架
+
+替代原来 routers 里模块级的 _background_tasks 字典：
+- 任务状态存数据库（background_jobs），重启不丢、多 worker 可见
+- 按块处理，每块结束写一次断点（cursor），重启后从断点继续
+- 支持取消（cancel_requested 标记，下一个断点生效）
+- 同类型任务并发上限（超出的排队等待；排队前先领取为 queued，其他 worker 不会接管）
+- 逐条结果写 background_job_results，按需分页流式读取，不在内存中累积
+
+用法:
+    async def my_handler(ctx: JobContext):
+        last_id = ctx.cursor.get("last_id", 0)
+        ...
+        ctx.progress["success"] = ctx.progress.get("success", 0) + n
+        await ctx.commit({"last_id": last_id}, processed=n, results=[...])
+
+    job_manager.register("my.job", my_handler)
+    job_id = await job_manager.submit("my.job", total=100, created_by=user.id)
+"""
+import asyncio
+import json
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import select, update, delete, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import async_session
+from app.models.user import BackgroundJob, BackgroundJobResult
+from app.config import settings
+
+
+# 心跳间隔；超过 JOB_STALE_SECONDS 没有心跳的 queued / running 任务视为 worker 已退出，可被接管
+JOB_HEARTBEAT_SECONDS = 30
+JOB_STALE_SECONDS = 120
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+# 已被某个 worker 领取（queued = 领取后等待并发名额）
+CLAIMED_STATUSES = ("queued", "running")
+
+
+def _claimable(stale_before: datetime):
+    """可领取的任务：没人领取的 pending，或心跳超时的 queued / running（原 worker 已退出）"""
+    return or_(
+        BackgroundJob.status == "pending",
+        and_(
+            BackgroundJob.status.in_(CLAIMED_STATUSES),
+            or_(BackgroundJob.heartbeat_at.is_(None), BackgroundJob.heartbeat_at < stale_before)
+        )
+    )
+
+
+class JobCancelled(Exception):
+    """任务被取消（由 JobContext.commit 在断点处抛出）"""
+    pass
+
+
+class JobContext:
+    """传给任务处理函数的上下文"""
+
+    def __init__(self, job: BackgroundJob):
+        self.job_id = job.id
+        self.job_type = job.job_type
+        self.params: Dict[str, Any] = json.loads(job.params) if job.params else {}
+        self.cursor: Dict[str, Any] = json.loads(job.checkpoint) if job.checkpoint else {}
+        self.progress: Dict[str, Any] = json.loads(job.progress) if job.progress else {}
+        self.total = job.total or 0
+        self.processed = job.processed or 0
+        self.cancelled = False
+
+    async def commit(
+        self,
+        cursor: Dict[str, Any],
+        processed: int = 0,
+        results: Optional[List[Dict]] = None,
+        session: Optional[AsyncSession] = None,
+    ):
+        """写入一个断点：cursor、进度计数和本块结果
+
+        传入 session 时与调用方的数据更新在同一事务中提交，保证重启后不会重复计数。
+        任务被取消时抛出 JobCancelled。
+        """
+        own_session = session is None
+        if own_session:
+            session = async_session()
+        try:
+            cancel_requested = (await session.execute(
+                select(BackgroundJob.cancel_requested).where(BackgroundJob.id == self.job_id)
+            )).scalar()
+            self.cursor = cursor
+            self.processed += processed
+            if results:
+                session.add_all([
+                    BackgroundJobResult(job_id=self.job_id, data=json.dumps(r, ensure_ascii=False, default=str))
+                    for r in results
+                ])
+            await session.execute(
+                update(BackgroundJob)
+                .where(BackgroundJob.id == self.job_id)
+                .values(
+                    checkpoint=json.dumps(cursor),
+                    progress=json.dumps(self.progress),
+                    processed=self.processed,
+                    total=self.total,
+                    heartbeat_at=datetime.utcnow(),
+                )
+            )
+            await session.commit()
+        finally:
+            if own_session:
+                await session.close()
+
+        if cancel_requested or self.cancelled:
+            raise JobCancelled()
+
+    async def set_total(self, total: int):
+        """更新任务总数（处理函数自己统计总数时使用）"""
+        self.total = total
+        async with async_session() as session:
+            await session.execute(
+                update(BackgroundJob).where(BackgroundJob.id == self.job_id).values(total=total)
+            )
+            await session.commit()
+
+
+JobHandler = Callable[[JobContext], Awaitable[None]]
+
+
+def job_to_dict(job: BackgroundJob) -> Dict[str, Any]:
+    """任务状态（进度计数同时平铺到顶层，兼容旧的 task-status 返回格式）"""
+    progress = json.loads(job.progress) if job.progress else {}
+    data = {
+        **progress,
+        "id": job.id,
+        "job_type": job.job_type,
+        "status": job.status,
+        "total": job.total or 0,
+        "processed": job.processed or 0,
+        "progress": progress,
+        "error": job.error,
+        "cancel_requested": bool(job.cancel_requested),
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    return data
+
+
+class JobManager:
+    """后台任务管理（进程内单例，状态全部在数据库）"""
+
+    def __init__(self):
+        self._handlers: Dict[str, JobHandler] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._contexts: Dict[str, JobContext] = {}
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def register(self, job_type: str, handler: JobHandler, concurrency: Optional[int] = None):
+        """注册任务类型；concurrency 为同类型任务并发上限（默认 job_max_concurrency）"""
+        self._handlers[job_type] = handler
+        self._semaphores[job_type] = asyncio.Semaphore(max(1, concurrency or settings.job_max_concurrency))
+
+    async def submit(
+        self,
+        job_type: str,
+        params: Optional[Dict] = None,
+        total: int = 0,
+        created_by: Optional[int] = None,
+    ) -> str:
+        """创建任务并在后台执行，立即返回任务 ID"""
+        if job_type not in self._handlers:
+            raise ValueError(f"未注册的任务类型: {job_type}")
+
+        job_id = uuid.uuid4().hex
+        async with async_session() as session:
+            session.add(BackgroundJob(
+                id=job_id,
+                job_type=job_type,
+                status="pending",
+                params=json.dumps(params or {}, ensure_ascii=False),
+                total=total,
+                processed=0,
+                created_by=created_by,
+            ))
+            await session.commit()
+
+        self._spawn(job_id, job_type)
+        return job_id
+
+    def _spawn(self, job_id: str, job_type: str):
+        task = asyncio.create_task(self._run(job_id, job_type))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _claim(self, job_id: str) -> bool:
+        """原子地领取任务（标记为本 worker 的 queued），之后由心跳保持领取状态"""
+        now = datetime.utcnow()
+        stale_before = now - timedelta(seconds=JOB_STALE_SECONDS)
+        async with async_session() as session:
+            result = await session.execute(
+                update(BackgroundJob)
+                .where(BackgroundJob.id == job_id)
+                .where(_claimable(stale_before))
+                .values(status="queued", worker_id=self.worker_id, heartbeat_at=now)
+            )
+            await session.commit()
+            return result.rowcount == 1
+
+    async def _start(self, job_id: str) -> Optional[BackgroundJob]:
+        """拿到并发名额后把自己领取的任务转为 running（排队期间被取消时返回 None）"""
+        async with async_session() as session:
+            result = await session.execute(
+                update(BackgroundJob)
+                .where(BackgroundJob.id == job_id)
+                .where(BackgroundJob.status == "queued")
+                .where(BackgroundJob.worker_id == self.worker_id)
+                .values(status="running", heartbeat_at=datetime.utcnow())
+            )
+            await session.commit()
+            if result.rowcount != 1:
+                return None
+            return (await session.execute(
+                select(BackgroundJob).where(BackgroundJob.id == job_id)
+            )).scalar_one_or_none()
+
+    async def _heartbeat(self, job_id: str):
+        """定期刷新心跳，并同步其他 worker 发起的取消请求"""
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                async with async_session() as session:
+                    await session.execute(
+                        update(BackgroundJob)
+                        .where(BackgroundJob.id == job_id)
+                        .where(BackgroundJob.worker_id == self.worker_id)
+                        .values(heartbeat_at=datetime.utcnow())
+                    )
+                    cancel_requested = (await session.execute(
+                        select(BackgroundJob.cancel_requested).where(BackgroundJob.id == job_id)
+                    )).scalar()
+                    await session.commit()
+                ctx = self._contexts.get(job_id)
+                if cancel_requested and ctx:
+                    ctx.cancelled = True
+            except Exception as e:
+                print(f"[Jobs] ⚠️ 任务 {job_id} 心跳失败: {e}", flush=True)
+
+    async def _finish(self, job_id: str, status: str, error: Optional[str] = None):
+        values = {"status": status, "error": error, "finished_at": datetime.utcnow()}
+        if status == "pending":
+            # 进程退出时放回队列，等待重启后继续
+            values = {"status": "pending", "worker_id": None, "heartbeat_at": None}
+        async with async_session() as session:
+            await session.execute(
+                update(BackgroundJob).where(BackgroundJob.id == job_id).values(**values)
+            )
+            await session.commit()
+
+    async def _run(self, job_id: str, job_type: str):
+        handler = self._handlers.get(job_type)
+        if not handler:
+            print(f"[Jobs] ⚠️ 任务 {job_id} 类型 {job_type} 未注册，跳过", flush=True)
+            return
+
+        # 先领取再排队：等待并发名额期间心跳照常刷新，其他 worker 的 resume_orphaned 不会接管
+        if not await self._claim(job_id):
+            return
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            async with self._semaphores[job_type]:
+                await self._execute(job_id, job_type, handler)
+        except asyncio.CancelledError:
+            # 进程退出（排队中或执行中）：放回队列，重启后从断点继续
+            await asyncio.shield(self._finish(job_id, "pending"))
+            raise
+        finally:
+            heartbeat.cancel()
+            self._contexts.pop(job_id, None)
+
+    async def _execute(self, job_id: str, job_type: str, handler: JobHandler):
+        job = await self._start(job_id)
+        if not job:
+            return
+        if job.cancel_requested:
+            await self._finish(job_id, "cancelled")
+            return
+
+        ctx = JobContext(job)
+        self._contexts[job_id] = ctx
+        resumed = " (从断点继续)" if ctx.cursor else ""
+        print(f"[Jobs] ▶ {job_type} {job_id}{resumed}", flush=True)
+        try:
+            await handler(ctx)
+            await self._finish(job_id, "done")
+            print(f"[Jobs] ✅ {job_type} {job_id} 完成", flush=True)
+        except JobCancelled:
+            await self._finish(job_id, "cancelled")
+            print(f"[Jobs] ⏹ {job_type} {job_id} 已取消", flush=True)
+        except Exception as e:
+            await self._finish(job_id, "failed", error=str(e)[:2000])
+            print(f"[Jobs] ❌ {job_type} {job_id} 失败: {e}", flush=True)
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        async with async_session() as session:
+            job = (await session.execute(
+                select(BackgroundJob).where(BackgroundJob.id == job_id)
+            )).scalar_one_or_none()
+            return job_to_dict(job) if job else None
+
+    async def list_jobs(self, job_type: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        async with async_session() as session:
+            query = select(BackgroundJob).order_by(BackgroundJob.created_at.desc()).limit(limit)
+            if job_type:
+                query = query.where(BackgroundJob.job_type == job_type)
+            jobs = (await session.execute(query)).scalars().all()
+            return [job_to_dict(j) for j in jobs]
+
+    async def cancel(self, job_id: str) -> bool:
+        """请求取消：排队中的任务直接取消，运行中的任务在下一个断点停止"""
+        async with async_session() as session:
+            result = await session.execute(
+                update(BackgroundJob)
+                .where(BackgroundJob.id == job_id)
+                .where(BackgroundJob.status.in_(("pending", "queued")))
+                .values(status="cancelled", cancel_requested=True, finished_at=datetime.utcnow())
+            )
+            if result.rowcount == 0:
+                result = await session.execute(
+                    update(BackgroundJob)
+                    .where(BackgroundJob.id == job_id)
+                    .where(BackgroundJob.status == "running")
+                    .values(cancel_requested=True)
+                )
+            await session.commit()
+
+        ctx = self._contexts.get(job_id)
+        if ctx:
+            ctx.cancelled = True
+        return result.rowcount > 0
+
+    async def iter_results(self, job_id: str, batch_size: int = 500) -> AsyncIterator[Dict]:
+        """按主键分页读取任务结果"""
+        last_id = 0
+        while True:
+            async with async_session() as session:
+                rows = (await session.execute(
+                    select(BackgroundJobResult.id, BackgroundJobResult.data)
+                    .where(BackgroundJobResult.job_id == job_id)
+                    .where(BackgroundJobResult.id > last_id)
+                    .order_by(BackgroundJobResult.id)
+                    .limit(batch_size)
+                )).all()
+            if not rows:
+                return
+            for row in rows:
+                yield json.loads(row.data)
+            last_id = rows[-1].id
+
+    async def resume_orphaned(self):
+        """启动时接管未完成的任务（没人领取的 pending，或心跳超时的 queued / running）"""
+        stale_before = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+        async with async_session() as session:
+            rows = (await session.execute(
+                select(BackgroundJob.id, BackgroundJob.job_type)
+                .where(_claimable(stale_before))
+                .order_by(BackgroundJob.created_at)
+            )).all()
+        for row in rows:
+            if row.job_type in self._handlers and row.id not in self._tasks:
+                self._spawn(row.id, row.job_type)
+        if rows:
+            print(f"[Jobs] 恢复 {len(rows)} 个未完成任务", flush=True)
+
+    async def prune(self) -> int:
+        """清理超过保留时间的已结束任务及其结果"""
+        cutoff = datetime.utcnow() - timedelta(hours=settings.job_retention_hours)
+        async with async_session() as session:
+            old_ids = select(BackgroundJob.id).where(
+                BackgroundJob.status.in_(FINISHED_STATUSES),
+                BackgroundJob.finished_at < cutoff,
+            )
+            await session.execute(
+                delete(BackgroundJobResult).where(BackgroundJobResult.job_id.in_(old_ids))
+            )
+            result = await session.execute(
+                delete(BackgroundJob).where(
+                    BackgroundJob.status.in_(FINISHED_STATUSES),
+                    BackgroundJob.finished_at < cutoff,
+                )
+            )
+            await session.commit()
+            return result.rowcount or 0
+
+    async def shutdown(self):
+        """进程退出：取消本进程的任务，放回队列等待重启后继续"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# 全局实例
+job_manager = JobManager()
@@ -0,0 +1,102 @@
+"""
+流式路径的 JSON 编解码层
+
+- 安装了 orjson 时使用 orjson（解析/序列化比标准库快数倍），否则退回标准库 json
+- 输出统一为紧凑格式、不转义非 ASCII 字符，两种实现的结果一致
+- ChunkTemplate 按流预先序列化 chat.completion.chunk 中不变的 id/object/model 部分，
+  每个 chunk 只需编码 delta
+"""
+import json
+import time
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，原有的 except 写法不受影响
+JSONDecodeError = json.JSONDecodeError
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+_stdlib_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+_stdlib_decoder = json.JSONDecoder()
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def loads(data: Union[str, bytes, bytearray]) -> Any:
+        """解析 JSON（str 或 bytes）"""
+        return orjson.loads(data)
+
+    def dumps(obj: Any) -> str:
+        """序列化为紧凑 JSON 字符串"""
+        try:
+            return orjson.dumps(obj, option=_ORJSON_OPTIONS).decode("utf-8")
+        except TypeError:
+            # orjson 不支持的类型（如超过 64 位的整数）交给标准库
+            return _stdlib_encoder.encode(obj)
+else:
+    def loads(data: Union[str, bytes, bytearray]) -> Any:
+        """解析 JSON（str 或 bytes）"""
+        if not isinstance(data, str):
+            data = bytes(data).decode("utf-8")
+        return _stdlib_decoder.decode(data)
+
+    def dumps(obj: Any) -> str:
+        """序列化为紧凑 JSON 字符串"""
+        return _stdlib_encoder.encode(obj)
+
+
+def sse(obj: Any) -> str:
+    """编码为一条 SSE data 事件"""
+    return f"data: {dumps(obj)}\n\n"
+
+
+class ChunkTemplate:
+    """OpenAI chat.completion.chunk 的预序列化信封
+
+    created=None 时每个 chunk 取当前时间，否则固定为给定值（如 0）。
+    """
+
+    def __init__(self, chunk_id: str, model: str, created: Optional[int] = 0):
+        self._head = f'data: {{"id":{dumps(chunk_id)},"object":"chat.completion.chunk","created":'
+        self._model = f',"model":{dumps(model)},"choices":'
+        self.created = created
+        self._fixed_prefix = None
+        if created is not None:
+            self._fixed_prefix = f"{self._head}{int(created)}{self._model}"
+        self._finish_suffixes: Dict[Optional[str], str] = {}
+
+    def _prefix(self, created: Optional[int] = None) -> str:
+        if created is not None:
+            return f"{self._head}{int(created)}{self._model}"
+        if self._fixed_prefix is not None:
+            return self._fixed_prefix
+        return f"{self._head}{int(time.time())}{self._model}"
+
+    def _finish_suffix(self, finish_reason: Optional[str]) -> str:
+        suffix = self._finish_suffixes.get(finish_reason)
+        if suffix is None:
+            suffix = f',"finish_reason":{dumps(finish_reason)}}}]}}\n\n'
+            self._finish_suffixes[finish_reason] = suffix
+        return suffix
+
+    def delta(self, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+        """单个 choice（index 0）的 chunk，只序列化 delta"""
+        return f'{self._prefix()}[{{"index":0,"delta":{dumps(delta)}{self._finish_suffix(finish_reason)}'
+
+    def choices(
+        self,
+        choices: List[Dict[str, Any]],
+        usage: Optional[Dict[str, Any]] = None,
+        created: Optional[int] = None,
+    ) -> str:
+        """多个 choice 或带 usage 的 chunk"""
+        body = dumps(choices)
+        if usage:
+            return f'{self._prefix(created)}{body},"usage":{dumps(usage)}}}\n\n'
+        return f"{self._prefix(created)}{body}}}\n\n"
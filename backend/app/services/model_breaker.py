@@ -0,0 +1,243 @@
+"""
+模型级配额耗尽熔断
+
+某个模型（如 gemini-3-pro-preview）在凭证池里大面积 RESOURCE_EXHAUSTED 时，每个新请求仍要
+换好几个凭证都失败后才返回。这里按 (凭证池, api_type, 模型) 维护一个滑动窗口：
+
+- 凭证池：公开凭证共用 "public"，私有凭证按所有者 user_id 各自一个（private 模式、Antigravity 只用自己的凭证，
+  某个用户的凭证耗尽不能让其他人也被熔断）
+
+- 输入：CredentialPool.handle_429_rate_limit（带凭证 CD 秒数）、FailoverExecutor 里经错误分类器
+  判定为 RATE_LIMIT / QUOTA_EXHAUSTED 的失败、以及成功/其他失败
+- 窗口内至少 model_breaker_min_credentials 个不同凭证耗尽，且耗尽占全部结果的比例不低于
+  model_breaker_ratio_percent% 时熔断（open）：请求可用的凭证池（有记录的）全部熔断时直接返回 429，
+  Retry-After 取最早到期的凭证 CD
+- 到期后进入 half_open，只放行一个探测请求：成功则恢复（closed），再次耗尽则重新熔断；
+  探测超过 model_breaker_probe_timeout_seconds 没有结果时允许下一个探测
+- 已经用过的凭证池全部熔断时，进行中的请求也不再换凭证重试
+"""
+import math
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, Iterable, Optional, Tuple
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 公共凭证池（私有凭证池用所有者 user_id 表示）
+PUBLIC_POOL = "public"
+
+# 最多跟踪的模型数（超过时丢弃已恢复的）
+_MAX_MODELS = 1000
+# 模型变体后缀（与 GeminiClient._map_model_name 一致），同一基础模型共用熔断器和 429 冷却
+_VARIANT_SUFFIXES = ("-maxthinking-search", "-nothinking-search", "-maxthinking", "-nothinking", "-search")
+
+
+def _policy() -> Tuple[bool, float, int, float, float, float, float]:
+    """(是否开启, 窗口秒, 最少耗尽凭证数, 耗尽比例, 最短熔断秒, 最长熔断秒, 探测超时秒)"""
+    try:
+        from app.config import settings
+        return (
+            settings.model_breaker_enabled,
+            max(1, settings.model_breaker_window_seconds),
+            max(1, settings.model_breaker_min_credentials),
+            min(max(settings.model_breaker_ratio_percent, 1), 100) / 100,
+            max(1, settings.model_breaker_min_open_seconds),
+            max(1, settings.model_breaker_max_open_seconds),
+            max(1, settings.model_breaker_probe_timeout_seconds),
+        )
+    except ImportError:
+        return True, 60.0, 3, 0.8, 5.0, 300.0, 60.0
+
+
+def base_model_name(model: str) -> str:
+    """基础模型名：去掉 假非流/ 等前缀和思考/搜索变体后缀"""
+    name = (model or "").rsplit("/", 1)[-1]
+    for suffix in _VARIANT_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def model_key(mode: str, model: str) -> Tuple[str, str]:
+    """(api_type, 基础模型名)"""
+    return mode or "geminicli", base_model_name(model)
+
+
+def pool_of(credential) -> Hashable:
+    """凭证所在的凭证池：公开凭证为 PUBLIC_POOL，私有凭证为所有者 user_id"""
+    return PUBLIC_POOL if credential.is_public else credential.user_id
+
+
+class _ModelState:
+    __slots__ = ("events", "cooldowns", "state", "open_until", "probe_started", "trips", "rejected")
+
+    def __init__(self):
+        # (时间, 凭证 ID, 是否耗尽)
+        self.events: Deque[Tuple[float, Optional[int], bool]] = deque()
+        # 凭证 ID -> CD 结束时间
+        self.cooldowns: Dict[int, float] = {}
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.probe_started: Optional[float] = None
+        self.trips = 0
+        self.rejected = 0
+
+
+class ModelBreaker:
+    """按 (凭证池, api_type, 模型) 的配额耗尽熔断器（进程内单例 model_breaker）"""
+
+    def __init__(self):
+        self._states: Dict[Tuple[Hashable, str, str], _ModelState] = {}
+
+    def _state(self, pool: Hashable, mode: str, model: str) -> _ModelState:
+        key = (pool, *model_key(mode, model))
+        state = self._states.get(key)
+        if state is None:
+            if len(self._states) >= _MAX_MODELS:
+                for stale in [k for k, v in self._states.items() if v.state == CLOSED]:
+                    del self._states[stale]
+            state = self._states[key] = _ModelState()
+        return state
+
+    # ===== 放行判断 =====
+
+    def check(self, pool: Hashable, mode: str, model: str) -> Optional[float]:
+        """该凭证池放行返回 None，熔断中返回建议的 Retry-After 秒数"""
+        enabled, *_, min_open, _, probe_timeout = _policy()
+        state = self._states.get((pool, *model_key(mode, model)))
+        if not enabled or state is None or state.state == CLOSED:
+            return None
+        now = time.time()
+        if state.state == OPEN:
+            if now < state.open_until:
+                state.rejected += 1
+                return state.open_until - now
+            state.state = HALF_OPEN
+            state.probe_started = None
+        # half_open：同一时间只放行一个探测请求
+        if state.probe_started is None or now - state.probe_started > probe_timeout:
+            state.probe_started = now
+            print(f"[ModelBreaker] 🔍 {pool}/{mode}/{model} 放行探测请求", flush=True)
+            return None
+        state.rejected += 1
+        return min_open
+
+    def is_open(self, pools: Iterable[Hashable], mode: str, model: str) -> bool:
+        """给定的凭证池（进行中的请求已经用过的）是否都处于熔断中，据此停止换凭证重试"""
+        if not _policy()[0]:
+            return False
+        key = model_key(mode, model)
+        now = time.time()
+        states = [self._states.get((pool, *key)) for pool in pools]
+        return bool(states) and all(
+            state is not None and state.state == OPEN and now < state.open_until for state in states
+        )
+
+    def enforce(self, pools: Iterable[Hashable], mode: str, model: str):
+        """请求可用的凭证池都在熔断中时抛出 429（附 Retry-After）；没有记录的凭证池不参与判断"""
+        key = model_key(mode, model)
+        retry_afters = []
+        for pool in pools:
+            if (pool, *key) not in self._states:
+                continue
+            retry_after = self.check(pool, mode, model)
+            if retry_after is None:
+                return
+            retry_afters.append(retry_after)
+        if not retry_afters:
+            return
+        retry_after = min(retry_afters)
+        from fastapi import HTTPException
+
+        seconds = max(1, math.ceil(retry_after))
+        raise HTTPException(
+            status_code=429,
+            detail=f"模型 {model} 的凭证配额已基本耗尽，请约 {seconds} 秒后重试",
+            headers={"Retry-After": str(seconds)},
+        )
+
+    # ===== 输入 =====
+
+    def record_success(self, pool: Hashable, mode: str, model: str):
+        state = self._state(pool, mode, model)
+        if state.state != CLOSED:
+            print(f"[ModelBreaker] ✅ {pool}/{mode}/{model} 探测成功，恢复", flush=True)
+            state.state = CLOSED
+            state.probe_started = None
+            state.events.clear()
+            state.cooldowns.clear()
+            return
+        self._append(state, None, False)
+
+    def record_failure(self, pool: Hashable, mode: str, model: str, credential_id: Optional[int] = None):
+        """非配额类失败：计入窗口；探测请求以这种方式失败时允许下一个探测"""
+        state = self._state(pool, mode, model)
+        if state.state == HALF_OPEN:
+            state.probe_started = None
+        self._append(state, credential_id, False)
+
+    def record_exhausted(self, pool: Hashable, mode: str, model: str, credential_id: Optional[int],
+                         cd_seconds: Optional[float] = None):
+        """凭证在该模型上配额耗尽（429 / RESOURCE_EXHAUSTED）"""
+        state = self._state(pool, mode, model)
+        now = time.time()
+        if credential_id is not None and cd_seconds:
+            state.cooldowns[credential_id] = now + cd_seconds
+        self._append(state, credential_id, True)
+
+        if state.state == HALF_OPEN:
+            self._trip(f"{pool}/{mode}/{model}", state, now, "探测失败")
+        elif state.state == CLOSED and self._should_trip(state):
+            self._trip(f"{pool}/{mode}/{model}", state, now, "大面积配额耗尽")
+
+    # ===== 内部 =====
+
+    def _append(self, state: _ModelState, credential_id: Optional[int], exhausted: bool):
+        _, window, *_ = _policy()
+        now = time.time()
+        state.events.append((now, credential_id, exhausted))
+        while state.events and state.events[0][0] < now - window:
+            state.events.popleft()
+        for cid in [cid for cid, until in state.cooldowns.items() if until <= now]:
+            del state.cooldowns[cid]
+
+    def _should_trip(self, state: _ModelState) -> bool:
+        enabled, _, min_credentials, ratio, *_ = _policy()
+        if not enabled or not state.events:
+            return False
+        exhausted = [cid for _, cid, is_exhausted in state.events if is_exhausted]
+        distinct = {cid for cid in exhausted if cid is not None}
+        return len(distinct) >= min_credentials and len(exhausted) / len(state.events) >= ratio
+
+    def _trip(self, label: str, state: _ModelState, now: float, reason: str):
+        _, _, _, _, min_open, max_open, _ = _policy()
+        # 最早结束的凭证 CD 就是最早可能恢复的时间
+        earliest = min(state.cooldowns.values(), default=now + min_open)
+        state.open_until = now + min(max(earliest - now, min_open), max_open)
+        state.state = OPEN
+        state.probe_started = None
+        state.trips += 1
+        print(f"[ModelBreaker] ⛔ {label} {reason}，熔断 {state.open_until - now:.0f}s", flush=True)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        result = {}
+        for (pool, mode, model), state in self._states.items():
+            exhausted = sum(1 for _, _, is_exhausted in state.events if is_exhausted)
+            result[f"{pool}/{mode}/{model}"] = {
+                "state": state.state,
+                "retry_after_seconds": round(max(0.0, state.open_until - now), 1) if state.state == OPEN else 0,
+                "window_events": len(state.events),
+                "window_exhausted": exhausted,
+                "cooling_credentials": sum(1 for until in state.cooldowns.values() if until > now),
+                "trips": state.trips,
+                "rejected": state.rejected,
+            }
+        return result
+
+
+# 全局单例
+model_breaker = ModelBreaker()
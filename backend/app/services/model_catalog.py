@@ -0,0 +1,196 @@
+"""
+模型列表缓存
+
+/v1/models、/v1beta/models 被客户端（如 SillyTavern）频繁轮询，原先每次都要做多次
+COUNT 查询、挑凭证刷新 token、再同步请求上游 fetch_available_models。这里：
+
+- 上游模型列表按凭证类型缓存，过期后继续返回旧列表并在后台刷新（请求路径从不同步访问上游）；
+  首次还没有缓存时由调用方回退到静态列表
+- 每个用户的凭证池可见性（有无 CLI / Antigravity 凭证、是否有 3.0）做短时快照
+- 渲染好的响应按“可见性 + 上游列表版本”缓存，附带 ETag，If-None-Match 命中时返回 304
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from fastapi import Request, Response
+from sqlalchemy import func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import async_session
+from app.models.user import Credential, User
+from app.services import json_codec
+from app.services.credential_pool import CredentialPool
+
+
+class PoolMembership(NamedTuple):
+    """用户在模型列表里能看到哪些凭证池"""
+    has_cli: bool
+    has_agy: bool
+    cli_tier3: bool
+
+
+# 上游刷新失败后的重试间隔（秒），避免每次请求都触发刷新
+_REFRESH_RETRY_SECONDS = 60
+# 凭证刷新 token 失败时最多换几个凭证
+_REFRESH_CANDIDATES = 3
+
+
+class ModelCatalog:
+    """模型列表缓存（进程内单例 model_catalog）"""
+
+    def __init__(self, max_rendered: int = 256, max_memberships: int = 10000):
+        # 凭证类型 -> (拉取时间, 模型列表)
+        self._upstream: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        self._upstream_version: Dict[str, int] = {}
+        self._next_refresh: Dict[str, float] = {}
+        self._refresh_tasks: Dict[str, asyncio.Task] = {}
+        # user_id -> (过期时间, PoolMembership)
+        self._memberships: "OrderedDict[int, Tuple[float, PoolMembership]]" = OrderedDict()
+        self._max_memberships = max_memberships
+        # 渲染缓存键 -> (响应体, ETag)
+        self._rendered: "OrderedDict[Hashable, Tuple[bytes, str]]" = OrderedDict()
+        self._max_rendered = max_rendered
+        self.hits = 0
+        self.not_modified = 0
+        self.renders = 0
+
+    # ===== 上游模型列表 =====
+
+    def upstream_models(self, mode: str = "antigravity") -> Tuple[Optional[List[Dict[str, Any]]], int]:
+        """返回 (缓存的上游模型列表或 None, 版本号)；过期或缺失时安排后台刷新"""
+        entry = self._upstream.get(mode)
+        now = time.time()
+        ttl = max(1, settings.model_catalog_ttl_seconds)
+        if (entry is None or now - entry[0] > ttl) and now >= self._next_refresh.get(mode, 0):
+            self.schedule_refresh(mode)
+        return (entry[1] if entry else None), self._upstream_version.get(mode, 0)
+
+    def schedule_refresh(self, mode: str = "antigravity"):
+        """后台刷新上游模型列表（同一类型同时只有一个刷新任务）"""
+        task = self._refresh_tasks.get(mode)
+        if task is not None and not task.done():
+            return
+        self._refresh_tasks[mode] = asyncio.create_task(self._refresh(mode))
+
+    async def _refresh(self, mode: str):
+        from app.services.antigravity_client import AntigravityClient
+
+        self._next_refresh[mode] = time.time() + _REFRESH_RETRY_SECONDS
+        try:
+            async with async_session() as db:
+                # 只用公共凭证或管理员自己的凭证探测，不拿普通用户的私有凭证（及其配额）去请求上游
+                admin_ids = select(User.id).where(User.is_admin == True)
+                result = await db.execute(
+                    select(Credential)
+                    .where(Credential.api_type == mode)
+                    .where(Credential.is_active == True)
+                    .where(or_(Credential.is_public == True, Credential.user_id.in_(admin_ids)))
+                    .order_by(Credential.is_public.desc(), Credential.last_used_at.desc())
+                    .limit(_REFRESH_CANDIDATES)
+                )
+                for credential in result.scalars().all():
+                    access_token = await CredentialPool.get_access_token(credential, db)
+                    if not access_token:
+                        continue
+                    client = AntigravityClient(access_token, credential.project_id or "")
+                    models = await client.fetch_available_models()
+                    if models:
+                        self._store_upstream(mode, models)
+                        print(f"[ModelCatalog] ✅ 已刷新 {mode} 模型列表: {len(models)} 个", flush=True)
+                        return
+        except Exception as e:
+            print(f"[ModelCatalog] ⚠️ 刷新 {mode} 模型列表失败: {e}", flush=True)
+
+    def _store_upstream(self, mode: str, models: List[Dict[str, Any]]):
+        previous = self._upstream.get(mode)
+        self._upstream[mode] = (time.time(), models)
+        if previous is None or previous[1] != models:
+            self._upstream_version[mode] = self._upstream_version.get(mode, 0) + 1
+
+    # ===== 用户可见性快照 =====
+
+    async def membership(self, db: AsyncSession, user) -> PoolMembership:
+        """用户可用凭证池的短时快照"""
+        now = time.time()
+        entry = self._memberships.get(user.id)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        # 一次分组查询得到自己的 + 公共的各类型凭证数
+        result = await db.execute(
+            select(Credential.api_type, func.count(Credential.id))
+            .where(Credential.is_active == True)
+            .where(or_(Credential.user_id == user.id, Credential.is_public == True))
+            .group_by(Credential.api_type)
+        )
+        counts = {api_type: count for api_type, count in result.all()}
+        has_agy = counts.get("antigravity", 0) > 0
+        has_cli = any(count for api_type, count in counts.items() if api_type != "antigravity")
+        cli_tier3 = await CredentialPool.has_tier3_credentials(user, db, mode="geminicli") if has_cli else False
+
+        membership = PoolMembership(has_cli=has_cli, has_agy=has_agy, cli_tier3=cli_tier3)
+        self._memberships[user.id] = (now + max(0, settings.model_catalog_membership_ttl_seconds), membership)
+        self._memberships.move_to_end(user.id)
+        while len(self._memberships) > self._max_memberships:
+            self._memberships.popitem(last=False)
+        return membership
+
+    # ===== 响应 =====
+
+    def respond(self, request: Request, key: Hashable, build: Callable[[], Any]) -> Response:
+        """按 key 缓存渲染结果；If-None-Match 命中时返回 304"""
+        cached = self._rendered.get(key)
+        if cached is None:
+            body = json_codec.dumps(build()).encode("utf-8")
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            cached = (body, etag)
+            self._rendered[key] = cached
+            self.renders += 1
+            while len(self._rendered) > self._max_rendered:
+                self._rendered.popitem(last=False)
+        else:
+            self._rendered.move_to_end(key)
+            self.hits += 1
+
+        body, etag = cached
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "upstream": {
+                mode: {"models": len(models), "age_seconds": round(time.time() - fetched_at, 1),
+                       "version": self._upstream_version.get(mode, 0)}
+                for mode, (fetched_at, models) in self._upstream.items()
+            },
+            "memberships": len(self._memberships),
+            "rendered": len(self._rendered),
+            "hits": self.hits,
+            "renders": self.renders,
+            "not_modified": self.not_modified,
+        }
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+# 全局单例
+model_catalog = ModelCatalog()
@@ -0,0 +1,138 @@
+"""
+凭证 × 模型 的 429 冷却
+
+原先 429 的冷却借用模型组 CD（last_used_flash / last_used_pro / last_used_30）：
+handle_429_rate_limit 反推出一个假的 last_used，让 is_credential_in_cd 算出正确的结束时间，
+结果一个模型 429 会把同组的其他模型也挡住。这里改为按 (凭证, 基础模型) 记录明确的 cooldown_until：
+
+- 内存里 凭证 ID -> {模型: 结束时间}，选凭证时 O(1) 查询
+- 持久化到 Credential.model_cooldowns（JSON {"模型": "UTC ISO 时间"}），启动时加载
+- 过期条目查询时视为不存在并顺手删除，写回数据库时一并丢弃
+- 删除凭证时由 ORM 事件清掉它的条目；批量 DELETE 语句不经过 ORM 事件，调用方提交后自行 clear
+
+模型组 CD 仍只用于轮询间隔（cd_flash / cd_pro / cd_30）。
+"""
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from app.services.model_breaker import base_model_name
+
+
+class ModelCooldowns:
+    """凭证按模型的冷却表（进程内单例 model_cooldowns）"""
+
+    def __init__(self):
+        # 凭证 ID -> {基础模型名: 冷却结束时间（time.time()）}
+        self._until: Dict[int, Dict[str, float]] = {}
+        self._installed = False
+
+    def remaining(self, credential_id: int, model: str) -> float:
+        """剩余冷却秒数（不在冷却中返回 0）"""
+        models = self._until.get(credential_id)
+        if not models:
+            return 0.0
+        name = base_model_name(model)
+        until = models.get(name)
+        if until is None:
+            return 0.0
+        left = until - time.time()
+        if left <= 0:
+            del models[name]
+            if not models:
+                del self._until[credential_id]
+            return 0.0
+        return left
+
+    def in_cooldown(self, credential_id: int, model: str) -> bool:
+        return self.remaining(credential_id, model) > 0
+
+    def set(self, credential_id: int, model: str, seconds: float) -> Optional[str]:
+        """设置冷却，返回写回 Credential.model_cooldowns 的 JSON"""
+        models = self._until.setdefault(credential_id, {})
+        name = base_model_name(model)
+        models[name] = max(models.get(name, 0.0), time.time() + seconds)
+        return self.serialize(credential_id)
+
+    def clear(self, credential_id: int) -> None:
+        """清掉凭证的全部冷却（凭证被删除时）"""
+        self._until.pop(credential_id, None)
+
+    def for_credential(self, credential_id: int) -> Dict[str, int]:
+        """{模型: 剩余秒数}（只含冷却中的）"""
+        now = time.time()
+        return {
+            name: int(until - now)
+            for name, until in self._until.get(credential_id, {}).items() if until - now >= 1
+        }
+
+    def serialize(self, credential_id: int) -> Optional[str]:
+        now = time.time()
+        models = {name: until for name, until in self._until.get(credential_id, {}).items() if until > now}
+        if not models:
+            self._until.pop(credential_id, None)
+            return None
+        self._until[credential_id] = models
+        return json.dumps({
+            name: (datetime.utcnow() + timedelta(seconds=until - now)).isoformat()
+            for name, until in models.items()
+        })
+
+    def load_row(self, credential_id: int, raw: Optional[str]) -> None:
+        """从 Credential.model_cooldowns 恢复（格式错误的条目忽略）"""
+        if not raw:
+            return
+        try:
+            data = json.loads(raw)
+        except (TypeError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+        now_utc = datetime.utcnow()
+        now = time.time()
+        for name, value in data.items():
+            try:
+                left = (datetime.fromisoformat(str(value)) - now_utc).total_seconds()
+            except ValueError:
+                continue
+            if left > 0:
+                self._until.setdefault(credential_id, {})[base_model_name(name)] = now + left
+
+    async def load(self, db) -> int:
+        """启动时从数据库加载所有未过期的冷却，返回加载的凭证数"""
+        from sqlalchemy import select
+        from app.models.user import Credential
+
+        result = await db.execute(
+            select(Credential.id, Credential.model_cooldowns).where(Credential.model_cooldowns.isnot(None))
+        )
+        for credential_id, raw in result.all():
+            self.load_row(credential_id, raw)
+        return len(self._until)
+
+    def install(self):
+        """注册 ORM 事件：删除凭证时清掉它的冷却（重复调用无效果）"""
+        if self._installed:
+            return
+        self._installed = True
+
+        from sqlalchemy import event
+        from app.models.user import Credential
+
+        @event.listens_for(Credential, "after_delete")
+        def credential_deleted(mapper, connection, target):
+            self.clear(target.id)
+
+    def stats(self) -> Dict[str, int]:
+        # 顺手清掉已过期的（包括已删除凭证留下的）
+        for credential_id in list(self._until):
+            self.serialize(credential_id)
+        return {
+            "credentials": len(self._until),
+            "active": sum(len(models) for models in self._until.values()),
+        }
+
+
+# 全局单例
+model_cooldowns = ModelCooldowns()
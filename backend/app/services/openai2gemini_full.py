@@ -7,8 +7,14 @@ import json
 import time
 import uuid
 import logging
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple, Union
 
+from app.services import json_codec
+from app.services.conversion_cache import content_digest, openai_request_cache
+from app.services.json_codec import ChunkTemplate
+
 # 尝试导入 pypinyin，如果不存在则使用简单替代
 try:
     from pypinyin import Style, lazy_pinyin
@@ -646,6 +652,106 @@ def fix_tool_call_args_types(
     return fixed_args
 
 
+# ==================== Tool Declaration Cache ====================
+
+
+class ToolDeclarationCache:
+    """
+    转换后的 functionDeclaration 的 LRU 缓存
+
+    Agent 客户端每一轮都会重发同样的 tools 数组，而 schema 清理（$ref 展开、递归改写）
+    和函数名规范化（拼音转换）开销较大。按 (目标格式, 工具定义内容哈希) 缓存转换结果，
+    命中时直接返回共享的 declaration 对象 —— 调用方不得修改返回的 declaration。
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._data: "OrderedDict[Tuple[str, bytes], Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(target: str, function: Dict[str, Any]) -> Tuple[str, bytes]:
+        """按工具定义内容生成缓存 key
+
+        marshal 序列化比 json.dumps 快数倍（哈希开销约为转换开销的 1/10）；
+        字段顺序不同会算作不同 key，但同一客户端重发的 tools 顺序是稳定的。
+        """
+        return target, content_digest(function)
+
+    def get(self, key: Tuple[str, bytes]) -> Optional[Dict[str, Any]]:
+        declaration = self._data.get(key)
+        if declaration is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return declaration
+
+    def put(self, key: Tuple[str, bytes], declaration: Dict[str, Any]):
+        self._data[key] = declaration
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+_tool_declaration_cache = ToolDeclarationCache()
+
+
+def get_tool_cache_stats() -> Dict[str, Any]:
+    """工具 schema 转换缓存的命中率统计"""
+    return _tool_declaration_cache.stats()
+
+
+def _build_function_declaration(function: Dict[str, Any], is_claude_model: bool) -> Dict[str, Any]:
+    """把单个 OpenAI function 定义转换为 Gemini functionDeclaration（未缓存）"""
+    # 获取并规范化函数名
+    original_name = function.get("name")
+    if not original_name:
+        log.warning("Tool missing 'name' field, using default")
+        original_name = "_unnamed_function"
+
+    normalized_name = _normalize_function_name(original_name)
+
+    # 如果名称被修改了，记录日志
+    if normalized_name != original_name:
+        log.debug(f"Function name normalized: '{original_name}' -> '{normalized_name}'")
+
+    # 构建 Gemini function declaration
+    declaration = {
+        "name": normalized_name,
+        "description": function.get("description", ""),
+    }
+
+    # 添加参数（如果有）- 根据模型选择不同的清理函数
+    if "parameters" in function:
+        if is_claude_model:
+            cleaned_params = _clean_schema_for_claude(function["parameters"])
+            log.debug(f"[OPENAI2GEMINI] Using Claude schema cleaning for tool: {normalized_name}")
+        else:
+            cleaned_params = _clean_schema_for_gemini(function["parameters"])
+
+        if cleaned_params:
+            declaration["parameters"] = cleaned_params
+
+    return declaration
+
+
 def convert_openai_tools_to_gemini(openai_tools: List, model: str = "") -> List[Dict[str, Any]]:
     """
     将 OpenAI tools 格式转换为 Gemini functionDeclarations 格式
@@ -675,34 +781,12 @@ def convert_openai_tools_to_gemini(openai_tools: List, model: str = "") -> List[
             log.warning("Tool missing 'function' field")
             continue
 
-        # 获取并规范化函数名
-        original_name = function.get("name")
-        if not original_name:
-            log.warning("Tool missing 'name' field, using default")
-            original_name = "_unnamed_function"
-
-        normalized_name = _normalize_function_name(original_name)
-
-        # 如果名称被修改了，记录日志
-        if normalized_name != original_name:
-            log.debug(f"Function name normalized: '{original_name}' -> '{normalized_name}'")
-
-        # 构建 Gemini function declaration
-        declaration = {
-            "name": normalized_name,
-            "description": function.get("description", ""),
-        }
-
-        # 添加参数（如果有）- 根据模型选择不同的清理函数
-        if "parameters" in function:
-            if is_claude_model:
-                cleaned_params = _clean_schema_for_claude(function["parameters"])
-                log.debug(f"[OPENAI2GEMINI] Using Claude schema cleaning for tool: {normalized_name}")
-            else:
-                cleaned_params = _clean_schema_for_gemini(function["parameters"])
-
-            if cleaned_params:
-                declaration["parameters"] = cleaned_params
+        # 相同的工具定义直接复用上一次的转换结果（按目标格式区分）
+        cache_key = ToolDeclarationCache.make_key("claude" if is_claude_model else "gemini", function)
+        declaration = _tool_declaration_cache.get(cache_key)
+        if declaration is None:
+            declaration = _build_function_declaration(function, is_claude_model)
+            _tool_declaration_cache.put(cache_key, declaration)
 
         function_declarations.append(declaration)
 
@@ -957,6 +1041,163 @@ def extract_images_from_content(content: Any) -> Dict[str, Any]:
 
     return result
 
+def _build_tool_call_mapping(messages: List[Dict[str, Any]]) -> Dict[str, Tuple[str, str, str]]:
+    """单次遍历建立 tool_call_id -> (name, original_id, signature) 的索引"""
+    tool_call_mapping = {}
+    for msg in messages:
+        if msg.get("role") == "assistant" and msg.get("tool_calls"):
+            for tc in msg["tool_calls"]:
+                encoded_id = tc.get("id", "")
+                func_name = tc.get("function", {}).get("name") or ""
+                if encoded_id:
+                    # 解码获取原始ID和签名
+                    original_id, signature = decode_tool_id_and_signature(encoded_id)
+                    tool_call_mapping[encoded_id] = (func_name, original_id, signature)
+    return tool_call_mapping
+
+
+def _convert_openai_message(
+    message: Dict[str, Any],
+    tool_call_mapping: Dict[str, Tuple[str, str, str]],
+    tool_schemas: Dict[str, Any],
+) -> Optional[Dict[str, Any]]:
+    """
+    将单条 OpenAI 消息转换为 Gemini content，不产生内容（如 system 消息）时返回 None
+
+    结果只取决于消息本身、tool_call_mapping 中该消息引用的 tool_call 和 tool_schemas，
+    因此可以按消息前缀缓存（工具调用总是出现在对应的工具结果之前）
+    """
+    role = message.get("role", "user")
+    content = message.get("content", "")
+
+    # 处理工具消息（tool role）
+    if role == "tool":
+        tool_call_id = message.get("tool_call_id", "")
+        func_name = message.get("name")
+
+        # 使用映射表查找（映射表已覆盖所有 assistant tool_calls，不再逐条回扫消息列表）
+        if tool_call_id in tool_call_mapping:
+            func_name, original_id, _ = tool_call_mapping[tool_call_id]
+        else:
+            # 解码 tool_call_id 获取原始 ID
+            original_id, _ = decode_tool_id_and_signature(tool_call_id)
+
+        # 最终兜底：确保 func_name 不为空
+        if not func_name:
+            func_name = "unknown_function"
+            log.warning(f"Tool message missing function name for tool_call_id={tool_call_id}, using default: {func_name}")
+
+        # 解析响应数据
+        try:
+            response_data = json.loads(content) if isinstance(content, str) else content
+        except (json.JSONDecodeError, TypeError):
+            response_data = {"result": str(content)}
+
+        # 确保 response_data 是字典类型（Gemini API 要求 response 必须是对象）
+        if not isinstance(response_data, dict):
+            response_data = {"result": response_data}
+
+        # 使用原始 ID（不带签名）
+        return {
+            "role": "user",
+            "parts": [{
+                "functionResponse": {
+                    "id": original_id,
+                    "name": func_name,
+                    "response": response_data
+                }
+            }]
+        }
+
+    # system 消息已经由 merge_system_messages 处理，这里跳过
+    if role == "system":
+        return None
+
+    # 将OpenAI角色映射到Gemini角色
+    if role == "assistant":
+        role = "model"
+
+    # 检查是否有tool_calls
+    tool_calls = message.get("tool_calls")
+    if tool_calls:
+        parts = []
+
+        # 如果有文本内容,先添加文本
+        if content:
+            parts.append({"text": content})
+
+        # 添加每个工具调用
+        for tool_call in tool_calls:
+            try:
+                args = (
+                    json.loads(tool_call["function"]["arguments"])
+                    if isinstance(tool_call["function"]["arguments"], str)
+                    else tool_call["function"]["arguments"]
+                )
+
+                # 根据工具的 schema 修正参数类型
+                func_name = tool_call["function"]["name"]
+                if func_name in tool_schemas:
+                    args = fix_tool_call_args_types(args, tool_schemas[func_name])
+
+                # 解码工具ID和thoughtSignature
+                encoded_id = tool_call.get("id", "")
+                original_id, signature = decode_tool_id_and_signature(encoded_id)
+
+                # 构建functionCall part
+                function_call_part = {
+                    "functionCall": {
+                        "id": original_id,
+                        "name": func_name,
+                        "args": args
+                    }
+                }
+
+                # 如果有thoughtSignature则添加，否则使用占位符以满足 Gemini API 要求
+                if signature:
+                    function_call_part["thoughtSignature"] = signature
+                else:
+                    function_call_part["thoughtSignature"] = "skip_thought_signature_validator"
+
+                parts.append(function_call_part)
+            except (json.JSONDecodeError, KeyError) as e:
+                log.error(f"Failed to parse tool call: {e}")
+                continue
+
+        if parts:
+            return {"role": role, "parts": parts}
+        return None
+
+    # 处理普通内容
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if part.get("type") == "text":
+                parts.append({"text": part.get("text", "")})
+            elif part.get("type") == "image_url":
+                image_url = part.get("image_url", {}).get("url")
+                if image_url:
+                    try:
+                        mime_type, base64_data = image_url.split(";")
+                        _, mime_type = mime_type.split(":")
+                        _, base64_data = base64_data.split(",")
+                        parts.append({
+                            "inlineData": {
+                                "mimeType": mime_type,
+                                "data": base64_data,
+                            }
+                        })
+                    except ValueError:
+                        continue
+        if parts:
+            return {"role": role, "parts": parts}
+    elif content:
+        return {"role": role, "parts": [{"text": content}]}
+    return None
+
+
+
+
 async def convert_openai_to_gemini_request(openai_request: Dict[str, Any]) -> Dict[str, Any]:
     """
     将 OpenAI 格式请求体转换为 Gemini 格式请求体
@@ -981,22 +1222,11 @@ async def convert_openai_to_gemini_request(openai_request: Dict[str, Any]) -> Di
     # 处理连续的system消息（兼容性模式）
     openai_request = await merge_system_messages(openai_request)
 
-    contents = []
-
     # 提取消息列表
     messages = openai_request.get("messages", [])
     
-    # 构建 tool_call_id -> (name, original_id, signature) 的映射
-    tool_call_mapping = {}
-    for msg in messages:
-        if msg.get("role") == "assistant" and msg.get("tool_calls"):
-            for tc in msg["tool_calls"]:
-                encoded_id = tc.get("id", "")
-                func_name = tc.get("function", {}).get("name") or ""
-                if encoded_id:
-                    # 解码获取原始ID和签名
-                    original_id, signature = decode_tool_id_and_signature(encoded_id)
-                    tool_call_mapping[encoded_id] = (func_name, original_id, signature)
+    # tool_call_id -> (name, original_id, signature) 的映射，只有需要转换的工具消息才会用到，按需构建
+    tool_call_mapping = None
     
     # 构建工具名称到参数 schema 的映射（用于类型修正）
     tool_schemas = {}
@@ -1008,145 +1238,16 @@ async def convert_openai_to_gemini_request(openai_request: Dict[str, Any]) -> Di
                 if func_name:
                     tool_schemas[func_name] = function.get("parameters", {})
 
-    for message in messages:
-        role = message.get("role", "user")
-        content = message.get("content", "")
-
-        # 处理工具消息（tool role）
-        if role == "tool":
-            tool_call_id = message.get("tool_call_id", "")
-            func_name = message.get("name")
-
-            # 使用映射表查找
-            if tool_call_id in tool_call_mapping:
-                func_name, original_id, _ = tool_call_mapping[tool_call_id]
-            else:
-                # 如果没有name,尝试从消息列表中查找
-                if not func_name and tool_call_id:
-                    for msg in messages:
-                        if msg.get("role") == "assistant" and msg.get("tool_calls"):
-                            for tc in msg["tool_calls"]:
-                                if tc.get("id") == tool_call_id:
-                                    func_name = tc.get("function", {}).get("name")
-                                    break
-                            if func_name:
-                                break
-
-                # 解码 tool_call_id 获取原始 ID
-                original_id, _ = decode_tool_id_and_signature(tool_call_id)
-
-            # 最终兜底：确保 func_name 不为空
-            if not func_name:
-                func_name = "unknown_function"
-                log.warning(f"Tool message missing function name for tool_call_id={tool_call_id}, using default: {func_name}")
-
-            # 解析响应数据
-            try:
-                response_data = json.loads(content) if isinstance(content, str) else content
-            except (json.JSONDecodeError, TypeError):
-                response_data = {"result": str(content)}
-
-            # 确保 response_data 是字典类型（Gemini API 要求 response 必须是对象）
-            if not isinstance(response_data, dict):
-                response_data = {"result": response_data}
-
-            # 使用原始 ID（不带签名）
-            contents.append({
-                "role": "user",
-                "parts": [{
-                    "functionResponse": {
-                        "id": original_id,
-                        "name": func_name,
-                        "response": response_data
-                    }
-                }]
-            })
-            continue
-
-        # system 消息已经由 merge_system_messages 处理，这里跳过
-        if role == "system":
-            continue
-
-        # 将OpenAI角色映射到Gemini角色
-        if role == "assistant":
-            role = "model"
-
-        # 检查是否有tool_calls
-        tool_calls = message.get("tool_calls")
-        if tool_calls:
-            parts = []
-
-            # 如果有文本内容,先添加文本
-            if content:
-                parts.append({"text": content})
+    # 逐条转换，未变化的历史前缀直接复用上一轮的结果（工具 schema 影响参数类型修正，纳入缓存键）
+    def convert_one(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        nonlocal tool_call_mapping
+        if tool_call_mapping is None and message.get("role") == "tool":
+            tool_call_mapping = _build_tool_call_mapping(messages)
+        return _convert_openai_message(message, tool_call_mapping or {}, tool_schemas)
 
-            # 添加每个工具调用
-            for tool_call in tool_calls:
-                try:
-                    args = (
-                        json.loads(tool_call["function"]["arguments"])
-                        if isinstance(tool_call["function"]["arguments"], str)
-                        else tool_call["function"]["arguments"]
-                    )
-                    
-                    # 根据工具的 schema 修正参数类型
-                    func_name = tool_call["function"]["name"]
-                    if func_name in tool_schemas:
-                        args = fix_tool_call_args_types(args, tool_schemas[func_name])
-
-                    # 解码工具ID和thoughtSignature
-                    encoded_id = tool_call.get("id", "")
-                    original_id, signature = decode_tool_id_and_signature(encoded_id)
-
-                    # 构建functionCall part
-                    function_call_part = {
-                        "functionCall": {
-                            "id": original_id,
-                            "name": func_name,
-                            "args": args
-                        }
-                    }
-
-                    # 如果有thoughtSignature则添加，否则使用占位符以满足 Gemini API 要求
-                    if signature:
-                        function_call_part["thoughtSignature"] = signature
-                    else:
-                        function_call_part["thoughtSignature"] = "skip_thought_signature_validator"
-
-                    parts.append(function_call_part)
-                except (json.JSONDecodeError, KeyError) as e:
-                    log.error(f"Failed to parse tool call: {e}")
-                    continue
-
-            if parts:
-                contents.append({"role": role, "parts": parts})
-            continue
-
-        # 处理普通内容
-        if isinstance(content, list):
-            parts = []
-            for part in content:
-                if part.get("type") == "text":
-                    parts.append({"text": part.get("text", "")})
-                elif part.get("type") == "image_url":
-                    image_url = part.get("image_url", {}).get("url")
-                    if image_url:
-                        try:
-                            mime_type, base64_data = image_url.split(";")
-                            _, mime_type = mime_type.split(":")
-                            _, base64_data = base64_data.split(",")
-                            parts.append({
-                                "inlineData": {
-                                    "mimeType": mime_type,
-                                    "data": base64_data,
-                                }
-                            })
-                        except ValueError:
-                            continue
-            if parts:
-                contents.append({"role": role, "parts": parts})
-        elif content:
-            contents.append({"role": role, "parts": [{"text": content}]})
+    converted = openai_request_cache.convert(messages, convert_one, context=content_digest(tool_schemas))
+    # 浅拷贝 content：下游会整体替换 content["parts"]，不能影响缓存中的对象
+    contents = [dict(content) for content in converted if content is not None]
 
     # 构建生成配置
     generation_config = {}
@@ -1437,8 +1538,8 @@ def convert_gemini_to_openai_stream(
             return None
 
         # 解析 JSON
-        gemini_chunk = json.loads(payload_str)
-    except (json.JSONDecodeError, UnicodeDecodeError):
+        gemini_chunk = json_codec.loads(payload_str)
+    except (json_codec.JSONDecodeError, UnicodeDecodeError):
         # 解析失败,跳过此块
         return None
 
@@ -1544,20 +1645,15 @@ def convert_gemini_to_openai_stream(
     # 转换 usageMetadata (只在流结束时存在)
     usage = _convert_usage_metadata(gemini_response.get("usageMetadata"))
 
-    # 构建 OpenAI 流式响应
-    response_data = {
-        "id": response_id,
-        "object": "chat.completion.chunk",
-        "created": int(time.time()),
-        "model": model,
-        "choices": choices,
-    }
-
     # 只在有 usage 数据且有 finish_reason 时添加 usage
-    if usage:
-        has_finish_reason = any(choice.get("finish_reason") for choice in choices)
-        if has_finish_reason:
-            response_data["usage"] = usage
+    if usage and not any(choice.get("finish_reason") for choice in choices):
+        usage = None
+
+    # 转换为 SSE 格式: "data: {json}\n\n"（id/object/model 使用该流预序列化的信封）
+    return _stream_chunk_template(response_id, model).choices(choices, usage, created=int(time.time()))
+
 
-    # 转换为 SSE 格式: "data: {json}\n\n"
-    return f"data: {json.dumps(response_data)}\n\n"
+@lru_cache(maxsize=256)
+def _stream_chunk_template(response_id: str, model: str) -> ChunkTemplate:
+    """同一个流（response_id + model）共用一个 chunk 信封"""
+    return ChunkTemplate(response_id, model)
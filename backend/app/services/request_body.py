@@ -0,0 +1,40 @@
+"""
+请求体解析（每个请求只解析一次）
+
+鉴权依赖要读 model 做配额检查，handler 还要再读一遍；GeminiCLI -> Antigravity 分发时
+又把 body 重新 json.dumps 后包成新的 Request。这里把解析结果缓存在 request.state 上
+（与 scope 绑定，同一请求的依赖和 handler 共享），handler 修改后的 dict 可以直接
+交给下一个 handler 复用。
+"""
+import json
+from typing import Any
+
+from fastapi import HTTPException, Request
+
+from app.services import json_codec
+
+
+async def get_json_body(request: Request, detail: str = "无效的JSON请求体") -> Any:
+    """解析并缓存 JSON 请求体，无效时返回 400"""
+    try:
+        return request.state.json_body
+    except AttributeError:
+        pass
+
+    raw = await request.body()
+    try:
+        body = json_codec.loads(raw)
+    except (json_codec.JSONDecodeError, ValueError):
+        # orjson 比标准库严格（NaN、超过 64 位的整数等），退回标准库再试一次
+        try:
+            body = json.loads(raw)
+        except (json.JSONDecodeError, ValueError):
+            raise HTTPException(status_code=400, detail=detail)
+
+    request.state.json_body = body
+    return body
+
+
+def set_json_body(request: Request, body: Any):
+    """替换缓存的请求体（转交给其他 handler 前修改了 body 时使用）"""
+    request.state.json_body = body
@@ -0,0 +1,112 @@
+"""
+使用日志里的请求内容摘要
+
+原先每个请求都先 json.dumps 整个请求体再截取前 2000 字符，而请求体经常带着
+几 MB 的 base64 图片或很长的历史消息。这里改为：
+
+- 惰性：只有日志真正需要写入 request_body 时才生成（目前只在失败时）
+- 有界：边遍历边输出，写满字符预算立即停止，长字符串先截断再编码
+- 省略图片：inlineData 的 data 和 data:...;base64, URI 只保留类型和长度
+
+输出格式与原来的 json.dumps(body, ensure_ascii=False)[:2000] 一致（省略的图片除外）。
+"""
+import json
+from typing import Any, Iterator, Optional
+
+
+DEFAULT_MAX_CHARS = 2000
+
+_INLINE_DATA_KEYS = ("inlineData", "inline_data")
+
+
+class _Budget:
+    __slots__ = ("remaining",)
+
+    def __init__(self, remaining: int):
+        self.remaining = remaining
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _elide_data_uri(value: str) -> Optional[str]:
+    """data:<mime>;base64,<数据> -> data:<mime>;base64,<N chars>"""
+    if not value.startswith("data:"):
+        return None
+    comma = value.find(",", 0, 256)
+    if comma < 0 or not value[:comma].endswith(";base64"):
+        return None
+    return f"{value[:comma + 1]}<{len(value) - comma - 1} chars>"
+
+
+def _pieces(obj: Any, budget: _Budget) -> Iterator[str]:
+    if isinstance(obj, dict):
+        yield "{"
+        first = True
+        for key, value in obj.items():
+            if budget.remaining <= 0:
+                return
+            if not first:
+                yield ", "
+            first = False
+            yield _dumps(key if isinstance(key, str) else str(key))
+            yield ": "
+            if key in _INLINE_DATA_KEYS and isinstance(value, dict) and isinstance(value.get("data"), str):
+                value = {**value, "data": f"<base64 {len(value['data'])} chars>"}
+            yield from _pieces(value, budget)
+        yield "}"
+    elif isinstance(obj, (list, tuple)):
+        yield "["
+        for i, item in enumerate(obj):
+            if budget.remaining <= 0:
+                return
+            if i:
+                yield ", "
+            yield from _pieces(item, budget)
+        yield "]"
+    elif isinstance(obj, str):
+        elided = _elide_data_uri(obj)
+        if elided is not None:
+            yield _dumps(elided)
+        else:
+            # 超出预算的部分不会输出，先截断再编码
+            yield _dumps(obj[:max(budget.remaining, 0) + 1])
+    else:
+        yield _dumps(obj)
+
+
+def bounded_json(obj: Any, max_chars: int = DEFAULT_MAX_CHARS) -> str:
+    """把 JSON 结构编码为至多 max_chars 个字符，达到预算后不再遍历剩余部分"""
+    budget = _Budget(max_chars)
+    parts = []
+    for piece in _pieces(obj, budget):
+        parts.append(piece)
+        budget.remaining -= len(piece)
+        if budget.remaining <= 0:
+            break
+    return "".join(parts)[:max_chars]
+
+
+class RequestSnapshot:
+    """请求体摘要：第一次读取 text 时才生成，之后复用"""
+
+    __slots__ = ("_body", "_max_chars", "_text", "_done")
+
+    def __init__(self, body: Any, max_chars: int = DEFAULT_MAX_CHARS):
+        self._body = body
+        self._max_chars = max_chars
+        self._text: Optional[str] = None
+        self._done = False
+
+    @property
+    def text(self) -> Optional[str]:
+        if not self._done:
+            self._done = True
+            if self._body:
+                try:
+                    self._text = bounded_json(self._body, self._max_chars)
+                except Exception as e:
+                    self._text = f"<snapshot failed: {e}>"[:self._max_chars]
+            self._body = None
+        return self._text
@@ -0,0 +1,142 @@
+"""
+全局重试预算与重试调度
+
+整个模型被 Google 限流时，每个请求都会立即换凭证重试 error_retry_count 次：上游负载被放大数倍，
+几秒内整个凭证池都进入 429 CD。FailoverExecutor 每次换凭证重试前都要经过这里（所有代理路由共享）：
+
+- 进程级令牌桶：每个成功请求存入 failover_retry_budget_percent% 个令牌，每次重试花 1 个，
+  另外每秒保底补充 failover_retry_budget_min_per_second 个（低流量时也能重试）；
+  令牌不足时不再重试，直接返回最后一次的错误
+- 退避：指数增长 + 全抖动，指数取“本请求第几次重试”和“该模型连续失败次数”中的较大者，
+  模型整体出问题时所有请求的重试一起放慢，该模型一有成功请求就恢复
+- 上游给出不超过 failover_retry_after_max_ms 的 Retry-After / retryDelay 时视为模型级限流，
+  之后该模型所有请求的重试都不早于这个时间；更长的等待是单个凭证的配额重置，交给凭证 CD 处理
+"""
+import random
+import re
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+# 指数上限，避免连续失败次数很大时溢出
+_MAX_EXPONENT = 16
+_RETRY_DELAY_RE = re.compile(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s?"')
+
+
+def _policy() -> Tuple[float, float, float, float, float, float]:
+    """(每个成功请求存入的令牌, 每秒保底补充, 令牌上限, 退避基数秒, 退避上限秒, Retry-After 上限秒)"""
+    try:
+        from app.config import settings
+        return (
+            max(0, settings.failover_retry_budget_percent) / 100,
+            max(0.0, settings.failover_retry_budget_min_per_second),
+            max(1, settings.failover_retry_budget_burst),
+            max(0, settings.failover_backoff_base_ms) / 1000,
+            max(0, settings.failover_backoff_max_ms) / 1000,
+            max(0, settings.failover_retry_after_max_ms) / 1000,
+        )
+    except ImportError:
+        return 0.2, 1.0, 20.0, 0.2, 2.0, 5.0
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """从 Retry-After 头或 Google 错误里的 retryDelay 解析建议等待秒数"""
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+    match = _RETRY_DELAY_RE.search(str(error))
+    if match:
+        return float(match.group(1))
+    return None
+
+
+class RetryBudget:
+    """进程级重试令牌桶 + 按模型的退避/Retry-After 调度（进程内单例 retry_budget）"""
+
+    def __init__(self):
+        self._tokens: Optional[float] = None  # 第一次使用时按上限填满
+        self._refilled_at = time.monotonic()
+        # 模型键 -> 连续可重试失败次数（该模型有请求成功即清零）
+        self._streaks: Dict[Hashable, int] = {}
+        # 模型键 -> 重试不早于（monotonic 时间）
+        self._not_before: Dict[Hashable, float] = {}
+        self.successes = 0
+        self.retries = 0
+        self.denied = 0
+        self.retry_after_waits = 0
+
+    def _refill(self, now: float) -> Tuple[float, float]:
+        earn, per_second, burst, *_ = _policy()
+        if self._tokens is None:
+            self._tokens = burst
+        else:
+            self._tokens = min(burst, self._tokens + (now - self._refilled_at) * per_second)
+        self._refilled_at = now
+        return earn, burst
+
+    def record_success(self, key: Hashable):
+        """一个请求成功：存入令牌，清零该模型的连续失败"""
+        self.successes += 1
+        earn, burst = self._refill(time.monotonic())
+        self._tokens = min(burst, self._tokens + earn)
+        self._streaks.pop(key, None)
+
+    def schedule(self, key: Hashable, retry_index: int, error: BaseException) -> Optional[float]:
+        """一次可重试的失败之后调用：返回重试前应等待的秒数，预算不足时返回 None（不再重试）
+
+        retry_index: 本请求的第几次重试（从 0 开始）
+        """
+        now = time.monotonic()
+        self._refill(now)
+        streak = self._streaks.get(key, 0) + 1
+        self._streaks[key] = streak
+        *_, base, cap, retry_after_max = _policy()
+
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None and retry_after <= retry_after_max:
+            self._not_before[key] = max(self._not_before.get(key, 0.0), now + retry_after)
+
+        if self._tokens < 1:
+            self.denied += 1
+            return None
+        self._tokens -= 1
+        self.retries += 1
+
+        exponent = min(_MAX_EXPONENT, max(retry_index, streak - 1))
+        delay = random.uniform(0, min(cap, base * (2 ** exponent))) if base > 0 else 0.0
+        paused = self._not_before.get(key, 0.0) - now
+        if paused > 0:
+            # 等到 Retry-After 之后，再加一点抖动避免同一时刻一起重试
+            self.retry_after_waits += 1
+            delay = max(delay, paused + random.uniform(0, base))
+        elif key in self._not_before:
+            del self._not_before[key]
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._refill(now)
+        return {
+            "tokens": round(self._tokens, 2),
+            "successes": self.successes,
+            "retries": self.retries,
+            "denied": self.denied,
+            "retry_after_waits": self.retry_after_waits,
+            "failure_streaks": {_key_name(key): streak for key, streak in self._streaks.items()},
+            "paused_ms": {
+                _key_name(key): round((until - now) * 1000)
+                for key, until in self._not_before.items() if until > now
+            },
+        }
+
+
+def _key_name(key: Hashable) -> str:
+    return "/".join(map(str, key)) if isinstance(key, tuple) else str(key)
+
+
+# 全局单例
+retry_budget = RetryBudget()
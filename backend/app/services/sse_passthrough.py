@@ -0,0 +1,229 @@
+"""
+Gemini 原生 streamGenerateContent 的字节级透传
+
+上游内部 API 的每个 SSE 事件形如 data: {"response": {...}, "traceId": "..."}，
+标准 Gemini 格式只需要其中的 response 对象。这里不再逐行 json.loads + json.dumps：
+
+- SSEFrameSplitter 直接在 aiter_bytes 的字节流上按空行切分事件
+- 大事件（图片 inlineData 等，>= 16KB）在字节层面定位 response 对象的起止位置并原样截取：
+  字符串内容用 bytes.find 跳过，Python 层只处理括号；小事件的结构字符占比高，
+  C 实现的解析 + 序列化反而更快，仍走 json_codec
+- 客户端声明接受内部格式时连截取都省掉，上游字节原样转发
+- usageMetadata 只做子串查找 + 小窗口正则提取，供日志记录 token 数
+"""
+import re
+from typing import List, Optional
+
+from app.services import json_codec
+
+
+# 字符串起始引号或括号；字符串内容用 bytes.find 直接跳到结束引号（memchr 速度），
+# 正则只扫描字符串之外的少量结构字符
+_STRUCTURAL_RE = re.compile(rb'["{}\[\]]')
+_RESPONSE_KEY_RE = re.compile(rb'\{\s*"response"\s*:\s*')
+_USAGE_FIELD_RE = re.compile(rb'"(promptTokenCount|candidatesTokenCount|thoughtsTokenCount)"\s*:\s*(\d+)')
+
+_OPEN = (ord("{"), ord("["))
+_CLOSE = (ord("}"), ord("]"))
+_QUOTE = ord('"')
+_BACKSLASH = ord("\\")
+
+# usageMetadata 对象很小，只在其后的窗口内查找计数字段
+_USAGE_SCAN_WINDOW = 2048
+
+# 低于该大小的事件直接解析（实测 8~16KB 以下 orjson/json 解析 + 序列化比逐个括号扫描快）
+_BYTE_UNWRAP_MIN_SIZE = 16 * 1024
+
+
+class SSEFrameSplitter:
+    """把任意切分的字节块重新组装为完整的 SSE 事件（以空行分隔）
+
+    只在新到达的数据里查找分隔符，未完成的事件以分块列表暂存，
+    大事件（如图片）跨多次读取时不会反复拼接和扫描整个缓冲区。
+    """
+
+    def __init__(self):
+        self._pending: List[bytes] = []
+        self._pending_ends_with_newline = False
+        self._carriage_return = False
+
+    def _normalize(self, data: bytes) -> bytes:
+        """\\r\\n 统一为 \\n；块末尾的 \\r 可能与下一块开头的 \\n 组成 \\r\\n，留到下次处理"""
+        if self._carriage_return:
+            data = b"\r" + data
+            self._carriage_return = False
+        if data.endswith(b"\r"):
+            data = data[:-1]
+            self._carriage_return = True
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n")
+        return data
+
+    def feed(self, data: bytes) -> List[bytes]:
+        data = self._normalize(data)
+        if not data:
+            return []
+        straddles = self._pending_ends_with_newline and data.startswith(b"\n")
+        if not straddles and b"\n\n" not in data:
+            self._pending.append(data)
+            self._pending_ends_with_newline = data.endswith(b"\n")
+            return []
+
+        buffer = b"".join(self._pending) + data if self._pending else data
+        frames = buffer.split(b"\n\n")
+        remainder = frames.pop()
+        self._pending = [remainder] if remainder else []
+        self._pending_ends_with_newline = remainder.endswith(b"\n")
+        return [frame.strip(b"\n") for frame in frames if frame.strip(b"\n")]
+
+    def flush(self) -> List[bytes]:
+        """流结束时返回缓冲区中未以空行结尾的最后一个事件"""
+        buffer = b"".join(self._pending).replace(b"\r\n", b"\n").strip(b"\r\n")
+        self._pending = []
+        self._pending_ends_with_newline = False
+        self._carriage_return = False
+        return [buffer] if buffer else []
+
+
+def frame_data(frame: bytes) -> Optional[bytes]:
+    """取出事件的 data 内容（多行 data 按 SSE 规范以 \\n 拼接），非 data 事件返回 None"""
+    if b"\n" not in frame:
+        if not frame.startswith(b"data:"):
+            return None
+        payload = frame[5:]
+        return payload[1:] if payload.startswith(b" ") else payload
+
+    lines = []
+    for line in frame.split(b"\n"):
+        if line.startswith(b"data:"):
+            payload = line[5:]
+            lines.append(payload[1:] if payload.startswith(b" ") else payload)
+    return b"\n".join(lines) if lines else None
+
+
+def _skip_string(payload: bytes, start: int) -> int:
+    """start 指向字符串的起始引号，返回结束引号之后的位置，未闭合时返回 -1"""
+    end = payload.find(b'"', start + 1)
+    while end > 0:
+        # 结束引号前有奇数个反斜杠说明是转义引号
+        backslashes = 0
+        index = end - 1
+        while payload[index] == _BACKSLASH:
+            backslashes += 1
+            index -= 1
+        if not backslashes % 2:
+            return end + 1
+        end = payload.find(b'"', end + 1)
+    return -1
+
+
+def _find_value_end(payload: bytes, start: int) -> int:
+    """返回从 start 开始的 JSON 对象/数组的结束位置（不含），无法匹配时返回 -1"""
+    depth = 0
+    position = start
+    while True:
+        match = _STRUCTURAL_RE.search(payload, position)
+        if match is None:
+            return -1
+        index = match.start()
+        char = payload[index]
+        if char == _QUOTE:
+            position = _skip_string(payload, index)
+            if position < 0:
+                return -1
+            continue
+        position = index + 1
+        if char in _OPEN:
+            depth += 1
+        elif char in _CLOSE:
+            depth -= 1
+            if depth == 0:
+                return position
+
+
+def unwrap_response_envelope(payload: bytes) -> Optional[bytes]:
+    """在字节层面取出 {"response": {...}, ...} 中的 response 对象
+
+    顶层还有 modelVersion 等需要合并进 response 的字段、或格式不符时返回 None，由调用方退回解析
+    """
+    match = _RESPONSE_KEY_RE.match(payload)
+    if not match or payload[match.end():match.end() + 1] != b"{":
+        return None
+    end = _find_value_end(payload, match.end())
+    if end < 0:
+        return None
+    # 旧逻辑会把顶层 modelVersion 合并进 response，这种情况交给解析路径处理
+    if b'"modelVersion"' in payload[end:]:
+        return None
+    return payload[match.end():end]
+
+
+def scan_usage_metadata(payload: bytes) -> Optional[dict]:
+    """不解析整个事件，只提取 usageMetadata 中的 token 计数"""
+    index = payload.rfind(b'"usageMetadata"')
+    if index < 0:
+        return None
+    window = payload[index:index + _USAGE_SCAN_WINDOW]
+    counts = {name.decode(): int(value) for name, value in _USAGE_FIELD_RE.findall(window)}
+    return counts or None
+
+
+class GeminiStreamPassthrough:
+    """把上游 SSE 字节流转换为输出字节流，同时记录最后一次出现的 usageMetadata
+
+    unwrap=False 时（客户端接受内部格式）上游事件原样转发。
+    """
+
+    def __init__(self, unwrap: bool = True):
+        self.unwrap = unwrap
+        self.splitter = SSEFrameSplitter()
+        self.usage: Optional[dict] = None
+        self.unwrapped_frames = 0
+        self.parsed_frames = 0
+
+    @property
+    def tokens_input(self) -> int:
+        return (self.usage or {}).get("promptTokenCount", 0)
+
+    @property
+    def tokens_output(self) -> int:
+        usage = self.usage or {}
+        return usage.get("candidatesTokenCount", 0) + usage.get("thoughtsTokenCount", 0)
+
+    def feed(self, data: bytes) -> List[bytes]:
+        return [self._rewrite(frame) for frame in self.splitter.feed(data)]
+
+    def flush(self) -> List[bytes]:
+        return [self._rewrite(frame) for frame in self.splitter.flush()]
+
+    def _rewrite(self, frame: bytes) -> bytes:
+        payload = frame_data(frame)
+        if payload is None:
+            return frame + b"\n\n"
+
+        if b'"usageMetadata"' in payload:
+            self.usage = scan_usage_metadata(payload) or self.usage
+
+        if not self.unwrap:
+            return frame + b"\n\n"
+
+        if len(payload) >= _BYTE_UNWRAP_MIN_SIZE:
+            response = unwrap_response_envelope(payload)
+            if response is not None:
+                self.unwrapped_frames += 1
+                return b"data: " + response + b"\n\n"
+        return self._rewrite_parsed(frame, payload)
+
+    def _rewrite_parsed(self, frame: bytes, payload: bytes) -> bytes:
+        """小事件或字节级截取失败时：解析后取 response 并合并顶层 modelVersion（与旧逻辑一致）"""
+        self.parsed_frames += 1
+        try:
+            data = json_codec.loads(payload)
+        except (json_codec.JSONDecodeError, UnicodeDecodeError):
+            return frame + b"\n\n"
+        if not isinstance(data, dict) or "response" not in data:
+            return frame + b"\n\n"
+        standard_data = data.get("response", {})
+        if "modelVersion" in data:
+            standard_data["modelVersion"] = data["modelVersion"]
+        return json_codec.sse(standard_data).encode("utf-8")
@@ -0,0 +1,124 @@
+"""
+SSE 写合并
+
+逐 token 的流（Gemini / Anthropic）会产生大量几十字节的小 chunk，StreamingResponse
+每 yield 一次就是一次 ASGI send 和一次 socket 写。这里在生成器和 StreamingResponse
+之间加一层：
+
+- 距上次发送已超过窗口时，新到的 chunk 立即发送（首个 chunk、稀疏的流不增加延迟）
+- 否则先缓冲，最迟在“上次发送 + 窗口”时刻合并成一次发送（延迟上界 = 窗口）
+- 缓冲超过字节阈值、或遇到 data: [DONE] 时立即发送
+
+上游由单独的 task 拉取，发送阻塞时可以继续读上游；缓冲超过阈值后等待发送方取走，
+不会无限堆积。窗口按端点配置（settings.sse_coalesce_<endpoint>_ms，0=关闭）。
+"""
+import asyncio
+from typing import AsyncIterator, List, Optional, Union
+
+
+Chunk = Union[str, bytes]
+
+_DONE_MARKER = "data: [DONE]"
+_DONE_MARKER_BYTES = b"data: [DONE]"
+
+
+def _is_done(chunk: Chunk) -> bool:
+    if isinstance(chunk, str):
+        return chunk.startswith(_DONE_MARKER)
+    return chunk.startswith(_DONE_MARKER_BYTES)
+
+
+def _join(chunks: List[Chunk]) -> Chunk:
+    if len(chunks) == 1:
+        return chunks[0]
+    if all(isinstance(chunk, str) for chunk in chunks):
+        return "".join(chunks)
+    return b"".join(chunk.encode("utf-8") if isinstance(chunk, str) else chunk for chunk in chunks)
+
+
+async def coalesce_chunks(
+    source: AsyncIterator[Chunk],
+    window_ms: float,
+    max_bytes: int,
+) -> AsyncIterator[Chunk]:
+    """把 window_ms 内到达的 chunk 合并为一次输出（str 和 bytes 均可，混合时输出 bytes）"""
+    loop = asyncio.get_running_loop()
+    window = window_ms / 1000
+
+    buffer: List[Chunk] = []
+    buffered_bytes = 0
+    last_flush = float("-inf")
+    timer: Optional[asyncio.TimerHandle] = None
+    finished = False
+    error: Optional[BaseException] = None
+    ready = asyncio.Event()
+    drained = asyncio.Event()
+
+    async def pump():
+        nonlocal buffered_bytes, timer, finished, error
+        try:
+            async for chunk in source:
+                if not chunk:
+                    continue
+                buffer.append(chunk)
+                buffered_bytes += len(chunk)
+                if buffered_bytes >= max_bytes or _is_done(chunk):
+                    ready.set()
+                    # 等发送方取走缓冲再继续读上游（背压）
+                    drained.clear()
+                    await drained.wait()
+                elif timer is None and not ready.is_set():
+                    delay = last_flush + window - loop.time()
+                    if delay <= 0:
+                        ready.set()
+                    else:
+                        timer = loop.call_later(delay, ready.set)
+        except Exception as e:
+            error = e
+        finally:
+            finished = True
+            ready.set()
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    producer = asyncio.create_task(pump())
+    try:
+        while True:
+            # 上游结束后不再等待（结束信号可能已在上一轮被 clear 掉）
+            if not finished:
+                await ready.wait()
+            ready.clear()
+            if timer is not None:
+                timer.cancel()
+                timer = None
+            if buffer:
+                chunks = buffer[:]
+                buffer.clear()
+                buffered_bytes = 0
+                last_flush = loop.time()
+                drained.set()
+                yield _join(chunks)
+            elif finished:
+                break
+        if error is not None:
+            raise error
+    finally:
+        # 客户端断开等提前退出时停止读取上游
+        if not producer.done():
+            producer.cancel()
+            # 等 pump 的 finally 关闭上游后再返回；用 wait 不会抛出 producer 的 CancelledError，
+            # 本协程自身被取消时照常向上传递
+            await asyncio.wait([producer])
+        if timer is not None:
+            timer.cancel()
+
+
+def coalesce_sse(source: AsyncIterator[Chunk], endpoint: str) -> AsyncIterator[Chunk]:
+    """按端点配置包装流式生成器；窗口为 0 时原样返回"""
+    from app.config import settings
+
+    window_ms = getattr(settings, f"sse_coalesce_{endpoint}_ms", 0)
+    if window_ms <= 0:
+        return source
+    return coalesce_chunks(source, window_ms, max(1, settings.sse_coalesce_max_bytes))
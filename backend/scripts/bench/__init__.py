@@ -0,0 +1,5 @@
+"""
+性能基准脚本（不随服务加载）
+
+在 backend 目录下运行：python -m scripts.bench.<模块名>，例如 python -m scripts.bench.failover
+"""
@@ -0,0 +1,70 @@
+"""
+admission 基准：凭证都在 CD 时照样发出（几乎必然 429）vs 排队等待就绪
+
+python -m scripts.bench.admission
+"""
+import asyncio
+import random
+import time
+from typing import List, Tuple
+
+from app.services import admission as module
+
+
+def _benchmark_admission(credentials: int = 3, cd_s: float = 1.0, requests: int = 30, spread_s: float = 3.0):
+    """credentials 个凭证、每次使用后 CD cd_s 秒，requests 个请求在 spread_s 秒内到达：
+    比较“全部在 CD 时照样发出（几乎必然 429）”和排队等待就绪"""
+    module._policy = lambda: (True, 5.0, "fair")
+
+    async def select(queue: module.AdmissionQueue, ready_at: List[float], wait: bool, user_id: int) -> Tuple[bool, float]:
+        start = time.monotonic()
+        ticket = None
+        deadline = start + 5.0
+        try:
+            while True:
+                now = time.monotonic()
+                index = min(range(len(ready_at)), key=lambda i: ready_at[i])
+                if ready_at[index] <= now:
+                    ready_at[index] = now + cd_s
+                    if ticket is not None:
+                        queue.release(ticket, admitted=True)
+                    return True, now - start
+                if not wait or ready_at[index] > deadline:
+                    return False, now - start
+                if ticket is None:
+                    ticket = queue.ticket("bench", user_id)
+                else:
+                    queue.release(ticket)
+                if not await queue.wait(ticket, ready_at[index] - now, deadline):
+                    return False, time.monotonic() - start
+        finally:
+            if ticket is not None:
+                queue.release(ticket)
+
+    async def run(wait: bool):
+        rng = random.Random(3)
+        queue = module.AdmissionQueue()
+        ready_at = [0.0] * credentials
+
+        async def one(i: int):
+            await asyncio.sleep(rng.uniform(0, spread_s))
+            return await select(queue, ready_at, wait, i % 5)
+
+        results = await asyncio.gather(*(one(i) for i in range(requests)))
+        ok = sum(1 for got, _ in results if got)
+        waits = sorted(w for got, w in results if got)
+        label = "排队等待就绪" if wait else "照样发出（旧）"
+        detail = f", 等待 p50 {waits[len(waits) // 2] * 1000:.0f}ms / 最长 {waits[-1] * 1000:.0f}ms" if wait and waits else ""
+        print(f"{label}: {ok}/{requests} 个请求拿到就绪凭证, {requests - ok} 个用了 CD 中的凭证{detail}")
+        if wait:
+            print(f"等待分布: {queue.stats()['wait_histogram']}")
+
+    async def main():
+        await run(False)
+        await run(True)
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    _benchmark_admission()
@@ -0,0 +1,60 @@
+"""
+credential_health 基准：10 个凭证里有慢的、不稳定的，比较纯轮询和按健康评分二选一时的失败率与平均耗时
+
+python -m scripts.bench.credential_health
+"""
+import random
+
+from app.services import credential_health as module
+
+
+def _benchmark_health(credentials: int = 10, requests: int = 2000, seed: int = 11):
+    """模拟上游：10 个凭证里 2 个慢（TTFB 5 倍）、2 个一半请求超时，其余正常。
+    比较纯轮询（旧）和按评分 power of two choices 选凭证时的失败率与平均耗时（模拟时间，不实际等待）"""
+    output_tokens = module._EXPECTED_OUTPUT_TOKENS
+
+    class _Cred:
+        def __init__(self, cid: int):
+            self.id = cid
+
+    rng = random.Random(seed)
+    profiles = {}
+    for cid in range(1, credentials + 1):
+        if cid <= 2:
+            profiles[cid] = (2.5, 1.0, 20.0)    # 慢：TTFB 2.5s、20 tokens/s
+        elif cid <= 4:
+            profiles[cid] = (0.5, 0.5, 60.0)    # 不稳定：一半请求超时
+        else:
+            profiles[cid] = (0.5, 0.99, 60.0)   # 正常
+
+    def run(label: str, enabled: bool):
+        module._policy = lambda: (enabled, 600.0)
+        health = module.CredentialHealth()
+        creds = [_Cred(cid) for cid in profiles]
+        total_time = 0.0
+        failures = 0
+        for _ in range(requests):
+            # 模拟 CD：每次只有随机一半的凭证可用（按最久未使用排序）
+            candidates = [c for c in creds if rng.random() < 0.5] or creds
+            cred = health.choose(candidates)
+            creds.remove(cred)
+            creds.append(cred)
+            ttfb, success_rate, tps = profiles[cred.id]
+            ttfb *= rng.uniform(0.7, 1.3)
+            if rng.random() < success_rate:
+                health.record_success(cred.id, ttfb)
+                health.record_stream(cred.id, output_tokens * module._BYTES_PER_TOKEN, output_tokens / tps)
+                total_time += ttfb + output_tokens / tps
+            else:
+                # 超时：等满 30 秒
+                health.record_failure(cred.id)
+                failures += 1
+                total_time += 30.0
+        print(f"{label}: 失败 {failures}/{requests} ({failures / requests:.1%}), 平均每次尝试耗时 {total_time / requests:.2f}s")
+
+    run("按 last_used_at 轮询（旧）", False)
+    run("健康评分 + 二选一", True)
+
+
+if __name__ == "__main__":
+    _benchmark_health()
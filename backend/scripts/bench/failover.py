@@ -0,0 +1,64 @@
+"""
+failover 基准：有无预取下一个凭证时，连续 429 后换凭证成功的总耗时
+
+python -m scripts.bench.failover
+"""
+import asyncio
+import time
+from typing import Optional
+
+from app.services import retry_budget as budget_module
+from app.services.failover import CredentialSource, FailoverExecutor, Lease, UpstreamStatusError
+
+
+class SimulatedSource(CredentialSource):
+    """模拟凭证池：选凭证 + 取 token 耗时 acquire_s"""
+
+    def __init__(self, acquire_s: float):
+        super().__init__(user_id=0, user_has_public_creds=True, model="gemini-2.5-pro")
+        self.acquire_s = acquire_s
+        self._next_id = 1
+
+    async def acquire(self, claim: bool = True) -> Optional[Lease]:
+        await asyncio.sleep(self.acquire_s)
+        self._next_id += 1
+        return Lease(self._next_id, f"cred-{self._next_id}", "token")
+
+    async def claim(self, lease: Lease):
+        pass
+
+    async def report_failure(self, lease: Lease, error: BaseException) -> Optional[int]:
+        return None
+
+
+def _benchmark_failover(rounds: int = 20, acquire_ms: float = 150, fail_after_ms: float = 300, failures: int = 2):
+    """前 failures 个凭证在 fail_after_ms 后返回 429，比较有无预取时的总耗时"""
+    # 只比较预取：关掉退避，预算给足
+    budget_module._policy = lambda: (1.0, 100.0, 1000.0, 0.0, 2.0, 5.0)
+
+    async def one(prewarm: bool) -> float:
+        source = SimulatedSource(acquire_ms / 1000)
+        first = Lease(1, "cred-1", "token")
+        executor = FailoverExecutor(source, first, max_retries=3, tag="Bench", prewarm=prewarm)
+
+        async def call(lease: Lease):
+            await asyncio.sleep(fail_after_ms / 1000)
+            if lease.credential_id <= failures:
+                raise UpstreamStatusError(429, "RESOURCE_EXHAUSTED")
+            return "ok"
+
+        start = time.perf_counter()
+        await executor.run(call)
+        return (time.perf_counter() - start) * 1000
+
+    async def main():
+        for prewarm in (False, True):
+            timings = [await one(prewarm) for _ in range(rounds)]
+            label = "预取下一个凭证" if prewarm else "失败后再取凭证（旧）"
+            print(f"{label}: {failures} 次 429 后成功, 平均 {sum(timings) / len(timings):.1f}ms")
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    _benchmark_failover()
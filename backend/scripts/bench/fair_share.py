@@ -0,0 +1,61 @@
+"""
+fair_share 基准：公共池被重度用户占满时，不调度 vs 加权公平排队下各用户拿到的请求数
+
+python -m scripts.bench.fair_share
+"""
+import asyncio
+import time
+from typing import Dict
+
+from app.services import fair_share as module
+
+
+def _benchmark_fair_share(capacity: int = 8, duration_s: float = 3.0, call_s: float = 0.1):
+    """容量 capacity 的公共池：1 个重度用户并发 40 个请求不停地发，另外 4 个普通用户各 2 个并发，
+    比较不调度（谁先到谁用）和加权公平排队下各用户拿到的请求数"""
+
+    async def run(label: str, scheduled: bool):
+        module._policy = lambda: (True, capacity, 1, 4, 2.0, 10.0)
+        scheduler = module.FairShare()
+        pool = asyncio.Semaphore(capacity)
+        served: Dict[int, int] = {}
+        rejected: Dict[int, int] = {}
+        deadline = time.monotonic() + duration_s
+
+        async def worker(user_id: int, weight: float):
+            while time.monotonic() < deadline:
+                slot = None
+                if scheduled:
+                    slot = await scheduler.acquire(user_id, weight, max(1, round(4 * weight)), 10.0)
+                try:
+                    if pool.locked():
+                        # 公共凭证都被占用：相当于拿到 CD 中的凭证 / 503
+                        rejected[user_id] = rejected.get(user_id, 0) + 1
+                        await asyncio.sleep(call_s / 5)
+                        continue
+                    async with pool:
+                        await asyncio.sleep(call_s)
+                    served[user_id] = served.get(user_id, 0) + 1
+                finally:
+                    if slot is not None:
+                        slot.release()
+
+        workers = [worker(0, 1.0) for _ in range(40)]
+        # 用户 1 是贡献者（权重 2）
+        for user_id in range(1, 5):
+            workers += [worker(user_id, 2.0 if user_id == 1 else 1.0) for _ in range(2)]
+        await asyncio.gather(*workers)
+        line = ", ".join(
+            f"用户{user_id} {served.get(user_id, 0)}次/失败{rejected.get(user_id, 0)}" for user_id in range(5)
+        )
+        print(f"{label}: {line}")
+
+    async def main():
+        await run("不调度（旧）", False)
+        await run("加权公平排队", True)
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    _benchmark_fair_share()
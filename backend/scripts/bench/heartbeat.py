@@ -0,0 +1,63 @@
+"""
+heartbeat 基准：上游完成后到输出最终结果的额外延迟（sleep 轮询 vs asyncio.wait）
+
+python -m scripts.bench.heartbeat
+"""
+import asyncio
+import random
+from typing import AsyncIterator
+
+from app.services.heartbeat import heartbeats_until_done
+
+
+async def _legacy_heartbeats(task: "asyncio.Future", interval: float) -> AsyncIterator[None]:
+    """旧写法：sleep 轮询 task.done()"""
+    while not task.done():
+        await asyncio.sleep(interval)
+        if not task.done():
+            yield
+
+
+async def _fake_stream(heartbeats, upstream_seconds: float, interval: float):
+    """假上游：upstream_seconds 后返回；返回 (上游完成到输出结果的延迟, 心跳次数)"""
+    loop = asyncio.get_running_loop()
+    finished_at = []
+
+    async def upstream():
+        await asyncio.sleep(upstream_seconds)
+        finished_at.append(loop.time())
+        return {"response": {"candidates": []}}
+
+    task = asyncio.create_task(upstream())
+    beats = 0
+    async for _ in heartbeats(task, interval):
+        beats += 1
+    await task
+    return loop.time() - finished_at[0], beats
+
+
+async def _run_streams(heartbeats, streams: int, interval: float):
+    rng = random.Random(11)
+    durations = [rng.uniform(0.05, 5 * interval) for _ in range(streams)]
+    results = await asyncio.gather(*(_fake_stream(heartbeats, d, interval) for d in durations))
+    delays = sorted(delay for delay, _ in results)
+    return {
+        "mean_ms": sum(delays) / len(delays) * 1000,
+        "p99_ms": delays[int(len(delays) * 0.99) - 1] * 1000,
+        "max_ms": delays[-1] * 1000,
+        "heartbeats": sum(beats for _, beats in results),
+    }
+
+
+def _benchmark_heartbeat(streams: int = 200, interval: float = 0.5):
+    """上游完成后到输出最终结果的额外延迟（心跳间隔按比例缩短以便快速运行）"""
+    for name, heartbeats in (("sleep 轮询", _legacy_heartbeats), ("asyncio.wait", heartbeats_until_done)):
+        result = asyncio.run(_run_streams(heartbeats, streams, interval))
+        print(
+            f"{name}: interval={interval}s, {streams} streams, 额外延迟 mean={result['mean_ms']:.1f}ms "
+            f"p99={result['p99_ms']:.1f}ms max={result['max_ms']:.1f}ms, 心跳 {result['heartbeats']} 次"
+        )
+
+
+if __name__ == "__main__":
+    _benchmark_heartbeat()
@@ -0,0 +1,51 @@
+"""
+hedging 基准：模拟 5% 请求卡住 3 秒的尾延迟，比较开启对冲前后的延迟分位数
+
+python -m scripts.bench.hedging
+"""
+import asyncio
+import random
+import time
+
+from app.services import hedging as module
+from app.services.failover import FailoverExecutor, Lease
+from scripts.bench.failover import SimulatedSource
+
+
+def _benchmark_hedging(requests: int = 400, tail_ratio: float = 0.05, seed: int = 7):
+    """模拟尾延迟：95% 的请求 50-150ms，5% 卡住 3 秒；比较开启对冲前后的延迟分位数"""
+    # 基准测试里把时间尺度缩小：最小对冲延迟 100ms，样本不足时 300ms
+    module._policy = lambda: (True, 95.0, 0.1, 0.3, 0.1, 2.0)
+
+    async def one(hedge: bool, rng: random.Random, user_id: int, arrival: float) -> float:
+        await asyncio.sleep(arrival)
+        source = SimulatedSource(0.02)
+        source.user_id = user_id
+        executor = FailoverExecutor(source, Lease(1, "cred-1", "token"), max_retries=3,
+                                    tag="Bench", prewarm=True, hedge=hedge)
+
+        async def call(lease: Lease):
+            stuck = rng.random() < tail_ratio
+            await asyncio.sleep(3.0 if stuck else rng.uniform(0.05, 0.15))
+            return "ok"
+
+        start = time.perf_counter()
+        await executor.run(call)
+        return (time.perf_counter() - start) * 1000
+
+    async def main():
+        for hedge in (False, True):
+            rng = random.Random(seed)
+            # 20 个用户，每 5ms 到达一个请求
+            timings = sorted(await asyncio.gather(*(one(hedge, rng, i % 20, i * 0.005) for i in range(requests))))
+            p50, p95, p99 = (timings[int(len(timings) * q) - 1] for q in (0.5, 0.95, 0.99))
+            label = "开启对冲" if hedge else "不对冲"
+            print(f"{label}: p50 {p50:.0f}ms, p95 {p95:.0f}ms, p99 {p99:.0f}ms, 最长 {timings[-1]:.0f}ms")
+        stats = module.hedging.stats()
+        print(f"对冲率 {stats['hedge_rate']:.1%}, 对冲胜出率 {stats['win_rate']:.1%}, 预算拒绝 {stats['budget_denied']} 次")
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    _benchmark_hedging()
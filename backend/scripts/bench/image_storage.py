@@ -0,0 +1,75 @@
+"""
+image_storage 基准：保存生成图片时事件循环的最长停顿（同步解码写盘 vs 内容哈希 + 线程池）
+
+python -m scripts.bench.image_storage
+"""
+import asyncio
+import base64
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from app.services.image_storage import ImageStorage
+
+
+def _legacy_save(base64_data: str, filename: str):
+    """旧写法：在事件循环上同步解码并写盘"""
+    image_data = base64.b64decode(base64_data)
+    with open(ImageStorage.STORAGE_DIR / filename, "wb") as f:
+        f.write(image_data)
+
+
+async def _measure_stall(save, images):
+    """生成图片的同时，另一个协程每 1ms 唤醒一次，统计事件循环最长停顿"""
+    loop = asyncio.get_running_loop()
+    stalls = []
+    running = True
+
+    async def ticker():
+        last = loop.time()
+        while running:
+            await asyncio.sleep(0.001)
+            now = loop.time()
+            stalls.append(now - last - 0.001)
+            last = now
+
+    tick_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    for i, data in enumerate(images):
+        await save(i, data)
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    running = False
+    await tick_task
+    stalls.sort()
+    return elapsed, stalls[-1], stalls[int(len(stalls) * 0.99) - 1]
+
+
+async def _legacy_save_async(i: int, data: str):
+    _legacy_save(data, f"legacy_{i}.png")
+
+
+def _benchmark_image_store(count: int = 20, size_mb: float = 2.0):
+    images = [base64.b64encode(os.urandom(int(size_mb * 1024 * 1024))).decode("ascii") for _ in range(count)]
+    with tempfile.TemporaryDirectory() as tmp:
+        ImageStorage.STORAGE_DIR = Path(tmp)
+        ImageStorage.init_storage()
+        for name, save in (
+            ("同步解码写盘（旧）", _legacy_save_async),
+            ("内容哈希 + 线程池", lambda i, data: ImageStorage.save_base64_image_async(data)),
+        ):
+            elapsed, max_stall, p99 = asyncio.run(_measure_stall(save, images))
+            print(
+                f"{name}: {count} 张 {size_mb}MB 图片, 总耗时 {elapsed * 1000:.1f}ms, "
+                f"最长停顿 {max_stall * 1000:.1f}ms, p99 停顿 {p99 * 1000:.1f}ms"
+            )
+        # 重复图片只存一份
+        before = ImageStorage.stats()["files"]
+        asyncio.run(_measure_stall(lambda i, data: ImageStorage.save_base64_image_async(data), images))
+        print(f"重复保存后文件数: {before} -> {ImageStorage.stats()['files']}")
+
+
+if __name__ == "__main__":
+    _benchmark_image_store()
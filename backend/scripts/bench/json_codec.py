@@ -0,0 +1,123 @@
+"""
+json_codec 基准：各流式转换器每秒可处理的 chunk 数
+
+python -m scripts.bench.json_codec
+"""
+import json
+import time
+from typing import Any, Dict, List
+
+from app.services.json_codec import BACKEND, ChunkTemplate, loads
+
+
+def _sample_gemini_lines(count: int = 2000) -> List[str]:
+    """构造上游 streamGenerateContent 的 SSE data 行（内部 API 的 response 包装格式）"""
+    lines = []
+    for i in range(count):
+        part = {"text": f"第 {i} 段输出，包含一些 token 和 punctuation. " * 3}
+        if i % 5 == 0:
+            part = {"text": f"thinking about step {i}", "thought": True}
+        lines.append(json.dumps({
+            "response": {
+                "candidates": [{"content": {"role": "model", "parts": [part]}, "index": 0}],
+                "modelVersion": "gemini-2.5-pro",
+            },
+            "traceId": f"trace-{i}",
+        }, ensure_ascii=False))
+    return lines
+
+
+def _sample_anthropic_lines(count: int = 2000) -> List[str]:
+    """构造 Anthropic Messages API 的 SSE data 行"""
+    return [
+        json.dumps({
+            "type": "content_block_delta",
+            "index": 0,
+            "delta": {"type": "text_delta", "text": f"第 {i} 段输出，包含一些 token. " * 3},
+        }, ensure_ascii=False)
+        for i in range(count)
+    ]
+
+
+def _benchmark_converters(count: int = 2000, rounds: int = 15):
+    """各流式转换器每秒可处理的 chunk 数（依赖缺失的转换器会跳过）"""
+    gemini_lines = _sample_gemini_lines(count)
+    anthropic_lines = _sample_anthropic_lines(count)
+    converters = []
+
+    # 对照：旧写法每个 chunk 重建完整 dict 并用 json.dumps 序列化，新写法只编码 delta
+    delta_lines = [loads(line)["response"]["candidates"][0]["content"]["parts"][0] for line in gemini_lines]
+    envelope_template = ChunkTemplate("chatcmpl-catiecli", "gemini-2.5-pro")
+
+    def legacy_envelope(part: Dict[str, Any]) -> str:
+        chunk = {
+            "id": "chatcmpl-catiecli",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gemini-2.5-pro",
+            "choices": [{"index": 0, "delta": {"content": part["text"]}, "finish_reason": None}],
+        }
+        return f"data: {json.dumps(chunk)}\n\n"
+    converters.append(("envelope: dict + json.dumps", legacy_envelope, delta_lines))
+    converters.append((
+        "envelope: ChunkTemplate.delta",
+        lambda part: envelope_template.delta({"content": part["text"]}),
+        delta_lines,
+    ))
+
+    try:
+        from app.services.gemini_client import GeminiClient
+        gemini = GeminiClient("", "")
+        gemini_template = ChunkTemplate("chatcmpl-catiecli", "gemini-2.5-pro")
+        converters.append((
+            "GeminiClient._convert_to_openai_stream",
+            lambda line: gemini._convert_to_openai_stream(line, "gemini-2.5-pro", gemini_template),
+            gemini_lines,
+        ))
+    except ImportError as e:
+        print(f"[skip] GeminiClient: {e}")
+
+    try:
+        from app.services.antigravity_client import AntigravityClient
+        antigravity = AntigravityClient("", "")
+        antigravity_template = ChunkTemplate("chatcmpl-antigravity", "gemini-2.5-pro")
+        converters.append((
+            "AntigravityClient._convert_to_openai_stream",
+            lambda line: antigravity._convert_to_openai_stream(line, "gemini-2.5-pro", template=antigravity_template),
+            gemini_lines,
+        ))
+    except ImportError as e:
+        print(f"[skip] AntigravityClient: {e}")
+
+    from app.services.openai2gemini_full import convert_gemini_to_openai_stream
+    converters.append((
+        "convert_gemini_to_openai_stream",
+        lambda line: convert_gemini_to_openai_stream(line, "gemini-2.5-pro", "chatcmpl-bench"),
+        gemini_lines,
+    ))
+
+    try:
+        from app.routers.anthropic_proxy import convert_anthropic_stream_to_openai
+        anthropic_template = ChunkTemplate("chatcmpl-bench", "claude-sonnet-4-5", created=None)
+        converters.append((
+            "anthropic_proxy.convert_anthropic_stream_to_openai",
+            lambda line: convert_anthropic_stream_to_openai(loads(line), anthropic_template),
+            anthropic_lines,
+        ))
+    except ImportError as e:
+        print(f"[skip] anthropic_proxy: {e}")
+
+    print(f"backend: {BACKEND}")
+    for name, convert, lines in converters:
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for line in lines:
+                convert(line)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name}: {len(lines) / best:,.0f} chunks/s")
+
+
+if __name__ == "__main__":
+    _benchmark_converters()
@@ -0,0 +1,164 @@
+"""
+openai2gemini_full 基准：工具声明缓存、长对话前缀转换缓存
+
+python -m scripts.bench.openai2gemini_full
+"""
+import asyncio
+import copy
+import json
+import time
+from typing import Any, Dict, List
+
+from app.services.conversion_cache import openai_request_cache
+from app.services.openai2gemini_full import (
+    _build_function_declaration,
+    _tool_declaration_cache,
+    convert_openai_to_gemini_request,
+    convert_openai_tools_to_gemini,
+    get_tool_cache_stats,
+)
+
+
+def _sample_mcp_tools(count: int = 50) -> List[Dict[str, Any]]:
+    """构造与 MCP server 导出工具结构相近的 tools 数组（$defs 引用、anyOf、嵌套对象、中文名）"""
+    tools = []
+    for i in range(count):
+        tools.append({
+            "type": "function",
+            "function": {
+                "name": f"mcp__server{i % 5}__工具_{i}" if i % 7 == 0 else f"mcp__server{i % 5}__tool_{i}",
+                "description": f"MCP tool #{i}: reads, searches and edits resources on server {i % 5}.",
+                "parameters": {
+                    "$schema": "http://json-schema.org/draft-07/schema#",
+                    "type": "object",
+                    "additionalProperties": False,
+                    "$defs": {
+                        "Range": {
+                            "type": "object",
+                            "properties": {
+                                "start": {"type": "integer", "minimum": 0},
+                                "end": {"type": ["integer", "null"], "exclusiveMinimum": 0},
+                            },
+                            "required": ["start"],
+                        },
+                    },
+                    "properties": {
+                        "path": {"type": "string", "format": "uri", "description": "Absolute path"},
+                        "mode": {"type": "string", "enum": ["read", "write", "append"], "default": "read"},
+                        "range": {"$ref": "#/$defs/Range"},
+                        "filters": {
+                            "type": "array",
+                            "items": {
+                                "anyOf": [
+                                    {"type": "string", "minLength": 1},
+                                    {"type": "object", "properties": {"glob": {"type": "string"}}},
+                                ]
+                            },
+                            "maxItems": 32,
+                        },
+                        "options": {
+                            "type": "object",
+                            "properties": {
+                                "recursive": {"type": "boolean", "default": False},
+                                "depth": {"type": "integer", "maximum": 16},
+                                "encoding": {"type": "string", "pattern": "^[a-z0-9-]+$"},
+                            },
+                        },
+                    },
+                    "required": ["path"],
+                },
+            },
+        })
+    return tools
+
+
+def _benchmark_tool_conversion(turns: int = 200, tool_count: int = 50):
+    """对比同一个 tools 数组重复转换时，缓存前后的耗时"""
+    tools = _sample_mcp_tools(tool_count)
+    for model in ("gemini-2.5-pro", "claude-sonnet-4-5"):
+        is_claude = "claude" in model
+
+        # 每轮都是从请求体重新解析出的新对象（预先构造，不计入耗时）
+        payloads = [copy.deepcopy(tools) for _ in range(turns)]
+        start = time.perf_counter()
+        for payload in payloads:
+            for tool in payload:
+                _build_function_declaration(tool["function"], is_claude)
+        uncached = (time.perf_counter() - start) / turns * 1000
+
+        _tool_declaration_cache.clear()
+        payloads = [copy.deepcopy(tools) for _ in range(turns)]
+        start = time.perf_counter()
+        for payload in payloads:
+            convert_openai_tools_to_gemini(payload, model)
+        cached = (time.perf_counter() - start) / turns * 1000
+
+        print(
+            f"[{model}] {tool_count} tools x {turns} turns: "
+            f"uncached {uncached:.3f} ms/turn, cached {cached:.3f} ms/turn, "
+            f"stats {get_tool_cache_stats()}"
+        )
+
+
+def _sample_conversation(length: int) -> List[Dict[str, Any]]:
+    """构造一段带工具调用的长对话（user / assistant tool_calls / tool / assistant 循环）"""
+    messages: List[Dict[str, Any]] = [{"role": "system", "content": "You are a coding assistant."}]
+    i = 0
+    while len(messages) < length:
+        call_id = f"call_{i}"
+        messages.extend([
+            {"role": "user", "content": f"Step {i}: please inspect file_{i}.py and explain it. " * 4},
+            {
+                "role": "assistant",
+                "content": "",
+                "tool_calls": [{
+                    "id": call_id,
+                    "type": "function",
+                    "function": {"name": "mcp_tool_0", "arguments": json.dumps({"path": f"/repo/file_{i}.py", "limit": "50"})},
+                }],
+            },
+            {"role": "tool", "tool_call_id": call_id, "content": json.dumps({"lines": [f"line {n}" for n in range(40)]})},
+            {"role": "assistant", "content": f"file_{i}.py defines a helper used by the request pipeline. " * 6},
+        ])
+        i += 1
+    return messages[:length]
+
+
+def _benchmark_conversation_conversion(max_length: int = 200, checkpoints=(50, 100, 200)):
+    """模拟一段不断增长的对话，每轮多 2 条消息，对比每轮请求转换耗时"""
+    tools = _sample_mcp_tools(10)
+    conversation = _sample_conversation(max_length)
+    # 每轮都是客户端重发的完整历史（预先构造，不计入耗时）
+    lengths = list(range(2, max_length + 1, 2))
+    requests = [
+        {"model": "gemini-2.5-pro", "messages": copy.deepcopy(conversation[:n]), "tools": tools}
+        for n in lengths
+    ]
+
+    async def run(use_cache: bool) -> Dict[int, float]:
+        timings = {}
+        openai_request_cache.clear()
+        for n, request in zip(lengths, requests):
+            if not use_cache:
+                openai_request_cache.clear()
+            start = time.perf_counter()
+            await convert_openai_to_gemini_request(dict(request))
+            timings[n] = (time.perf_counter() - start) * 1000
+        return timings
+
+    uncached = asyncio.run(run(False))
+    cached = asyncio.run(run(True))
+    for n in checkpoints:
+        window = [m for m in lengths if n - 10 < m <= n]
+        avg_uncached = sum(uncached[m] for m in window) / len(window)
+        avg_cached = sum(cached[m] for m in window) / len(window)
+        print(
+            f"[conversation] {n} messages: uncached {avg_uncached:.3f} ms/turn, "
+            f"cached {avg_cached:.3f} ms/turn"
+        )
+    print(f"[conversation] stats {openai_request_cache.stats()}")
+
+
+if __name__ == "__main__":
+    _benchmark_tool_conversion()
+    _benchmark_conversation_conversion()
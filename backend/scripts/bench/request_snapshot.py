@@ -0,0 +1,54 @@
+"""
+request_snapshot 基准：记录请求体快照的开销（json.dumps 截断 vs bounded_json / 延迟快照）
+
+python -m scripts.bench.request_snapshot
+"""
+import base64
+import json
+import os
+import time
+
+from app.services.request_snapshot import RequestSnapshot, bounded_json
+
+
+def _sample_body(images: int = 4, image_kb: int = 1024, turns: int = 200) -> dict:
+    messages = [{"role": "system", "content": "You are a helpful assistant. " * 20}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"第 {i} 轮问题，附带一些上下文。" * 10})
+        messages.append({"role": "assistant", "content": f"第 {i} 轮回答。" * 30})
+    image = base64.b64encode(os.urandom(image_kb * 1024)).decode("ascii")
+    messages.append({
+        "role": "user",
+        "content": [{"type": "text", "text": "描述这些图片"}] + [
+            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image}"}}
+            for _ in range(images)
+        ],
+    })
+    return {"model": "gemini-2.5-pro", "stream": True, "messages": messages}
+
+
+def _benchmark_snapshot(rounds: int = 20):
+    cases = [
+        ("纯文本 400 条历史", _sample_body(images=0)),
+        ("400 条历史 + 4 张 1MB 图片", _sample_body()),
+    ]
+    for label, body in cases:
+        timings = {}
+        for name, make in (
+            ("json.dumps()[:2000]", lambda: json.dumps(body, ensure_ascii=False)[:2000]),
+            ("bounded_json", lambda: bounded_json(body)),
+            ("RequestSnapshot（成功请求，不读取）", lambda: RequestSnapshot(body)),
+        ):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                make()
+            timings[name] = (time.perf_counter() - start) / rounds * 1000
+        print(f"== {label} ==")
+        for name, ms in timings.items():
+            print(f"{name}: {ms:.3f}ms")
+    old = json.dumps(cases[0][1], ensure_ascii=False)[:2000]
+    print("纯文本时输出与旧格式一致:", bounded_json(cases[0][1]) == old)
+
+
+if __name__ == "__main__":
+    _benchmark_snapshot()
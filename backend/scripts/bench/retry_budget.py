@@ -0,0 +1,58 @@
+"""
+retry_budget 基准：模拟模型级 429，比较立即重试和全局预算 + 退避下的上游调用数与成功率
+
+python -m scripts.bench.retry_budget
+"""
+import asyncio
+import time
+from typing import Tuple
+
+from app.services import failover as failover_module, retry_budget as module
+from app.services.failover import FailoverError, FailoverExecutor, Lease, UpstreamStatusError
+from scripts.bench.failover import SimulatedSource
+
+
+def _benchmark_retry_storm(requests: int = 300, interval_ms: float = 10, outage: Tuple[float, float] = (1.0, 2.5)):
+    """模拟模型级 429：outage 时间段内所有上游调用都返回 429（带 retryDelay 1s），
+    比较旧的“立即重试 3 次”和全局预算 + 退避下的上游调用数与成功率"""
+    default_policy = module._policy
+
+    async def run(label: str, policy: Tuple[float, float, float, float, float, float]):
+        module._policy = lambda: policy
+        failover_module.retry_budget = module.retry_budget = module.RetryBudget()
+        calls = {"total": 0, "during_outage": 0}
+        start = time.perf_counter()
+
+        async def one(index: int) -> bool:
+            await asyncio.sleep(index * interval_ms / 1000)
+            source = SimulatedSource(0.005)
+            executor = FailoverExecutor(source, Lease(1, "cred-1", "token"), max_retries=3,
+                                        tag="Bench", prewarm=False, hedge=False)
+
+            async def call(lease: Lease):
+                await asyncio.sleep(0.05)
+                calls["total"] += 1
+                if outage[0] <= time.perf_counter() - start < outage[1]:
+                    calls["during_outage"] += 1
+                    raise UpstreamStatusError(429, '{"error": {"status": "RESOURCE_EXHAUSTED", "retryDelay": "1s"}}')
+                return "ok"
+
+            try:
+                await executor.run(call)
+                return True
+            except FailoverError:
+                return False
+
+        results = await asyncio.gather(*(one(i) for i in range(requests)))
+        print(f"{label}: 上游调用 {calls['total']} 次（限流期间 {calls['during_outage']} 次），"
+              f"成功 {sum(results)}/{requests}，拒绝重试 {module.retry_budget.denied} 次", flush=True)
+
+    async def main():
+        await run("立即重试（旧）", (1.0, 1000.0, 1e9, 0.0, 0.0, 0.0))
+        await run("全局预算 + 退避", default_policy())
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    _benchmark_retry_storm()
@@ -0,0 +1,88 @@
+"""
+sse_passthrough 基准：旧的逐行解析 + 重新序列化 vs 字节级解包的吞吐
+
+python -m scripts.bench.sse_passthrough
+"""
+import base64
+import codecs
+import json
+import time
+
+from app.services.sse_passthrough import GeminiStreamPassthrough
+
+
+def _sample_upstream_stream(events: int = 500, image_every: int = 100) -> bytes:
+    """构造上游 SSE 字节流：普通文本事件，穿插少量大体积 inlineData 事件，最后带 usageMetadata"""
+    image = base64.b64encode(bytes(range(256)) * 4096).decode()  # 约 1.4MB
+    chunks = []
+    for i in range(events):
+        part = {"text": f"第 {i} 段输出 with some {{braces}} and \"quotes\". " * 4}
+        if image_every and i and i % image_every == 0:
+            part = {"inlineData": {"mimeType": "image/png", "data": image}}
+        response = {"candidates": [{"content": {"role": "model", "parts": [part]}, "index": 0}]}
+        if i == events - 1:
+            response["usageMetadata"] = {
+                "promptTokenCount": 1200,
+                "candidatesTokenCount": 3400,
+                "thoughtsTokenCount": 560,
+                "promptTokensDetails": [{"modality": "TEXT", "tokenCount": 1200}],
+            }
+        chunks.append("data: " + json.dumps({"response": response, "traceId": f"t{i}"}, ensure_ascii=False) + "\r\n\r\n")
+    return "".join(chunks).encode("utf-8")
+
+
+def _legacy_rewrite(stream: bytes, read_size: int) -> int:
+    """旧逻辑：aiter_lines 式的增量解码 + 按行切分，json.loads 解析后重新 json.dumps，输出再编码为字节"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    total = 0
+    for offset in range(0, len(stream), read_size):
+        text = pending + decoder.decode(stream[offset:offset + read_size])
+        lines = text.splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith(("\n", "\r")) else ""
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if line and line.startswith("data: "):
+                data = json.loads(line[6:])
+                standard_data = data.get("response", {})
+                total += len(f"data: {json.dumps(standard_data)}\n\n".encode("utf-8"))
+    return total
+
+
+def _benchmark_passthrough(read_size: int = 65536, rounds: int = 5):
+    for image_every in (0, 100):
+        stream = _sample_upstream_stream(image_every=image_every)
+        label = "text only" if not image_every else "with 1.4MB images"
+        size_mb = len(stream) / 1024 / 1024
+
+        def run_passthrough(unwrap: bool) -> GeminiStreamPassthrough:
+            passthrough = GeminiStreamPassthrough(unwrap=unwrap)
+            for offset in range(0, len(stream), read_size):
+                passthrough.feed(stream[offset:offset + read_size])
+            passthrough.flush()
+            return passthrough
+
+        results = {}
+        for name, run in (
+            ("legacy parse + dumps", lambda: _legacy_rewrite(stream, read_size)),
+            ("byte-level unwrap", lambda: run_passthrough(True)),
+            ("internal passthrough", lambda: run_passthrough(False)),
+        ):
+            best = None
+            for _ in range(rounds):
+                start = time.perf_counter()
+                result = run()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = result
+            print(f"[{label}, {size_mb:.1f}MB] {name}: {size_mb / best:,.1f} MB/s")
+
+        passthrough = results["byte-level unwrap"]
+        print(
+            f"[{label}] usage tokens in/out: {passthrough.tokens_input}/{passthrough.tokens_output}, "
+            f"byte-level/parsed frames: {passthrough.unwrapped_frames}/{passthrough.parsed_frames}"
+        )
+
+
+if __name__ == "__main__":
+    _benchmark_passthrough()
@@ -0,0 +1,96 @@
+"""
+sse_writer 基准：每 1k token 的 send 次数、CPU 时间和合并带来的额外延迟
+
+python -m scripts.bench.sse_writer
+"""
+import asyncio
+import random
+import socket
+import threading
+import time
+from typing import List
+
+from app.services.json_codec import ChunkTemplate
+from app.services.sse_writer import coalesce_chunks
+
+
+async def _token_stream(tokens: int, burst_interval_ms: float, seed: int = 7):
+    """模拟上游逐 token 输出：每隔 burst_interval_ms 到达 1~4 个 chunk（同一次网络读取）"""
+    rng = random.Random(seed)
+    template = ChunkTemplate("chatcmpl-bench", "gemini-2.5-flash")
+    sent = 0
+    while sent < tokens:
+        for _ in range(min(rng.randint(1, 4), tokens - sent)):
+            yield template.delta({"content": f" token{sent}"}), time.perf_counter()
+            sent += 1
+        if burst_interval_ms:
+            await asyncio.sleep(burst_interval_ms / 1000)
+        else:
+            await asyncio.sleep(0)
+    yield "data: [DONE]\n\n", time.perf_counter()
+
+
+async def _run_stream(tokens: int, burst_interval_ms: float, window_ms: float, max_bytes: int = 16384):
+    """模拟 StreamingResponse + uvicorn：每次输出 = 一次 chunked 编码 + 一次 socket send"""
+    writer, reader = socket.socketpair()
+    writer.setblocking(False)
+
+    def drain():
+        while reader.recv(1 << 16):
+            pass
+
+    drain_thread = threading.Thread(target=drain, daemon=True)
+    drain_thread.start()
+
+    loop = asyncio.get_running_loop()
+    pending: List[float] = []
+    latencies: List[float] = []
+
+    async def chunks():
+        async for chunk, produced_at in _token_stream(tokens, burst_interval_ms):
+            pending.append(produced_at)
+            yield chunk
+
+    stream = chunks() if window_ms <= 0 else coalesce_chunks(chunks(), window_ms, max_bytes)
+    sends = 0
+    cpu_start = time.thread_time()
+    async for chunk in stream:
+        body = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+        await loop.sock_sendall(writer, b"%x\r\n%s\r\n" % (len(body), body))
+        sends += 1
+        now = time.perf_counter()
+        latencies.extend(now - produced_at for produced_at in pending)
+        pending.clear()
+    cpu = time.thread_time() - cpu_start
+
+    writer.close()
+    drain_thread.join()
+    reader.close()
+    latencies.sort()
+    return {
+        "sends": sends,
+        "cpu_ms": cpu * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def _benchmark_coalescing(tokens: int = 1000):
+    """每 1k token 的 send 次数（≈ write 系统调用数）、CPU 时间和额外延迟"""
+    scenarios = [
+        ("逐 token（每 5ms 到达 1~4 个）", 5),
+        ("上游突发（无间隔）", 0),
+    ]
+    for label, interval in scenarios:
+        print(f"== {label}, {tokens} tokens ==")
+        for window_ms in (0, 10, 20):
+            result = asyncio.run(_run_stream(tokens, interval, window_ms))
+            name = "直接发送" if window_ms == 0 else f"合并窗口 {window_ms}ms"
+            print(
+                f"{name}: sends={result['sends']}, cpu={result['cpu_ms']:.1f}ms, "
+                f"延迟 p50={result['p50_ms']:.2f}ms max={result['max_ms']:.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    _benchmark_coalescing()
@@ -166,7 +166,8 @@ export function QuotaModal({ isOpen, onClose, onSubmit, title, defaultValues = {
   const [values, setValues] = useState({
     quota_flash: defaultValues.quota_flash || 0,
     quota_25pro: defaultValues.quota_25pro || 0,
-    quota_30pro: defaultValues.quota_30pro || 0
+    quota_30pro: defaultValues.quota_30pro || 0,
+    share_weight: defaultValues.share_weight || 0
   })
 
   useEffect(() => {
@@ -174,7 +175,8 @@ export function QuotaModal({ isOpen, onClose, onSubmit, title, defaultValues = {
       setValues({
         quota_flash: defaultValues.quota_flash || 0,
         quota_25pro: defaultValues.quota_25pro || 0,
-        quota_30pro: defaultValues.quota_30pro || 0
+        quota_30pro: defaultValues.quota_30pro || 0,
+        share_weight: defaultValues.share_weight || 0
       })
     }
   }, [isOpen, defaultValues])
@@ -225,6 +227,17 @@ export function QuotaModal({ isOpen, onClose, onSubmit, title, defaultValues = {
               </div>
             </div>
           </div>
+          <div>
+            <label className="block text-gray-400 text-sm mb-1">共享池调度权重（0=自动，贡献者高于普通用户）</label>
+            <input
+              type="number"
+              min="0"
+              step="0.5"
+              value={values.share_weight}
+              onChange={(e) => setValues({ ...values, share_weight: parseFloat(e.target.value) || 0 })}
+              className="w-full px-3 py-2 bg-dark-900 border border-dark-600 rounded-lg text-white text-sm focus:border-purple-500 focus:outline-none"
+            />
+          </div>
           <div className="border-t border-dark-600 pt-4">
             <div className="flex justify-between items-center">
               <span className="text-gray-400 text-sm">总配额（自动计算）</span>
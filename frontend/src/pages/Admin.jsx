@@ -202,7 +202,11 @@ export default function Admin() {
   useEffect(() => {
     if (tab !== "credentials") return;
     const hasCD = credentials.some(
-      (c) => c.cd_flash > 0 || c.cd_pro > 0 || c.cd_30 > 0,
+      (c) =>
+        c.cd_flash > 0 ||
+        c.cd_pro > 0 ||
+        c.cd_30 > 0 ||
+        Object.keys(c.model_cooldowns || {}).length > 0,
     );
     if (!hasCD) return;
 
@@ -213,6 +217,11 @@ export default function Admin() {
           cd_flash: Math.max(0, (c.cd_flash || 0) - 1),
           cd_pro: Math.max(0, (c.cd_pro || 0) - 1),
           cd_30: Math.max(0, (c.cd_30 || 0) - 1),
+          model_cooldowns: Object.fromEntries(
+            Object.entries(c.model_cooldowns || {})
+              .map(([model, left]) => [model, left - 1])
+              .filter(([, left]) => left > 0),
+          ),
         })),
       );
     }, 1000);
@@ -220,6 +229,32 @@ export default function Admin() {
     return () => clearInterval(timer);
   }, [tab, credentials.length]);
 
+  // 进行中的上游调用数（凭证 / 项目）实时刷新
+  useEffect(() => {
+    if (tab !== "credentials") return;
+
+    const timer = setInterval(async () => {
+      try {
+        const res = await api.get("/api/admin/credentials/inflight");
+        const byCredential = res.data.credentials || {};
+        const byProject = res.data.projects || {};
+        setCredentials((prev) =>
+          prev.map((c) => ({
+            ...c,
+            in_flight: {
+              credential: byCredential[c.id] || 0,
+              project: byProject[c.project_id] || 0,
+            },
+          })),
+        );
+      } catch (err) {
+        console.error("获取进行中调用数失败", err);
+      }
+    }, 3000);
+
+    return () => clearInterval(timer);
+  }, [tab]);
+
   // 用户操作
   const toggleUserActive = async (userId, isActive) => {
     try {
@@ -239,6 +274,7 @@ export default function Admin() {
         quota_flash: user.quota_flash || 0,
         quota_25pro: user.quota_25pro || 0,
         quota_30pro: user.quota_30pro || 0,
+        share_weight: user.share_weight || 0,
       },
     });
   };
@@ -403,6 +439,21 @@ export default function Admin() {
               "success",
             );
           }
+        } else if (
+          res.data.status === "failed" ||
+          res.data.status === "cancelled"
+        ) {
+          fetchData();
+          if (type === "verify") {
+            setVerifyingAll(false);
+          } else {
+            setStartingAll(false);
+          }
+          showAlert(
+            res.data.status === "failed" ? "任务失败" : "任务已取消",
+            res.data.error || `已处理: ${res.data.processed}/${res.data.total}`,
+            "error",
+          );
         } else {
           // 继续轮询
           setTimeout(poll, 2000);
@@ -1421,7 +1472,9 @@ export default function Admin() {
                                 {/* CD 状态 */}
                                 {(c.cd_flash > 0 ||
                                   c.cd_pro > 0 ||
-                                  c.cd_30 > 0) && (
+                                  c.cd_30 > 0 ||
+                                  Object.keys(c.model_cooldowns || {}).length >
+                                    0) && (
                                   <div className="flex gap-1 flex-wrap">
                                     {c.cd_flash > 0 && (
                                       <span className="text-xs px-1 bg-cyan-500/20 text-cyan-400 rounded">
@@ -1438,8 +1491,63 @@ export default function Admin() {
                                         3:{c.cd_30}s
                                       </span>
                                     )}
+                                    {Object.entries(c.model_cooldowns || {}).map(
+                                      ([model, left]) => (
+                                        <span
+                                          key={model}
+                                          className="text-xs px-1 bg-red-500/20 text-red-400 rounded"
+                                          title={`${model} 429 冷却`}
+                                        >
+                                          {model}:{left}s
+                                        </span>
+                                      ),
+                                    )}
                                   </div>
                                 )}
+                                {/* 进行中的上游调用数（达到并发上限时标红） */}
+                                {(c.in_flight?.credential > 0 ||
+                                  c.in_flight?.project > 0) && (
+                                  <span
+                                    className={`text-xs px-1 rounded w-fit ${
+                                      c.max_concurrency > 0 &&
+                                      Math.max(
+                                        c.in_flight.credential,
+                                        c.in_flight.project,
+                                      ) >= c.max_concurrency
+                                        ? "bg-red-500/20 text-red-400"
+                                        : "bg-blue-500/20 text-blue-400"
+                                    }`}
+                                    title={`进行中: 凭证 ${c.in_flight.credential}，项目 ${c.in_flight.project}${
+                                      c.max_concurrency > 0
+                                        ? `，上限 ${c.max_concurrency}`
+                                        : ""
+                                    }`}
+                                  >
+                                    ⚡ {c.in_flight.credential}
+                                    {c.max_concurrency > 0 &&
+                                      `/${c.max_concurrency}`}
+                                  </span>
+                                )}
+                                {/* 健康评分（成功率 / 首字节耗时 EWMA） */}
+                                {c.health && (
+                                  <span
+                                    className={`text-xs px-1 rounded w-fit ${
+                                      c.health.success_rate >= 0.9
+                                        ? "bg-green-500/20 text-green-400"
+                                        : c.health.success_rate >= 0.7
+                                          ? "bg-yellow-500/20 text-yellow-400"
+                                          : "bg-red-500/20 text-red-400"
+                                    }`}
+                                    title={`健康评分 ${c.health.score}（${c.health.samples} 次样本${
+                                      c.health.tokens_per_second
+                                        ? `，${c.health.tokens_per_second} tokens/s`
+                                        : ""
+                                    }）`}
+                                  >
+                                    {Math.round(c.health.success_rate * 100)}% ·{" "}
+                                    {(c.health.ttfb_ms / 1000).toFixed(1)}s
+                                  </span>
+                                )}
                               </div>
                             </td>
                             <td className="text-xs text-gray-500 max-w-xs truncate">
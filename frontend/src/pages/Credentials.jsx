@@ -42,7 +42,7 @@ export default function Credentials() {
 
   // CD 实时倒计时
   useEffect(() => {
-    const hasCD = credentials.some(c => c.cd_flash > 0 || c.cd_pro > 0 || c.cd_30 > 0)
+    const hasCD = credentials.some(c => c.cd_flash > 0 || c.cd_pro > 0 || c.cd_30 > 0 || Object.keys(c.model_cooldowns || {}).length > 0)
     if (!hasCD) return
     
     const timer = setInterval(() => {
@@ -50,7 +50,12 @@ export default function Credentials() {
         ...c,
         cd_flash: Math.max(0, (c.cd_flash || 0) - 1),
         cd_pro: Math.max(0, (c.cd_pro || 0) - 1),
-        cd_30: Math.max(0, (c.cd_30 || 0) - 1)
+        cd_30: Math.max(0, (c.cd_30 || 0) - 1),
+        model_cooldowns: Object.fromEntries(
+          Object.entries(c.model_cooldowns || {})
+            .map(([model, left]) => [model, left - 1])
+            .filter(([, left]) => left > 0)
+        )
       })))
     }, 1000)
     
@@ -385,7 +390,7 @@ export default function Credentials() {
                       </div>
                       
                       {/* CD 状态行 */}
-                      {(cred.cd_flash > 0 || cred.cd_pro > 0 || cred.cd_30 > 0) && (
+                      {(cred.cd_flash > 0 || cred.cd_pro > 0 || cred.cd_30 > 0 || Object.keys(cred.model_cooldowns || {}).length > 0) && (
                         <div className="flex items-center gap-2 mb-1 flex-wrap">
                           {cred.cd_flash > 0 && (
                             <span className="text-xs px-2 py-0.5 bg-cyan-500/20 text-cyan-400 rounded">
@@ -402,6 +407,11 @@ export default function Credentials() {
                               3.0 CD: {cred.cd_30}s
                             </span>
                           )}
+                          {Object.entries(cred.model_cooldowns || {}).map(([model, left]) => (
+                            <span key={model} className="text-xs px-2 py-0.5 bg-red-500/20 text-red-400 rounded">
+                              429 {model}: {left}s
+                            </span>
+                          ))}
                         </div>
                       )}
                       
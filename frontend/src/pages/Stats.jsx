@@ -24,6 +24,7 @@ export default function Stats() {
   const [loading, setLoading] = useState(true);
   const [days, setDays] = useState(7);
   const [apiType, setApiType] = useState("all"); // all, cli, antigravity
+  const [upstream, setUpstream] = useState(null);
 
   // 报错统计相关状态
   const [errorStats, setErrorStats] = useState(null);
@@ -49,6 +50,7 @@ export default function Stats() {
       ),
       api.get(`/api/manage/stats/by-user?days=${days}`),
       api.get(`/api/manage/stats/daily?days=${days}`),
+      api.get("/api/admin/upstream/stats"),
     ]);
 
     // 检查是否有权限错误
@@ -77,6 +79,7 @@ export default function Stats() {
       setByUser(results[3].value.data.users || []);
     if (results[4].status === "fulfilled")
       setDaily(results[4].value.data.daily || []);
+    if (results[5].status === "fulfilled") setUpstream(results[5].value.data);
 
     setLoading(false);
   };
@@ -87,6 +90,17 @@ export default function Stats() {
     full_shared: "🍲 大锅饭",
   };
 
+  const breakerStateLabel = {
+    closed: { text: "正常", color: "bg-green-600" },
+    open: { text: "熔断中", color: "bg-red-600" },
+    half_open: { text: "探测中", color: "bg-yellow-600" },
+  };
+
+  // 熔断过或正在熔断的模型
+  const breakerModels = Object.entries(upstream?.model_breaker || {}).filter(
+    ([, item]) => item.state !== "closed" || item.trips > 0,
+  );
+
   // 获取报错统计
   const fetchErrorStats = async (page = 1) => {
     setErrorLoading(true);
@@ -414,6 +428,48 @@ export default function Stats() {
           </div>
         )}
 
+        {/* 模型熔断状态 */}
+        {upstream?.model_breaker && (
+          <div className="bg-gray-800 rounded-xl p-6 mb-8">
+            <h2 className="text-xl font-semibold mb-4">⛔ 模型配额熔断</h2>
+            {breakerModels.length === 0 ? (
+              <p className="text-gray-400">所有模型正常</p>
+            ) : (
+              <div className="space-y-2">
+                {breakerModels.map(([model, item]) => (
+                  <div
+                    key={model}
+                    className="flex flex-wrap items-center gap-3 text-sm"
+                  >
+                    <span
+                      className={`px-2 py-0.5 rounded text-xs text-white ${breakerStateLabel[item.state]?.color || "bg-gray-600"}`}
+                    >
+                      {breakerStateLabel[item.state]?.text || item.state}
+                    </span>
+                    <span className="text-gray-300 flex-1 truncate">
+                      {model}
+                    </span>
+                    {item.state === "open" && (
+                      <span className="text-red-300">
+                        {Math.ceil(item.retry_after_seconds)}s 后探测
+                      </span>
+                    )}
+                    <span className="text-gray-400">
+                      窗口耗尽 {item.window_exhausted}/{item.window_events}
+                    </span>
+                    <span className="text-gray-400">
+                      CD 中凭证 {item.cooling_credentials}
+                    </span>
+                    <span className="text-gray-400">
+                      熔断 {item.trips} 次 • 拒绝 {item.rejected} 次
+                    </span>
+                  </div>
+                ))}
+              </div>
+            )}
+          </div>
+        )}
+
         <div className="grid grid-cols-1 lg:grid-cols-2 gap-8">
           {/* 按模型统计 */}
           <div className="bg-gray-800 rounded-xl p-6">